@@ -0,0 +1,65 @@
+"""
+Bytes on the wire and latency of $batch responses per encoding and
+representation, for typical bundle sizes.
+
+Each row posts the same synthetic cohort to the in-process app and reports the
+response size as sent (after compression) and the median request latency.
+Encodings other than gzip appear when brotli / zstandard are installed.
+
+    python -m benchmarks.bench_compression [--sizes 10,100,1000] [--repeat 5]
+"""
+import argparse
+import json
+import statistics
+import time
+
+import httpx
+from fastapi.testclient import TestClient
+
+from benchmarks.cohorts import cohort_bundle, cohort_of
+from src import main as app_module
+from src.assessment_cache import AssessmentCache, LocalCacheBackend
+from src.compression import available_codecs
+from src.http_client import athena_http
+from src.session_store import session_store
+
+HEADERS = {"Content-Type": "application/fhir+json"}
+REPRESENTATIONS = {"full": {}, "_elements=prediction": {"_elements": "prediction"}, "_summary=true": {"_summary": "true"}}
+
+
+def measure(client: TestClient, body: str, encoding: str, params: dict, repeat: int):
+    timings, wire = [], 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.post("/RiskAssessment/$batch", content=body, params=params,
+                               headers={**HEADERS, "Accept-Encoding": encoding})
+        timings.append(time.perf_counter() - start)
+        wire = response.num_bytes_downloaded
+    return wire, statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10,100,1000", help="comma-separated bundle sizes (patients)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    athena_http.transport = httpx.MockTransport(lambda request: httpx.Response(200, json={"access_token": "abc"}))
+    app_module.assessment_cache = AssessmentCache(LocalCacheBackend(max_entries=0))
+    encodings = ["identity"] + [codec.name for codec in available_codecs()]
+    session = session_store.create_session({"access_token": "abc"})
+
+    print(f"{'patients':>8}  {'representation':<22}{'encoding':<10}{'bytes':>12}{'ratio':>8}{'p50 ms':>9}")
+    with TestClient(app_module.app, headers={"Authorization": f"Bearer {session.id}"}) as client:
+        for size in (int(size) for size in args.sizes.split(",")):
+            body = json.dumps(cohort_bundle(cohort_of(size)))
+            baseline = None
+            for name, params in REPRESENTATIONS.items():
+                for encoding in encodings:
+                    wire, latency = measure(client, body, encoding, params, args.repeat)
+                    baseline = baseline or wire
+                    print(f"{size:>8}  {name:<22}{encoding:<10}{wire:>12}{baseline / wire:>8.1f}{latency * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Overhead of explaining scores: per-factor contributions against plain scoring.
+
+Times the scalar scorer (``risk_score`` vs ``explain``, one patient at a
+time) and the batch scorer (``score_patients`` with and without
+``explain``) on the same synthetic cohorts, and exits non-zero when
+explaining costs the batch scorer, which every endpoint scores through, more
+than ``--max-overhead`` percent over plain scoring. The scalar overhead is
+reported only: a fraction of a microsecond per patient, it is a large share
+of a scorer that does little else and is within timing noise on a busy host.
+
+    python -m benchmarks.bench_explain [--sizes 1000,100000] [--repeat 15] [--max-overhead 10]
+"""
+import argparse
+import sys
+import time
+from typing import Dict, Tuple
+
+from benchmarks.cohorts import cohort_of
+from src.rules import current_rules
+from src.scoring import score_patients
+
+
+def compare(plain, explained, repeat: int) -> Tuple[float, float]:
+    """
+    Fastest of ``repeat`` runs of each, in ms. Runs alternate between the two
+    so drift in machine load affects both alike.
+    """
+    plain(), explained()  # warm up
+    timings = ([], [])
+    for _ in range(repeat):
+        for fn, runs in zip((plain, explained), timings):
+            started = time.perf_counter()
+            fn()
+            runs.append((time.perf_counter() - started) * 1000)
+    return min(timings[0]), min(timings[1])
+
+
+def measure(size: int, repeat: int) -> Dict[str, Tuple[float, float]]:
+    rules = current_rules()
+    patients = list(cohort_of(size).values())
+    sections = [(p["molecular_data"], p["clinical_data"], p["imaging_data"]) for p in patients]
+
+    def scalar(scorer):
+        def run():
+            # One patient at a time, results used and dropped, as in a request handler
+            for patient in sections:
+                scorer(*patient)
+        return run
+
+    return {
+        "scalar": compare(scalar(rules.risk_score), scalar(rules.explain), repeat),
+        "batch": compare(
+            lambda: score_patients(patients, rules), lambda: score_patients(patients, rules, explain=True), repeat
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1000,100000", help="comma-separated cohort sizes")
+    parser.add_argument("--repeat", type=int, default=15, help="timed runs of each scorer")
+    parser.add_argument("--max-overhead", type=float, default=10, help="allowed overhead in percent")
+    args = parser.parse_args()
+
+    print(f"{'patients':>9}{'scorer':>8}{'plain ms':>11}{'explain ms':>12}{'overhead':>10}")
+    failed = False
+    for size in (int(size) for size in args.sizes.split(",")):
+        for scorer, (plain, explained) in measure(size, args.repeat).items():
+            overhead = (explained / plain - 1) * 100
+            failed |= scorer == "batch" and overhead > args.max_overhead
+            print(f"{size:>9}{scorer:>8}{plain:>11.2f}{explained:>12.2f}{overhead:>9.1f}%")
+    if failed:
+        print(f"explaining costs batch scoring more than {args.max_overhead:g}% over plain scoring", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Allocation benchmark for the shared FHIR fragment registry.
+
+Builds 10k RiskAssessments with the constant codings / references rebuilt
+inline on every call (the pre-registry behaviour, reproduced below) and with
+the shared fragments from ``src.fhir_fragments``, and reports allocated and
+retained memory plus wall time for each.
+
+    python -m benchmarks.bench_fragments [--count 10000]
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+from fhir.resources.codeableconcept import CodeableConcept
+from fhir.resources.coding import Coding
+from fhir.resources.reference import Reference
+from fhir.resources.riskassessment import RiskAssessment
+
+from src.athena import map_to_risk_assessment
+from src.fast_fhir import risk_assessment_dict
+
+PATIENT_DATA = {
+    "clinical_data": {"pain": True, "swelling": True, "fever": False, "tumor_size": 6},
+    "imaging_data": {"mri_abnormalities": True, "pet_scan_high_activity": True},
+}
+SUBTYPES = ["Soft Tissue Sarcoma", "Osteosarcoma"]
+
+
+def model_inline(patient_id: str) -> RiskAssessment:
+    risk_assessment = map_to_risk_assessment(PATIENT_DATA, 0.93, "High", SUBTYPES, patient_id=patient_id)
+    risk_assessment.code = CodeableConcept(
+        coding=[Coding(system="http://snomed.info/sct", code="420324007", display="Sarcoma risk assessment")]
+    )
+    risk_assessment.basis = [
+        Reference(reference="Observation/clinical-data"),
+        Reference(reference="Observation/molecular-data"),
+        Reference(reference="Observation/tumor-size"),
+        Reference(reference="Observation/clinical-symptoms"),
+        Reference(reference="Observation/imaging-findings"),
+    ]
+    return risk_assessment
+
+
+def model_shared(patient_id: str) -> RiskAssessment:
+    return map_to_risk_assessment(PATIENT_DATA, 0.93, "High", SUBTYPES, patient_id=patient_id)
+
+
+def dict_inline(patient_id: str) -> dict:
+    resource = risk_assessment_dict(PATIENT_DATA, 0.93, "High", SUBTYPES, patient_id)
+    resource["code"] = {
+        "coding": [{"system": "http://snomed.info/sct", "code": "420324007", "display": "Sarcoma risk assessment"}]
+    }
+    resource["basis"] = [
+        {"reference": "Observation/clinical-data"},
+        {"reference": "Observation/molecular-data"},
+        {"reference": "Observation/tumor-size"},
+        {"reference": "Observation/clinical-symptoms"},
+        {"reference": "Observation/imaging-findings"},
+    ]
+    return resource
+
+
+def dict_shared(patient_id: str) -> dict:
+    return risk_assessment_dict(PATIENT_DATA, 0.93, "High", SUBTYPES, patient_id)
+
+
+def measure(build, count: int) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    kept = [build(str(i)) for i in range(count)]
+    elapsed = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return {"seconds": elapsed, "retained_bytes": retained, "peak_bytes": peak}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=10_000)
+    args = parser.parse_args()
+
+    print(f"{'variant':<14}{'time (s)':>10}{'retained KiB':>15}{'peak KiB':>12}")
+    for name, build in [("model-inline", model_inline), ("model-shared", model_shared),
+                        ("dict-inline", dict_inline), ("dict-shared", dict_shared)]:
+        result = measure(build, args.count)
+        print(f"{name:<14}{result['seconds']:>10.3f}{result['retained_bytes'] / 1024:>15.0f}"
+              f"{result['peak_bytes'] / 1024:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Validation + mapping cost per $batch request: ``patient_data`` dicts versus
+typed ``PatientRecord``s.
+
+Both paths parse the same synthetic Bundle, validate its Patients and
+Observations, score, hash and render the RiskAssessments (assessment cache
+off). "dicts" builds nested ``patient_data`` dicts (``group_patient_data``),
+"records" validates straight into ``PatientRecord``s (``ingest_records``), as
+the $batch endpoint does.
+
+    python -m benchmarks.bench_ingest [--sizes 1,10,100,1000] [--repeat 15]
+"""
+import argparse
+import json
+import timeit
+
+from benchmarks.cohorts import cohort_bundle, cohort_of
+from src.athena import assess_patients
+from src.fhir_ingest import group_patient_data, ingest_records, parse_resources
+
+PATHS = {"dicts": group_patient_data, "records": ingest_records}
+
+
+def request_cost(body: bytes, ingest, repeat: int) -> float:
+    """Best-of-``repeat`` seconds to validate and map one request body"""
+    def handle():
+        patients, errors = ingest(parse_resources(body))
+        return assess_patients(patients, errors)
+
+    number = max(1, 1000 // (body.count(b'"Patient"') or 1))
+    return min(timeit.repeat(handle, number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1,10,100,1000", help="comma-separated bundle sizes (patients)")
+    parser.add_argument("--repeat", type=int, default=15)
+    args = parser.parse_args()
+
+    print(f"{'patients':>8}{'dicts ms':>11}{'records ms':>12}{'speedup':>9}{'us/patient':>12}")
+    for size in (int(size) for size in args.sizes.split(",")):
+        body = json.dumps(cohort_bundle(cohort_of(size))).encode()
+        before, after = (request_cost(body, ingest, args.repeat) for ingest in PATHS.values())
+        print(f"{size:>8}{before * 1000:>11.3f}{after * 1000:>12.3f}{before / after:>9.2f}{after / size * 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Session lookup latency with several worker processes reading the store at once.
+
+Each worker process resolves random session ids (decrypting each record),
+the way ``get_oauth_token`` does per request, while a writer creates
+sessions at a steady rate (logins and token refreshes). The memory backend
+(every worker holding its own copy) is the baseline for the SQLite file the
+workers share.
+
+    python -m benchmarks.bench_sessions [--workers 1,2,4,8] [--lookups 20000] [--sessions 1000] [--writes 50]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from src.session_store import MemorySessionBackend, SessionCipher, SessionStore, SQLiteSessionBackend
+
+TOKEN_RESPONSE = {"access_token": "a" * 64, "token_type": "Bearer", "expires_in": 3600, "refresh_token": "r" * 64}
+
+
+def make_store(backend: str, path: str, key: bytes) -> SessionStore:
+    if backend == "memory":
+        return SessionStore(MemorySessionBackend(), SessionCipher([key]))
+    return SessionStore(SQLiteSessionBackend(path), SessionCipher([key]))
+
+
+def populate(store: SessionStore, sessions: int):
+    return [store.create_session(TOKEN_RESPONSE).id for _ in range(sessions)]
+
+
+def reader(backend: str, path: str, key: bytes, session_ids, lookups: int, start):
+    store = make_store(backend, path, key)
+    if backend == "memory":
+        session_ids = populate(store, len(session_ids))
+    rng = random.Random(os.getpid())
+    ids = [rng.choice(session_ids) for _ in range(lookups)]
+    timings = []
+    start.wait()
+    for session_id in ids:
+        begin = time.perf_counter_ns()
+        session = store.session(session_id)
+        timings.append(time.perf_counter_ns() - begin)
+        assert session is not None
+    return timings
+
+
+def writer(path: str, key: bytes, rate: float, stop):
+    store = make_store("sqlite", path, key)
+    while not stop.is_set():
+        store.create_session(TOKEN_RESPONSE)
+        time.sleep(1 / rate)
+
+
+def measure(backend: str, workers: int, lookups: int, sessions: int, writes: float):
+    key = SessionCipher.generate_key()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "sessions.sqlite3")
+        session_ids = populate(make_store(backend, path, key), sessions)
+        context = multiprocessing.get_context("spawn")
+        with context.Manager() as manager:
+            start, stop = manager.Event(), manager.Event()
+            background = context.Process(target=writer, args=(path, key, writes, stop)) if writes else None
+            with context.Pool(workers) as pool:
+                results = [pool.apply_async(reader, (backend, path, key, session_ids, lookups, start))
+                           for _ in range(workers)]
+                time.sleep(1)  # let every worker open the store before the clock starts
+                if background is not None:
+                    background.start()
+                begin = time.perf_counter()
+                start.set()
+                timings = [timing for result in results for timing in result.get()]
+                elapsed = time.perf_counter() - begin
+            stop.set()
+            if background is not None:
+                background.join()
+    timings.sort()
+    return statistics.median(timings) / 1000, timings[int(len(timings) * 0.99)] / 1000, len(timings) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4,8", help="comma-separated worker process counts")
+    parser.add_argument("--lookups", type=int, default=20_000, help="lookups per worker")
+    parser.add_argument("--sessions", type=int, default=1_000, help="sessions in the store")
+    parser.add_argument("--writes", type=float, default=50, help="sessions created per second while reading (0: none)")
+    args = parser.parse_args()
+
+    print(f"{'backend':<8}{'workers':>8}{'p50 us':>9}{'p99 us':>9}{'lookups/s':>12}")
+    for backend in ("memory", "sqlite"):
+        for workers in (int(workers) for workers in args.workers.split(",")):
+            writes = args.writes if backend == "sqlite" else 0
+            p50, p99, rate = measure(backend, workers, args.lookups, args.sessions, writes)
+            print(f"{backend:<8}{workers:>8}{p50:>9.1f}{p99:>9.1f}{rate:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Synthetic cohorts for the benchmarks and load tests: ``patient_data`` dicts
+and the equivalent FHIR resources, generated from a fixed seed so every run
+scores the same patients.
+
+Patients are drawn from a referral population: about ``CASE_PREVALENCE`` of
+them have a sarcoma and the rest a benign lesion. Cases have larger tumours
+(log-normal, median ~8 cm vs ~3.5 cm), higher serum VEGF, more TP53 and
+CDKN2A alterations and more abnormal imaging; symptoms become more likely as
+the tumour grows. Not every patient has every test: VEGF is missing for some
+and each imaging modality is only present when it was performed.
+
+Write a cohort to a file with
+
+    python -m benchmarks.cohorts --size 10000 [--seed 0] [--format records|ndjson|bundle] [--output cohort.ndjson]
+
+``records`` is one ``patient_data`` object per line (the ``$export`` input),
+``ndjson`` the Patient and Observation resources one per line and ``bundle``
+a FHIR batch Bundle of them (both accepted by ``$batch``).
+"""
+import argparse
+import json
+import random
+import sys
+from typing import Dict, Iterator, List, Tuple
+
+FEATURE_SYSTEM = "http://example.com/sarcrisk-features"
+
+COHORT_SIZES = (1, 1_000, 100_000)
+
+CASE_PREVALENCE = 0.1
+
+FAMILY_NAMES = ("Doe", "Roe", "Smith", "Garcia", "Nguyen", "Okafor", "Kowalski", "Haddad", "Tanaka", "Silva")
+GIVEN_NAMES = ("Jane", "John", "Maria", "Wei", "Amara", "Luca", "Fatima", "Noah", "Aiko", "Diego")
+
+# (median, sigma) of the log-normal distributions, for (benign, case) patients
+TUMOR_SIZE_CM = ((3.5, 0.5), (8.0, 0.45))
+VEGF_PG_ML = ((70.0, 0.45), (140.0, 0.5))
+VEGF_MEASURED = 0.8
+
+# Prevalence of each flag in (benign, case) patients
+MOLECULAR_FLAGS = {"CDKN2A_mutation": (0.02, 0.15), "TP53_mutation": (0.02, 0.2)}
+IMAGING_FLAGS = {
+    "mri_abnormalities": (0.25, 0.85),
+    "ct_scan_abnormalities": (0.1, 0.55),
+    "pet_scan_high_activity": (0.05, 0.6),
+    "x_ray_findings": (0.1, 0.35),
+}
+# Share of patients who had each imaging study
+IMAGING_PERFORMED = {
+    "mri_abnormalities": 0.9, "ct_scan_abnormalities": 0.6, "pet_scan_high_activity": 0.3, "x_ray_findings": 0.7,
+}
+
+# Observation search category under which each section's inputs are filed (see ``athena_fhir``)
+SECTION_CATEGORIES = {"molecular_data": "laboratory", "clinical_data": "exam", "imaging_data": "imaging"}
+
+
+def _log_normal(rng: random.Random, median: float, sigma: float) -> float:
+    return median * rng.lognormvariate(0, sigma)
+
+
+def make_patient(rng: random.Random) -> dict:
+    case = rng.random() < CASE_PREVALENCE
+    tumor_size = min(max(round(_log_normal(rng, *TUMOR_SIZE_CM[case]), 1), 0.3), 30.0)
+    molecular_data = {}
+    if rng.random() < VEGF_MEASURED:
+        molecular_data["VEGF_level"] = round(_log_normal(rng, *VEGF_PG_ML[case]), 1)
+    for flag, prevalence in MOLECULAR_FLAGS.items():
+        molecular_data[flag] = rng.random() < prevalence[case]
+    return {
+        "name": {"family": rng.choice(FAMILY_NAMES), "given": [rng.choice(GIVEN_NAMES)]},
+        "molecular_data": molecular_data,
+        "clinical_data": {
+            "pain": rng.random() < min(0.3 + 0.04 * tumor_size, 0.9),
+            "swelling": rng.random() < min(0.4 + 0.05 * tumor_size, 0.95),
+            "fever": rng.random() < (0.08 if case else 0.04),
+            "tumor_size": tumor_size,
+        },
+        "imaging_data": {
+            flag: rng.random() < prevalence[case]
+            for flag, prevalence in IMAGING_FLAGS.items() if rng.random() < IMAGING_PERFORMED[flag]
+        },
+    }
+
+
+def iter_cohort(size: int, seed: int = 0) -> Iterator[Tuple[str, dict]]:
+    """``(patient_id, patient_data)`` for ``size`` synthetic patients, generated lazily"""
+    rng = random.Random(seed)
+    for i in range(size):
+        yield f"p{i}", make_patient(rng)
+
+
+def make_cohort(size: int, seed: int = 0) -> Dict[str, dict]:
+    """``{patient_id: patient_data}`` for ``size`` synthetic patients"""
+    return dict(iter_cohort(size, seed))
+
+
+_cohorts: Dict[int, Dict[str, dict]] = {}
+
+
+def cohort_of(size: int) -> Dict[str, dict]:
+    """``make_cohort(size)``, generated once per session"""
+    if size not in _cohorts:
+        _cohorts[size] = make_cohort(size)
+    return _cohorts[size]
+
+
+def _observation(patient_id: str, code: str, value) -> dict:
+    observation = {
+        "resourceType": "Observation",
+        "status": "final",
+        "code": {"coding": [{"system": FEATURE_SYSTEM, "code": code}]},
+        "subject": {"reference": f"Patient/{patient_id}"},
+    }
+    if isinstance(value, bool):
+        observation["valueBoolean"] = value
+    else:
+        observation["valueQuantity"] = {"value": value}
+    return observation
+
+
+def patient_resource(patient_id: str, patient_data: dict) -> dict:
+    return {"resourceType": "Patient", "id": patient_id, "name": [patient_data["name"]]}
+
+
+def section_observations(patient_id: str, patient_data: dict, section: str) -> List[dict]:
+    """Observations carrying one section of a patient's scoring inputs"""
+    return [_observation(patient_id, code, value) for code, value in patient_data[section].items()]
+
+
+def patient_resources(patient_id: str, patient_data: dict) -> List[dict]:
+    """The Patient and the Observations carrying its scoring inputs"""
+    resources = [patient_resource(patient_id, patient_data)]
+    for section in SECTION_CATEGORIES:
+        resources.extend(section_observations(patient_id, patient_data, section))
+    return resources
+
+
+def cohort_resources(cohort: Dict[str, dict]) -> List[dict]:
+    """Patient and Observation resources carrying the cohort's scoring inputs"""
+    return [resource for patient_id, patient_data in cohort.items()
+            for resource in patient_resources(patient_id, patient_data)]
+
+
+def cohort_bundle(cohort: Dict[str, dict]) -> dict:
+    return {"resourceType": "Bundle", "type": "batch", "entry": [{"resource": r} for r in cohort_resources(cohort)]}
+
+
+def write_cohort(out, size: int, seed: int = 0, format: str = "records") -> None:
+    """Stream a cohort to the text file ``out`` without holding it in memory"""
+    patients = iter_cohort(size, seed)
+    if format == "records":
+        for patient_id, patient_data in patients:
+            out.write(json.dumps({"id": patient_id, **patient_data}) + "\n")
+    elif format == "ndjson":
+        for patient_id, patient_data in patients:
+            for resource in patient_resources(patient_id, patient_data):
+                out.write(json.dumps(resource) + "\n")
+    elif format == "bundle":
+        out.write('{"resourceType": "Bundle", "type": "batch", "entry": [')
+        separator = ""
+        for patient_id, patient_data in patients:
+            for resource in patient_resources(patient_id, patient_data):
+                out.write(separator + json.dumps({"resource": resource}))
+                separator = ", "
+        out.write("]}\n")
+    else:
+        raise ValueError(f"Unknown cohort format {format!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a seeded synthetic cohort")
+    parser.add_argument("--size", type=int, default=1_000, help="number of patients")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", choices=("records", "ndjson", "bundle"), default="records")
+    parser.add_argument("--output", help="file to write (default: stdout)")
+    args = parser.parse_args()
+
+    if args.output is None:
+        write_cohort(sys.stdout, args.size, args.seed, args.format)
+        return
+    with open(args.output, "w") as out:
+        write_cohort(out, args.size, args.seed, args.format)
+
+
+if __name__ == "__main__":
+    main()
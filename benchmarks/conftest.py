@@ -0,0 +1,47 @@
+import time
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from benchmarks.cohorts import COHORT_SIZES, cohort_of
+from src import main
+from src.assessment_cache import AssessmentCache, LocalCacheBackend
+from src.http_client import athena_http
+from src.main import app
+from src.session_store import session_store
+
+
+@pytest.fixture(params=COHORT_SIZES, ids=lambda size: f"{size}-patients")
+def cohort(request):
+    return cohort_of(request.param)
+
+
+@pytest.fixture
+def run(benchmark):
+    """Benchmark ``fn``; large cohorts get a few fixed rounds instead of pytest-benchmark's calibration"""
+    def runner(fn, *args, size: int = 1):
+        if size >= 100_000:
+            return benchmark.pedantic(fn, args=args, rounds=3, iterations=1, warmup_rounds=1)
+        return benchmark(fn, *args)
+
+    return runner
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """
+    In-process app with the shared Athena client routed to a mocked token
+    endpoint, a session for the benchmarks' bearer token (``bench-token``) and
+    the assessment cache disabled, so every request is scored
+    """
+    def token_endpoint(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json={"access_token": "abc", "token_type": "Bearer", "expires_in": 3600})
+
+    monkeypatch.setattr(athena_http, "transport", httpx.MockTransport(token_endpoint))
+    monkeypatch.setattr(main, "assessment_cache", AssessmentCache(LocalCacheBackend(max_entries=0)))
+    expires_at = time.time() + 3600
+    session_store.save("session", "bench-token", {"access_token": "abc", "expires_at": expires_at}, expires_at)
+    with TestClient(app) as client:
+        yield client
+    session_store.end_session("bench-token")
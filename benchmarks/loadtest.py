@@ -0,0 +1,158 @@
+"""
+Load test for the multi-worker serving mode.
+
+Starts the app under gunicorn (``gunicorn.conf.py``) with each requested
+worker count, drives the health check (``GET /``) and the scoring endpoint
+(``POST /RiskAssessment/$batch``) with concurrent keep-alive clients, and
+reports requests/sec and latency percentiles so scaling with worker count is
+visible. The clients authenticate with a session opened in an encrypted
+session store that the server is pointed at.
+
+    python -m benchmarks.loadtest [--workers 1 2 4] [--duration 10] [--concurrency 64]
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict
+
+import httpx
+
+from src.session_store import SessionCipher, SessionStore, SQLiteSessionBackend
+
+
+def observation(code, **value):
+    return {
+        "resourceType": "Observation",
+        "status": "final",
+        "code": {"coding": [{"system": "http://example.com/sarcrisk-features", "code": code}]},
+        "subject": {"reference": "Patient/p1"},
+        **value,
+    }
+
+
+SCORING_BODY = json.dumps({
+    "resourceType": "Bundle",
+    "type": "batch",
+    "entry": [{"resource": r} for r in (
+        {"resourceType": "Patient", "id": "p1", "name": [{"family": "Doe", "given": ["Jane"]}]},
+        observation("VEGF_level", valueQuantity={"value": 120, "unit": "pg/mL"}),
+        observation("CDKN2A_mutation", valueBoolean=True),
+        observation("pain", valueBoolean=True),
+        observation("tumor_size", valueQuantity={"value": 6, "unit": "cm"}),
+        observation("mri_abnormalities", valueBoolean=True),
+    )],
+})
+
+ENDPOINTS = {
+    "health": ("GET", "/", {}, None),
+    "scoring": ("POST", "/RiskAssessment/$batch", {"Content-Type": "application/fhir+json"}, SCORING_BODY),
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def open_session(env: Dict[str, str]) -> Dict[str, str]:
+    """Authorization header of a new session, in a session store ``env`` points the server at (with a fresh cache)"""
+    key = SessionCipher.generate_key()
+    directory = tempfile.mkdtemp(prefix="sarcrisk-loadtest-")
+    path = os.path.join(directory, "sessions.sqlite3")
+    env.update(SARCRISK_SESSION_BACKEND="sqlite", SARCRISK_SESSION_KEYS=key.decode(), SARCRISK_SESSION_PATH=path,
+               SARCRISK_CACHE_PATH=os.path.join(directory, "cache.sqlite3"))
+    store = SessionStore(SQLiteSessionBackend(path), SessionCipher([key]))
+    session = store.create_session({"access_token": "load-test"})
+    return {"Authorization": f"Bearer {session.id}"}
+
+
+def start_server(workers: int, port: int, env: Dict[str, str]) -> subprocess.Popen:
+    env = {**os.environ, **env, "WEB_CONCURRENCY": str(workers)}
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "src.main:app", "--bind", f"127.0.0.1:{port}"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/").status_code == 200:
+                return server
+        except httpx.TransportError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("server did not become ready")
+
+
+def stop_server(server: subprocess.Popen) -> None:
+    server.send_signal(signal.SIGTERM)
+    server.wait(timeout=60)
+
+
+async def drive(base_url: str, endpoint: str, duration: float, concurrency: int, auth: Dict[str, str]):
+    method, path, headers, body = ENDPOINTS[endpoint]
+    headers = {**auth, **headers}
+    latencies = []
+    failures = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        deadline = time.monotonic() + duration
+
+        async def user():
+            nonlocal failures
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                response = await client.request(method, path, headers=headers, content=body)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    failures += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "failures": failures,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--endpoints", nargs="+", choices=sorted(ENDPOINTS), default=sorted(ENDPOINTS))
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per endpoint")
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    env: Dict[str, str] = {}
+    auth = open_session(env)
+    print(f"{os.cpu_count()} CPUs, {args.concurrency} concurrent clients, {args.duration:.0f}s per run")
+    print(f"{'workers':>7} {'endpoint':>8} {'requests':>9} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'failed':>6}")
+    for workers in args.workers:
+        port = free_port()
+        server = start_server(workers, port, env)
+        try:
+            for endpoint in args.endpoints:
+                result = asyncio.run(drive(f"http://127.0.0.1:{port}", endpoint, args.duration, args.concurrency, auth))
+                print(f"{workers:>7} {endpoint:>8} {result['requests']:>9} {result['rps']:>9.0f} "
+                      f"{result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f} {result['failures']:>6}")
+        finally:
+            stop_server(server)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+Replay harness: drives the app at a target request rate with synthetic patients.
+
+Requests are sent open-loop, on a fixed schedule of ``--rps`` per second,
+whatever the app's latency, and each latency is measured from the moment the
+request was due, so a stalled server shows up as latency rather than as a
+lower request rate. Every request is one of the ``--mix`` scenarios, picked
+at random in proportion to its weight:
+
+    batch        POST /RiskAssessment/$batch with --batch-size patients
+    transaction  POST /RiskAssessment/$transaction with --batch-size patients
+    patient      GET /Patient/{id}/$risk-assessment, fetched from Athena
+    health       GET /
+
+Patients come from the seeded cohort generator (``benchmarks.cohorts``), and
+Athena is replaced by an in-process stub that issues OAuth tokens and serves
+the cohort over FHIR, optionally after ``--athena-latency`` ms. Requests are
+made under a session opened in the app's session store for the replay. The app runs
+in this process, called either through its ASGI interface (``--mode
+inprocess``) or over a localhost socket served by uvicorn (``--mode
+localhost``). The report (throughput, latency percentiles, status codes and
+error rate per scenario) is written as JSON.
+
+    python -m benchmarks.replay [--mode inprocess|localhost] [--rps 50] [--duration 10]
+        [--mix batch=1,patient=1] [--batch-size 10] [--seed 0] [--output report.json]
+"""
+import argparse
+import asyncio
+import json
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+import uvicorn
+
+from benchmarks.cohorts import (
+    SECTION_CATEGORIES, cohort_bundle, make_cohort, patient_resource, section_observations,
+)
+from src import main as app_module
+from src.assessment_cache import AssessmentCache, LocalCacheBackend
+from src.athena_fhir import ATHENA_FHIR_BASE_URL
+from src.http_client import athena_http
+from src.session_store import session_store
+from src.upstream import RateLimiter
+
+
+SCENARIOS = ("batch", "transaction", "patient", "health")
+PERCENTILES = (50, 90, 99)
+
+
+class AthenaStub:
+    """Athena's OAuth token endpoint and FHIR API, serving a synthetic cohort"""
+
+    def __init__(self, cohort: Dict[str, dict], latency: float = 0.0, fhir_base_url: str = ATHENA_FHIR_BASE_URL):
+        self.cohort = cohort
+        self.latency = latency
+        self.fhir_path = urlsplit(fhir_base_url).path.rstrip("/")
+        self.categories = {category: section for section, category in SECTION_CATEGORIES.items()}
+        self.requests = 0
+
+    def read(self, path: str, params: Dict[str, str]) -> Tuple[int, dict]:
+        resource_type, _, resource_id = path.strip("/").partition("/")
+        if resource_type == "Observation":
+            patient_id, section = params.get("patient"), self.categories.get(params.get("category"))
+            observations = []
+            if patient_id in self.cohort and section is not None:
+                observations = section_observations(patient_id, self.cohort[patient_id], section)
+            entries = [{"resource": observation} for observation in observations]
+            return 200, {"resourceType": "Bundle", "type": "searchset", "entry": entries}
+        if resource_type == "Patient" and resource_id in self.cohort:
+            return 200, patient_resource(resource_id, self.cohort[resource_id])
+        return 404, {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "not-found"}]}
+
+    def batch(self, body: dict) -> dict:
+        entries = []
+        for entry in body.get("entry") or []:
+            url = httpx.URL(entry["request"]["url"])
+            status, resource = self.read(url.path, dict(url.params))
+            entries.append({"resource": resource, "response": {"status": str(status)}})
+        return {"resourceType": "Bundle", "type": "batch-response", "entry": entries}
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if request.url.path.endswith("/oauth2/token"):
+            return httpx.Response(200, json={"access_token": "stub-token", "token_type": "Bearer", "expires_in": 3600})
+        if not request.url.path.startswith(self.fhir_path):
+            return httpx.Response(404)
+        path = request.url.path[len(self.fhir_path):]
+        if request.method == "POST" and not path.strip("/"):
+            return httpx.Response(200, json=self.batch(json.loads(request.content)))
+        status, body = self.read(path, dict(request.url.params))
+        return httpx.Response(status, json=body)
+
+
+class Workload:
+    """Seeded stream of requests over a cohort"""
+
+    def __init__(self, cohort: Dict[str, dict], mix: Dict[str, float], batch_size: int = 10, seed: int = 0,
+                 session_id: str = "load-test"):
+        self.patient_ids = list(cohort)
+        self.cohort = cohort
+        self.mix = {scenario: weight for scenario, weight in mix.items() if weight > 0}
+        self.batch_size = batch_size
+        self.rng = random.Random(seed)
+        self.auth = {"Authorization": f"Bearer {session_id}"}
+        self.fhir_headers = {**self.auth, "Content-Type": "application/fhir+json"}
+
+    def _bundle(self) -> bytes:
+        patient_ids = self.rng.sample(self.patient_ids, min(self.batch_size, len(self.patient_ids)))
+        return json.dumps(cohort_bundle({patient_id: self.cohort[patient_id] for patient_id in patient_ids})).encode()
+
+    def next(self) -> Tuple[str, str, str, dict, Optional[bytes]]:
+        """``(scenario, method, path, headers, body)`` of the next request"""
+        scenario = self.rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        if scenario == "batch":
+            return scenario, "POST", "/RiskAssessment/$batch", self.fhir_headers, self._bundle()
+        if scenario == "transaction":
+            return scenario, "POST", "/RiskAssessment/$transaction", self.fhir_headers, self._bundle()
+        if scenario == "patient":
+            return scenario, "GET", f"/Patient/{self.rng.choice(self.patient_ids)}/$risk-assessment", self.auth, None
+        return scenario, "GET", "/", {}, None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@asynccontextmanager
+async def serve(mode: str) -> AsyncIterator[httpx.AsyncClient]:
+    """A client for the app, running in this process under ``mode``"""
+    app = app_module.app
+    if mode == "inprocess":
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://replay", timeout=60) as client:
+                yield client
+        return
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    try:
+        deadline = time.monotonic() + 30
+        while not server.started:
+            if not thread.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError("server did not become ready")
+            await asyncio.sleep(0.05)
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60) as client:
+            yield client
+    finally:
+        server.should_exit = True
+        await asyncio.to_thread(thread.join, 30)
+
+
+def summarize(samples: List[Tuple[float, int]], elapsed: float) -> dict:
+    """Report for ``(latency_seconds, status_code)`` samples; status 0 is a transport error"""
+    latencies = sorted(latency * 1000 for latency, _ in samples)
+    statuses = Counter(status for _, status in samples)
+    errors = sum(count for status, count in statuses.items() if not 200 <= status < 300)
+    report = {
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": errors / len(samples) if samples else 0.0,
+        "throughput_rps": len(samples) / elapsed if elapsed else 0.0,
+        "status_codes": {str(status): count for status, count in sorted(statuses.items())},
+        "latency_ms": {},
+    }
+    if latencies:
+        report["latency_ms"] = {
+            "mean": statistics.fmean(latencies),
+            **{f"p{p}": latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] for p in PERCENTILES},
+            "max": latencies[-1],
+        }
+    return report
+
+
+async def replay(mode: str = "inprocess", rps: float = 50, duration: float = 10,
+                 mix: Optional[Dict[str, float]] = None, batch_size: int = 10, cohort_size: int = 1_000,
+                 seed: int = 0, athena_latency: float = 0.0, cache: bool = False) -> dict:
+    """Run one replay and return its report"""
+    mix = mix or {"batch": 1, "patient": 1}
+    cohort = make_cohort(cohort_size, seed)
+    stub = AthenaStub(cohort, athena_latency / 1000)
+    # The session the load is sent under, as /callback would have opened it
+    session = session_store.create_session({"access_token": "stub-token", "expires_in": duration + 3600})
+    workload = Workload(cohort, mix, batch_size, seed, session.id)
+    total = int(rps * duration)
+    # Built up front so generating bodies does not delay the schedule
+    requests = [workload.next() for _ in range(total)]
+
+    # Athena is the stub, without the per-practice rate limit; the assessment cache is off unless asked for
+    saved = athena_http.transport, athena_http.rate_limiter, app_module.assessment_cache
+    athena_http.transport, athena_http.rate_limiter = httpx.MockTransport(stub), RateLimiter(rate=0)
+    if not cache:
+        app_module.assessment_cache = AssessmentCache(LocalCacheBackend(max_entries=0))
+    samples: Dict[str, List[Tuple[float, int]]] = {scenario: [] for scenario in workload.mix}
+    try:
+        async with serve(mode) as client:
+            async def send(due: float, scenario: str, method: str, path: str, headers: dict, body: Optional[bytes]):
+                try:
+                    response = await client.request(method, path, headers=headers, content=body)
+                    status = response.status_code
+                except httpx.HTTPError:
+                    status = 0
+                samples[scenario].append((time.perf_counter() - due, status))
+
+            tasks = []
+            started = time.perf_counter()
+            for i, request in enumerate(requests):
+                due = started + i / rps
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(send(due, *request)))
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+    finally:
+        athena_http.transport, athena_http.rate_limiter, app_module.assessment_cache = saved
+        session_store.end_session(session.id)
+
+    return {
+        "config": {
+            "mode": mode, "target_rps": rps, "duration_s": duration, "mix": workload.mix, "batch_size": batch_size,
+            "cohort_size": cohort_size, "seed": seed, "athena_latency_ms": athena_latency, "cache": cache,
+        },
+        "elapsed_s": elapsed,
+        "athena_requests": stub.requests,
+        "total": summarize([sample for group in samples.values() for sample in group], elapsed),
+        "scenarios": {scenario: summarize(group, elapsed) for scenario, group in samples.items()},
+    }
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        scenario, _, weight = part.partition("=")
+        if scenario not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {scenario!r}; choose from {', '.join(SCENARIOS)}")
+        mix[scenario] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=("inprocess", "localhost"), default="inprocess")
+    parser.add_argument("--rps", type=float, default=50, help="target requests per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of requests to send")
+    parser.add_argument("--mix", type=parse_mix, default="batch=1,patient=1", help="scenario=weight,...")
+    parser.add_argument("--batch-size", type=int, default=10, help="patients per $batch / $transaction request")
+    parser.add_argument("--cohort-size", type=int, default=1_000, help="patients known to the Athena stub")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--athena-latency", type=float, default=0.0, help="ms added to every Athena response")
+    parser.add_argument("--cache", action="store_true", help="keep the assessment cache enabled")
+    parser.add_argument("--output", help="file for the JSON report (default: stdout)")
+    args = parser.parse_args()
+
+    report = asyncio.run(replay(
+        args.mode, args.rps, args.duration, args.mix, args.batch_size, args.cohort_size, args.seed,
+        args.athena_latency, args.cache,
+    ))
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    with open(args.output, "w") as out:
+        json.dump(report, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
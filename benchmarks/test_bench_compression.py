@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+from benchmarks.cohorts import cohort_bundle, cohort_of
+from src.athena import build_risk_assessment_bundle
+from src.compression import available_codecs
+
+AUTH = {"Authorization": "Bearer bench-token"}
+
+# Typical $batch sizes sent by a clinic site
+BUNDLE_SIZES = (10, 100, 1_000)
+CODECS = {codec.name: codec for codec in available_codecs()}
+REPRESENTATIONS = {"full": {}, "prediction-only": {"_elements": "prediction"}}
+
+
+def response_body(size: int) -> bytes:
+    return build_risk_assessment_bundle(cohort_of(size), []).encode()
+
+
+@pytest.mark.benchmark(group="compress")
+@pytest.mark.parametrize("encoding", sorted(CODECS))
+@pytest.mark.parametrize("size", BUNDLE_SIZES, ids=lambda size: f"{size}-patients")
+def test_compress_response_bundle(benchmark, size, encoding):
+    body = response_body(size)
+    compressed = benchmark(CODECS[encoding].compress, body)
+    benchmark.extra_info.update(bytes=len(body), compressed_bytes=len(compressed), ratio=len(body) / len(compressed))
+
+
+@pytest.mark.benchmark(group="endpoint-batch-wire")
+@pytest.mark.parametrize("representation", sorted(REPRESENTATIONS))
+@pytest.mark.parametrize("encoding", ["identity"] + sorted(CODECS))
+@pytest.mark.parametrize("size", BUNDLE_SIZES, ids=lambda size: f"{size}-patients")
+def test_risk_assessment_batch_on_the_wire(benchmark, client, size, encoding, representation):
+    body = json.dumps(cohort_bundle(cohort_of(size)))
+    headers = {**AUTH, "Content-Type": "application/fhir+json", "Accept-Encoding": encoding}
+
+    response = benchmark(client.post, "/RiskAssessment/$batch", content=body, headers=headers,
+                         params=REPRESENTATIONS[representation])
+    assert response.status_code == 200
+    benchmark.extra_info["bytes_on_wire"] = response.num_bytes_downloaded
@@ -0,0 +1,29 @@
+import json
+
+import pytest
+
+from benchmarks.cohorts import cohort_bundle, cohort_of
+
+AUTH = {"Authorization": "Bearer bench-token"}
+
+
+@pytest.mark.benchmark(group="endpoint")
+def test_health(benchmark, client):
+    response = benchmark(client.get, "/")
+    assert response.status_code == 200
+
+
+@pytest.mark.benchmark(group="endpoint")
+def test_callback_token_exchange(benchmark, client):
+    response = benchmark(client.get, "/callback", params={"code": "bench"})
+    assert response.json()["session_id"]
+
+
+@pytest.mark.benchmark(group="endpoint-batch")
+@pytest.mark.parametrize("size", [1, 1_000], ids=lambda size: f"{size}-patients")
+def test_risk_assessment_batch(benchmark, client, size):
+    body = json.dumps(cohort_bundle(cohort_of(size)))
+    headers = {**AUTH, "Content-Type": "application/fhir+json"}
+
+    response = benchmark(client.post, "/RiskAssessment/$batch", content=body, headers=headers)
+    assert response.status_code == 200
@@ -0,0 +1,56 @@
+import pytest
+
+from benchmarks.cohorts import cohort_of
+from src.athena import map_to_observation, map_to_patient, map_to_risk_assessment
+from src.fast_fhir import render_observation, render_patient, render_risk_assessment
+
+PATIENT = cohort_of(1)["p0"]
+SUBTYPES = ["Soft Tissue Sarcoma", "Osteosarcoma"]
+
+
+@pytest.mark.benchmark(group="map")
+def test_map_to_risk_assessment(benchmark):
+    benchmark(map_to_risk_assessment, PATIENT, 0.72, "High", SUBTYPES, "p0")
+
+
+@pytest.mark.benchmark(group="map")
+def test_map_to_observation(benchmark):
+    benchmark(map_to_observation, "clinical", PATIENT["clinical_data"], "7530005", "Tumor Size", "p0")
+
+
+@pytest.mark.benchmark(group="map")
+def test_map_to_patient(benchmark):
+    benchmark(map_to_patient, PATIENT, "p0")
+
+
+@pytest.mark.benchmark(group="serialize-model")
+def test_risk_assessment_model_json(benchmark):
+    resource = map_to_risk_assessment(PATIENT, 0.72, "High", SUBTYPES, "p0")
+    benchmark(resource.json)
+
+
+@pytest.mark.benchmark(group="serialize-model")
+def test_observation_model_json(benchmark):
+    resource = map_to_observation("clinical", PATIENT["clinical_data"], "7530005", "Tumor Size", "p0")
+    benchmark(resource.json)
+
+
+@pytest.mark.benchmark(group="serialize-model")
+def test_patient_model_json(benchmark):
+    resource = map_to_patient(PATIENT, "p0")
+    benchmark(resource.json)
+
+
+@pytest.mark.benchmark(group="serialize-fast")
+def test_render_risk_assessment(benchmark):
+    benchmark(render_risk_assessment, PATIENT, 0.72, "High", SUBTYPES, "p0")
+
+
+@pytest.mark.benchmark(group="serialize-fast")
+def test_render_observation(benchmark):
+    benchmark(render_observation, "clinical", PATIENT["clinical_data"], "7530005", "Tumor Size", "p0")
+
+
+@pytest.mark.benchmark(group="serialize-fast")
+def test_render_patient(benchmark):
+    benchmark(render_patient, PATIENT, "p0")
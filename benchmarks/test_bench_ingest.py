@@ -0,0 +1,25 @@
+import json
+
+import pytest
+
+from benchmarks.cohorts import cohort_bundle, cohort_of
+from src.athena import assess_patients
+from src.fhir_ingest import group_patient_data, ingest_records, parse_resources
+
+# Typical $batch sizes sent by a clinic site
+BUNDLE_SIZES = (1, 100, 1_000)
+PATHS = {"dicts": group_patient_data, "records": ingest_records}
+
+
+@pytest.mark.benchmark(group="ingest")
+@pytest.mark.parametrize("path", sorted(PATHS))
+@pytest.mark.parametrize("size", BUNDLE_SIZES, ids=lambda size: f"{size}-patients")
+def test_validate_and_map_request(benchmark, size, path):
+    body = json.dumps(cohort_bundle(cohort_of(size))).encode()
+
+    def handle():
+        patients, errors = PATHS[path](parse_resources(body))
+        return assess_patients(patients, errors)
+
+    assessments, errors = benchmark(handle)
+    assert len(assessments) == size and not errors
@@ -0,0 +1,50 @@
+import pytest
+
+from benchmarks.cohorts import cohort_of
+from src.athena import build_risk_assessment_bundle
+from src.feature_store import FeatureStore
+from src.scoring import calculate_risk_score_with_symptoms_and_imaging, categorize_risk, score_patients
+
+PATIENT = cohort_of(1)["p0"]
+
+
+@pytest.mark.benchmark(group="scoring-single")
+def test_score_single_patient(benchmark):
+    def score():
+        total = calculate_risk_score_with_symptoms_and_imaging(
+            PATIENT["molecular_data"], PATIENT["clinical_data"], PATIENT["imaging_data"]
+        )
+        return categorize_risk(total)
+
+    assert benchmark(score) in ("High", "Medium", "Low")
+
+
+@pytest.mark.benchmark(group="scoring-scalar-loop")
+def test_score_cohort_scalar(run, cohort):
+    def score():
+        return [
+            calculate_risk_score_with_symptoms_and_imaging(p["molecular_data"], p["clinical_data"], p["imaging_data"])
+            for p in cohort.values()
+        ]
+
+    assert len(run(score, size=len(cohort))) == len(cohort)
+
+
+@pytest.mark.benchmark(group="scoring-batch")
+def test_score_cohort_batch(run, cohort):
+    scores = run(score_patients, list(cohort.values()), size=len(cohort))
+    assert len(scores) == len(cohort)
+
+
+@pytest.mark.benchmark(group="scoring-feature-store")
+def test_score_feature_store(run, cohort, tmp_path):
+    store = FeatureStore(str(tmp_path), initial_capacity=len(cohort))
+    store.upsert(cohort)
+    ids, scores = run(store.score, size=len(cohort))
+    assert len(scores) == len(ids) == len(cohort)
+
+
+@pytest.mark.benchmark(group="bundle")
+def test_risk_assessment_bundle(run, cohort):
+    bundle = run(build_risk_assessment_bundle, cohort, [], size=len(cohort))
+    assert bundle.startswith('{"resourceType":"Bundle"')
@@ -0,0 +1,42 @@
+import pytest
+from fastapi.security import HTTPAuthorizationCredentials
+
+from benchmarks.bench_sessions import TOKEN_RESPONSE
+from src import athena_auth
+from src.athena_auth import get_oauth_token
+from src.session_store import (
+    MemorySessionBackend, SessionCipher, SessionStore, SharedSessionBackend, SQLiteSessionBackend,
+)
+
+from tests.test_assessment_cache import FakeRedis
+
+SESSIONS = 1_000
+
+
+def make_store(backend: str, tmp_path) -> SessionStore:
+    backends = {
+        "memory": lambda: MemorySessionBackend(),
+        "sqlite": lambda: SQLiteSessionBackend(str(tmp_path / "sessions.sqlite3")),
+        "shared": lambda: SharedSessionBackend(FakeRedis()),
+    }
+    return SessionStore(backends[backend](), SessionCipher([SessionCipher.generate_key()]))
+
+
+@pytest.mark.benchmark(group="session-lookup")
+@pytest.mark.parametrize("backend", ["memory", "sqlite", "shared"])
+def test_session_lookup(benchmark, tmp_path, backend):
+    store = make_store(backend, tmp_path)
+    session_ids = [store.create_session(TOKEN_RESPONSE).id for _ in range(SESSIONS)]
+
+    session = benchmark(store.session, session_ids[SESSIONS // 2])
+    assert session is not None
+
+
+@pytest.mark.benchmark(group="session-lookup")
+def test_get_oauth_token_from_sqlite_session(benchmark, tmp_path, monkeypatch):
+    store = make_store("sqlite", tmp_path)
+    monkeypatch.setattr(athena_auth, "session_store", store)
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=store.create_session(TOKEN_RESPONSE).id)
+
+    headers = benchmark(get_oauth_token, credentials)
+    assert headers == {"Authorization": f"Bearer {TOKEN_RESPONSE['access_token']}"}
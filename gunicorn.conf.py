@@ -0,0 +1,60 @@
+"""
+Gunicorn configuration for the production image.
+
+Runs ``src.main:app`` in several Uvicorn worker processes:
+
+    gunicorn -c gunicorn.conf.py src.main:app
+
+The worker count defaults to the CPUs this container may use (its affinity
+mask, capped by a cgroup CPU quota) and can be overridden with
+``WEB_CONCURRENCY``. The Uvicorn worker picks uvloop and httptools
+automatically when they are installed (``uvicorn[standard]``). The app is
+imported once in the master before forking, so the FHIR model classes and
+fragments are shared copy-on-write between workers.
+"""
+import gc
+import os
+
+from src.cpus import available_cpus
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY") or available_cpus())
+# The preloaded app reads it to give each worker its share of the Athena rate limit
+os.environ["WEB_CONCURRENCY"] = str(workers)
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Import the app (and fhir.resources) in the master and fork workers from it.
+# Per-process state (the HTTP pool, token refresh loop) is created in each
+# worker's startup event, after the fork.
+preload_app = True
+
+# On SIGTERM workers stop accepting connections and get this long to finish
+# in-flight requests and run the app shutdown events before being killed.
+graceful_timeout = int(os.getenv("SARCRISK_GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("SARCRISK_WORKER_TIMEOUT", "120"))
+
+# Longer than the ingress idle timeout so the proxy, not us, closes idle connections
+keepalive = int(os.getenv("SARCRISK_KEEPALIVE", "75"))
+
+# Optional worker recycling, e.g. to bound memory growth; off by default
+max_requests = int(os.getenv("SARCRISK_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("SARCRISK_MAX_REQUESTS_JITTER", "0"))
+
+# Heartbeat files on tmpfs: container overlay filesystems can stall the worker heartbeat
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+accesslog = "-" if os.getenv("SARCRISK_ACCESS_LOG", "false").lower() in ("1", "true", "yes") else None
+errorlog = "-"
+
+
+def when_ready(server):
+    # With SARCRISK_FHIR_WARMUP=preload, import fhir.resources once here so the
+    # workers share it; otherwise each worker warms it in the background
+    from src import fhir_models
+
+    if fhir_models.SARCRISK_FHIR_WARMUP == "preload":
+        fhir_models.warm_up()
+
+    # Move the preloaded objects out of the GC's tracked generations so
+    # collections in the workers do not touch (and copy) the shared pages
+    gc.freeze()
@@ -0,0 +1,365 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from .fhir_json import dumps
+from .models import SORTED_SECTION_SLOTS, PatientInputs, PatientRecord
+from .rules import current_rules
+
+# Assessment cache configuration
+SARCRISK_CACHE_MAX_ENTRIES = int(os.getenv("SARCRISK_CACHE_MAX_ENTRIES", "10000"))
+SARCRISK_CACHE_MAX_BYTES = int(os.getenv("SARCRISK_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+SARCRISK_CACHE_TTL = float(os.getenv("SARCRISK_CACHE_TTL", "3600"))
+SARCRISK_CACHE_REDIS_URL = os.getenv("SARCRISK_CACHE_REDIS_URL")
+# Cache shared by the worker processes on this node, unless SARCRISK_CACHE_REDIS_URL is set: sqlite or none
+SARCRISK_CACHE_SHARED = os.getenv("SARCRISK_CACHE_SHARED", "sqlite")
+SARCRISK_CACHE_PATH = os.getenv("SARCRISK_CACHE_PATH", os.path.join(tempfile.gettempdir(), "sarcrisk-cache.sqlite3"))
+
+SECTIONS = ("molecular_data", "clinical_data", "imaging_data")
+NUMERIC_INPUTS = ("VEGF_level", "tumor_size")
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(key: str, value):
+    # Scoring treats VEGF_level / tumor_size as numbers and every other input as a flag
+    if key in NUMERIC_INPUTS:
+        try:
+            return None if value is None else float(value)
+        except (TypeError, ValueError):
+            return str(value)
+    return bool(value)
+
+
+def canonical_input_hash(patient_data: PatientInputs, patient_id: str, model_version: Optional[str] = None) -> str:
+    """
+    Stable hash of everything that determines a patient's RiskAssessment.
+
+    Values are normalized (``True``/``1`` and ``6``/``6.0`` hash the same) and
+    keys are sorted, so equivalent inputs share a cache entry. ``model_version``
+    defaults to the active rule set's fingerprint, so a rule change is a miss.
+    """
+    if isinstance(patient_data, PatientRecord):
+        values = patient_data.values
+        canonical = {
+            section: {key: _normalize(key, values[slot]) for key, slot in slots if values[slot] is not None}
+            for section, slots in SORTED_SECTION_SLOTS.items()
+        }
+    else:
+        canonical = {
+            section: {key: _normalize(key, value) for key, value in sorted((patient_data.get(section) or {}).items())}
+            for section in SECTIONS
+        }
+    canonical["patient"] = patient_id
+    canonical["model"] = model_version or current_rules().fingerprint
+    return hashlib.sha256(dumps(canonical).encode()).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(self.__dict__)
+
+
+class LocalCacheBackend:
+    """
+    In-process LRU cache with a TTL, an entry limit and a memory budget.
+
+    Values are bytes so their size can be accounted exactly. Safe to use from
+    the threadpool that runs scoring.
+    """
+
+    def __init__(self, max_entries: int = SARCRISK_CACHE_MAX_ENTRIES, max_bytes: int = SARCRISK_CACHE_MAX_BYTES,
+                 ttl: float = SARCRISK_CACHE_TTL, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.stats = CacheStats()
+        self.size = 0
+        self._entries: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= self.clock():
+                self._remove(key)
+                self.stats.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, self.clock() + (self.ttl if ttl is None else ttl))
+            self.size += len(value)
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.stats.evictions += 1
+
+    def set_many(self, items: Iterable[Tuple[str, bytes]]) -> None:
+        for key, value in items:
+            self.set(key, value)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key: str) -> None:
+        value, _ = self._entries.pop(key)
+        self.size -= len(value)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SharedCacheBackend:
+    """
+    Cache backend on a shared key-value service (anything with a redis-py
+    style ``get`` / ``set(name, value, ex=...)`` / ``delete`` client), so
+    every worker and replica sees the same assessments.
+    """
+
+    def __init__(self, client, prefix: str = "sarcrisk:", ttl: float = SARCRISK_CACHE_TTL):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(self.prefix + key)
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        self.client.set(self.prefix + key, value, ex=max(1, int(self.ttl if ttl is None else ttl)))
+
+    def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        values = {key: self.get(key) for key in keys}
+        return {key: value for key, value in values.items() if value is not None}
+
+    def set_many(self, items: Iterable[Tuple[str, bytes]]) -> None:
+        for key, value in items:
+            self.set(key, value)
+
+    def delete(self, key: str) -> None:
+        self.client.delete(self.prefix + key)
+
+
+class SQLiteCacheBackend:
+    """
+    Cache backend in a local SQLite file that every worker process on the
+    node opens, so an assessment scored by one worker is read by the others.
+
+    WAL lets readers run alongside a writer. Each process opens its own
+    connection on first use (connections must not cross a fork); a batch of
+    entries is written in one transaction, which also purges expired rows.
+    """
+
+    def __init__(self, path: str = SARCRISK_CACHE_PATH, ttl: float = SARCRISK_CACHE_TTL,
+                 clock: Callable[[], float] = time.time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self._db: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            # A rowid table: rendered assessments are too large for WITHOUT ROWID to pay off
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                "expires_at REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS entries_expiry ON entries (expires_at)")
+            self._db, self._pid = db, os.getpid()
+        return self._db
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value FROM entries WHERE key = ? AND expires_at > ?", (key, self.clock())
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        found = {}
+        with self._lock:
+            db = self._connection()
+            for start in range(0, len(keys), 500):  # within SQLite's bound-parameter limit
+                batch = keys[start:start + 500]
+                found.update(db.execute(
+                    f"SELECT key, value FROM entries WHERE key IN ({','.join('?' * len(batch))}) AND expires_at > ?",
+                    (*batch, self.clock())
+                ).fetchall())
+        return found
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        self.set_many([(key, value)], ttl)
+
+    def set_many(self, items: Iterable[Tuple[str, bytes]], ttl: Optional[float] = None) -> None:
+        now = self.clock()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        rows = [(key, value, expires_at) for key, value in items]
+        if not rows:
+            return
+        with self._lock:
+            db = self._connection()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", rows)
+                db.execute("DELETE FROM entries WHERE expires_at <= ?", (now,))
+            finally:
+                db.execute("COMMIT")
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._connection().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+
+class AssessmentCache:
+    """
+    Rendered RiskAssessments keyed by ``canonical_input_hash``, plus a pointer
+    from each patient to their latest assessment for the read endpoint. The
+    pointers are scoped (by the caller's credential, see
+    ``http_client.credential_key``): a caller only reads back assessments made
+    for it.
+
+    Lookups go to the local LRU first and then, if configured, to the shared
+    backend (filling the local cache on a shared hit). Assessments are
+    immutable per key, but the latest pointers change, so with a shared
+    backend they are always read from it: another worker may have moved them.
+    """
+
+    def __init__(self, local: Optional[LocalCacheBackend] = None,
+                 shared: Optional[Union[SharedCacheBackend, SQLiteCacheBackend]] = None):
+        self.local = local or LocalCacheBackend()
+        self.shared = shared
+
+    @property
+    def stats(self) -> CacheStats:
+        return self.local.stats
+
+    def _get(self, key: str) -> Optional[bytes]:
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def _set(self, key: str, value: bytes) -> None:
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    def get(self, key: str) -> Optional[str]:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """Cached assessments for those of ``keys`` that have one; the shared backend is asked once for the rest"""
+        found, missing = {}, []
+        for key in keys:
+            value = self.local.get("ra:" + key)
+            if value is not None:
+                found[key] = value
+            else:
+                missing.append("ra:" + key)
+        if missing and self.shared is not None:
+            for name, value in self.shared.get_many(missing).items():
+                found[name[len("ra:"):]] = value
+                self.local.set(name, value)
+        self.stats.hits += len(found)
+        self.stats.misses += len(keys) - len(found)
+        return {key: value.decode() for key, value in found.items()}
+
+    def _set_many(self, items: List[Tuple[str, bytes]]) -> None:
+        self.local.set_many(items)
+        if self.shared is not None:
+            self.shared.set_many(items)
+
+    def set(self, key: str, resource_json: str) -> None:
+        self.set_many([(key, resource_json)])
+
+    def set_many(self, assessments: Iterable[Tuple[str, str]]) -> None:
+        """Cache ``(input_hash, resource_json)`` assessments, in one write"""
+        self._set_many([("ra:" + key, resource_json.encode()) for key, resource_json in assessments])
+
+    def set_latest(self, scope: str, patient_id: str, key: str) -> None:
+        self.set_latest_many(scope, [(patient_id, key)])
+
+    def set_latest_many(self, scope: str, pointers: Iterable[Tuple[str, str]]) -> None:
+        """Point ``scope``'s latest assessment of each ``(patient_id, input_hash)`` at that assessment"""
+        self._set_many([(f"latest:{scope}:{patient_id}", key.encode()) for patient_id, key in pointers])
+
+    def latest(self, scope: str, patient_id: str) -> Optional[Tuple[str, str]]:
+        """``(input_hash, resource_json)`` of the patient's latest assessment for ``scope``, if still cached"""
+        if self.shared is not None:
+            key = self.shared.get(f"latest:{scope}:{patient_id}")
+        else:
+            key = self.local.get(f"latest:{scope}:{patient_id}")
+        if key is None:
+            return None
+        key = key.decode()
+        value = self._get("ra:" + key)
+        return (key, value.decode()) if value is not None else None
+
+
+def etag(key: str) -> str:
+    return f'W/"{key}"'
+
+
+def etag_matches(if_none_match: Optional[str], key: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag(key) in tags or f'"{key}"' in tags
+
+
+def create_assessment_cache() -> AssessmentCache:
+    """
+    Build the process cache: the local LRU in front of the shared Redis
+    backend when configured and installed, else of the node's SQLite cache
+    (``SARCRISK_CACHE_SHARED=sqlite``, the default) so every worker process
+    sees the same assessments.
+    """
+    shared = None
+    if SARCRISK_CACHE_REDIS_URL:
+        try:
+            import redis
+        except ImportError:
+            logger.warning("SARCRISK_CACHE_REDIS_URL is set but redis is not installed; using the node cache")
+        else:
+            shared = SharedCacheBackend(redis.Redis.from_url(SARCRISK_CACHE_REDIS_URL))
+    if shared is None and SARCRISK_CACHE_SHARED == "sqlite":
+        shared = SQLiteCacheBackend()
+    elif shared is None and SARCRISK_CACHE_SHARED != "none":
+        raise ValueError(f"Unknown SARCRISK_CACHE_SHARED {SARCRISK_CACHE_SHARED!r}; use sqlite or none")
+    return AssessmentCache(shared=shared)
+
+
+# Process-wide assessment cache
+assessment_cache = create_assessment_cache()
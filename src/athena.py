@@ -0,0 +1,332 @@
+import hashlib
+import math
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+
+from . import fhir_models
+from .assessment_cache import AssessmentCache, canonical_input_hash, etag
+from .fast_fhir import dumps, operation_outcome_dict, present_findings, render_risk_assessment
+from .fhir_fragments import (
+    BASIS_REFERENCES, CLINICAL_SYMPTOMS_URL, IMAGING_FINDINGS_URL, SARCOMA_RISK_CODE, SNOMED_SYSTEM,
+    SUSPECTED_SUBTYPES_URL, TUMOR_SIZE_URL, Fragment, observation_code
+)
+from .fhir_ingest import FEATURE_SYSTEM, IngestError
+from .metrics import stage
+from .models import PatientInputs
+from .rules import CompiledRules, current_rules, format_factors
+from .scoring import categorize_risk, explain_risk_score, score_patients
+
+if TYPE_CHECKING:
+    from fhir.resources.observation import Observation
+    from fhir.resources.operationoutcome import OperationOutcome
+    from fhir.resources.patient import Patient
+    from fhir.resources.riskassessment import RiskAssessment
+
+# Observations exported alongside each RiskAssessment: (patient_data section, mapping type, system, code, display)
+EXPORT_OBSERVATIONS = (
+    ("clinical_data", "clinical", SNOMED_SYSTEM, "7530005", "Tumor Size"),
+    ("molecular_data", "molecular", FEATURE_SYSTEM, "VEGF_level", "VEGF level"),
+    ("imaging_data", "imaging", FEATURE_SYSTEM, "imaging-findings", "Imaging findings"),
+)
+
+# Longest FHIR resource id
+MAX_ID_LENGTH = 64
+
+
+def resource_id(patient_id: str, suffix: str) -> str:
+    """Id of a resource derived from a patient, kept within the FHIR id length"""
+    resource_id = f"{patient_id}-{suffix}"
+    if len(resource_id) > MAX_ID_LENGTH:
+        resource_id = f"{hashlib.sha256(patient_id.encode()).hexdigest()[:40]}-{suffix}"
+    return resource_id
+
+
+def observation_ids(patient_id: str) -> List[str]:
+    """Ids of a patient's Observations, in ``EXPORT_OBSERVATIONS`` order"""
+    return [resource_id(patient_id, resource_type) for _, resource_type, _, _, _ in EXPORT_OBSERVATIONS]
+
+
+def observation_basis(patient_id: str, contributions: Sequence[float], rules: CompiledRules) -> List[dict]:
+    """
+    ``RiskAssessment.basis`` for a patient: a reference to each of its
+    Observations, labelled with the factors that Observation's section
+    contributed (``contributions`` per ``rules.factor_terms``).
+    """
+    basis = []
+    for (section, _, _, _, _), observation_id in zip(EXPORT_OBSERVATIONS, observation_ids(patient_id)):
+        reference = {"reference": f"Observation/{observation_id}"}
+        factors = rules.contributing_factors(contributions, section)
+        if factors:
+            reference["display"] = format_factors(factors)
+        basis.append(reference)
+    return basis
+
+
+def map_to_risk_assessment(patient_data: dict, total_score: float, risk_category: str,
+                           suspected_subtypes: list, patient_id: str = "12345",
+                           assessment_id: Optional[str] = None,
+                           method: Optional[Fragment] = None,
+                           basis: Optional[List[dict]] = None,
+                           rationale: Optional[str] = None) -> "RiskAssessment":
+    """
+    Maps patient data to a FHIR RiskAssessment resource, incorporating clinical, molecular, and imaging data.
+
+    ``total_score`` is the overall risk score in [0, 1] and is reported as the prediction probability.
+    ``method`` names the rule set that produced it (see ``rules.CompiledRules.method``). ``basis``
+    references the Observations it was derived from; by default the shared placeholder references.
+    ``rationale`` explains the prediction (see ``rules.CompiledRules.rationale``).
+    """
+    # Create a RiskAssessment resource
+    risk_assessment = fhir_models.RiskAssessment(
+        status="final",
+        subject=fhir_models.Reference(reference=f"Patient/{patient_id}")  # Reference to the patient in FHIR
+    )
+    if assessment_id is not None:
+        risk_assessment.id = assessment_id
+    if method is not None:
+        risk_assessment.method = method.model
+    risk_assessment.code = SARCOMA_RISK_CODE.model
+    risk_assessment.prediction = [
+        fhir_models.RiskAssessmentPrediction(
+            outcome=fhir_models.CodeableConcept(text=risk_category),
+            probabilityDecimal=total_score,
+            rationale=rationale
+        )
+    ]
+
+    # Adding suspected sarcoma subtypes based on molecular and clinical data
+    risk_assessment.extension = [
+        fhir_models.Extension(
+            url=SUSPECTED_SUBTYPES_URL,
+            valueCodeableConcept=fhir_models.CodeableConcept(text=", ".join(suspected_subtypes))
+        )
+    ]
+
+    # Adding tumor size, the symptoms and imaging findings that are present as extensions
+    symptoms, findings = present_findings(patient_data)
+    risk_assessment.extension.append(
+        fhir_models.Extension(
+            url=TUMOR_SIZE_URL,
+            valueQuantity=fhir_models.Quantity(value=patient_data["clinical_data"].get("tumor_size", 0), unit="cm")
+        )
+    )
+    risk_assessment.extension.append(
+        fhir_models.Extension(
+            url=CLINICAL_SYMPTOMS_URL,
+            valueCodeableConcept=fhir_models.CodeableConcept(text="Pain, Swelling, Fever: " + ", ".join(symptoms))
+        )
+    )
+    risk_assessment.extension.append(
+        fhir_models.Extension(
+            url=IMAGING_FINDINGS_URL,
+            valueCodeableConcept=fhir_models.CodeableConcept(text="MRI Abnormalities, PET Scan Activity: " + ", ".join(findings))
+        )
+    )
+
+    # Setting the references to the relevant Observation resources (shared, pre-validated fragments)
+    if basis is None:
+        risk_assessment.basis = list(BASIS_REFERENCES.model)
+    else:
+        risk_assessment.basis = [fhir_models.Reference(**reference) for reference in basis]
+
+    return risk_assessment
+
+def map_to_observation(resource_type: str, data: dict, code: str, display: str,
+                       patient_id: Optional[str] = None, system: str = SNOMED_SYSTEM,
+                       observation_id: Optional[str] = None) -> "Observation":
+    """
+    Maps clinical data to a FHIR Observation resource.
+    """
+    observation = fhir_models.Observation(status="final", code=observation_code(system, code, display).model)
+    if observation_id is not None:
+        observation.id = observation_id
+    if patient_id is not None:
+        observation.subject = fhir_models.Reference(reference=f"Patient/{patient_id}")
+
+    if resource_type == "clinical":
+        observation.valueQuantity = fhir_models.Quantity(value=data.get("tumor_size", 0), unit="cm")
+    elif resource_type == "molecular":
+        observation.valueQuantity = fhir_models.Quantity(value=data.get("VEGF_level", 0), unit="pg/mL")  # Example for VEGF level
+    elif resource_type == "imaging":
+        observation.valueCodeableConcept = fhir_models.CodeableConcept(text=", ".join(data.keys()))  # Example imaging findings
+
+    return observation
+
+def map_to_patient(patient_data: dict, patient_id: str = "12345") -> "Patient":
+    """
+    Maps patient data to a FHIR Patient resource.
+    """
+    patient = fhir_models.Patient()
+    patient.id = patient_id
+    patient.name = [{"use": "official", "family": patient_data["name"]["family"], "given": patient_data["name"]["given"]}]
+
+    # Add other patient demographics like gender, birth date, etc. if needed
+    return patient
+
+def map_to_operation_outcome(message: str, code: str = "invalid") -> "OperationOutcome":
+    """
+    Maps an error message to a FHIR OperationOutcome resource.
+    """
+    return fhir_models.OperationOutcome(issue=[{"severity": "error", "code": code, "diagnostics": message}])
+
+def assess_patients(patients: Dict[str, PatientInputs], errors: List[Exception],
+                    cache: Optional[AssessmentCache] = None, rules: Optional[CompiledRules] = None,
+                    latest_scope: Optional[str] = None) -> Tuple[Dict[str, Tuple[str, str]], List[Exception]]:
+    """
+    Scores every patient in one pass and renders their RiskAssessments.
+
+    ``patients`` are ``patient_data`` dicts or ``models.PatientRecord``s (as
+    produced by ``fhir_ingest.ingest_records``), which are scored, hashed and
+    mapped without building dicts.
+
+    Returns ``{patient_id: (input_hash, resource_json)}`` plus the input errors
+    extended with any patient that could not be mapped. Each RiskAssessment's
+    ``prediction.rationale`` lists the factors that raised its score, taken
+    from the same scoring pass. Resources are rendered
+    through the fast serialization path (see ``fast_fhir``). With a ``cache``,
+    patients whose inputs are unchanged are served from it and only the rest
+    are scored. The whole call uses one rule set (``rules``, by default the
+    active one), even if it is reloaded meanwhile.
+
+    With ``latest_scope`` the assessments also become the patients' latest
+    for that scope on the read endpoint. Only pass it for inputs read from
+    Athena with the scope's credential, never for client-supplied ones.
+    """
+    rules = rules or current_rules()
+    keys = {
+        patient_id: canonical_input_hash(patient_data, patient_id, rules.fingerprint)
+        for patient_id, patient_data in patients.items()
+    }
+    rendered = {}
+    if cache is not None:
+        cached = cache.get_many(list(keys.values()))
+        for patient_id, key in keys.items():
+            if key in cached:
+                rendered[patient_id] = cached[key]
+
+    errors = list(errors)
+    pending = [patient_id for patient_id in patients if patient_id not in rendered]
+    with stage("score"):
+        scores = score_patients((patients[patient_id] for patient_id in pending), rules, explain=True)
+    with stage("map"):
+        contributions = scores.contributions.tolist()
+        for i, patient_id in enumerate(pending):
+            try:
+                rendered[patient_id] = render_risk_assessment(
+                    patients[patient_id], float(scores.total[i]), str(scores.category[i]),
+                    rules.suspected_subtypes(patients[patient_id]), patient_id=patient_id,
+                    assessment_id=patient_id, method=rules.method,
+                    basis=observation_basis(patient_id, contributions[i], rules),
+                    rationale=rules.rationale(contributions[i])
+                )
+            except ValueError as e:
+                index = getattr(patients[patient_id], "index", None)
+                errors.append(IngestError(f"Patient/{patient_id} could not be mapped: {e}", index))
+        if cache is not None:
+            cache.set_many((keys[patient_id], rendered[patient_id]) for patient_id in pending if patient_id in rendered)
+            if latest_scope is not None:
+                cache.set_latest_many(latest_scope, ((patient_id, keys[patient_id]) for patient_id in rendered))
+
+    return {patient_id: (key, rendered[patient_id]) for patient_id, key in keys.items() if patient_id in rendered}, errors
+
+def bundle_entries(assessments: Dict[str, Tuple[str, str]], errors: List[Exception],
+                   patients: Optional[Dict[str, PatientInputs]] = None) -> List[str]:
+    """
+    Serialized transaction-response Bundle entries for ``assess_patients`` output:
+    a ``201 Created`` entry per RiskAssessment and a ``400 Bad Request`` entry
+    holding an OperationOutcome per error.
+
+    Entries follow the request: each RiskAssessment takes the place of its
+    Patient entry (``PatientRecord.index`` in ``patients``) and each error the
+    place of the entry it reports; anything without an entry comes last.
+    """
+    ordered = []
+    for patient_id, (key, resource) in assessments.items():
+        index = getattr((patients or {}).get(patient_id), "index", None)
+        entry = '{"resource":%s,"response":{"status":"201 Created","etag":%s}}' % (resource, dumps(etag(key)))
+        ordered.append((index, entry))
+    for error in errors:
+        index = getattr(error, "index", None)
+        message = f"Entry {index}: {error}" if index is not None else str(error)
+        ordered.append((index, dumps({"response": {"status": "400 Bad Request",
+                                                   "outcome": operation_outcome_dict(message)}})))
+    # Stable, so entries without an index keep their relative order
+    ordered.sort(key=lambda item: math.inf if item[0] is None else item[0])
+    return [entry for _, entry in ordered]
+
+def build_risk_assessment_bundle(patients: Dict[str, PatientInputs], errors: List[Exception],
+                                 cache: Optional[AssessmentCache] = None) -> str:
+    """
+    Scores every patient in one pass and returns a transaction-response Bundle as JSON.
+
+    Each scored patient becomes a ``201 Created`` entry holding its RiskAssessment;
+    each error becomes a ``400 Bad Request`` entry holding an OperationOutcome, so
+    one bad entry does not fail the whole batch. See ``assess_patients``.
+    """
+    assessments, errors = assess_patients(patients, errors, cache)
+    with stage("serialize"):
+        return '{"resourceType":"Bundle","type":"transaction-response","entry":[%s]}' % ",".join(
+            bundle_entries(assessments, errors, patients)
+        )
+
+def main():
+    # Example patient data
+    patient_data = {
+        "name": {"family": "Doe", "given": ["John"]},
+        "molecular_data": {
+            "VEGF_level": 120,  # High VEGF level
+            "CDKN2A_mutation": True,  # CDKN2A mutation present
+            "TP53_mutation": True,  # TP53 mutation detected
+        },
+        "clinical_data": {
+            "pain": True,  # Persistent pain
+            "swelling": True,  # Localized swelling
+            "fever": False,  # No fever
+            "tumor_size": 6  # Tumor size 6 cm
+        },
+        "imaging_data": {
+            "mri_abnormalities": True,  # MRI shows irregularities
+            "ct_scan_abnormalities": False,
+            "pet_scan_high_activity": True,  # PET scan shows increased activity
+            "x_ray_findings": False
+        }
+    }
+
+    # Calculate risk score with the active rule set, and what each factor contributed to it
+    rules = current_rules()
+    risk_score, contributions = explain_risk_score(
+        patient_data["molecular_data"],
+        patient_data["clinical_data"],
+        patient_data["imaging_data"],
+        rules
+    )
+
+    # Define risk category based on score
+    risk_category = categorize_risk(risk_score, rules)
+
+    # Suspected subtypes inferred by the rule set from clinical and molecular data
+    suspected_subtypes = rules.suspected_subtypes(patient_data)
+
+    # Map to FHIR resources: the Patient, the Observations the assessment is based on, and the assessment
+    patient_id = "12345"
+    patient_resource = map_to_patient(patient_data, patient_id)
+    observation_resources = [
+        map_to_observation(resource_type, patient_data[section], code, display, patient_id, system, observation_id)
+        for (section, resource_type, system, code, display), observation_id in zip(
+            EXPORT_OBSERVATIONS, observation_ids(patient_id)
+        )
+    ]
+    risk_assessment_resource = map_to_risk_assessment(
+        patient_data, risk_score, risk_category, suspected_subtypes, patient_id, assessment_id=patient_id,
+        method=rules.method,
+        basis=observation_basis(patient_id, contributions, rules),
+        rationale=rules.rationale(contributions)
+    )
+
+    # Print the resulting resources as JSON
+    print(patient_resource.json())
+    for observation_resource in observation_resources:
+        print(observation_resource.json())
+    print(risk_assessment_resource.json())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+from fastapi import HTTPException, Depends
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+import os
+from typing import Dict, Optional
+
+from .http_client import AthenaHttpClient, athena_http
+from .session_store import Session, SessionStore, session_store
+
+# Athena API credentials (you should set these as environment variables for security)
+ATHENA_API_BASE_URL = "https://api.athenahealth.com"
+CLIENT_ID = os.getenv("ATHENA_CLIENT_ID", "your-client-id-here")
+CLIENT_SECRET = os.getenv("ATHENA_CLIENT_SECRET", "your-client-secret-here")
+# Token endpoint for every grant: the /callback code exchange, client credentials and refresh
+AUTH_URL = f"{ATHENA_API_BASE_URL}/oauth2/token"
+REDIRECT_URI = os.getenv("ATHENA_REDIRECT_URI",
+    "https://athena-sarcrisk-fhir-api.ashystone-7ad37a18.eastus.azurecontainerapps.io/callback")
+SCOPE = os.getenv("ATHENA_SCOPE", "system/Patient.read system/Observation.read")
+
+# Use FastAPI security for authentication
+security = HTTPBearer()
+
+class AthenaAuth:
+    def __init__(self, http_client: Optional[AthenaHttpClient] = None, store: Optional[SessionStore] = None,
+                 client_id: Optional[str] = None, client_secret: Optional[str] = None, auth_url: Optional[str] = None,
+                 redirect_uri: Optional[str] = None):
+        self.client_id = client_id or CLIENT_ID
+        self.client_secret = client_secret or CLIENT_SECRET
+        self.auth_url = auth_url or AUTH_URL
+        self.redirect_uri = redirect_uri or REDIRECT_URI
+        self.http_client = http_client or athena_http
+        self.store = store or session_store
+
+    def get_auth_url(self) -> str:
+        """Generate the OAuth2 authorization URL"""
+        auth_url = (
+            f"{self.auth_url}?client_id={self.client_id}"
+            f"&redirect_uri={self.redirect_uri}&response_type=code"
+        )
+        return auth_url
+
+    async def get_access_token(self, code: str) -> Dict[str, str]:
+        """Exchange authorization code for access token"""
+        payload = {
+            "grant_type": "authorization_code",
+            "code": code,
+            "redirect_uri": self.redirect_uri,
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+        }
+        response = await self.http_client.post(self.auth_url, data=payload)
+
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail="Failed to get access token")
+
+        return response.json()
+
+    async def create_session(self, code: str, practice_id: str = "") -> Session:
+        """Exchange an authorization code and keep the tokens in the session store"""
+        return self.store.create_session(await self.get_access_token(code), practice_id)
+
+    def session_headers(self, session_id: str) -> Optional[Dict[str, str]]:
+        """Authorization headers for a stored session, without calling Athena; None if unknown or expired"""
+        session = self.store.session(session_id)
+        return session.headers if session is not None else None
+
+    async def get_client_credentials_token(self, scope: Optional[str] = None) -> Dict[str, str]:
+        """Obtain a system-level access token using the client credentials grant"""
+        payload = {
+            "grant_type": "client_credentials",
+            "scope": scope or SCOPE,
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+        }
+        response = await self.http_client.post(self.auth_url, data=payload)
+
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail="Failed to get client credentials token")
+
+        return response.json()
+
+    async def refresh_access_token(self, refresh_token: str) -> Dict[str, str]:
+        """Refresh access token using the refresh token"""
+        payload = {
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+        }
+        response = await self.http_client.post(self.auth_url, data=payload)
+
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail="Failed to refresh access token")
+
+        return response.json()
+
+# Process-wide client for the configured Athena environment, used by /callback and the system token cache
+athena_auth = AthenaAuth()
+
+def get_oauth_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict[str, str]:
+    """
+    Resolve the bearer token to the caller's Athena authorization headers.
+
+    The bearer token is a session id issued by ``/callback``; it resolves to
+    the session's Athena token straight from the session store. Anything else
+    (an unknown or expired session, or a raw token) is rejected with 401.
+    """
+    if credentials:
+        session = session_store.session(credentials.credentials)
+        if session is not None:
+            return session.headers
+        raise HTTPException(status_code=401, detail="Unknown or expired session",
+                            headers={"WWW-Authenticate": "Bearer"})
+    raise HTTPException(status_code=401, detail="Authentication credentials are missing")
+
+# Example function to retrieve the access token after the user completes OAuth flow
+async def oauth_callback(code: str):
+    """Handle the OAuth callback and exchange code for access token"""
+    access_token_data = await athena_auth.get_access_token(code)
+    return access_token_data
@@ -0,0 +1,217 @@
+import asyncio
+import copy
+import os
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import quote, urlencode, urlsplit
+
+import httpx
+
+from .fhir_ingest import IngestError, group_patient_data
+from .http_client import AthenaHttpClient, athena_http
+from .metrics import stage
+from .token_manager import get_athena_headers
+
+# Athena FHIR API configuration
+ATHENA_FHIR_BASE_URL = os.getenv("ATHENA_FHIR_BASE_URL", "https://api.athenahealth.com/fhir/r4")
+ATHENA_FHIR_MAX_PER_HOST = int(os.getenv("ATHENA_FHIR_MAX_PER_HOST", "10"))
+ATHENA_FHIR_MAX_RETRIES = int(os.getenv("ATHENA_FHIR_MAX_RETRIES", "3"))
+ATHENA_FHIR_BACKOFF = float(os.getenv("ATHENA_FHIR_BACKOFF", "0.5"))
+ATHENA_FHIR_MAX_BACKOFF = float(os.getenv("ATHENA_FHIR_MAX_BACKOFF", "30"))
+ATHENA_PRACTICE_ID = os.getenv("ATHENA_PRACTICE_ID", "")
+
+# Observation categories holding the molecular labs, symptoms/exam findings and imaging
+OBSERVATION_CATEGORIES = ("laboratory", "exam", "imaging")
+
+HeadersProvider = Callable[[str], Awaitable[Dict[str, str]]]
+
+
+class AthenaFhirError(Exception):
+    """A non-retryable (or retries exhausted) error from the Athena FHIR API"""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"Athena FHIR request failed ({status_code}): {message}")
+        self.status_code = status_code
+
+
+class AthenaFhirClient:
+    """
+    Async reader for Athena's FHIR API that assembles ``patient_data``.
+
+    Independent reads for a patient are issued concurrently (or as a single
+    FHIR batch Bundle), search results are streamed page by page following
+    ``Bundle.link[next]``, requests per host are capped, and 429 responses are
+    retried after ``Retry-After`` (or exponential backoff).
+    """
+
+    def __init__(
+        self,
+        base_url: str = ATHENA_FHIR_BASE_URL,
+        http_client: Optional[AthenaHttpClient] = None,
+        headers: HeadersProvider = get_athena_headers,
+        practice_id: str = ATHENA_PRACTICE_ID,
+        max_per_host: int = ATHENA_FHIR_MAX_PER_HOST,
+        max_retries: int = ATHENA_FHIR_MAX_RETRIES,
+        backoff: float = ATHENA_FHIR_BACKOFF,
+        max_backoff: float = ATHENA_FHIR_MAX_BACKOFF,
+        sleep: Callable[[float], Awaitable[None]] = asyncio.sleep,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.http_client = http_client or athena_http
+        self.headers = headers
+        self.practice_id = practice_id
+        self.max_per_host = max_per_host
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.max_per_host)
+        return self._host_limits[host]
+
+    def _retry_delay(self, response: httpx.Response, attempt: int) -> float:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return min(self.backoff * 2 ** attempt, self.max_backoff)
+
+    async def _request(self, method: str, url: str, endpoint: Optional[str] = None, **kwargs) -> dict:
+        headers = {"Accept": "application/fhir+json", **await self.headers(self.practice_id)}
+        for attempt in range(self.max_retries + 1):
+            async with self._host_limit(url):
+                response = await self.http_client.request(method, url, endpoint=endpoint, practice_id=self.practice_id,
+                                                          headers=headers, **kwargs)
+            if response.status_code == 429 and attempt < self.max_retries:
+                # Back off outside the host limit so other requests can proceed
+                await self.sleep(self._retry_delay(response, attempt))
+                continue
+            if response.status_code >= 400:
+                raise AthenaFhirError(response.status_code, response.text)
+            try:
+                return response.json()
+            except ValueError as e:
+                raise AthenaFhirError(502, f"response is not JSON: {e}")
+
+    def on_behalf_of(self, headers: Dict[str, str]) -> "AthenaFhirClient":
+        """
+        This client making its requests with ``headers`` (a user session's
+        Athena token) instead of the system token; it shares the per-host limits.
+        """
+        async def session_headers(practice_id: str) -> Dict[str, str]:
+            return headers
+
+        client = copy.copy(self)
+        client.headers = session_headers
+        return client
+
+    async def read(self, resource_type: str, resource_id: str) -> dict:
+        return await self._request("GET", f"{self.base_url}/{resource_type}/{quote(resource_id, safe='')}")
+
+    async def search(self, resource_type: str, params: Dict[str, str]) -> AsyncIterator[dict]:
+        """Stream matching resources, fetching the next page only when the current one is consumed"""
+        bundle = await self._request("GET", f"{self.base_url}/{resource_type}", params=params)
+        async for resource in self._follow_pages(bundle):
+            yield resource
+
+    async def _follow_pages(self, bundle: dict) -> AsyncIterator[dict]:
+        while True:
+            for entry in bundle.get("entry") or []:
+                if entry.get("resource"):
+                    yield entry["resource"]
+            next_url = next((link["url"] for link in bundle.get("link") or [] if link.get("relation") == "next"), None)
+            if next_url is None:
+                return
+            bundle = await self._request("GET", next_url)
+
+    async def _collect(self, pages: AsyncIterator[dict]) -> List[dict]:
+        return [resource async for resource in pages]
+
+    async def fetch_patient_resources(self, patient_id: str) -> List[dict]:
+        """Patient plus its scoring Observations, read concurrently"""
+        results = await asyncio.gather(
+            self.read("Patient", patient_id),
+            *(
+                self._collect(self.search("Observation", {"patient": patient_id, "category": category}))
+                for category in OBSERVATION_CATEGORIES
+            ),
+        )
+        patient, observations = results[0], results[1:]
+        return [patient] + [resource for group in observations for resource in group]
+
+    async def fetch_patient_resources_batch(self, patient_id: str) -> List[dict]:
+        """Same as ``fetch_patient_resources`` in a single FHIR batch Bundle round-trip"""
+        requests = [f"Patient/{quote(patient_id, safe='')}"] + [
+            f"Observation?{urlencode({'patient': patient_id, 'category': category})}"
+            for category in OBSERVATION_CATEGORIES
+        ]
+        batch = {
+            "resourceType": "Bundle",
+            "type": "batch",
+            "entry": [{"request": {"method": "GET", "url": url}} for url in requests],
+        }
+        # A batch of reads is safe to resend
+        response = await self._request("POST", self.base_url, endpoint="batch", json=batch)
+        resources = []
+        for entry in response.get("entry") or []:
+            status = (entry.get("response") or {}).get("status", "200")
+            if not status.startswith("2"):
+                raise AthenaFhirError(int(status.split()[0]), f"batch entry failed: {status}")
+            resource = entry.get("resource") or {}
+            if resource.get("resourceType") == "Bundle":
+                resources.extend(await self._collect(self._follow_pages(resource)))
+            elif resource:
+                resources.append(resource)
+        return resources
+
+    async def fetch_patient_data(self, patient_id: str, use_batch: bool = False) -> dict:
+        """Fetch a patient and assemble the ``patient_data`` dict used by scoring"""
+        with stage("athena_fetch"):
+            if use_batch:
+                resources = await self.fetch_patient_resources_batch(patient_id)
+            else:
+                resources = await self.fetch_patient_resources(patient_id)
+        patients, errors = group_patient_data(list(enumerate(resources)))
+        if patient_id not in patients:
+            raise IngestError("; ".join(str(error) for error in errors) or f"Patient/{patient_id} not returned")
+        return patients[patient_id]
+
+    async def fetch_cohort(self, patient_ids: Iterable[str], concurrency: int = ATHENA_FHIR_MAX_PER_HOST,
+                           use_batch: bool = False) -> AsyncIterator[Tuple[str, object]]:
+        """
+        Stream ``(patient_id, patient_data)`` pairs for a cohort, as they complete.
+
+        At most ``concurrency`` patients are in flight; failures are yielded as
+        ``(patient_id, exception)`` so one bad patient does not stop the cohort.
+        """
+        patient_ids = iter(patient_ids)
+        pending = set()
+
+        async def fetch(patient_id: str):
+            try:
+                return patient_id, await self.fetch_patient_data(patient_id, use_batch)
+            except (AthenaFhirError, IngestError, httpx.HTTPError) as e:
+                return patient_id, e
+
+        def refill():
+            for patient_id in patient_ids:
+                pending.add(asyncio.ensure_future(fetch(patient_id)))
+                if len(pending) >= concurrency:
+                    return
+
+        refill()
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                pending.discard(task)
+                yield task.result()
+            refill()
+
+
+# Process-wide FHIR reader, sharing the pooled HTTP client and per-host limits
+athena_fhir = AthenaFhirClient()
@@ -0,0 +1,419 @@
+import asyncio
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from itertools import islice
+from typing import AsyncIterable, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .athena import EXPORT_OBSERVATIONS, observation_basis, observation_ids
+from .fast_fhir import operation_outcome_dict, render, render_observation, render_risk_assessment
+from .fhir_ingest import new_patient_data, valid_id
+from .fhir_json import loads
+from .metrics import stage
+from .models import INPUT_INDEX, PatientRecord
+from .rules import NUMERIC_COLUMNS, SECTIONS, current_rules
+from .scoring import score_patients
+
+# Bulk export configuration
+SARCRISK_EXPORT_DIR = os.getenv("SARCRISK_EXPORT_DIR", os.path.join(tempfile.gettempdir(), "sarcrisk-exports"))
+SARCRISK_EXPORT_CHUNK_SIZE = int(os.getenv("SARCRISK_EXPORT_CHUNK_SIZE", "1000"))
+# Seconds a finished export's files are kept for download; 0 keeps them until the client deletes the job
+SARCRISK_EXPORT_TTL = float(os.getenv("SARCRISK_EXPORT_TTL", "3600"))
+SARCRISK_EXPORT_READ_SIZE = 64 * 1024
+
+EXPORT_TYPES = ("RiskAssessment", "Observation")
+
+def check_record(record: object) -> None:
+    """Raise ``ValueError`` unless ``record`` is a ``patient_data`` object that scoring and mapping can take"""
+    if not isinstance(record, dict):
+        raise ValueError("record is not a JSON object")
+    if "id" in record and not valid_id(record["id"]):
+        raise ValueError(f"id {record['id']!r} is not a valid FHIR id")
+    for section in ("name",) + SECTIONS:
+        if not isinstance(record.get(section, {}), dict):
+            raise ValueError(f"{section} must be an object")
+    values = PatientRecord.from_patient_data("", record).values
+    for name, index in INPUT_INDEX.items():
+        value = values[index]
+        if value is None:
+            continue
+        if name in NUMERIC_COLUMNS:
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+                raise ValueError(f"{name} must be a finite number, got {value!r}")
+        elif not isinstance(value, bool):
+            raise ValueError(f"{name} must be true or false, got {value!r}")
+
+
+def read_records(path: str, on_error: Optional[Callable[[str], None]] = None) -> Iterator[dict]:
+    """
+    Stream ``patient_data`` records (one JSON object per line) from an NDJSON file.
+
+    Blank lines are skipped. Lines that are not valid JSON or fail
+    ``check_record`` are skipped and described through ``on_error``.
+    """
+    with open(path, "rb") as source:
+        for number, line in enumerate(source, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = loads(line)
+                check_record(record)
+            except ValueError as e:
+                if on_error is not None:
+                    on_error(f"Line {number}: {e}")
+                continue
+            patient = new_patient_data()
+            patient.update(record)
+            yield patient
+
+
+def iter_export_lines(records: Iterable[dict], types: Iterable[str] = EXPORT_TYPES,
+                      chunk_size: int = SARCRISK_EXPORT_CHUNK_SIZE,
+                      on_error: Optional[Callable[[str], None]] = None) -> Iterator[Tuple[str, str]]:
+    """
+    Yield ``(resource_type, ndjson_line)`` pairs for every record.
+
+    Records are consumed ``chunk_size`` at a time and scored in one vectorized
+    pass per chunk, so memory use is bounded by the chunk size rather than the
+    size of the cohort. Records that cannot be mapped are skipped and described
+    through ``on_error``.
+    """
+    types = set(types)
+    records = iter(records)
+    position = 0
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        rules = current_rules()
+        with stage("score"):
+            scores = score_patients(chunk, rules, explain=True)
+        contributions = scores.contributions.tolist()
+        for i, patient_data in enumerate(chunk):
+            patient_id = str(patient_data.get("id") or position + i)
+            lines = []
+            try:
+                if "RiskAssessment" in types:
+                    lines.append(("RiskAssessment", render_risk_assessment(
+                        patient_data, float(scores.total[i]), str(scores.category[i]),
+                        rules.suspected_subtypes(patient_data), patient_id=patient_id, method=rules.method,
+                        basis=observation_basis(patient_id, contributions[i], rules),
+                        rationale=rules.rationale(contributions[i])
+                    )))
+                if "Observation" in types:
+                    for (section, resource_type, system, code, display), observation_id in zip(
+                        EXPORT_OBSERVATIONS, observation_ids(patient_id)
+                    ):
+                        lines.append(("Observation", render_observation(
+                            resource_type, patient_data[section], code, display, patient_id=patient_id, system=system,
+                            observation_id=observation_id
+                        )))
+            except ValueError as e:
+                if on_error is not None:
+                    on_error(f"Patient/{patient_id} could not be mapped: {e}")
+                continue
+            yield from lines
+        position += len(chunk)
+
+
+@dataclass
+class ExportJob:
+    id: str
+    types: Tuple[str, ...]
+    request_url: str
+    directory: str
+    total: int = 0
+    processed: int = 0
+    status: str = "in-progress"  # in-progress | completed | failed | cancelled
+    error: Optional[str] = None
+    counts: Dict[str, int] = field(default_factory=dict)
+    error_count: int = 0  # OperationOutcomes written to the error file
+    transaction_time: str = field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    finished: Optional[float] = None  # wall clock, once completed or failed
+    pid: int = field(default_factory=os.getpid)  # process running the job
+    task: Optional[asyncio.Task] = None
+
+    # Kept in the job directory so every worker process can report on the job
+    PERSISTED = ("id", "types", "request_url", "total", "processed", "status", "error", "counts", "error_count",
+                 "transaction_time", "finished", "pid")
+
+    @property
+    def source_path(self) -> str:
+        return os.path.join(self.directory, "source.ndjson")
+
+    @property
+    def state_path(self) -> str:
+        return os.path.join(self.directory, "job.json")
+
+    def output_path(self, resource_type: str) -> str:
+        return os.path.join(self.directory, f"{resource_type}.ndjson")
+
+    def save(self) -> None:
+        """Write the job's state next to its files; raises FileNotFoundError once the job was deleted"""
+        with open(self.state_path + ".tmp", "w") as state:
+            json.dump({name: getattr(self, name) for name in self.PERSISTED}, state)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["ExportJob"]:
+        try:
+            with open(os.path.join(directory, "job.json")) as state:
+                fields = json.load(state)
+        except (OSError, ValueError):
+            return None
+        return cls(directory=directory, **{**fields, "types": tuple(fields["types"])})
+
+    @property
+    def progress(self) -> str:
+        percent = 100 if not self.total else int(self.processed * 100 / self.total)
+        return f"{percent}% ({self.processed}/{self.total} patients)"
+
+    def manifest(self, base_url: str) -> dict:
+        """Bulk Data completion manifest"""
+        return {
+            "transactionTime": self.transaction_time,
+            "request": self.request_url,
+            "requiresAccessToken": True,
+            "output": [
+                {
+                    "type": resource_type,
+                    "url": f"{base_url}/$export-files/{self.id}/{resource_type}.ndjson",
+                    "count": self.counts.get(resource_type, 0),
+                }
+                for resource_type in self.types
+            ],
+            "error": [
+                {
+                    "type": "OperationOutcome",
+                    "url": f"{base_url}/$export-files/{self.id}/OperationOutcome.ndjson",
+                    "count": self.error_count,
+                }
+            ] if self.error_count else [],
+        }
+
+
+class ExportJobManager:
+    """
+    Runs FHIR Bulk Data style ($export) jobs.
+
+    Kick-off spools the request body to disk, the job streams it through
+    scoring and FHIR mapping in fixed-size chunks, and writes one NDJSON file
+    per resource type that the download endpoint streams back in chunks.
+
+    A job's state is kept in its directory (``job.json``, updated after every
+    chunk), so any worker process sharing ``root`` can report on, serve or
+    delete a job another one runs; a job whose process is gone is reported as
+    failed. Finished jobs and their files are removed ``ttl`` seconds after
+    they finish.
+    """
+
+    def __init__(self, root: str = SARCRISK_EXPORT_DIR, chunk_size: int = SARCRISK_EXPORT_CHUNK_SIZE,
+                 ttl: float = SARCRISK_EXPORT_TTL, clock: Callable[[], float] = time.time):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self.clock = clock
+        # Jobs running in this process
+        self.jobs: Dict[str, ExportJob] = {}
+
+    async def kick_off(self, body: AsyncIterable[bytes], types: Iterable[str], request_url: str) -> ExportJob:
+        await asyncio.to_thread(self.expire)
+        job_id = uuid.uuid4().hex
+        job = ExportJob(
+            id=job_id, types=tuple(types), request_url=request_url, directory=os.path.join(self.root, job_id)
+        )
+        await asyncio.to_thread(os.makedirs, job.directory, exist_ok=True)
+
+        # Spool the cohort to disk so the request body is never held in memory; file I/O stays off the event loop
+        source = await asyncio.to_thread(open, job.source_path, "wb")
+        in_record = False
+        try:
+            async for data in body:
+                await asyncio.to_thread(source.write, data)
+                records, in_record = _count_records(data, in_record)
+                job.total += records
+        finally:
+            await asyncio.to_thread(source.close)
+        job.total += in_record
+        await asyncio.to_thread(job.save)
+
+        self.jobs[job_id] = job
+        job.task = asyncio.ensure_future(self._run(job))
+        return job
+
+    async def _run(self, job: ExportJob) -> None:
+        try:
+            await asyncio.to_thread(self._write_outputs, job)
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+        else:
+            if job.status == "in-progress":
+                job.status = "completed"
+        job.finished = self.clock()
+        self.jobs.pop(job.id, None)
+        if job.status != "cancelled":
+            try:
+                await asyncio.to_thread(job.save)
+            except FileNotFoundError:
+                pass  # deleted by another process meanwhile
+
+    def _write_outputs(self, job: ExportJob) -> None:
+        outputs = {resource_type: open(job.output_path(resource_type), "w") for resource_type in job.types}
+
+        def report(message: str) -> None:
+            # Errors are streamed to their file as they occur, so a bad cohort costs no memory
+            if "OperationOutcome" not in outputs:
+                outputs["OperationOutcome"] = open(job.output_path("OperationOutcome"), "w")
+            outputs["OperationOutcome"].write(render(operation_outcome_dict(message)))
+            outputs["OperationOutcome"].write("\n")
+            job.error_count += 1
+
+        def reject(message: str) -> None:
+            job.processed += 1  # counted in ``total`` too
+            report(message)
+
+        try:
+            records = self._track_progress(job, read_records(job.source_path, reject))
+            for resource_type, line in iter_export_lines(records, job.types, self.chunk_size, report):
+                if job.status == "cancelled":
+                    return
+                outputs[resource_type].write(line)
+                outputs[resource_type].write("\n")
+                job.counts[resource_type] = job.counts.get(resource_type, 0) + 1
+        finally:
+            for output in outputs.values():
+                output.close()
+
+    def _track_progress(self, job: ExportJob, records: Iterator[dict]) -> Iterator[dict]:
+        for record in records:
+            # Once per chunk, before it is scored: publish progress, and stop if the job was deleted elsewhere
+            if job.processed % self.chunk_size == 0:
+                try:
+                    job.save()
+                except FileNotFoundError:
+                    job.status = "cancelled"
+                    return
+            job.processed += 1
+            yield record
+
+    def _directory(self, job_id: str) -> Optional[str]:
+        # Job ids are uuid4 hex; anything else must not reach the filesystem
+        if len(job_id) != 32 or not all(c in "0123456789abcdef" for c in job_id):
+            return None
+        return os.path.join(self.root, job_id)
+
+    def get(self, job_id: str) -> Optional[ExportJob]:
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job if os.path.isdir(job.directory) else None
+        directory = self._directory(job_id)
+        job = ExportJob.load(directory) if directory is not None else None
+        if job is None:
+            return None
+        if self._expired(job.finished):
+            shutil.rmtree(directory, ignore_errors=True)
+            return None
+        if job.status == "in-progress" and not _process_alive(job.pid):
+            job.status, job.error = "failed", "the process running the export stopped"
+        return job
+
+    def _expired(self, finished: Optional[float]) -> bool:
+        return self.ttl > 0 and finished is not None and finished <= self.clock() - self.ttl
+
+    def expire(self) -> int:
+        """Remove jobs finished more than ``ttl`` seconds ago, including those of stopped processes; returns how many"""
+        if self.ttl <= 0 or not os.path.isdir(self.root):
+            return 0
+        expired = 0
+        for name in os.listdir(self.root):
+            directory = os.path.join(self.root, name)
+            if name in self.jobs or not os.path.isdir(directory):
+                continue
+            job = ExportJob.load(directory)
+            finished = job.finished if job is not None else None
+            if finished is None and (job is None or not _process_alive(job.pid)):
+                # Interrupted, or never got as far as saving its state: judged by its last write
+                finished = _last_modified(directory)
+            if self._expired(finished):
+                shutil.rmtree(directory, ignore_errors=True)
+                expired += 1
+        return expired
+
+    def delete(self, job_id: str) -> bool:
+        """Cancel a running job (or discard a finished one) and remove its files"""
+        job = self.jobs.pop(job_id, None)
+        if job is None:
+            directory = self._directory(job_id)
+            if directory is None or not os.path.isdir(directory):
+                return False
+            # Run by another process (if still running): it stops at its next chunk
+            shutil.rmtree(directory, ignore_errors=True)
+            return True
+        job.status = "cancelled"
+        if job.task is not None and not job.task.done():
+            job.task.add_done_callback(lambda _: shutil.rmtree(job.directory, ignore_errors=True))
+        else:
+            shutil.rmtree(job.directory, ignore_errors=True)
+        return True
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # exists, run by another user
+    return True
+
+
+def _last_modified(directory: str) -> float:
+    with os.scandir(directory) as entries:
+        return max([os.path.getmtime(directory)] + [entry.stat().st_mtime for entry in entries])
+
+
+def _count_records(data: bytes, in_record: bool) -> Tuple[int, bool]:
+    """
+    Non-blank lines completed in ``data``, a piece of NDJSON, and whether its
+    unfinished last line has content so far. ``in_record`` is that flag for the
+    previous piece.
+    """
+    lines = data.split(b"\n")
+    records = 0
+    for line in lines[:-1]:
+        if in_record or line.strip():
+            records += 1
+        in_record = False
+    return records, in_record or bool(lines[-1].strip())
+
+
+def iter_file(path: str, chunk_size: int = SARCRISK_EXPORT_READ_SIZE) -> Iterator[bytes]:
+    """Stream a file in fixed-size chunks"""
+    with open(path, "rb") as source:
+        while True:
+            data = source.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+
+def parse_types(types: Optional[str]) -> List[str]:
+    """Parse the ``_type`` parameter, rejecting resource types this server does not export"""
+    if not types:
+        return list(EXPORT_TYPES)
+    requested = [resource_type.strip() for resource_type in types.split(",") if resource_type.strip()]
+    unsupported = [resource_type for resource_type in requested if resource_type not in EXPORT_TYPES]
+    if unsupported:
+        raise ValueError(f"Unsupported _type: {', '.join(unsupported)}")
+    return requested
+
+
+# Process-wide export job registry
+export_jobs = ExportJobManager()
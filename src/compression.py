@@ -0,0 +1,274 @@
+"""
+Response compression.
+
+``CompressionMiddleware`` compresses JSON / NDJSON / text responses with the
+best encoding the client accepts: zstd and brotli when the optional
+``zstandard`` / ``brotli`` packages are installed, gzip always. Bodies under
+``SARCRISK_COMPRESS_MIN_SIZE`` bytes go out as-is (the framing overhead is
+not worth it), bodies of ``SARCRISK_COMPRESS_THREADPOOL_SIZE`` bytes or more
+are compressed in the thread pool so a large Bundle does not stall the event
+loop, and streamed responses (``$export`` downloads) are compressed chunk by
+chunk.
+"""
+import abc
+import gzip
+import os
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - zstandard is optional
+    zstandard = None
+
+SARCRISK_COMPRESS_MIN_SIZE = int(os.getenv("SARCRISK_COMPRESS_MIN_SIZE", "1024"))
+SARCRISK_COMPRESS_THREADPOOL_SIZE = int(os.getenv("SARCRISK_COMPRESS_THREADPOOL_SIZE", str(64 * 1024)))
+# Enabled encodings, most preferred first (unavailable ones are skipped)
+SARCRISK_COMPRESS_ENCODINGS = os.getenv("SARCRISK_COMPRESS_ENCODINGS", "zstd,br,gzip")
+
+# Levels tuned for on-the-fly compression rather than maximum ratio
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+
+class Codec(abc.ABC):
+    """One content coding: one-shot ``compress`` plus a streaming ``compressor``"""
+    name: str
+
+    @abc.abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        """The whole body, compressed"""
+
+    @abc.abstractmethod
+    def compressor(self) -> "StreamCompressor":
+        """A compressor for a body sent in chunks"""
+
+
+class StreamCompressor(abc.ABC):
+    """Compresses one streamed body chunk by chunk"""
+
+    @abc.abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        """Compressed output for the next chunk; may be empty while the compressor buffers"""
+
+    @abc.abstractmethod
+    def finish(self) -> bytes:
+        """The rest of the compressed output, ending the stream"""
+
+
+class _ZlibStream(StreamCompressor):
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip container
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class GzipCodec(Codec):
+    name = "gzip"
+
+    def compress(self, data: bytes) -> bytes:
+        return gzip.compress(data, GZIP_LEVEL, mtime=0)
+
+    def compressor(self) -> StreamCompressor:
+        return _ZlibStream(GZIP_LEVEL)
+
+
+class _BrotliStream(StreamCompressor):
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class BrotliCodec(Codec):
+    name = "br"
+
+    def compress(self, data: bytes) -> bytes:
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+
+    def compressor(self) -> StreamCompressor:
+        return _BrotliStream()
+
+
+class _ZstdStream(StreamCompressor):
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+
+    def compress(self, data: bytes) -> bytes:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+    def compressor(self) -> StreamCompressor:
+        return _ZstdStream()
+
+
+def available_codecs(names: str = SARCRISK_COMPRESS_ENCODINGS) -> List[Codec]:
+    """Codecs for the comma-separated encoding names, in order, skipping those not installed"""
+    installed = {"gzip": GzipCodec}
+    if brotli is not None:
+        installed["br"] = BrotliCodec
+    if zstandard is not None:
+        installed["zstd"] = ZstdCodec
+    return [installed[name]() for name in (name.strip() for name in names.split(",")) if name in installed]
+
+
+def parse_qvalues(header: str) -> Dict[str, float]:
+    """``{value: q}`` from an Accept-style header (Accept, Accept-Encoding), in header order"""
+    weights = {}
+    for item in header.split(","):
+        coding, _, params = item.strip().partition(";")
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding.strip().lower()] = q
+    return weights
+
+
+def choose_codec(accept_encoding: Optional[str], codecs: List[Codec]) -> Optional[Codec]:
+    """The codec with the client's highest q-value, ties going to the server's preference order"""
+    if not accept_encoding:
+        return None
+    weights = parse_qvalues(accept_encoding)
+    wildcard = weights.get("*", 0.0)
+    best, best_q = None, 0.0
+    for codec in codecs:
+        q = weights.get(codec.name, wildcard)
+        if q > best_q:
+            best, best_q = codec, q
+    return best
+
+
+def compressible(content_type: Optional[str]) -> bool:
+    """JSON (including FHIR JSON and NDJSON), XML and text"""
+    if not content_type:
+        return False
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    return media_type.startswith("text/") or media_type.endswith(("json", "xml"))
+
+
+class CompressionMiddleware:
+    """Pure ASGI response compression (see the module docstring)"""
+
+    def __init__(self, app, minimum_size: int = SARCRISK_COMPRESS_MIN_SIZE,
+                 threadpool_size: int = SARCRISK_COMPRESS_THREADPOOL_SIZE, codecs: Optional[List[Codec]] = None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.threadpool_size = threadpool_size
+        self.codecs = available_codecs() if codecs is None else codecs
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if not self.codecs:
+            await self.app(scope, receive, send)
+            return
+        # Without an acceptable encoding the response still gets its Vary header
+        codec = choose_codec(Headers(scope=scope).get("accept-encoding"), self.codecs)
+        await _CompressingResponder(self, codec, send).run(self.app, scope, receive)
+
+    async def _compress(self, function, data: bytes) -> bytes:
+        if len(data) >= self.threadpool_size:
+            return await run_in_threadpool(function, data)
+        return function(data)
+
+
+class _CompressingResponder:
+    def __init__(self, middleware: CompressionMiddleware, codec: Optional[Codec], send):
+        self.middleware = middleware
+        self.codec = codec
+        self.send = send
+        self.start: Optional[dict] = None
+        self.mode: Optional[str] = None  # None until the first body chunk, then "identity" or "stream"
+        self.stream: Optional[StreamCompressor] = None
+
+    async def run(self, app, scope, receive) -> None:
+        await app(scope, receive, self.on_send)
+
+    def _eligible(self) -> Tuple[bool, MutableHeaders]:
+        headers = MutableHeaders(raw=self.start.setdefault("headers", []))
+        eligible = (
+            self.start["status"] not in (204, 304)
+            and "content-encoding" not in headers
+            and compressible(headers.get("content-type"))
+        )
+        return eligible, headers
+
+    async def on_send(self, message) -> None:
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body, more_body = message.get("body", b""), message.get("more_body", False)
+        if self.mode == "identity":
+            await self.send(message)
+            return
+        if self.mode == "stream":
+            data = await self.middleware._compress(self.stream.compress, body)
+            if not more_body:
+                data += self.stream.finish()
+            await self.send({"type": "http.response.body", "body": data, "more_body": more_body})
+            return
+
+        eligible, headers = self._eligible()
+        if eligible:
+            # On every compressible response, so caches do not reuse an identity body for gzip clients or vice versa
+            headers.add_vary_header("Accept-Encoding")
+        if self.codec is None or not eligible or (not more_body and len(body) < self.middleware.minimum_size):
+            self.mode = "identity"
+            await self.send(self.start)
+            await self.send(message)
+            return
+
+        headers["Content-Encoding"] = self.codec.name
+        if more_body:
+            # Streamed body of unknown length: compress chunk by chunk
+            self.mode = "stream"
+            del headers["Content-Length"]
+            self.stream = self.codec.compressor()
+            data = await self.middleware._compress(self.stream.compress, body)
+            await self.send(self.start)
+            await self.send({"type": "http.response.body", "body": data, "more_body": True})
+            return
+
+        self.mode = "identity"
+        data = await self.middleware._compress(self.codec.compress, body)
+        headers["Content-Length"] = str(len(data))
+        await self.send(self.start)
+        await self.send({"type": "http.response.body", "body": data, "more_body": False})
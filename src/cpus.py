@@ -0,0 +1,27 @@
+"""
+CPUs available to this process, for sizing worker pools.
+
+Inside a container the host's CPU count overstates what the process may use:
+it can be pinned to fewer CPUs (affinity mask) and throttled to a share of
+them (cgroup CPU quota). Both the Gunicorn worker count and the process pools
+default to this.
+"""
+import math
+import os
+
+
+def available_cpus() -> int:
+    """CPUs this process may run on, capped by the cgroup (v2 or v1) CPU quota if there is one"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f, open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as g:
+                quota, period = f.read().strip(), g.read().strip()
+        except OSError:
+            return cpus
+    if quota in ("max", "-1"):
+        return cpus
+    return max(1, min(cpus, math.ceil(int(quota) / int(period))))
@@ -0,0 +1,210 @@
+import os
+from decimal import Decimal, InvalidOperation
+from typing import List, Optional, Tuple
+
+from .fhir_fragments import (
+    BASIS_REFERENCES, CLINICAL_SYMPTOMS_URL, EXTENSION_URL_JSON, IMAGING_FINDINGS_URL, SARCOMA_RISK_CODE,
+    SNOMED_SYSTEM, SUSPECTED_SUBTYPES_URL, TUMOR_SIZE_URL, Fragment, observation_code
+)
+from .fhir_json import dumps
+from .models import PatientInputs, PatientRecord
+from .rules import CLINICAL_FLAGS, IMAGING_FLAGS
+
+# Fast mode builds FHIR JSON from plain dicts. Strict mode round-trips every
+# resource through its fhir.resources model before serializing.
+SARCRISK_STRICT_FHIR = os.getenv("SARCRISK_STRICT_FHIR", "false").lower() in ("1", "true", "yes")
+
+
+def _decimal(value):
+    """FHIR decimal from client-supplied input; the only value checked in fast mode"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    # Same coercion (and the same rejections) as the pydantic decimal field
+    try:
+        if isinstance(value, bool):
+            raise InvalidOperation
+        parsed = Decimal(str(value))
+    except InvalidOperation:
+        raise ValueError(f"{value!r} is not a valid decimal")
+    return float(parsed) if "." in str(parsed) or "E" in str(parsed) else int(parsed)
+
+
+def present_findings(patient_data: PatientInputs) -> Tuple[List[str], List[str]]:
+    """``(symptoms, imaging findings)`` that are present, tested as the scorer tests them"""
+    if isinstance(patient_data, PatientRecord):
+        clinical_data = imaging_data = patient_data
+    else:
+        clinical_data, imaging_data = patient_data["clinical_data"], patient_data["imaging_data"]
+    return ([name for name in CLINICAL_FLAGS if clinical_data.get(name)],
+            [name for name in IMAGING_FLAGS if imaging_data.get(name)])
+
+
+def _mapped_inputs(patient_data: PatientInputs):
+    """``(tumor_size, symptoms, imaging findings)`` shown on a RiskAssessment"""
+    clinical_data = patient_data if isinstance(patient_data, PatientRecord) else patient_data["clinical_data"]
+    return (clinical_data.get("tumor_size", 0),) + present_findings(patient_data)
+
+
+def risk_assessment_dict(patient_data: PatientInputs, total_score: float, risk_category: str,
+                         suspected_subtypes: list, patient_id: str = "12345",
+                         assessment_id: Optional[str] = None, method: Optional[Fragment] = None,
+                         basis: Optional[List[dict]] = None, rationale: Optional[str] = None) -> dict:
+    """Plain-dict equivalent of ``athena.map_to_risk_assessment``"""
+    tumor_size, symptoms, findings = _mapped_inputs(patient_data)
+    resource = {"resourceType": "RiskAssessment"}
+    if assessment_id is not None:
+        resource["id"] = assessment_id
+    resource.update({
+        "extension": [
+            {
+                "url": SUSPECTED_SUBTYPES_URL,
+                "valueCodeableConcept": {"text": ", ".join(suspected_subtypes)},
+            },
+            {
+                "url": TUMOR_SIZE_URL,
+                "valueQuantity": {"value": _decimal(tumor_size), "unit": "cm"},
+            },
+            {
+                "url": CLINICAL_SYMPTOMS_URL,
+                "valueCodeableConcept": {"text": "Pain, Swelling, Fever: " + ", ".join(symptoms)},
+            },
+            {
+                "url": IMAGING_FINDINGS_URL,
+                "valueCodeableConcept": {"text": "MRI Abnormalities, PET Scan Activity: " + ", ".join(findings)},
+            },
+        ],
+        "status": "final",
+    })
+    if method is not None:
+        resource["method"] = method.value
+    prediction = {"outcome": {"text": risk_category}, "probabilityDecimal": float(total_score)}
+    if rationale is not None:
+        prediction["rationale"] = rationale
+    resource.update({
+        "code": SARCOMA_RISK_CODE.value,
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "basis": BASIS_REFERENCES.value if basis is None else basis,
+        "prediction": [prediction],
+    })
+    return resource
+
+
+# RiskAssessment JSON template: the constant segments are pre-serialized once
+# and the dynamic values are spliced in between them.
+_RISK_ASSESSMENT_SEGMENTS = (
+    '"extension":[{"url":%s,"valueCodeableConcept":{"text":' % EXTENSION_URL_JSON[SUSPECTED_SUBTYPES_URL],
+    '}},{"url":%s,"valueQuantity":{"value":' % EXTENSION_URL_JSON[TUMOR_SIZE_URL],
+    ',"unit":"cm"}},{"url":%s,"valueCodeableConcept":{"text":' % EXTENSION_URL_JSON[CLINICAL_SYMPTOMS_URL],
+    '}},{"url":%s,"valueCodeableConcept":{"text":' % EXTENSION_URL_JSON[IMAGING_FINDINGS_URL],
+    '}}],"status":"final"',
+    ',"code":%s,"subject":{"reference":' % SARCOMA_RISK_CODE.json,
+    '},"basis":',
+    ',"prediction":[{"outcome":{"text":',
+    '},"probabilityDecimal":',
+    ',"rationale":',
+    '}]}',
+)
+
+
+def _render_risk_assessment_template(patient_data: PatientInputs, total_score: float, risk_category: str,
+                                     suspected_subtypes: list, patient_id: str, assessment_id: Optional[str],
+                                     method: Optional[Fragment], basis: Optional[List[dict]],
+                                     rationale: Optional[str]) -> str:
+    tumor_size, symptoms, findings = _mapped_inputs(patient_data)
+    segments = _RISK_ASSESSMENT_SEGMENTS
+    header = '{"resourceType":"RiskAssessment",'
+    if assessment_id is not None:
+        header = '{"resourceType":"RiskAssessment","id":%s,' % dumps(assessment_id)
+    return "".join((
+        header, segments[0], dumps(", ".join(suspected_subtypes)),
+        segments[1], dumps(_decimal(tumor_size)),
+        segments[2], dumps("Pain, Swelling, Fever: " + ", ".join(symptoms)),
+        segments[3], dumps("MRI Abnormalities, PET Scan Activity: " + ", ".join(findings)),
+        segments[4], ',"method":' + method.json if method is not None else "",
+        segments[5], dumps(f"Patient/{patient_id}"),
+        segments[6], BASIS_REFERENCES.json if basis is None else dumps(basis),
+        segments[7], dumps(risk_category),
+        segments[8], dumps(float(total_score)),
+        segments[9] + dumps(rationale) if rationale is not None else "",
+        segments[10],
+    ))
+
+
+def observation_dict(resource_type: str, data: dict, code: str, display: str,
+                     patient_id: Optional[str] = None, system: str = SNOMED_SYSTEM,
+                     observation_id: Optional[str] = None) -> dict:
+    """Plain-dict equivalent of ``athena.map_to_observation``"""
+    observation = {"resourceType": "Observation"}
+    if observation_id is not None:
+        observation["id"] = observation_id
+    observation["status"] = "final"
+    observation["code"] = observation_code(system, code, display).value
+    if patient_id is not None:
+        observation["subject"] = {"reference": f"Patient/{patient_id}"}
+    if resource_type == "clinical":
+        observation["valueQuantity"] = {"value": _decimal(data.get("tumor_size", 0)), "unit": "cm"}
+    elif resource_type == "molecular":
+        observation["valueQuantity"] = {"value": _decimal(data.get("VEGF_level", 0)), "unit": "pg/mL"}
+    elif resource_type == "imaging":
+        observation["valueCodeableConcept"] = {"text": ", ".join(data.keys())}
+    return observation
+
+
+def patient_dict(patient_data: dict, patient_id: str = "12345") -> dict:
+    """Plain-dict equivalent of ``athena.map_to_patient``"""
+    name = patient_data["name"]
+    return {
+        "resourceType": "Patient",
+        "id": patient_id,
+        "name": [{"use": "official", "family": name["family"], "given": list(name["given"])}],
+    }
+
+
+def operation_outcome_dict(message: str, code: str = "invalid") -> dict:
+    """Plain-dict equivalent of ``athena.map_to_operation_outcome``"""
+    return {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": code, "diagnostics": message}]}
+
+
+def render(resource: dict, validate: Optional[bool] = None) -> str:
+    """
+    Serialize a resource dict to FHIR JSON.
+
+    With ``validate`` (default: ``SARCRISK_STRICT_FHIR``) the resource is parsed
+    into its fhir.resources model first, so invalid content raises exactly as
+    the object-graph path would.
+    """
+    strict = SARCRISK_STRICT_FHIR if validate is None else validate
+    if strict:
+        from fhir.resources import construct_fhir_element
+
+        return construct_fhir_element(resource["resourceType"], resource).json()
+    return dumps(resource)
+
+
+def render_risk_assessment(patient_data: PatientInputs, total_score: float, risk_category: str, suspected_subtypes: list,
+                           patient_id: str = "12345", validate: Optional[bool] = None,
+                           assessment_id: Optional[str] = None, method: Optional[Fragment] = None,
+                           basis: Optional[List[dict]] = None, rationale: Optional[str] = None) -> str:
+    strict = SARCRISK_STRICT_FHIR if validate is None else validate
+    if not strict:
+        return _render_risk_assessment_template(
+            patient_data, total_score, risk_category, suspected_subtypes, patient_id, assessment_id, method, basis,
+            rationale
+        )
+    return render(
+        risk_assessment_dict(
+            patient_data, total_score, risk_category, suspected_subtypes, patient_id, assessment_id, method, basis,
+            rationale
+        ),
+        True
+    )
+
+
+def render_observation(resource_type: str, data: dict, code: str, display: str, patient_id: Optional[str] = None,
+                       system: str = SNOMED_SYSTEM, validate: Optional[bool] = None,
+                       observation_id: Optional[str] = None) -> str:
+    return render(observation_dict(resource_type, data, code, display, patient_id, system, observation_id), validate)
+
+
+def render_patient(patient_data: dict, patient_id: str = "12345", validate: Optional[bool] = None) -> str:
+    return render(patient_dict(patient_data, patient_id), validate)
@@ -0,0 +1,366 @@
+"""
+Local columnar store of patient scoring inputs.
+
+One row per patient with a fixed schema: ``VEGF_level`` and ``tumor_size`` as
+float64 columns, and the nine mutation / symptom / imaging flags bit-packed
+into a uint16, plus a second bitmask recording which inputs were supplied.
+That is 20 bytes per patient instead of a few hundred for nested dicts.
+
+Columns are ``.npy`` files opened as memory maps, so the store persists
+across restarts, the OS pages it in on demand, and ``cohort()`` hands the
+float columns to ``scoring.score_cohort`` without copying. Re-scoring the
+whole population needs no network I/O:
+
+    python -m src.feature_store <directory> [--ndjson out.ndjson]
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .rules import CompiledRules, current_rules
+from .scoring import CLINICAL_FLAGS, IMAGING_FLAGS, MOLECULAR_FLAGS, CohortArrays, CohortScores, score_cohort
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - fcntl is POSIX-only
+    fcntl = None
+
+SARCRISK_FEATURE_STORE_DIR = os.getenv("SARCRISK_FEATURE_STORE_DIR")
+
+FORMAT_VERSION = 1
+
+# Every scoring input as (section, key), in bit order
+FIELDS: Tuple[Tuple[str, str], ...] = (
+    (("molecular_data", "VEGF_level"),)
+    + tuple(("molecular_data", name) for name in MOLECULAR_FLAGS)
+    + (("clinical_data", "tumor_size"),)
+    + tuple(("clinical_data", name) for name in CLINICAL_FLAGS)
+    + tuple(("imaging_data", name) for name in IMAGING_FLAGS)
+)
+BITS = {key: np.uint16(1 << i) for i, (_, key) in enumerate(FIELDS)}
+FLAG_NAMES = MOLECULAR_FLAGS + CLINICAL_FLAGS + IMAGING_FLAGS
+SECTIONS = ("molecular_data", "clinical_data", "imaging_data")
+
+COLUMNS = (
+    ("vegf_level", np.float64),
+    ("tumor_size", np.float64),
+    ("flags", np.uint16),    # value of each flag input
+    ("present", np.uint16),  # which inputs (flags and numbers) were supplied
+)
+
+
+def encode(patient_data: dict) -> Tuple[float, float, int, int]:
+    """Row values for one ``patient_data`` dict, with the scorer's coercions"""
+    flags = present = 0
+    values = {}
+    for section, key in FIELDS:
+        data = patient_data.get(section) or {}
+        if key not in data:
+            continue
+        present |= int(BITS[key])
+        if key in ("VEGF_level", "tumor_size"):
+            values[key] = float(data[key] or 0)
+        elif data[key]:
+            flags |= int(BITS[key])
+    return values.get("VEGF_level", 0.0), values.get("tumor_size", 0.0), flags, present
+
+
+def decode(vegf_level: float, tumor_size: float, flags: int, present: int) -> dict:
+    """``patient_data`` sections holding the supplied inputs, in schema order"""
+    patient_data = {section: {} for section in SECTIONS}
+    numbers = {"VEGF_level": vegf_level, "tumor_size": tumor_size}
+    for section, key in FIELDS:
+        bit = int(BITS[key])
+        if present & bit:
+            patient_data[section][key] = float(numbers[key]) if key in numbers else bool(flags & bit)
+    return patient_data
+
+
+class FeatureStore:
+    """
+    Memory-mapped feature store keyed by patient ID.
+
+    Several processes (e.g. gunicorn workers) may open the same directory.
+    Writers are serialized by a thread lock and an ``fcntl`` lock on the
+    ``lock`` file, and catch up with rows other processes added before
+    writing; readers get views of the mapped columns and catch up whenever
+    ``meta.json`` changed. The row count in ``meta.json`` is written last on
+    every upsert, so a crash mid-write leaves the previous state readable.
+    """
+
+    def __init__(self, path: str, initial_capacity: int = 1024):
+        self.path = path
+        self._lock = threading.RLock()
+        self._lock_file = None
+        self._lock_pid: Optional[int] = None
+        self._lock_depth = 0
+        self._count = 0
+        self._columns: Dict[str, np.memmap] = {}
+        self._column_inodes: Dict[str, int] = {}
+        self._ids: List[str] = []
+        self._ids_offset = 0  # bytes of ids.txt holding the first ``_count`` ids
+        self._rows: Dict[str, int] = {}
+        self._meta_version: Optional[Tuple[int, int]] = None
+        os.makedirs(path, exist_ok=True)
+        with self.locked(sync=False):
+            if not os.path.exists(self._meta_path):
+                for name, dtype in COLUMNS:
+                    np.lib.format.open_memmap(self._column_path(name), mode="w+", dtype=dtype,
+                                              shape=(max(1, initial_capacity),)).flush()
+                open(self._ids_path, "w").close()
+                self._write_meta()
+                self._meta_version = None
+            self._reload()
+
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.path, "meta.json")
+
+    @property
+    def _ids_path(self) -> str:
+        return os.path.join(self.path, "ids.txt")
+
+    def _column_path(self, name: str) -> str:
+        return os.path.join(self.path, f"{name}.npy")
+
+    @contextmanager
+    def locked(self, sync: bool = True) -> Iterator["FeatureStore"]:
+        """
+        Hold the store's write lock across threads and processes, up to date
+        with every other writer, e.g. for a read-modify-write of some rows.
+        Reentrant within a thread.
+        """
+        with self._lock:
+            if self._lock_depth == 0 and fcntl is not None:
+                if self._lock_pid != os.getpid():
+                    # An flock is shared by forked copies of a descriptor: each process opens its own
+                    self._lock_file = open(os.path.join(self.path, "lock"), "a")
+                    self._lock_pid = os.getpid()
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                if sync and self._lock_depth == 1:
+                    self._reload()
+                yield self
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and fcntl is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _sync(self) -> None:
+        # Catch up with other processes' writes; while we hold the write lock there are none
+        if self._lock_depth == 0:
+            with self._lock:
+                self._reload()
+
+    def _reload(self) -> None:
+        """Pick up rows added, and columns grown, by other processes since this one last looked"""
+        stat = os.stat(self._meta_path)
+        if (stat.st_ino, stat.st_mtime_ns) == self._meta_version:
+            return
+        with open(self._meta_path) as f:
+            meta = json.load(f)
+        if meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported feature store version {meta.get('version')!r} in {self.path}")
+        for name, _ in COLUMNS:
+            inode = os.stat(self._column_path(name)).st_ino
+            if self._column_inodes.get(name) != inode:
+                self._columns[name] = np.lib.format.open_memmap(self._column_path(name), mode="r+")
+                self._column_inodes[name] = inode
+        if meta["count"] > len(self._ids):
+            with open(self._ids_path, "rb") as f:
+                f.seek(self._ids_offset)
+                for line in f:
+                    if len(self._ids) == meta["count"] or not line.endswith(b"\n"):
+                        break
+                    self._rows[line[:-1].decode()] = len(self._ids)
+                    self._ids.append(line[:-1].decode())
+                    self._ids_offset += len(line)
+        self._count = meta["count"]
+        self._meta_version = (stat.st_ino, stat.st_mtime_ns)
+
+    @property
+    def capacity(self) -> int:
+        return len(self._columns["flags"])
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes of column data in use"""
+        self._sync()
+        return sum(column[:self._count].nbytes for column in self._columns.values())
+
+    def __len__(self) -> int:
+        self._sync()
+        return self._count
+
+    def __contains__(self, patient_id: str) -> bool:
+        self._sync()
+        return patient_id in self._rows
+
+    @property
+    def ids(self) -> List[str]:
+        self._sync()
+        return self._ids[:self._count]
+
+    def _write_meta(self) -> None:
+        tmp = self._meta_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": FORMAT_VERSION, "count": self._count}, f)
+        os.replace(tmp, self._meta_path)
+        stat = os.stat(self._meta_path)
+        self._meta_version = (stat.st_ino, stat.st_mtime_ns)
+
+    def _grow(self, needed: int) -> None:
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        for name, dtype in COLUMNS:
+            path = self._column_path(name)
+            grown = np.lib.format.open_memmap(path + ".tmp", mode="w+", dtype=dtype, shape=(capacity,))
+            grown[:self._count] = self._columns[name][:self._count]
+            grown.flush()
+            os.replace(path + ".tmp", path)
+            # Earlier views keep the old mapping alive; new reads use the grown one
+            self._columns[name] = grown
+            self._column_inodes[name] = os.stat(path).st_ino
+
+    def upsert(self, patients: Dict[str, dict]) -> int:
+        """Insert or overwrite rows from ``{patient_id: patient_data}``; returns the number of rows written"""
+        encoded = [(patient_id, encode(patient_data)) for patient_id, patient_data in patients.items()]
+        for patient_id, _ in encoded:
+            if not patient_id or "\n" in patient_id:
+                raise ValueError(f"Invalid patient ID {patient_id!r}")
+
+        with self.locked():
+            new_ids = [patient_id for patient_id, _ in encoded if patient_id not in self._rows]
+            if self._count + len(new_ids) > self.capacity:
+                self._grow(self._count + len(new_ids))
+            for patient_id in new_ids:
+                self._rows[patient_id] = self._count
+                self._ids.append(patient_id)
+                self._count += 1
+
+            rows = np.fromiter((self._rows[patient_id] for patient_id, _ in encoded), dtype=np.int64,
+                               count=len(encoded))
+            for i, (name, dtype) in enumerate(COLUMNS):
+                self._columns[name][rows] = np.fromiter((values[i] for _, values in encoded), dtype=dtype,
+                                                        count=len(encoded))
+                self._columns[name].flush()
+            if new_ids:
+                # Drop ids a crashed writer appended without committing them to meta.json
+                os.truncate(self._ids_path, self._ids_offset)
+                written = "".join(patient_id + "\n" for patient_id in new_ids).encode()
+                with open(self._ids_path, "ab") as f:
+                    f.write(written)
+                self._ids_offset += len(written)
+            self._write_meta()
+        return len(encoded)
+
+    def get(self, patient_id: str) -> Optional[dict]:
+        """The stored inputs as a ``patient_data`` dict, or None"""
+        self._sync()
+        row = self._rows.get(patient_id)
+        if row is None:
+            return None
+        columns = self._columns
+        return decode(columns["vegf_level"][row], columns["tumor_size"][row],
+                      int(columns["flags"][row]), int(columns["present"][row]))
+
+    def rows(self, patient_ids: Iterable[str]) -> np.ndarray:
+        """Row numbers of ``patient_ids``; raises KeyError for unknown patients"""
+        self._sync()
+        return np.fromiter((self._rows[patient_id] for patient_id in patient_ids), dtype=np.int64)
+
+    def cohort(self, patient_ids: Optional[Iterable[str]] = None) -> CohortArrays:
+        """
+        Scoring inputs for all patients (row order, see ``ids``) or a subset.
+
+        For the whole store the float columns are zero-copy views of the memory
+        map; the flags are unpacked from their bits in one vectorized pass.
+        """
+        self._sync()
+        if patient_ids is None:
+            vegf_level = self._columns["vegf_level"][:self._count]
+            tumor_size = self._columns["tumor_size"][:self._count]
+            flags = self._columns["flags"][:self._count]
+        else:
+            rows = self.rows(patient_ids)
+            vegf_level = self._columns["vegf_level"][rows]
+            tumor_size = self._columns["tumor_size"][rows]
+            flags = self._columns["flags"][rows]
+        return CohortArrays(
+            vegf_level=vegf_level,
+            tumor_size=tumor_size,
+            flags={name: (flags & BITS[name]) != 0 for name in FLAG_NAMES},
+        )
+
+    def score(self, patient_ids: Optional[Iterable[str]] = None, rules: Optional[CompiledRules] = None,
+              explain: bool = False) -> Tuple[List[str], CohortScores]:
+        """
+        Score stored patients without touching the network; returns ``(ids, scores)`` in matching order.
+        ``explain`` adds per-factor contributions (see ``scoring.score_cohort``).
+        """
+        ids = self.ids if patient_ids is None else list(patient_ids)
+        return ids, score_cohort(self.cohort(None if patient_ids is None else ids), rules, explain)
+
+    def close(self) -> None:
+        for column in self._columns.values():
+            column.flush()
+        self._columns = {}
+        self._column_inodes = {}
+        self._meta_version = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file, self._lock_pid = None, None
+
+
+def create_feature_store() -> Optional[FeatureStore]:
+    """The process feature store, when SARCRISK_FEATURE_STORE_DIR is configured"""
+    return FeatureStore(SARCRISK_FEATURE_STORE_DIR) if SARCRISK_FEATURE_STORE_DIR else None
+
+
+# Process-wide feature store (None unless configured)
+feature_store = create_feature_store()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score every patient in a feature store")
+    parser.add_argument("path", help="feature store directory")
+    parser.add_argument("--ndjson", help="also write the RiskAssessments as NDJSON to this file")
+    args = parser.parse_args()
+
+    store = FeatureStore(args.path)
+    rules = current_rules()
+    started = time.perf_counter()
+    ids, scores = store.score(rules=rules, explain=bool(args.ndjson))
+    elapsed = time.perf_counter() - started
+    print(f"scored {len(ids)} patients from {args.path} in {elapsed * 1000:.1f} ms "
+          f"({store.nbytes} bytes of features)")
+    for category, count in sorted(Counter(scores.category.tolist()).items()):
+        print(f"  {category:<6} {count}")
+
+    if args.ndjson:
+        from .athena import observation_basis
+        from .fast_fhir import render_risk_assessment
+
+        contributions = scores.contributions.tolist()
+        with open(args.ndjson, "w") as f:
+            for i, patient_id in enumerate(ids):
+                patient_data = store.get(patient_id)
+                f.write(render_risk_assessment(
+                    patient_data, float(scores.total[i]), str(scores.category[i]),
+                    rules.suspected_subtypes(patient_data), patient_id=patient_id, assessment_id=patient_id,
+                    method=rules.method, basis=observation_basis(patient_id, contributions[i], rules),
+                    rationale=rules.rationale(contributions[i])
+                ) + "\n")
+
+
+if __name__ == "__main__":
+    main()
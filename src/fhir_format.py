@@ -0,0 +1,185 @@
+"""
+FHIR response representations.
+
+``negotiate`` picks FHIR JSON or NDJSON from ``_format`` (which wins) or the
+``Accept`` header, and reads the ``_elements`` / ``_summary`` subsetting
+parameters. ``Representation.render`` then reshapes an already-serialized
+resource or Bundle: a plain FHIR JSON request is passed through untouched,
+anything else is parsed once, subsetted and re-serialized. In a Bundle the
+subsetting applies to each entry's resource; as NDJSON a Bundle becomes one
+line per entry resource (or per error OperationOutcome).
+"""
+from dataclasses import dataclass
+from typing import Callable, Mapping, Optional, Tuple
+
+from .compression import parse_qvalues
+from .fhir_json import dumps, loads
+
+FHIR_JSON = "application/fhir+json"
+FHIR_NDJSON = "application/fhir+ndjson"
+
+FORMATS = {
+    "json": FHIR_JSON,
+    "application/json": FHIR_JSON,
+    "application/fhir+json": FHIR_JSON,
+    "ndjson": FHIR_NDJSON,
+    "application/ndjson": FHIR_NDJSON,
+    "application/x-ndjson": FHIR_NDJSON,
+    "application/fhir+ndjson": FHIR_NDJSON,
+}
+SUMMARY_MODES = ("true", "text", "data", "false")
+
+# Kept in every subset
+BASE_ELEMENTS = ("resourceType", "id", "meta")
+
+# Elements with a minimum cardinality of 1, kept by ``_elements`` and ``_summary=text``
+MANDATORY_ELEMENTS = {
+    "RiskAssessment": ("status", "subject"),
+    "Observation": ("status", "code"),
+    "OperationOutcome": ("issue",),
+    "Bundle": ("type",),
+}
+
+# Summary (Σ) elements of the resources this server returns (FHIR R4 / R4B);
+# "[x]" marks a choice element such as ``valueQuantity``
+SUMMARY_ELEMENTS = {
+    "RiskAssessment": (
+        "implicitRules", "identifier", "basedOn", "parent", "status", "method", "code", "subject", "encounter",
+        "occurrence[x]", "condition", "performer",
+    ),
+    "Observation": (
+        "implicitRules", "identifier", "basedOn", "partOf", "status", "code", "subject", "focus", "encounter",
+        "effective[x]", "issued", "performer", "value[x]", "hasMember", "derivedFrom", "component",
+    ),
+    "Patient": (
+        "implicitRules", "identifier", "active", "name", "telecom", "gender", "birthDate", "deceased[x]", "address",
+        "managingOrganization", "link",
+    ),
+    "OperationOutcome": ("implicitRules", "issue"),
+    "Bundle": ("implicitRules", "identifier", "type", "timestamp", "total", "link", "entry"),
+}
+
+SUBSETTED_TAG = {"system": "http://terminology.hl7.org/CodeSystem/v3-ObservationValue", "code": "SUBSETTED"}
+
+
+class FormatError(ValueError):
+    """A representation the server cannot produce; ``status_code`` is the HTTP status to answer with"""
+
+    def __init__(self, status_code: int, message: str, code: str = "not-supported"):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+
+
+def _matches(key: str, elements: Tuple[str, ...]) -> bool:
+    name = key[1:] if key.startswith("_") else key  # ``_status`` carries the extensions of ``status``
+    for element in elements:
+        if element.endswith("[x]"):
+            prefix = element[:-3]
+            if name.startswith(prefix) and name[len(prefix):len(prefix) + 1].isupper():
+                return True
+        elif name == element:
+            return True
+    return False
+
+
+def subset(resource: dict, keep: Callable[[str, str], bool]) -> dict:
+    """
+    ``resource`` with only the top-level elements ``keep(resource_type, key)``
+    accepts (plus ``BASE_ELEMENTS``), tagged SUBSETTED when anything was dropped.
+    """
+    resource_type = resource.get("resourceType", "")
+    kept = {key: value for key, value in resource.items() if key in BASE_ELEMENTS or keep(resource_type, key)}
+    if len(kept) == len(resource):
+        return resource
+    meta = dict(kept.get("meta") or {})
+    meta["tag"] = list(meta.get("tag") or []) + [SUBSETTED_TAG]
+    # ``meta`` belongs right after ``id``; rebuild to keep the element order
+    tagged = {}
+    for key, value in kept.items():
+        if key != "meta":
+            tagged[key] = value
+        if key == ("id" if "id" in kept else "resourceType"):
+            tagged["meta"] = meta
+    return tagged
+
+
+@dataclass(frozen=True)
+class Representation:
+    media_type: str = FHIR_JSON
+    elements: Optional[Tuple[str, ...]] = None
+    summary: Optional[str] = None  # "true" | "text" | "data"; None for the full resource
+
+    @property
+    def subsetted(self) -> bool:
+        return self.elements is not None or self.summary is not None
+
+    @property
+    def reshapes(self) -> bool:
+        """False when the serialized content is sent as-is"""
+        return self.subsetted or self.media_type != FHIR_JSON
+
+    def keep(self, resource_type: str, key: str) -> bool:
+        mandatory = MANDATORY_ELEMENTS.get(resource_type, ())
+        if self.elements is not None:
+            return _matches(key, self.elements + mandatory)
+        if self.summary == "data":
+            return key != "text"
+        if self.summary == "text":
+            return key == "text" or _matches(key, mandatory)
+        return _matches(key, SUMMARY_ELEMENTS.get(resource_type, ()) + mandatory)
+
+    def render(self, content: str) -> str:
+        """Reshape one serialized resource or Bundle into this representation"""
+        if not self.reshapes:
+            return content
+        resource = loads(content)
+        if resource.get("resourceType") == "Bundle":
+            entries = resource.get("entry") or []
+            if self.subsetted:
+                for entry in entries:
+                    if "resource" in entry:
+                        entry["resource"] = subset(entry["resource"], self.keep)
+            if self.media_type == FHIR_NDJSON:
+                lines = [entry.get("resource") or (entry.get("response") or {}).get("outcome") for entry in entries]
+                return "".join(dumps(line) + "\n" for line in lines if line)
+        elif self.subsetted:
+            resource = subset(resource, self.keep)
+        return dumps(resource) + "\n" if self.media_type == FHIR_NDJSON else dumps(resource)
+
+
+def _accepted_format(accept: Optional[str]) -> str:
+    """The best FHIR format in an Accept header; JSON when it names none we produce"""
+    best, best_q = FHIR_JSON, 0.0
+    for media_type, q in parse_qvalues(accept or "").items():
+        media_format = FORMATS.get(media_type) or (FHIR_JSON if media_type in ("*/*", "application/*") else None)
+        if media_format is not None and q > best_q:
+            best, best_q = media_format, q
+    return best
+
+
+def negotiate(params: Mapping[str, str], accept: Optional[str] = None) -> Representation:
+    """
+    The representation asked for by the ``_format`` / ``_elements`` / ``_summary``
+    query parameters and the ``Accept`` header; raises ``FormatError``.
+    """
+    requested = params.get("_format")
+    if requested:
+        # An unescaped "+" in a query string arrives as a space
+        media_format = FORMATS.get(requested.split(";", 1)[0].strip().lower().replace(" ", "+"))
+        if media_format is None:
+            raise FormatError(406, f"Unsupported _format {requested!r}; use json or ndjson")
+    else:
+        media_format = _accepted_format(accept)
+
+    elements = params.get("_elements")
+    summary = params.get("_summary")
+    if summary is not None and summary not in SUMMARY_MODES:
+        raise FormatError(400, f"Unsupported _summary {summary!r}; use {', '.join(SUMMARY_MODES)}")
+    if elements is not None and summary not in (None, "false"):
+        raise FormatError(400, "_elements and _summary cannot be combined", "invalid")
+    return Representation(
+        media_type=media_format,
+        elements=tuple(name.strip() for name in elements.split(",") if name.strip()) if elements is not None else None,
+        summary=None if summary in (None, "false") else summary,
+    )
@@ -0,0 +1,122 @@
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Any, Dict, List
+
+from . import fhir_models
+from .fhir_json import dumps
+
+# Constant FHIR content shared by every RiskAssessment / Observation we emit.
+# Each fragment is built once and then reused as-is:
+#  - ``value``: a frozen plain-data form for the dict serialization path
+#  - ``json``:  its pre-serialized JSON text for the template path
+#  - ``model``: a validated fhir.resources object for the model path, parsed
+#    on first use (or by ``fhir_models.warm_up``) to keep fhir.resources off
+#    the import path
+# All three are shared between responses and must be treated as read-only.
+
+SNOMED_SYSTEM = "http://snomed.info/sct"
+
+SUSPECTED_SUBTYPES_URL = "http://example.com/suspected-sarcoma-subtypes"
+TUMOR_SIZE_URL = "http://example.com/tumor-size"
+CLINICAL_SYMPTOMS_URL = "http://example.com/clinical-symptoms"
+IMAGING_FINDINGS_URL = "http://example.com/imaging-findings"
+RULESET_SYSTEM = "http://example.com/sarcrisk-ruleset"
+
+
+class FrozenDict(dict):
+    """A dict that refuses modification, so shared fragments cannot be corrupted by one response"""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("FHIR fragments are immutable")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __hash__(self):
+        return hash(dumps(self))
+
+
+def freeze(value: Any) -> Any:
+    """Recursively convert dicts to FrozenDicts and lists to tuples"""
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+@dataclass(frozen=True)
+class Fragment:
+    value: Any
+    json: str
+    model_class: str  # class name in ``fhir_models``
+
+    @cached_property
+    def model(self) -> Any:
+        model_class = getattr(fhir_models, self.model_class)
+        if isinstance(self.value, tuple):
+            return [model_class.parse_obj(item) for item in self.value]
+        return model_class.parse_obj(self.value)
+
+
+_fragments: List[Fragment] = []
+
+
+def _fragment(model_class: str, value) -> Fragment:
+    fragment = Fragment(value=freeze(value), json=dumps(value), model_class=model_class)
+    _fragments.append(fragment)
+    return fragment
+
+
+SARCOMA_RISK_CODE = _fragment("CodeableConcept", {
+    "coding": [{"system": SNOMED_SYSTEM, "code": "420324007", "display": "Sarcoma risk assessment"}]
+})
+
+BASIS_REFERENCES = _fragment("Reference", [
+    {"reference": "Observation/clinical-data"},
+    {"reference": "Observation/molecular-data"},
+    {"reference": "Observation/tumor-size"},
+    {"reference": "Observation/clinical-symptoms"},
+    {"reference": "Observation/imaging-findings"},
+])
+
+# Pre-serialized ``"url":...`` prefixes for the RiskAssessment extensions
+EXTENSION_URL_JSON: Dict[str, str] = {
+    url: dumps(url) for url in (SUSPECTED_SUBTYPES_URL, TUMOR_SIZE_URL, CLINICAL_SYMPTOMS_URL, IMAGING_FINDINGS_URL)
+}
+
+_codings: Dict[tuple, Fragment] = {}
+
+
+def observation_code(system: str, code: str, display: str) -> Fragment:
+    """Shared ``Observation.code`` fragment, built and validated on first use per code"""
+    key = (system, code, display)
+    fragment = _codings.get(key)
+    if fragment is None:
+        fragment = _codings[key] = _fragment(
+            "CodeableConcept", {"coding": [{"system": system, "code": code, "display": display}]}
+        )
+    return fragment
+
+
+_methods: Dict[tuple, Fragment] = {}
+
+
+def ruleset_method(name: str, version: str) -> Fragment:
+    """Shared ``RiskAssessment.method`` fragment naming the rule set version that scored it"""
+    key = (name, version)
+    fragment = _methods.get(key)
+    if fragment is None:
+        fragment = _methods[key] = _fragment("CodeableConcept", {
+            "coding": [{"system": RULESET_SYSTEM, "code": version, "display": f"{name} rule set {version}"}]
+        })
+    return fragment
+
+
+# Observation codes used by the export and the examples in athena.py
+TUMOR_SIZE_CODE = observation_code(SNOMED_SYSTEM, "7530005", "Tumor Size")
+
+
+def warm_up_fragments() -> None:
+    """Parse the model of every fragment built so far"""
+    for fragment in list(_fragments):
+        fragment.model
@@ -0,0 +1,277 @@
+import math
+import re
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .fhir_json import loads
+from .models import INPUT_INDEX, PatientRecord
+
+# Observation codes understood by the scoring pipeline, mapped to the
+# patient_data section and key they populate. Observations may carry the value
+# directly or as components coded the same way.
+FEATURE_SYSTEM = "http://example.com/sarcrisk-features"
+FEATURE_CODES = {
+    "VEGF_level": ("molecular_data", "VEGF_level"),
+    "CDKN2A_mutation": ("molecular_data", "CDKN2A_mutation"),
+    "TP53_mutation": ("molecular_data", "TP53_mutation"),
+    "pain": ("clinical_data", "pain"),
+    "swelling": ("clinical_data", "swelling"),
+    "fever": ("clinical_data", "fever"),
+    "tumor_size": ("clinical_data", "tumor_size"),
+    "7530005": ("clinical_data", "tumor_size"),  # SNOMED tumor size, as produced by map_to_observation
+    "mri_abnormalities": ("imaging_data", "mri_abnormalities"),
+    "ct_scan_abnormalities": ("imaging_data", "ct_scan_abnormalities"),
+    "pet_scan_high_activity": ("imaging_data", "pet_scan_high_activity"),
+    "x_ray_findings": ("imaging_data", "x_ray_findings"),
+}
+
+# Observation code -> ``PatientRecord`` slot
+FEATURE_INDEX = {code: INPUT_INDEX[key] for code, (_, key) in FEATURE_CODES.items()}
+
+NDJSON_MEDIA_TYPES = ("application/fhir+ndjson", "application/x-ndjson", "application/ndjson")
+
+# FHIR ``id`` datatype: up to 64 letters, digits, '-' and '.'
+FHIR_ID = re.compile(r"[A-Za-z0-9\-.]{1,64}")
+
+
+def valid_id(value: object) -> bool:
+    return isinstance(value, str) and FHIR_ID.fullmatch(value) is not None
+
+
+class IngestError(ValueError):
+    """An input entry that cannot be turned into scoring data"""
+
+    def __init__(self, message: str, index: Optional[int] = None):
+        super().__init__(message)
+        self.index = index
+
+
+def parse_resources(body: bytes, content_type: str = "application/fhir+json") -> List[Tuple[int, object]]:
+    """
+    Parse a request body into ``(entry_index, resource)`` pairs.
+
+    Accepts a FHIR Bundle, a single resource, or NDJSON (one resource per
+    line). Lines or entries that cannot be parsed are returned as
+    ``IngestError`` values so they can be reported per entry.
+    """
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type in NDJSON_MEDIA_TYPES:
+        return list(_parse_ndjson(body))
+
+    document = loads(body)
+    if not isinstance(document, dict):
+        raise IngestError("Request body must be a FHIR resource or Bundle")
+    if document.get("resourceType") != "Bundle":
+        return [(0, document)]
+    return [
+        (index, entry.get("resource") if isinstance(entry, dict) and entry.get("resource")
+         else IngestError("Bundle entry has no resource", index))
+        for index, entry in enumerate(document.get("entry") or [])
+    ]
+
+
+def _parse_ndjson(body: bytes) -> Iterator[Tuple[int, object]]:
+    for index, line in enumerate(body.splitlines()):
+        if not line.strip():
+            continue
+        try:
+            yield index, loads(line)
+        except ValueError as e:
+            yield index, IngestError(f"Invalid JSON: {e}", index)
+
+
+def _codes(concept: Optional[dict]) -> Iterable[str]:
+    for coding in (concept or {}).get("coding") or []:
+        if coding.get("code"):
+            yield coding["code"]
+    if (concept or {}).get("text"):
+        yield concept["text"]
+
+
+def _value(element: dict):
+    if "valueBoolean" in element:
+        return bool(element["valueBoolean"])
+    if "valueQuantity" in element:
+        quantity = element["valueQuantity"]
+        if not isinstance(quantity, dict):
+            raise IngestError("valueQuantity must be an object")
+        value = float(quantity.get("value") or 0)
+        if not math.isfinite(value):
+            raise IngestError(f"valueQuantity value {quantity.get('value')!r} is not a finite number")
+        return value
+    if "valueInteger" in element:
+        value = element["valueInteger"]
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise IngestError(f"valueInteger {value!r} is not an integer")
+        return value
+    raise IngestError("Observation value must be valueBoolean, valueQuantity or valueInteger")
+
+
+def _apply_element(patient_data: dict, element: dict) -> None:
+    for code in _codes(element.get("code")):
+        if code in FEATURE_CODES:
+            section, key = FEATURE_CODES[code]
+            patient_data[section][key] = _value(element)
+            return
+
+
+def _feature_index(concept: Optional[dict]) -> Optional[int]:
+    """Record slot of the first code (then the text) of ``concept`` the scorer uses; same order as ``_codes``"""
+    if not concept:
+        return None
+    for coding in concept.get("coding") or ():
+        code = coding.get("code")
+        if code and code in FEATURE_INDEX:
+            return FEATURE_INDEX[code]
+    text = concept.get("text")
+    return FEATURE_INDEX.get(text) if text else None
+
+
+def _apply_to_record(record: PatientRecord, element: dict) -> None:
+    index = _feature_index(element.get("code"))
+    if index is not None:
+        record.set(index, _value(element))
+
+
+def _patient_name(patient: dict) -> Tuple[str, List[str]]:
+    """``(family, given)`` of a Patient's first name; raises ``IngestError`` for a malformed ``name``"""
+    names = patient.get("name") or [{}]
+    if not isinstance(names, list) or not isinstance(names[0], dict):
+        raise IngestError("Patient.name must be a list of HumanName objects")
+    family, given = names[0].get("family", ""), names[0].get("given", [])
+    if not isinstance(family, str) or not isinstance(given, list) or not all(isinstance(g, str) for g in given):
+        raise IngestError("Patient.name must have a string family and a list of string given names")
+    return family, given
+
+
+def new_patient_data(patient: Optional[dict] = None) -> dict:
+    """Empty ``patient_data`` dict in the shape used by athena.py; raises ``IngestError`` for a malformed name"""
+    family, given = _patient_name(patient or {})
+    return {
+        "name": {"family": family, "given": given},
+        "molecular_data": {},
+        "clinical_data": {},
+        "imaging_data": {},
+    }
+
+
+def _patient_key(reference: str) -> str:
+    return reference.split("/")[-1] if reference.startswith("Patient/") else reference
+
+
+def _subject_key(observation: dict) -> str:
+    """Patient key of an Observation's ``subject``, "" without one; raises ``IngestError`` for a malformed subject"""
+    subject = observation.get("subject") or {}
+    if not isinstance(subject, dict):
+        raise IngestError("Observation.subject must be a Reference object")
+    reference = subject.get("reference") or ""
+    if not isinstance(reference, str):
+        raise IngestError("Observation.subject.reference must be a string")
+    return _patient_key(reference)
+
+
+def observation_features(observation: dict) -> Tuple[str, Dict[str, dict]]:
+    """
+    ``(patient_id, sections)`` for a single Observation, where ``sections`` maps
+    each patient_data section to the scoring inputs this Observation sets.
+    Raises ``IngestError`` for an unusable Observation.
+    """
+    patient_id = _subject_key(observation)
+    if not patient_id:
+        raise IngestError("Observation has no subject")
+    sections = {"molecular_data": {}, "clinical_data": {}, "imaging_data": {}}
+    try:
+        _apply_element(sections, observation)
+        for component in observation.get("component") or []:
+            _apply_element(sections, component)
+    except (TypeError, ValueError, AttributeError) as e:
+        raise IngestError(str(e))
+    return patient_id, sections
+
+
+def ingest_records(resources: List[Tuple[int, object]]) -> Tuple[Dict[str, PatientRecord], List[IngestError]]:
+    """
+    Validate Patient and Observation resources into ``PatientRecord``s.
+
+    Returns the patients keyed by id (in input order) and the per-entry errors.
+    Observations are linked to their Patient through ``subject.reference``. A
+    Patient id given more than once is ambiguous, so that patient is not scored.
+    """
+    patients: Dict[str, PatientRecord] = {}
+    observations: List[Tuple[int, dict]] = []
+    errors: List[IngestError] = []
+    duplicates: Dict[str, int] = {}
+
+    for index, resource in resources:
+        if isinstance(resource, IngestError):
+            errors.append(resource)
+            continue
+        resource_type = resource.get("resourceType") if isinstance(resource, dict) else None
+        if resource_type == "Patient":
+            if not resource.get("id"):
+                errors.append(IngestError("Patient resource has no id", index))
+                continue
+            patient_id = resource["id"]
+            if not valid_id(patient_id):
+                errors.append(IngestError(
+                    f"Patient id {patient_id!r} is not a valid FHIR id (1-64 letters, digits, '-' or '.')", index
+                ))
+                continue
+            if patient_id in patients or patient_id in duplicates:
+                first = patients[patient_id].index if patient_id in patients else duplicates[patient_id]
+                errors.append(IngestError(f"Patient/{patient_id} is already given in entry {first}", index))
+                duplicates.setdefault(patient_id, first)
+                continue
+            try:
+                family, given = _patient_name(resource)
+            except IngestError as e:
+                errors.append(IngestError(str(e), index))
+                continue
+            patients[patient_id] = PatientRecord(patient_id, family, given, index)
+        elif resource_type == "Observation":
+            observations.append((index, resource))
+        else:
+            errors.append(IngestError(f"Unsupported resourceType: {resource_type}", index))
+
+    # A patient with a malformed Observation is not scored: silently dropping
+    # an input would under-report their risk.
+    for patient_id, index in duplicates.items():
+        del patients[patient_id]
+        errors.append(IngestError(f"Patient/{patient_id} was not scored because its id is not unique", index))
+
+    rejected: Dict[str, int] = {}
+    for index, observation in observations:
+        try:
+            key = _subject_key(observation)
+        except IngestError as e:
+            errors.append(IngestError(str(e), index))
+            continue
+        if key in duplicates:
+            continue
+        record = patients.get(key)
+        if record is None:
+            errors.append(IngestError(f"Observation subject {key or '(missing)'} is not a Patient in this batch", index))
+            continue
+        try:
+            # Observations with codes the scorer does not use are ignored
+            slot = _feature_index(observation.get("code"))
+            if slot is not None:
+                record.set(slot, _value(observation))
+            for component in observation.get("component") or ():
+                _apply_to_record(record, component)
+        except (IngestError, TypeError, ValueError, AttributeError) as e:
+            errors.append(IngestError(str(e), index))
+            rejected.setdefault(key, index)
+
+    for key, index in rejected.items():
+        record = patients.pop(key)
+        errors.append(
+            IngestError(f"Patient/{key} was not scored because Observation entry {index} is invalid", record.index)
+        )
+
+    return patients, errors
+
+
+def group_patient_data(resources: List[Tuple[int, object]]) -> Tuple[Dict[str, dict], List[IngestError]]:
+    """``ingest_records`` with the patients as ``patient_data`` dicts"""
+    records, errors = ingest_records(resources)
+    return {patient_id: record.as_patient_data() for patient_id, record in records.items()}, errors
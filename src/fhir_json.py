@@ -0,0 +1,22 @@
+import json
+from typing import Callable
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+
+def _dumps_orjson(value) -> str:
+    return orjson.dumps(value).decode()
+
+
+def _dumps_json(value) -> str:
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+# Compact JSON encoder matching fhir.resources' own ``.json()`` output
+dumps: Callable[[object], str] = _dumps_orjson if orjson is not None else _dumps_json
+
+# JSON decoder to pair with ``dumps``
+loads: Callable[[object], object] = orjson.loads if orjson is not None else json.loads
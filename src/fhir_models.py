@@ -0,0 +1,44 @@
+import importlib
+import os
+
+# fhir.resources classes used by the model path, imported on first attribute
+# access (``fhir_models.RiskAssessment``) instead of at app import, so they
+# stay off the cold-start path. ``warm_up`` imports them all ahead of use.
+_CLASSES = {
+    "CodeableConcept": "fhir.resources.codeableconcept",
+    "Extension": "fhir.resources.extension",
+    "Observation": "fhir.resources.observation",
+    "OperationOutcome": "fhir.resources.operationoutcome",
+    "Patient": "fhir.resources.patient",
+    "Quantity": "fhir.resources.quantity",
+    "Reference": "fhir.resources.reference",
+    "RiskAssessment": "fhir.resources.riskassessment",
+    "RiskAssessmentPrediction": "fhir.resources.riskassessment",
+}
+
+# When to import them: "background" (shortly after the server starts),
+# "preload" (in the gunicorn master, before forking) or "off" (first use only)
+SARCRISK_FHIR_WARMUP = os.getenv("SARCRISK_FHIR_WARMUP", "background").lower()
+SARCRISK_FHIR_WARMUP_DELAY = float(os.getenv("SARCRISK_FHIR_WARMUP_DELAY", "1.0"))
+
+
+def __getattr__(name: str):
+    module = _CLASSES.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    cls = getattr(importlib.import_module(module), name)
+    globals()[name] = cls
+    return cls
+
+
+def loaded() -> bool:
+    return all(name in globals() for name in _CLASSES)
+
+
+def warm_up() -> None:
+    """Import every FHIR class (and build the shared fragment models) now"""
+    from .fhir_fragments import warm_up_fragments
+
+    for name in _CLASSES:
+        __getattr__(name)
+    warm_up_fragments()
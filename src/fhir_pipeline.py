@@ -0,0 +1,160 @@
+"""
+Complete FHIR resource sets for scored patients, as one transaction Bundle.
+
+For every patient the pipeline produces the Patient, its clinical, molecular
+and imaging Observations and the RiskAssessment, whose ``basis`` references
+those Observations by id. Ids are derived from the patient id, so a Bundle
+can be re-posted (``PUT``) without duplicating resources and every reference
+resolves inside it.
+
+Resources are built through the fast serialization path (see ``fast_fhir``),
+and the resources of one patient share their subobjects: one ``subject``
+reference and one set of ``basis`` references. A batch of at least
+``SARCRISK_PIPELINE_PARALLEL_MIN`` patients is split into chunks that are
+scored and mapped in a process pool; smaller batches stay in the calling
+thread, where starting the work costs less than it would save.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from .athena import EXPORT_OBSERVATIONS, observation_basis, observation_ids, resource_id
+from .cpus import available_cpus
+from .fast_fhir import dumps, observation_dict, patient_dict, render, render_risk_assessment
+from .fhir_ingest import valid_id
+from .metrics import stage
+from .models import PatientInputs, PatientRecord
+from .rules import CompiledRules, current_rules
+from .scoring import score_patients
+
+# Transaction pipeline configuration; 0 or 1 workers maps every batch in the calling thread
+SARCRISK_PIPELINE_WORKERS = int(os.getenv("SARCRISK_PIPELINE_WORKERS", str(min(4, available_cpus()))))
+SARCRISK_PIPELINE_PARALLEL_MIN = int(os.getenv("SARCRISK_PIPELINE_PARALLEL_MIN", "1000"))
+SARCRISK_PIPELINE_CHUNK_SIZE = int(os.getenv("SARCRISK_PIPELINE_CHUNK_SIZE", "250"))
+SARCRISK_PIPELINE_START_METHOD = os.getenv("SARCRISK_PIPELINE_START_METHOD", "spawn")
+
+# Entry envelopes around a rendered resource; the URLs are filled in as JSON strings
+_ENTRY = '{"resource":%s,"request":{"method":"PUT","url":%s}}'
+_FULL_URL_ENTRY = '{"fullUrl":%s,"resource":%s,"request":{"method":"PUT","url":%s}}'
+
+
+def patient_entries(patient_id: str, patient_data: PatientInputs, total_score: float, risk_category: str,
+                    contributions: Sequence[float], rules: CompiledRules, base_url: Optional[str] = None,
+                    validate: Optional[bool] = None) -> List[str]:
+    """
+    Serialized transaction entries for one patient: Patient, Observations, RiskAssessment.
+
+    ``contributions`` (per ``rules.factor_terms``) explain the score: the
+    RiskAssessment's ``prediction.rationale`` lists every factor that raised
+    it, and each ``basis`` reference is labelled with the factors its
+    Observation section contributed. Raises ``ValueError`` if any resource
+    cannot be mapped, so a patient is either complete in the Bundle or
+    missing from it. So does a ``patient_id`` that is not a valid FHIR id,
+    as it becomes the Patient's and the RiskAssessment's id.
+    """
+    if not valid_id(patient_id):
+        raise ValueError(f"Patient id {patient_id!r} is not a valid FHIR id")
+    sections = patient_data.as_patient_data() if isinstance(patient_data, PatientRecord) else patient_data
+    subject = {"reference": f"Patient/{patient_id}"}
+    resources = [("Patient", patient_id, render(patient_dict(sections, patient_id), validate))]
+    for (section, resource_type, system, code, display), observation_id in zip(
+        EXPORT_OBSERVATIONS, observation_ids(patient_id)
+    ):
+        observation = observation_dict(resource_type, sections[section], code, display, patient_id, system,
+                                       observation_id)
+        observation["subject"] = subject
+        resources.append(("Observation", observation_id, render(observation, validate)))
+    resources.append(("RiskAssessment", patient_id, render_risk_assessment(
+        patient_data, total_score, risk_category, rules.suspected_subtypes(patient_data), patient_id=patient_id,
+        validate=validate, assessment_id=patient_id, method=rules.method,
+        basis=observation_basis(patient_id, contributions, rules),
+        rationale=rules.rationale(contributions)
+    )))
+    if base_url is None:
+        return [_ENTRY % (resource, dumps(f"{resource_type}/{id_}")) for resource_type, id_, resource in resources]
+    return [
+        _FULL_URL_ENTRY % (dumps(f"{base_url}/{resource_type}/{id_}"), resource, dumps(f"{resource_type}/{id_}"))
+        for resource_type, id_, resource in resources
+    ]
+
+
+def map_chunk(patients: List[Tuple[str, PatientInputs]], rules: CompiledRules, base_url: Optional[str] = None,
+              validate: Optional[bool] = None) -> Tuple[List[str], List[str]]:
+    """Scores a chunk of patients in one pass; returns their entries and the patients that could not be mapped"""
+    scores = score_patients((patient_data for _, patient_data in patients), rules, explain=True)
+    contributions = scores.contributions.tolist()
+    entries, errors = [], []
+    for i, (patient_id, patient_data) in enumerate(patients):
+        try:
+            entries.extend(patient_entries(
+                patient_id, patient_data, float(scores.total[i]), str(scores.category[i]), contributions[i], rules,
+                base_url, validate
+            ))
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append(f"Patient/{patient_id} could not be mapped: {e}")
+    return entries, errors
+
+
+def _chunks(items: Iterable, size: int) -> Iterator[list]:
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class TransactionPipeline:
+    """
+    Builds transaction Bundles, in a lazily started process pool for large batches.
+    """
+
+    def __init__(self, workers: int = SARCRISK_PIPELINE_WORKERS, parallel_min: int = SARCRISK_PIPELINE_PARALLEL_MIN,
+                 chunk_size: int = SARCRISK_PIPELINE_CHUNK_SIZE):
+        self.workers = workers
+        self.parallel_min = parallel_min
+        self.chunk_size = chunk_size
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context(SARCRISK_PIPELINE_START_METHOD)
+            )
+        return self._executor
+
+    def build(self, patients: Dict[str, PatientInputs], rules: Optional[CompiledRules] = None,
+              base_url: Optional[str] = None, validate: Optional[bool] = None) -> Tuple[str, List[str]]:
+        """
+        Returns the transaction Bundle for ``patients`` as JSON, plus a
+        description of every patient that could not be mapped (and is not in
+        the Bundle). The whole batch uses one rule set (``rules``, by default
+        the active one).
+        """
+        rules = rules or current_rules()
+        base_url = base_url.rstrip("/") if base_url else None
+        chunks = _chunks(patients.items(), self.chunk_size)
+        with stage("map"):
+            if self.workers > 1 and len(patients) >= self.parallel_min:
+                count = -(-len(patients) // self.chunk_size)
+                results = self._pool().map(
+                    map_chunk, chunks, [rules] * count, [base_url] * count, [validate] * count
+                )
+            else:
+                results = (map_chunk(chunk, rules, base_url, validate) for chunk in chunks)
+            entries, errors = [], []
+            for chunk_entries, chunk_errors in results:
+                entries.extend(chunk_entries)
+                errors.extend(chunk_errors)
+        with stage("serialize"):
+            return '{"resourceType":"Bundle","type":"transaction","entry":[%s]}' % ",".join(entries), errors
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+
+transaction_pipeline = TransactionPipeline()
@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import os
+import time
+from typing import Dict, Hashable, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from .metrics import record_upstream
+from .upstream import (
+    ATHENA_RETRY_MAX_BACKOFF, POLICIES, CircuitBreaker, CircuitOpenError, Clock, EndpointPolicy, RateLimiter, Sleep,
+    StaleCache, UpstreamStats, backoff_delay, classify_endpoint, retry_after, retryable,
+)
+
+# Upstream HTTP configuration (all values can be overridden per environment)
+ATHENA_HTTP_TIMEOUT = float(os.getenv("ATHENA_HTTP_TIMEOUT", "10.0"))
+ATHENA_HTTP_CONNECT_TIMEOUT = float(os.getenv("ATHENA_HTTP_CONNECT_TIMEOUT", "5.0"))
+ATHENA_HTTP_MAX_CONNECTIONS = int(os.getenv("ATHENA_HTTP_MAX_CONNECTIONS", "100"))
+ATHENA_HTTP_MAX_KEEPALIVE = int(os.getenv("ATHENA_HTTP_MAX_KEEPALIVE", "20"))
+ATHENA_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("ATHENA_HTTP_KEEPALIVE_EXPIRY", "30.0"))
+ATHENA_HTTP_MAX_CONCURRENCY = int(os.getenv("ATHENA_HTTP_MAX_CONCURRENCY", "20"))
+
+
+class AthenaHttpClient:
+    """
+    Shared async HTTP client for all athenahealth calls.
+
+    Wraps a single pooled ``httpx.AsyncClient`` so connections are kept alive
+    between requests, and caps the number of in-flight upstream calls with a
+    semaphore so a login burst cannot open an unbounded number of sockets.
+
+    Every request also goes through the resilience layer in ``upstream``: the
+    endpoint's timeout and retry policy, a per-host circuit breaker with stale
+    reads while it is open, per-practice rate limiting, and coalescing of
+    identical concurrent GETs into one upstream call.
+    """
+
+    def __init__(
+        self,
+        timeout: float = ATHENA_HTTP_TIMEOUT,
+        connect_timeout: float = ATHENA_HTTP_CONNECT_TIMEOUT,
+        max_connections: int = ATHENA_HTTP_MAX_CONNECTIONS,
+        max_keepalive: int = ATHENA_HTTP_MAX_KEEPALIVE,
+        keepalive_expiry: float = ATHENA_HTTP_KEEPALIVE_EXPIRY,
+        max_concurrency: int = ATHENA_HTTP_MAX_CONCURRENCY,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        policies: Optional[Dict[str, EndpointPolicy]] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        stale_cache: Optional[StaleCache] = None,
+        breaker_factory=CircuitBreaker,
+        clock: Clock = time.monotonic,
+        sleep: Sleep = asyncio.sleep,
+    ):
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.max_concurrency = max_concurrency
+        self.transport = transport
+        self.policies = policies or POLICIES
+        self.rate_limiter = rate_limiter or RateLimiter(clock=clock)
+        self.stale_cache = stale_cache if stale_cache is not None else StaleCache(clock=clock)
+        self.breaker_factory = breaker_factory
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = UpstreamStats()
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+
+    @property
+    def started(self) -> bool:
+        return self._client is not None
+
+    async def start(self) -> None:
+        """Create the pooled client; called once from app startup"""
+        if self._client is not None:
+            return
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout, limits=self.limits, transport=self.transport
+        )
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self) -> None:
+        """Close pooled connections; called once from app shutdown"""
+        if self._client is None:
+            return
+        await self._client.aclose()
+        self._client = None
+        self._semaphore = None
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        if host not in self.breakers:
+            self.breakers[host] = self.breaker_factory(clock=self.clock)
+        return self.breakers[host]
+
+    async def request(self, method: str, url: str, *, endpoint: Optional[str] = None, practice_id: str = "",
+                      **kwargs) -> httpx.Response:
+        """
+        Send a request through the shared pool under the policy of ``endpoint``
+        (a ``POLICIES`` name, classified from the method and URL by default);
+        ``practice_id`` selects the rate limit. Raises ``UpstreamUnavailable``
+        when failing fast.
+        """
+        if self._client is None:
+            # Allows use outside the app lifecycle (scripts, tests)
+            await self.start()
+        policy = self.policies[endpoint or classify_endpoint(method, url)]
+        if "timeout" not in kwargs:
+            kwargs["timeout"] = httpx.Timeout(policy.timeout, connect=self.timeout.connect)
+        full_url = httpx.URL(str(url))
+        if kwargs.get("params") is not None:
+            full_url = full_url.copy_merge_params(kwargs["params"])
+        full_url = str(full_url)
+        if method.upper() != "GET" or any(kwargs.get(name) is not None for name in ("content", "data", "json", "files")):
+            return await self._resilient_request(method, url, policy, practice_id, full_url, kwargs)
+
+        # Single-flight: identical concurrent GETs share one upstream call
+        key = (full_url, practice_id, tuple(sorted(httpx.Headers(kwargs.get("headers")).multi_items())))
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._resilient_request(method, url, policy, practice_id, full_url, kwargs))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.stats.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _resilient_request(self, method: str, url: str, policy: EndpointPolicy, practice_id: str,
+                                 full_url: str, kwargs: dict) -> httpx.Response:
+        host = urlsplit(str(url)).netloc
+        breaker = self.breaker(host)
+        stale_key = (practice_id, full_url, credential_key(kwargs.get("headers"))) if policy.serve_stale else None
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                self.stats.short_circuited += 1
+                stale = self._stale(stale_key)
+                if stale is not None:
+                    return stale
+                raise CircuitOpenError(f"circuit open for {host}", breaker.retry_after())
+            try:
+                await self.rate_limiter.acquire(practice_id, self.stats, self.sleep)
+            except BaseException:
+                # Rejected or cancelled before anything was sent: give a half-open probe slot back
+                breaker.release()
+                raise
+            try:
+                response = await self._send(method, url, host, **kwargs)
+            except httpx.TransportError as e:
+                breaker.record_failure()
+                if attempt < policy.retries and retryable(policy, error=e):
+                    await self._backoff(attempt)
+                    attempt += 1
+                    continue
+                stale = self._stale(stale_key)
+                if stale is not None:
+                    return stale
+                raise
+            except BaseException:
+                breaker.release()
+                raise
+
+            if response.status_code < 500:
+                breaker.record_success()
+                if response.status_code == 429:
+                    # Hold the whole practice back, not just this caller
+                    self.stats.throttled += 1
+                    self.rate_limiter.pause(practice_id, retry_after(response) or backoff_delay(attempt))
+                elif stale_key is not None and response.status_code == 200:
+                    self.stale_cache.put(stale_key, response)
+                return response
+
+            breaker.record_failure()
+            if attempt < policy.retries and retryable(policy, response=response):
+                await self._backoff(attempt, retry_after(response))
+                attempt += 1
+                continue
+            stale = self._stale(stale_key)
+            return stale if stale is not None else response
+
+    async def _send(self, method: str, url: str, host: str, **kwargs) -> httpx.Response:
+        async with self._semaphore:
+            start = time.perf_counter()
+            try:
+                response = await self._client.request(method, url, **kwargs)
+            except httpx.HTTPError as e:
+                record_upstream(host, method, None, time.perf_counter() - start, e)
+                raise
+        record_upstream(host, method, response.status_code, time.perf_counter() - start)
+        return response
+
+    async def _backoff(self, attempt: int, delay: Optional[float] = None) -> None:
+        self.stats.retries += 1
+        await self.sleep(min(delay, ATHENA_RETRY_MAX_BACKOFF) if delay is not None else backoff_delay(attempt))
+
+    def _stale(self, key: Optional[Hashable]) -> Optional[httpx.Response]:
+        response = self.stale_cache.get(key) if key is not None else None
+        if response is not None:
+            self.stats.stale_served += 1
+        return response
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+
+def credential_key(headers) -> Optional[str]:
+    """
+    Digest of the Authorization in ``headers``: what is read on behalf of a
+    caller (stale responses, latest assessments) is only served back to the
+    same credential.
+    """
+    authorization = httpx.Headers(headers).get("authorization")
+    return hashlib.sha256(authorization.encode()).hexdigest() if authorization else None
+
+
+# Process-wide client shared by the API endpoints and AthenaAuth
+athena_http = AthenaHttpClient()
@@ -0,0 +1,220 @@
+"""
+Incremental re-scoring from a feed of new or updated Observations.
+
+The feature store holds the inputs behind each patient's last emitted
+RiskAssessment. For every patient touched by the feed only the sub-scores
+(molecular / clinical / imaging) whose inputs actually changed are
+recomputed, and a new RiskAssessment is emitted only when the category or
+probability moves. Replays a change feed or Subscription notifications
+saved as NDJSON (Observations or notification Bundles, one per line):
+
+    python -m src.incremental --store DIR --feed changes.ndjson [--out assessments.ndjson]
+"""
+import argparse
+import json
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .athena import observation_basis
+from .fast_fhir import render_risk_assessment
+from .feature_store import SECTIONS, FeatureStore
+from .fhir_ingest import IngestError, observation_features
+from .metrics import stage
+from .rules import current_rules
+from .scoring import (
+    calculate_clinical_score, calculate_imaging_score, calculate_molecular_score, categorize_risk, combine_scores
+)
+
+SUB_SCORES = {
+    "molecular_data": calculate_molecular_score,
+    "clinical_data": calculate_clinical_score,
+    "imaging_data": calculate_imaging_score,
+}
+NUMERIC_INPUTS = ("VEGF_level", "tumor_size")
+
+# Probability changes at or below this are float noise, not a new assessment
+PROBABILITY_TOLERANCE = 1e-9
+
+
+@dataclass
+class Change:
+    """The outcome for one patient touched by the feed"""
+    patient_id: str
+    sections: Tuple[str, ...]  # sections whose inputs changed (and were re-scored)
+    previous_total: Optional[float]
+    total: float
+    previous_category: Optional[str]
+    category: str
+    resource: Optional[str] = None  # RiskAssessment JSON, when one was emitted
+
+    @property
+    def emitted(self) -> bool:
+        return self.resource is not None
+
+
+@dataclass
+class IncrementalStats:
+    observations: int = 0
+    ignored: int = 0  # no scoring input in the Observation
+    errors: List[str] = field(default_factory=list)
+    patients: int = 0
+    unchanged_inputs: int = 0
+    recomputed_sections: int = 0
+    emitted: int = 0
+
+    def as_dict(self) -> Dict[str, object]:
+        return {**self.__dict__, "errors": len(self.errors)}
+
+
+def iter_feed_observations(lines: Iterable[str], errors: Optional[List[str]] = None) -> Iterator[dict]:
+    """
+    Observations from NDJSON lines holding Observations or Bundles (change
+    feed pages, ``subscription-notification`` / ``history`` notifications).
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            resource = json.loads(line)
+        except ValueError as e:
+            if errors is not None:
+                errors.append(f"Line {number}: invalid JSON: {e}")
+            continue
+        if resource.get("resourceType") == "Bundle":
+            for entry in resource.get("entry") or []:
+                entry_resource = entry.get("resource") or {}
+                if entry_resource.get("resourceType") == "Observation":
+                    yield entry_resource
+        elif resource.get("resourceType") == "Observation":
+            yield resource
+
+
+def _normalize(key: str, value):
+    # The coercions the feature store (and the scorer) apply
+    return float(value or 0) if key in NUMERIC_INPUTS else bool(value)
+
+
+class IncrementalScorer:
+    """Applies Observation changes to a feature store and re-scores only what moved"""
+
+    def __init__(self, store: FeatureStore, tolerance: float = PROBABILITY_TOLERANCE):
+        self.store = store
+        self.tolerance = tolerance
+        self.stats = IncrementalStats()
+
+    def collect(self, observations: Iterable[dict]) -> Dict[str, Dict[str, dict]]:
+        """Latest value of every input per patient; later Observations win"""
+        updates: Dict[str, Dict[str, dict]] = {}
+        for observation in observations:
+            self.stats.observations += 1
+            try:
+                patient_id, sections = observation_features(observation)
+            except IngestError as e:
+                self.stats.errors.append(f"Observation/{observation.get('id', '?')}: {e}")
+                continue
+            if not any(sections.values()):
+                self.stats.ignored += 1
+                continue
+            patient = updates.setdefault(patient_id, {section: {} for section in SECTIONS})
+            for section, values in sections.items():
+                for key, value in values.items():
+                    patient[section][key] = _normalize(key, value)
+        return updates
+
+    def apply(self, observations: Iterable[dict]) -> List[Change]:
+        """Fold the Observations into the store and return one ``Change`` per patient whose inputs changed"""
+        updates = self.collect(observations)
+        self.stats.patients += len(updates)
+        # Merged against the stored inputs: no other writer may change them before the upsert
+        with self.store.locked():
+            return self._apply(updates)
+
+    def _apply(self, updates: Dict[str, Dict[str, dict]]) -> List[Change]:
+        rules = current_rules()
+
+        # Sub-scores behind the last assessment, for the known patients only
+        known = [patient_id for patient_id in updates if patient_id in self.store]
+        baseline = {}
+        if known:
+            with stage("score"):
+                _, scores = self.store.score(known, rules)
+            for i, patient_id in enumerate(known):
+                baseline[patient_id] = (
+                    {"molecular_data": scores.molecular[i], "clinical_data": scores.clinical[i],
+                     "imaging_data": scores.imaging[i]},
+                    float(scores.total[i]),
+                    str(scores.category[i]),
+                )
+
+        changes, merged_inputs = [], {}
+        for patient_id, update in updates.items():
+            current = self.store.get(patient_id) or {section: {} for section in SECTIONS}
+            changed = tuple(
+                section for section in SECTIONS
+                if any(key not in current[section] or current[section][key] != value
+                       for key, value in update[section].items())
+            )
+            if not changed:
+                self.stats.unchanged_inputs += 1
+                continue
+
+            merged = {section: {**current[section], **update[section]} for section in SECTIONS}
+            previous = baseline.get(patient_id)
+            sub_scores = {}
+            for section in SECTIONS:
+                if previous is None or section in changed:
+                    sub_scores[section] = SUB_SCORES[section](merged[section], rules)
+                    self.stats.recomputed_sections += 1
+                else:
+                    sub_scores[section] = float(previous[0][section])
+            total = combine_scores(sub_scores["molecular_data"], sub_scores["clinical_data"],
+                                   sub_scores["imaging_data"], rules)
+            category = categorize_risk(total, rules)
+
+            change = Change(
+                patient_id, changed,
+                previous[1] if previous else None, total,
+                previous[2] if previous else None, category,
+            )
+            if previous is None or category != previous[2] or abs(total - previous[1]) > self.tolerance:
+                with stage("map"):
+                    # Only emitted assessments need the per-factor explanation
+                    _, contributions = rules.explain(
+                        merged["molecular_data"], merged["clinical_data"], merged["imaging_data"]
+                    )
+                    change.resource = render_risk_assessment(
+                        merged, total, category, rules.suspected_subtypes(merged),
+                        patient_id=patient_id, assessment_id=patient_id, method=rules.method,
+                        basis=observation_basis(patient_id, contributions, rules),
+                        rationale=rules.rationale(contributions)
+                    )
+                self.stats.emitted += 1
+            merged_inputs[patient_id] = merged
+            changes.append(change)
+
+        if merged_inputs:
+            self.store.upsert(merged_inputs)
+        return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score patients affected by an Observation feed")
+    parser.add_argument("--store", required=True, help="feature store directory")
+    parser.add_argument("--feed", required=True, help="NDJSON of Observations or notification Bundles")
+    parser.add_argument("--out", help="write emitted RiskAssessments as NDJSON to this file")
+    args = parser.parse_args()
+
+    scorer = IncrementalScorer(FeatureStore(args.store))
+    with open(args.feed) as feed:
+        changes = scorer.apply(iter_feed_observations(feed, scorer.stats.errors))
+    if args.out:
+        with open(args.out, "w") as out:
+            out.writelines(change.resource + "\n" for change in changes if change.emitted)
+
+    print(json.dumps(scorer.stats.as_dict()))
+    for error in scorer.stats.errors:
+        print(f"  {error}")
+
+
+if __name__ == "__main__":
+    main()
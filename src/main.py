@@ -1,26 +1,97 @@
-from fastapi import FastAPI, Depends, HTTPException, Request
-from fastapi.security import OAuth2PasswordBearer
-import requests
+from fastapi import FastAPI, Depends, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+import asyncio
+import httpx
+import math
 import os
-from typing import List, Optional
-from urllib.parse import urlencode
+from typing import Dict, Optional
 
-# OAuth2 configuration
-ATHENA_API_BASE_URL = "https://api.athenahealth.com"
-ATHENA_CLIENT_ID = os.getenv("ATHENA_CLIENT_ID", "your-client-id-here")
-ATHENA_CLIENT_SECRET = os.getenv("ATHENA_CLIENT_SECRET", "your-client-secret-here")
-ATHENA_REDIRECT_URI = os.getenv("ATHENA_REDIRECT_URI", 
-    "https://athena-sarcrisk-fhir-api.ashystone-7ad37a18.eastus.azurecontainerapps.io/callback")
-ATHENA_TOKEN_URL = f"{ATHENA_API_BASE_URL}/oauth2/token"
+from . import fhir_models
+from .athena import assess_patients, build_risk_assessment_bundle
+from .assessment_cache import assessment_cache, etag, etag_matches
+from .athena_auth import athena_auth, get_oauth_token
+from .athena_fhir import AthenaFhirError, athena_fhir
+from .bulk_export import export_jobs, iter_file, parse_types
+from .compression import CompressionMiddleware
+from .fast_fhir import dumps, operation_outcome_dict
+from .feature_store import feature_store
+from .fhir_format import FHIR_JSON, FHIR_NDJSON, FormatError, Representation, negotiate
+from .fhir_ingest import IngestError, ingest_records, parse_resources, valid_id
+from .fhir_pipeline import transaction_pipeline
+from .http_client import athena_http, credential_key
+from .metrics import MetricsMiddleware, registry, request_profiler, stage
+from .rules import SARCRISK_RULES_POLL_INTERVAL, RuleSetError, ruleset
+from .scoring_jobs import scoring_jobs
+from .session_store import session_store
+from .token_manager import athena_tokens
+from .upstream import UpstreamUnavailable
+
+# Largest number of patients accepted by a single $batch request
+SARCRISK_MAX_BATCH_SIZE = int(os.getenv("SARCRISK_MAX_BATCH_SIZE", "1000"))
+# Largest number of patients accepted by a single asynchronous (Prefer: respond-async) $batch job
+SARCRISK_MAX_JOB_SIZE = int(os.getenv("SARCRISK_MAX_JOB_SIZE", "200000"))
+
+# Subsetting / NDJSON responses at least this large are reshaped in the thread pool
+SARCRISK_RENDER_THREADPOOL_SIZE = int(os.getenv("SARCRISK_RENDER_THREADPOOL_SIZE", str(64 * 1024)))
 
 # FastAPI app initialization - THIS LINE IS CRITICAL FOR THE APP TO WORK
 app = FastAPI(title="SarcRisk API", description="FHIR-compatible Sarcoma Risk Assessment API")
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)  # outermost, so request timings include compression
+
+# Shared upstream HTTP client lifecycle: one connection pool per process
+@app.on_event("startup")
+async def start_http_client():
+    await athena_http.start()
+    await athena_tokens.start()
+
+# fhir.resources is not imported at startup; warm it in the background once
+# the server is up so cold starts answer / without waiting for it
+async def _warm_up_fhir_models():
+    await asyncio.sleep(fhir_models.SARCRISK_FHIR_WARMUP_DELAY)
+    await run_in_threadpool(fhir_models.warm_up)
+
+@app.on_event("startup")
+async def schedule_fhir_warm_up():
+    if fhir_models.SARCRISK_FHIR_WARMUP == "background" and not fhir_models.loaded():
+        app.state.fhir_warm_up = asyncio.create_task(_warm_up_fhir_models())
+
+# Pick up edits to the rule set file without a restart, in every worker process
+@app.on_event("startup")
+async def watch_rule_set():
+    if SARCRISK_RULES_POLL_INTERVAL > 0:
+        app.state.rules_watcher = asyncio.create_task(ruleset.watch(SARCRISK_RULES_POLL_INTERVAL))
+
+# Background scoring jobs: resume interrupted jobs and run queued ones
+@app.on_event("startup")
+async def start_scoring_jobs():
+    await scoring_jobs.start()
+
+@app.on_event("shutdown")
+async def stop_scoring_jobs():
+    await scoring_jobs.stop()
+    transaction_pipeline.shutdown()
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await athena_tokens.stop()
+    await athena_http.close()
+    for name in ("fhir_warm_up", "rules_watcher"):
+        task = getattr(app.state, name, None)
+        if task is not None and not task.done():
+            task.cancel()
 
 # Basic route for health check
 @app.get("/")
 def read_root():
     return {"status": "healthy", "message": "SarcRisk API is running"}
 
+# Token cache counters, to confirm token endpoint load stays at ~one call per token lifetime
+@app.get("/auth/token-cache")
+def token_cache_stats():
+    return athena_tokens.stats.as_dict()
+
 # OAuth2 callback endpoint
 @app.get("/callback")
 async def callback(code: str = None, state: str = None):
@@ -28,47 +99,376 @@ async def callback(code: str = None, state: str = None):
     OAuth2 callback endpoint for athenahealth authentication.
     
     This endpoint receives the authorization code from athenahealth after 
-    user authentication and exchanges it for an access token.
+    user authentication and exchanges it for an access token
+    (``AthenaAuth.create_session``).
+
+    The tokens stay server-side in the encrypted session store; the response
+    carries only an opaque session id, sent back as the bearer token.
     """
     if not code:
         return {"error": "Authorization code missing"}
     
     try:
-        # Exchange the authorization code for an access token
-        token_request_data = {
-            "grant_type": "authorization_code",
-            "code": code,
-            "redirect_uri": ATHENA_REDIRECT_URI,
-            "client_id": ATHENA_CLIENT_ID,
-            "client_secret": ATHENA_CLIENT_SECRET
-        }
-        
-        token_response = requests.post(
-            ATHENA_TOKEN_URL,
-            data=token_request_data,
-            headers={"Content-Type": "application/x-www-form-urlencoded"}
-        )
-        
-        if token_response.status_code != 200:
-            return {
-                "error": "Failed to obtain access token",
-                "details": token_response.text,
-                "status_code": token_response.status_code
-            }
-            
-        # Successfully obtained the token
-        token_data = token_response.json()
-        
-        # For debugging/development, return the token info
-        # In production, you should store this securely and redirect to your app
+        # Exchange the authorization code and keep the tokens server-side
+        with stage("oauth_exchange"):
+            session = await athena_auth.create_session(code)
         return {
             "message": "Authentication successful",
-            "access_token": token_data.get("access_token"),
-            "token_type": token_data.get("token_type"),
-            "expires_in": token_data.get("expires_in"),
-            "refresh_token": token_data.get("refresh_token", "Not provided")
+            "session_id": session.id,
+            "token_type": "Bearer",
+            "expires_in": round(session.expires_at - session_store.clock()),
         }
         
+    except HTTPException as e:
+        return {
+            "error": "Failed to obtain access token",
+            "details": e.detail,
+            "status_code": e.status_code
+        }
+    except httpx.TimeoutException:
+        return {"error": "Authentication failed: token endpoint timed out"}
+    except UpstreamUnavailable as e:
+        return {"error": f"Authentication failed: {e}", "retry_after": math.ceil(e.retry_after)}
     except Exception as e:
         return {"error": f"Authentication failed: {str(e)}"}
 
+def fhir_error(status_code: int, message: str, code: str = "invalid",
+               headers: Optional[Dict[str, str]] = None) -> Response:
+    return Response(
+        content=dumps(operation_outcome_dict(message, code)),
+        status_code=status_code,
+        headers=headers,
+        media_type=FHIR_JSON
+    )
+
+def requested_representation(request: Request) -> Representation:
+    """``_format`` / ``Accept`` / ``_elements`` / ``_summary`` of a request; raises FormatError"""
+    return negotiate(request.query_params, request.headers.get("accept"))
+
+async def fhir_response(content: str, representation: Representation, headers: Optional[Dict[str, str]] = None,
+                        status_code: int = 200) -> Response:
+    """A serialized resource or Bundle in the representation the client asked for"""
+    if representation.reshapes and len(content) >= SARCRISK_RENDER_THREADPOOL_SIZE:
+        content = await run_in_threadpool(representation.render, content)
+    else:
+        content = representation.render(content)
+    return Response(content=content, status_code=status_code, media_type=representation.media_type, headers=headers)
+
+# Batch risk assessment endpoint
+@app.post("/RiskAssessment/$batch")
+async def risk_assessment_batch(request: Request, token: Dict[str, str] = Depends(get_oauth_token)):
+    """
+    Scores a batch of patients and returns a transaction-response Bundle of RiskAssessments.
+
+    The body is a FHIR Bundle (or NDJSON) of Patient resources and the Observations
+    that reference them. Auth, parsing and scoring happen once for the whole batch;
+    entries that cannot be scored are reported individually in the response Bundle.
+    The response honours ``_format`` / ``Accept`` (FHIR JSON or NDJSON) and
+    ``_elements`` / ``_summary``.
+
+    With ``Prefer: respond-async`` the cohort (up to ``SARCRISK_MAX_JOB_SIZE``
+    patients) is scored as a background job instead: the answer is 202 with
+    the job's status URL in ``Content-Location``, see ``scoring_job_status``.
+    """
+    respond_async = "respond-async" in request.headers.get("prefer", "")
+    try:
+        representation = requested_representation(request)
+    except FormatError as e:
+        return fhir_error(e.status_code, str(e), e.code)
+    body = await request.body()
+    try:
+        if respond_async:
+            resources = await run_in_threadpool(parse_resources, body, request.headers.get("content-type", FHIR_JSON))
+        else:
+            resources = parse_resources(body, request.headers.get("content-type", FHIR_JSON))
+    except ValueError as e:
+        return fhir_error(400, f"Invalid request body: {e}")
+
+    # Validated once, straight into the typed records that scoring and mapping read
+    if respond_async:
+        patients, errors = await run_in_threadpool(ingest_records, resources)
+    else:
+        patients, errors = ingest_records(resources)
+    max_size = SARCRISK_MAX_JOB_SIZE if respond_async else SARCRISK_MAX_BATCH_SIZE
+    if len(patients) > max_size:
+        return fhir_error(413, f"Batch contains {len(patients)} patients; the maximum is {max_size}", "too-costly")
+
+    # Keep the local feature store current so the population can be re-scored offline
+    if feature_store is not None:
+        await run_in_threadpool(feature_store.upsert, patients)
+
+    if respond_async:
+        job = await scoring_jobs.submit(patients, errors)
+        status_url = f"{str(request.base_url).rstrip('/')}/$job-status/{job.id}"
+        return Response(content=dumps(job.as_dict()), status_code=202, media_type="application/json",
+                        headers={"Content-Location": status_url})
+
+    # Scoring and FHIR mapping are CPU-bound; keep them off the event loop
+    bundle = await run_in_threadpool(build_risk_assessment_bundle, patients, errors, assessment_cache)
+    return await fhir_response(bundle, representation)
+
+# Transaction Bundle endpoint
+@app.post("/RiskAssessment/$transaction")
+async def risk_assessment_transaction(request: Request, token: Dict[str, str] = Depends(get_oauth_token)):
+    """
+    Scores a batch of patients and returns the complete resource set as a transaction Bundle.
+
+    Takes the same body as ``$batch``. For every patient the Bundle holds the
+    Patient, its clinical, molecular and imaging Observations and the
+    RiskAssessment whose ``basis`` references them, each as a ``PUT`` with an
+    id derived from the patient id (see ``fhir_pipeline``). A transaction is
+    all or nothing, so any entry that cannot be validated or mapped fails the
+    request with 422 and an OperationOutcome listing every problem.
+    """
+    try:
+        representation = requested_representation(request)
+    except FormatError as e:
+        return fhir_error(e.status_code, str(e), e.code)
+    body = await request.body()
+    try:
+        resources = parse_resources(body, request.headers.get("content-type", FHIR_JSON))
+    except ValueError as e:
+        return fhir_error(400, f"Invalid request body: {e}")
+    patients, errors = ingest_records(resources)
+    if len(patients) > SARCRISK_MAX_BATCH_SIZE:
+        return fhir_error(413, f"Batch contains {len(patients)} patients; the maximum is {SARCRISK_MAX_BATCH_SIZE}",
+                          "too-costly")
+
+    messages = [f"Entry {e.index}: {e}" if e.index is not None else str(e) for e in errors]
+    if not messages:
+        bundle, messages = await run_in_threadpool(
+            transaction_pipeline.build, patients, None, str(request.base_url)
+        )
+    if messages:
+        issues = [issue for message in messages for issue in operation_outcome_dict(message)["issue"]]
+        return Response(content=dumps({"resourceType": "OperationOutcome", "issue": issues}), status_code=422,
+                        media_type=FHIR_JSON)
+    return await fhir_response(bundle, representation)
+
+# RiskAssessment read endpoint
+@app.get("/RiskAssessment/{patient_id}")
+async def read_risk_assessment(patient_id: str, request: Request, token: Dict[str, str] = Depends(get_oauth_token)):
+    """
+    Returns the caller's latest cached RiskAssessment for a patient.
+
+    Only assessments computed from Athena with the caller's credential
+    (``/Patient/{id}/$risk-assessment``) are served: ``$batch`` inputs are
+    client-supplied and Athena reads are per user. The ETag is the hash of the scoring inputs, so a client sending it back in
+    ``If-None-Match`` gets a bodiless 304 until the patient's inputs change.
+    """
+    try:
+        representation = requested_representation(request)
+    except FormatError as e:
+        return fhir_error(e.status_code, str(e), e.code)
+    if not valid_id(patient_id):
+        return fhir_error(400, f"Invalid Patient id {patient_id!r}")
+    latest = assessment_cache.latest(credential_key(token), patient_id)
+    if latest is None:
+        return fhir_error(404, f"No RiskAssessment for Patient/{patient_id}", "not-found")
+    key, resource = latest
+    headers = {"ETag": etag(key)}
+    if etag_matches(request.headers.get("if-none-match"), key):
+        return Response(status_code=304, headers=headers)
+    return await fhir_response(resource, representation, headers)
+
+# Score a patient straight from Athena's FHIR API
+@app.get("/Patient/{patient_id}/$risk-assessment")
+async def patient_risk_assessment(patient_id: str, request: Request, batch: bool = False,
+                                  token: Dict[str, str] = Depends(get_oauth_token)):
+    """
+    Fetches the Patient and its molecular, symptom and imaging Observations from
+    Athena (concurrently, or as one FHIR batch request with ``batch=true``) and
+    returns the resulting RiskAssessment. Athena is read with the caller's
+    session token, so it only returns what the caller may see.
+    """
+    try:
+        representation = requested_representation(request)
+    except FormatError as e:
+        return fhir_error(e.status_code, str(e), e.code)
+    if not valid_id(patient_id):
+        return fhir_error(400, f"Invalid Patient id {patient_id!r}")
+    try:
+        patient_data = await athena_fhir.on_behalf_of(token).fetch_patient_data(patient_id, use_batch=batch)
+    except AthenaFhirError as e:
+        if e.status_code == 404:
+            return fhir_error(404, f"Patient/{patient_id} not found in Athena", "not-found")
+        return fhir_error(502, str(e), "exception")
+    except IngestError as e:
+        return fhir_error(422, str(e), "processing")
+    except UpstreamUnavailable as e:
+        # Failing fast (breaker open / quota queue full): tell the client when to come back
+        return fhir_error(503, f"Athena FHIR is unavailable: {e}", "transient",
+                          {"Retry-After": str(math.ceil(e.retry_after))})
+    except httpx.HTTPError as e:
+        return fhir_error(502, f"Athena FHIR request failed: {e}", "exception")
+
+    if feature_store is not None:
+        await run_in_threadpool(feature_store.upsert, {patient_id: patient_data})
+    assessments, errors = await run_in_threadpool(assess_patients, {patient_id: patient_data}, [], assessment_cache,
+                                                  latest_scope=credential_key(token))
+    if patient_id not in assessments:
+        return fhir_error(422, "; ".join(str(error) for error in errors), "processing")
+    key, resource = assessments[patient_id]
+    return await fhir_response(resource, representation, {"ETag": etag(key)})
+
+# Assessment cache counters
+@app.get("/assessment-cache")
+def assessment_cache_stats():
+    return {**assessment_cache.stats.as_dict(), "entries": len(assessment_cache.local), "bytes": assessment_cache.local.size}
+
+# Cache counters exported alongside the request / stage metrics
+@registry.collector
+def cache_metrics():
+    yield (
+        "sarcrisk_assessment_cache_events_total", "counter", "Assessment cache hits, misses, evictions and expirations",
+        {(event,): value for event, value in assessment_cache.stats.as_dict().items()}, ("event",),
+    )
+    yield (
+        "sarcrisk_assessment_cache_bytes", "gauge", "Bytes held by the local assessment cache",
+        {(): assessment_cache.local.size}, (),
+    )
+    yield (
+        "sarcrisk_token_cache_events_total", "counter", "Athena token cache hits, misses, refreshes and failures",
+        {(event,): value for event, value in athena_tokens.stats.as_dict().items()}, ("event",),
+    )
+
+# Athena resilience layer: retries, coalescing, stale reads, throttling and breaker state
+@registry.collector
+def upstream_metrics():
+    yield (
+        "sarcrisk_upstream_resilience_events_total", "counter",
+        "Athena retries, coalesced GETs, stale responses, short circuits, 429s and rate-limit queueing",
+        {(event,): value for event, value in athena_http.stats.as_dict().items()}, ("event",),
+    )
+    yield (
+        "sarcrisk_upstream_circuit_open", "gauge", "1 while the host's circuit breaker is open or half-open",
+        {(host,): int(breaker.state != breaker.CLOSED) for host, breaker in athena_http.breakers.items()}, ("host",),
+    )
+
+# Scoring jobs by status
+@registry.collector
+def scoring_job_metrics():
+    if scoring_jobs.backend is None:
+        return
+    yield (
+        "sarcrisk_scoring_jobs", "gauge", "Background scoring jobs by status",
+        {(status,): count for status, count in scoring_jobs.backend.counts().items()}, ("status",),
+    )
+
+# Session / token store lookups
+@registry.collector
+def session_metrics():
+    yield (
+        "sarcrisk_session_store_events_total", "counter", "Session store hits, misses, rejected records and writes",
+        {(event,): value for event, value in session_store.stats.as_dict().items()}, ("event",),
+    )
+
+# Active scoring rule set
+@app.get("/rules")
+def rules_info():
+    return ruleset.rules.describe()
+
+# Hot-reload the rule set file; in-flight requests finish with the rules they started with.
+# This reloads the worker serving the request at once; the others pick the change up when
+# they next poll the file (SARCRISK_RULES_POLL_INTERVAL)
+@app.post("/rules/$reload")
+async def rules_reload(token: Dict[str, str] = Depends(get_oauth_token)):
+    try:
+        rules = await run_in_threadpool(ruleset.reload)
+    except RuleSetError as e:
+        return fhir_error(422, f"Rule set not reloaded: {e}", "invalid")
+    return rules.describe()
+
+# Prometheus metrics endpoint
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+# Download a request profile captured with the X-SarcRisk-Profile header. It records the
+# event loop while the request ran, including other requests' work at its awaits and
+# excluding its threadpool work (see metrics.RequestProfiler)
+@app.get("/metrics/profiles/{profile_id}")
+def request_profile(profile_id: str, token: Dict[str, str] = Depends(get_oauth_token)):
+    path = request_profiler.path(profile_id)
+    if not request_profiler.enabled or not profile_id.isalnum() or not os.path.exists(path):
+        return fhir_error(404, f"Unknown profile {profile_id}", "not-found")
+    return FileResponse(path, media_type="application/octet-stream", filename=f"{profile_id}.prof")
+
+# Bulk Data ($export) kick-off endpoint
+@app.post("/$export")
+async def bulk_export_kick_off(request: Request, _type: Optional[str] = None,
+                               token: Dict[str, str] = Depends(get_oauth_token)):
+    """
+    Starts an asynchronous export of RiskAssessment and Observation resources.
+
+    The body is NDJSON with one ``patient_data`` record per line (plus an ``id``).
+    Follows the FHIR Bulk Data kick-off pattern: requires ``Prefer: respond-async``
+    and answers 202 with the status URL in ``Content-Location``.
+    """
+    if "respond-async" not in request.headers.get("prefer", ""):
+        return fhir_error(400, "Bulk export requires the 'Prefer: respond-async' header")
+    try:
+        types = parse_types(_type)
+    except ValueError as e:
+        return fhir_error(400, str(e), "not-supported")
+
+    job = await export_jobs.kick_off(request.stream(), types, str(request.url))
+    status_url = f"{str(request.base_url).rstrip('/')}/$export-status/{job.id}"
+    return Response(status_code=202, headers={"Content-Location": status_url})
+
+# Bulk Data status endpoint
+@app.get("/$export-status/{job_id}")
+async def bulk_export_status(job_id: str, request: Request, token: Dict[str, str] = Depends(get_oauth_token)):
+    job = export_jobs.get(job_id)
+    if job is None:
+        return fhir_error(404, f"Unknown export job {job_id}", "not-found")
+    if job.status == "in-progress":
+        return Response(status_code=202, headers={"X-Progress": job.progress, "Retry-After": "1"})
+    if job.status == "failed":
+        return fhir_error(500, f"Export failed: {job.error}", "exception")
+    return job.manifest(str(request.base_url).rstrip("/"))
+
+# Bulk Data cancellation endpoint
+@app.delete("/$export-status/{job_id}")
+async def bulk_export_cancel(job_id: str, token: Dict[str, str] = Depends(get_oauth_token)):
+    if not export_jobs.delete(job_id):
+        return fhir_error(404, f"Unknown export job {job_id}", "not-found")
+    return Response(status_code=202)
+
+# Background scoring job status
+@app.get("/$job-status/{job_id}")
+async def scoring_job_status(job_id: str, token: Dict[str, str] = Depends(get_oauth_token)):
+    """
+    Progress of an asynchronous $batch job: 202 with the job (and ``X-Progress``)
+    while it is queued or running, then 200 with its transaction-response Bundle.
+    """
+    job = scoring_jobs.get(job_id)
+    if job is None:
+        return fhir_error(404, f"Unknown scoring job {job_id}", "not-found")
+    if job.status in ("queued", "running"):
+        return Response(content=dumps(job.as_dict()), status_code=202, media_type="application/json",
+                        headers={"X-Progress": job.progress, "Retry-After": "1"})
+    if job.status == "failed":
+        return fhir_error(500, f"Scoring job failed: {job.error}", "exception")
+    # Streamed from the per-chunk results, so large cohorts never sit in memory
+    return StreamingResponse(scoring_jobs.iter_bundle(job), media_type=FHIR_JSON)
+
+# Cancel a scoring job (or discard a finished one)
+@app.delete("/$job-status/{job_id}")
+async def scoring_job_cancel(job_id: str, token: Dict[str, str] = Depends(get_oauth_token)):
+    if not await scoring_jobs.cancel(job_id):
+        return fhir_error(404, f"Unknown scoring job {job_id}", "not-found")
+    return Response(status_code=202)
+
+# Bulk Data file download endpoint
+@app.get("/$export-files/{job_id}/{file_name}")
+async def bulk_export_file(job_id: str, file_name: str, token: Dict[str, str] = Depends(get_oauth_token)):
+    job = export_jobs.get(job_id)
+    resource_type = file_name[:-len(".ndjson")] if file_name.endswith(".ndjson") else None
+    if job is None or job.status != "completed" or resource_type not in job.types + ("OperationOutcome",):
+        return fhir_error(404, f"Unknown export file {job_id}/{file_name}", "not-found")
+    path = job.output_path(resource_type)
+    if not os.path.exists(path):
+        return fhir_error(404, f"Unknown export file {job_id}/{file_name}", "not-found")
+    # Streamed in fixed-size chunks so large exports never sit in memory
+    return StreamingResponse(iter_file(path), media_type=FHIR_NDJSON)
@@ -0,0 +1,344 @@
+import cProfile
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Per-request profiling: off unless enabled; then a request is profiled when it
+# sends ``X-SarcRisk-Profile: 1`` or is picked at SARCRISK_PROFILE_SAMPLE_RATE.
+# A profile covers the event loop thread while the request runs, so it also
+# holds other requests' work interleaved at its awaits (see RequestProfiler)
+SARCRISK_PROFILING = os.getenv("SARCRISK_PROFILING", "false").lower() in ("1", "true", "yes")
+SARCRISK_PROFILE_SAMPLE_RATE = float(os.getenv("SARCRISK_PROFILE_SAMPLE_RATE", "0"))
+SARCRISK_PROFILE_DIR = os.getenv("SARCRISK_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "sarcrisk-profiles"))
+PROFILE_HEADER = "x-sarcrisk-profile"
+
+# Seconds; spans sub-millisecond scoring up to slow upstream calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Labels = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Labels, object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str, **kwargs: str):
+        """Child series for one label combination; keep a reference to it on hot paths"""
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for values, child in list(self._children.items()):
+            lines.append(f"{self.name}{_label_text(self.labelnames, values)} {_number(child.value)}")
+        return lines
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self) -> "_Timer":
+        return _Timer(self)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Labels = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _label_text(self.labelnames, values, f'le="{_number(float(bound))}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _label_text(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_number(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class _Timer:
+    """Observes the elapsed time of a ``with`` block into a histogram child"""
+    __slots__ = ("child", "start")
+
+    def __init__(self, child: _HistogramChild):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+# Scrape-time callback: returns (name, type, help, {label values: value}, label names)
+Collector = Callable[[], Iterable[Tuple[str, str, str, Dict[Labels, float], Labels]]]
+
+
+class Registry:
+    """
+    Process-local metrics in the Prometheus text exposition format.
+
+    Each worker process keeps its own registry; scrape every replica/worker
+    (or aggregate with ``sum``) for service-wide numbers.
+    """
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Collector] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Labels = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Labels = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, collect: Collector) -> Collector:
+        """Register values read at scrape time (e.g. existing stats objects)"""
+        self._collectors.append(collect)
+        return collect
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            for name, kind, documentation, samples, labelnames in collect():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for values, value in samples.items():
+                    lines.append(f"{name}{_label_text(labelnames, values)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry and the service's metrics
+registry = Registry()
+
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "sarcrisk_http_request_duration_seconds", "API request latency by route and status",
+    ("method", "route", "status"),
+)
+STAGE_SECONDS = registry.histogram(
+    "sarcrisk_stage_duration_seconds",
+    "Time spent per processing stage (oauth_exchange, athena_fetch, score, map, serialize)", ("stage",),
+)
+UPSTREAM_REQUEST_SECONDS = registry.histogram(
+    "sarcrisk_upstream_request_duration_seconds", "Athena API call latency by host, method and status",
+    ("host", "method", "status"),
+)
+UPSTREAM_ERRORS = registry.counter(
+    "sarcrisk_upstream_errors_total", "Athena API calls that failed (transport errors, 429 and 5xx)",
+    ("host", "reason"),
+)
+
+_stages: Dict[str, _HistogramChild] = {}
+
+
+def stage(name: str) -> _Timer:
+    """``with stage("score"): ...`` records the block's duration under that stage"""
+    child = _stages.get(name)
+    if child is None:
+        child = _stages[name] = STAGE_SECONDS.labels(name)
+    return _Timer(child)
+
+
+def record_upstream(host: str, method: str, status: Optional[int], seconds: float,
+                    error: Optional[BaseException] = None) -> None:
+    UPSTREAM_REQUEST_SECONDS.labels(host, method, status if status is not None else "error").observe(seconds)
+    if error is not None:
+        UPSTREAM_ERRORS.labels(host, type(error).__name__).inc()
+    elif status == 429 or status >= 500:
+        UPSTREAM_ERRORS.labels(host, str(status)).inc()
+
+
+class RequestProfiler:
+    """
+    Opt-in cProfile capture of individual requests.
+
+    Only one request is profiled at a time; others proceed unprofiled.
+    Profiles are written as pstats files (``python -m pstats <file>`` or
+    snakeviz) under ``directory``.
+
+    cProfile hooks the thread that started it, here the event loop, from the
+    start of the request to the end of its response. Other requests' coroutines
+    that run while the profiled one awaits are included, and work the request
+    hands to the threadpool (sync endpoints, ``asyncio.to_thread``) is not.
+    Read a profile as "what the event loop did meanwhile", most useful with
+    no concurrent traffic; profile a sync section with ``cProfile`` directly.
+    """
+
+    def __init__(self, enabled: bool = SARCRISK_PROFILING, sample_rate: float = SARCRISK_PROFILE_SAMPLE_RATE,
+                 directory: str = SARCRISK_PROFILE_DIR):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self._busy = threading.Lock()
+
+    def wanted(self, headers) -> bool:
+        if not self.enabled:
+            return False
+        return headers.get(PROFILE_HEADER) == "1" or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def start(self) -> Optional[cProfile.Profile]:
+        if not self._busy.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile: cProfile.Profile, profile_id: str) -> None:
+        """Stop profiling and save the stats under ``profile_id``"""
+        try:
+            profile.disable()
+        finally:
+            self._busy.release()
+        os.makedirs(self.directory, exist_ok=True)
+        profile.dump_stats(self.path(profile_id))
+
+    def path(self, profile_id: str) -> str:
+        return os.path.join(self.directory, f"{profile_id}.prof")
+
+
+request_profiler = RequestProfiler()
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every request by route template and status, and
+    running the opt-in per-request profiler. Plain ASGI (rather than
+    ``BaseHTTPMiddleware``) to keep the per-request overhead to a few
+    microseconds and leave streaming responses untouched.
+    """
+
+    def __init__(self, app, profiler: RequestProfiler = request_profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        profile = profile_id = None
+        if self.profiler.enabled:
+            headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+            if self.profiler.wanted(headers):
+                profile = self.profiler.start()
+                profile_id = uuid.uuid4().hex if profile is not None else None
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if profile_id is not None:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"x-sarcrisk-profile-id", profile_id.encode())
+                    ]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            if profile is not None:
+                self.profiler.stop(profile, profile_id)
+            route = scope.get("route")
+            # Route templates, not raw paths, keep the label cardinality bounded
+            path = getattr(route, "path", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.labels(scope["method"], path, status).observe(elapsed)
@@ -0,0 +1,110 @@
+"""
+Typed internal records for the scoring pipeline.
+
+``PatientRecord`` holds one patient's validated scoring inputs in flat slots:
+one value per input in ``INPUTS`` order (None when not supplied) instead of
+nested ``patient_data`` section dicts. ``fhir_ingest.ingest_records`` fills
+records straight from the request's Observations, and scoring, hashing and
+mapping read them without building dicts.
+
+Code written against ``patient_data`` dicts keeps working: a record is its own
+section view, so ``record.get("clinical_data")`` returns the record and
+``get`` / ``in`` / ``[]`` accept input names. ``as_patient_data`` converts
+back when a real dict is needed.
+"""
+from typing import List, Optional, Sequence, Tuple, Union
+
+from .rules import INPUT_SECTIONS, NUMERIC_COLUMNS, SECTION_INPUTS, SECTIONS
+
+# Every scoring input, section by section in SECTIONS order
+INPUTS = tuple(name for section in SECTIONS for name in SECTION_INPUTS[section])
+INPUT_INDEX = {name: index for index, name in enumerate(INPUTS)}
+SECTION_NUMBERS = {section: number for number, section in enumerate(SECTIONS)}
+# Section number of each input slot
+_INPUT_SECTION = tuple(SECTION_NUMBERS[INPUT_SECTIONS[name]] for name in INPUTS)
+# ``(input, slot)`` per section, sorted by input name (for canonical hashing)
+SORTED_SECTION_SLOTS = {
+    section: tuple(sorted((name, INPUT_INDEX[name]) for name in SECTION_INPUTS[section])) for section in SECTIONS
+}
+_NUMERIC_SLOTS = tuple(INPUT_INDEX[name] for name in NUMERIC_COLUMNS)
+
+Value = Union[bool, int, float]
+
+
+class PatientRecord:
+    __slots__ = ("id", "family", "given", "values", "order", "index")
+
+    def __init__(self, patient_id: str, family: str = "", given: Sequence[str] = (), index: Optional[int] = None):
+        self.id = patient_id
+        self.family = family
+        self.given = given
+        # Request entry the Patient came from, so responses can answer entries in request order
+        self.index = index
+        self.values: List[Optional[Value]] = [None] * len(INPUTS)
+        # Per section, the slots in the order they were first supplied
+        self.order: Tuple[List[int], ...] = tuple([] for _ in SECTIONS)
+
+    def __repr__(self) -> str:
+        return f"PatientRecord({self.id!r}, {self.as_patient_data()!r})"
+
+    def set(self, index: int, value: Value) -> None:
+        if self.values[index] is None:
+            self.order[_INPUT_SECTION[index]].append(index)
+        self.values[index] = value
+
+    def get(self, name: str, default=None):
+        index = INPUT_INDEX.get(name)
+        if index is None:
+            return self if name in SECTION_NUMBERS else default
+        value = self.values[index]
+        return default if value is None else value
+
+    def __contains__(self, name: str) -> bool:
+        index = INPUT_INDEX.get(name)
+        return index is not None and self.values[index] is not None
+
+    def __getitem__(self, name: str):
+        if name not in self:
+            raise KeyError(name)
+        return self.get(name)
+
+    def items(self, section: str) -> List[Tuple[str, Value]]:
+        """The section's supplied ``(input, value)`` pairs, in supply order"""
+        values = self.values
+        return [(INPUTS[index], values[index]) for index in self.order[SECTION_NUMBERS[section]]]
+
+    def keys(self, section: str) -> List[str]:
+        return [INPUTS[index] for index in self.order[SECTION_NUMBERS[section]]]
+
+    @property
+    def vector(self) -> List[float]:
+        """Inputs as floats with the batch scorer's coercions: flags 1.0 / 0.0, numbers ``float(v or 0)``"""
+        values = self.values
+        vector = [1.0 if value else 0.0 for value in values]
+        for index in _NUMERIC_SLOTS:
+            vector[index] = float(values[index] or 0)
+        return vector
+
+    def as_patient_data(self) -> dict:
+        patient_data = {"name": {"family": self.family, "given": self.given}}
+        for section in SECTIONS:
+            patient_data[section] = dict(self.items(section))
+        return patient_data
+
+    @classmethod
+    def from_patient_data(cls, patient_id: str, patient_data: dict) -> "PatientRecord":
+        """Record for a ``patient_data`` dict; raises ``ValueError`` for inputs the scorer does not know"""
+        name = patient_data.get("name") or {}
+        record = cls(patient_id, name.get("family", ""), name.get("given", []))
+        for section in SECTIONS:
+            for key, value in (patient_data.get(section) or {}).items():
+                index = INPUT_INDEX.get(key)
+                if index is None or INPUT_SECTIONS[key] != section:
+                    raise ValueError(f"Unknown {section} input {key!r}")
+                record.set(index, value)
+        return record
+
+
+# A ``patient_data`` dict or a record; everything downstream of ingest accepts either
+PatientInputs = Union[dict, PatientRecord]
+
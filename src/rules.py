@@ -0,0 +1,438 @@
+"""
+Data-driven scoring rules.
+
+Weights, thresholds, risk categories and subtype inference live in a
+versioned JSON rule set (``SARCRISK_RULES_PATH``, by default
+``sarcrisk_rules.json`` next to this module). It is loaded and compiled once
+at startup into a flat plan that ``scoring`` evaluates for single patients
+and whole cohorts alike:
+
+ - each section is an ordered tuple of terms: a flag input, or a numeric
+   input strictly ``above`` a threshold, adding ``weight`` when it holds
+ - the section sub-scores are weighted by their ``factor`` and capped at
+   ``max_score``
+ - categories are a sorted threshold vector looked up with a binary search
+   (``bisect`` / ``np.searchsorted``) instead of an if/elif chain
+ - a term that holds contributes ``weight * factor`` to the overall score;
+   these per-factor contributions explain an assessment and come out of the
+   same evaluation as the score itself
+
+``ruleset.reload()`` compiles a new file and swaps it in with one reference
+assignment; requests already holding the previous ``CompiledRules`` finish
+with it. Every worker process polls the file every
+``SARCRISK_RULES_POLL_INTERVAL`` seconds (0 disables), so an edit reaches
+all of them, not only the one that served ``POST /rules/$reload``. Validate a rule set without starting the server:
+
+    python -m src.rules [path]
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+from bisect import bisect_left
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .fhir_fragments import Fragment, ruleset_method
+
+SARCRISK_RULES_PATH = os.getenv(
+    "SARCRISK_RULES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "sarcrisk_rules.json")
+)
+# Seconds between checks of the rule set file by each worker process; 0 disables
+SARCRISK_RULES_POLL_INTERVAL = float(os.getenv("SARCRISK_RULES_POLL_INTERVAL", "5"))
+
+# Input schema: boolean inputs per section, in scoring order
+MOLECULAR_FLAGS = ("CDKN2A_mutation", "TP53_mutation")
+CLINICAL_FLAGS = ("pain", "swelling", "fever")
+IMAGING_FLAGS = ("mri_abnormalities", "ct_scan_abnormalities", "pet_scan_high_activity", "x_ray_findings")
+
+# Numeric inputs and the ``CohortArrays`` column holding each
+NUMERIC_COLUMNS = {"VEGF_level": "vegf_level", "tumor_size": "tumor_size"}
+
+SECTIONS = ("molecular_data", "clinical_data", "imaging_data")
+SECTION_INPUTS = {
+    "molecular_data": ("VEGF_level",) + MOLECULAR_FLAGS,
+    "clinical_data": ("tumor_size",) + CLINICAL_FLAGS,
+    "imaging_data": IMAGING_FLAGS,
+}
+INPUT_SECTIONS = {name: section for section, names in SECTION_INPUTS.items() for name in names}
+
+logger = logging.getLogger(__name__)
+
+
+class RuleSetError(ValueError):
+    """The rule set file is missing, malformed or refers to unknown inputs"""
+
+
+@dataclass(frozen=True)
+class Term:
+    """One compiled condition: a flag, or a numeric input strictly above ``above``"""
+    input: str
+    weight: float = 0.0
+    above: Optional[float] = None
+
+    @property
+    def label(self) -> str:
+        """How the factor is named in an explanation"""
+        return self.input if self.above is None else f"{self.input} > {self.above:g}"
+
+    def holds(self, data: dict) -> bool:
+        value = data.get(self.input)
+        if self.above is None:
+            return bool(value)
+        return (value or 0) > self.above
+
+    def condition(self, cohort) -> np.ndarray:
+        """Vectorized ``holds`` over a ``scoring.CohortArrays``"""
+        if self.above is None:
+            return cohort.flags[self.input]
+        return getattr(cohort, NUMERIC_COLUMNS[self.input]) > self.above
+
+
+@dataclass(frozen=True)
+class CompiledRules:
+    name: str
+    version: str
+    fingerprint: str  # version plus a content hash; cached assessments are keyed on it
+    terms: Tuple[Tuple[Term, ...], ...]  # per section, in SECTIONS order
+    factors: Tuple[float, ...]  # per section, in SECTIONS order
+    max_score: float
+    thresholds: Tuple[float, ...]  # ascending; a score strictly above thresholds[i] is at least labels[i + 1]
+    labels: Tuple[str, ...]
+    subtypes: Tuple[Tuple[str, Tuple[Term, ...]], ...]
+
+    def __getstate__(self) -> dict:
+        # The compiled scalar functions are not picklable; a copy (e.g. sent to a
+        # scoring worker process) recompiles them on first use
+        return {key: value for key, value in self.__dict__.items() if key != "_scalar"}
+
+    @cached_property
+    def _scalar(self) -> Tuple[Tuple[Callable[[dict], float], ...], Callable[[dict, dict, dict], float], Callable]:
+        return _compile_scalar(self.terms, self.factors, self.max_score)
+
+    @cached_property
+    def factor_terms(self) -> Tuple[Tuple[str, Term], ...]:
+        """``(section, term)`` for every scoring term, in evaluation order; contributions are reported in this order"""
+        return tuple((section, term) for section, terms in zip(SECTIONS, self.terms) for term in terms)
+
+    @cached_property
+    def contribution_weights(self) -> np.ndarray:
+        """What each of ``factor_terms`` adds to the overall score when it holds"""
+        return np.array([term.weight * factor for factor, terms in zip(self.factors, self.terms) for term in terms],
+                        dtype=np.float64)
+
+    @property
+    def section_scorers(self) -> Tuple[Callable[[dict], float], ...]:
+        """Sub-score functions, in SECTIONS order"""
+        return self._scalar[0]
+
+    @property
+    def risk_score(self) -> Callable[[dict, dict, dict], float]:
+        """Overall score from the three sections' inputs; same result as combining the sub-scores"""
+        return self._scalar[1]
+
+    @property
+    def explain(self) -> Callable[[dict, dict, dict], Tuple[float, Tuple[float, ...]]]:
+        """``risk_score`` that also returns the contribution of each of ``factor_terms``, from the same evaluation"""
+        return self._scalar[2]
+
+    def contributing_factors(self, contributions: Sequence[float],
+                             section: Optional[str] = None) -> List[Tuple[str, float]]:
+        """``(label, contribution)`` of the factors that raised the score, largest first"""
+        factors = [
+            (term.label, contribution)
+            for (term_section, term), contribution in zip(self.factor_terms, contributions)
+            if contribution > 0 and (section is None or term_section == section)
+        ]
+        factors.sort(key=lambda factor: -factor[1])
+        return factors
+
+    def rationale(self, contributions: Sequence[float]) -> str:
+        """``RiskAssessment.prediction.rationale`` for a patient's contributions"""
+        factors = self.contributing_factors(contributions)
+        if not factors:
+            return "No risk factors present"
+        return "Risk factors: " + format_factors(factors)
+
+    def category(self, risk_score: float) -> str:
+        return self.labels[bisect_left(self.thresholds, risk_score)]
+
+    def categories(self, risk_scores: np.ndarray) -> np.ndarray:
+        return np.asarray(self.labels)[np.searchsorted(self.thresholds, risk_scores, side="left")]
+
+    def suspected_subtypes(self, patient_data: dict) -> List[str]:
+        """Subtypes whose conditions all hold (a subtype without conditions always applies)"""
+        return [
+            name for name, conditions in self.subtypes
+            if all(term.holds(patient_data.get(INPUT_SECTIONS[term.input]) or {}) for term in conditions)
+        ]
+
+    @property
+    def method(self) -> Fragment:
+        """``RiskAssessment.method`` stamped on every assessment scored with these rules"""
+        return ruleset_method(self.name, self.version)
+
+    def describe(self) -> Dict[str, object]:
+        return {"name": self.name, "version": self.version, "fingerprint": self.fingerprint}
+
+
+def format_factors(factors: Sequence[Tuple[str, float]]) -> str:
+    return ", ".join(f"{label} (+{contribution:.2f})" for label, contribution in factors)
+
+
+def _section_source(terms: Tuple[Term, ...], data: str, score: str, first_bit: Optional[int] = None) -> List[str]:
+    """
+    Source lines adding up one section's score. With ``first_bit`` each term
+    that holds also sets its bit (``first_bit`` onwards, in term order) in
+    ``held``, inside the same branch as the addition.
+    """
+    lines = [f"    {score} = 0.0"]
+    for i, term in enumerate(terms):
+        value = f"{data}.get({term.input!r})"
+        test = value if term.above is None else f"({value} or 0) > {term.above!r}"
+        lines += [f"    if {test}:", f"        {score} += {term.weight!r}"]
+        if first_bit is not None:
+            lines.append(f"        held |= {1 << first_bit + i}")
+    return lines
+
+
+def _exec_function(name: str, args: str, body: List[str], namespace: Optional[Dict[str, object]] = None) -> Callable:
+    namespace = dict(namespace or {})
+    exec("\n".join([f"def {name}({args}):"] + body), namespace)
+    return namespace[name]
+
+
+def _compile_scalar(terms: Tuple[Tuple[Term, ...], ...], factors: Tuple[float, ...], max_score: float):
+    """
+    Generate the scalar scorers: the same tests as ``Term.holds``, unrolled in
+    rule order with thresholds and weights as literals, so a rule set scores
+    as fast as hand-written code. Inputs are validated schema names and the
+    constants are float reprs, so the generated source is safe to exec.
+
+    Returns one function per section, ``risk_score(molecular, clinical, imaging)``
+    and ``explain(molecular, clinical, imaging)``. ``explain`` performs the
+    same additions while collecting a bit mask of the terms that held, and
+    returns ``(risk_score, contributions)``; the contributions tuple of each
+    mask is built once and shared.
+    """
+    sections = tuple(
+        _exec_function(f"score_{section}", "data",
+                       _section_source(section_terms, "data", "score") + ["    return score"])
+        for section, section_terms in zip(SECTIONS, terms)
+    )
+    total = "min({!r}, molecular_score * {!r} + clinical_score * {!r} + imaging_score * {!r})".format(
+        max_score, *factors
+    )
+    body, explained = [], ["    held = 0"]
+    first_bit = 0
+    for section_terms, name in zip(terms, ("molecular", "clinical", "imaging")):
+        body += _section_source(section_terms, name, f"{name}_score")
+        explained += _section_source(section_terms, name, f"{name}_score", first_bit)
+        first_bit += len(section_terms)
+    body.append(f"    return {total}")
+    explained.append(f"    return {total}, contributions[held]")
+
+    weights = [term.weight * factor for factor, section_terms in zip(factors, terms) for term in section_terms]
+    return (
+        sections,
+        _exec_function("risk_score", "molecular, clinical, imaging", body),
+        _exec_function("explain", "molecular, clinical, imaging", explained,
+                       {"contributions": _ContributionTable(weights)}),
+    )
+
+
+class _ContributionTable(dict):
+    """Contributions tuple per bit mask of terms that held, built on first use"""
+
+    def __init__(self, weights: List[float]):
+        super().__init__()
+        self.weights = weights
+
+    def __missing__(self, held: int) -> Tuple[float, ...]:
+        value = self[held] = tuple(weight if held >> bit & 1 else 0.0 for bit, weight in enumerate(self.weights))
+        return value
+
+
+def _number(value, where: str) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise RuleSetError(f"{where} must be a finite number, got {value!r}")
+    return float(value)
+
+
+def _term(spec, section: str, where: str, weighted: bool = True) -> Term:
+    if not isinstance(spec, dict) or "input" not in spec:
+        raise RuleSetError(f"{where} must be an object with an input")
+    name = spec["input"]
+    if name not in SECTION_INPUTS[section]:
+        raise RuleSetError(f"{where}: unknown {section} input {name!r}")
+    numeric = name in NUMERIC_COLUMNS
+    if numeric and "above" not in spec:
+        raise RuleSetError(f"{where}: {name} needs an 'above' threshold")
+    if not numeric and "above" in spec:
+        raise RuleSetError(f"{where}: {name} is a flag and takes no threshold")
+    return Term(
+        input=name,
+        weight=_number(spec.get("weight"), f"{where}.weight") if weighted else 0.0,
+        above=_number(spec["above"], f"{where}.above") if numeric else None,
+    )
+
+
+def compile_rules(spec: dict) -> CompiledRules:
+    """Validate a parsed rule set and compile it into an evaluation plan"""
+    if not isinstance(spec, dict):
+        raise RuleSetError("Rule set must be a JSON object")
+    version = spec.get("version")
+    if not isinstance(version, str) or not version:
+        raise RuleSetError("Rule set needs a version string")
+
+    sections = spec.get("sections") or {}
+    if sorted(sections) != sorted(SECTIONS):
+        raise RuleSetError(f"Rule set sections must be exactly {', '.join(SECTIONS)}")
+    terms, factors = [], []
+    for section in SECTIONS:
+        terms.append(tuple(
+            _term(term, section, f"sections.{section}.terms[{i}]")
+            for i, term in enumerate(sections[section].get("terms") or [])
+        ))
+        factors.append(_number(sections[section].get("factor"), f"sections.{section}.factor"))
+
+    categories = spec.get("categories") or []
+    if not categories or "above" in categories[0] or any("above" not in category for category in categories[1:]):
+        raise RuleSetError("Categories must start with a catch-all label followed by labels with 'above' thresholds")
+    thresholds = tuple(_number(category["above"], f"categories[{i}].above")
+                       for i, category in enumerate(categories[1:], 1))
+    if list(thresholds) != sorted(set(thresholds)):
+        raise RuleSetError("Category thresholds must be strictly ascending")
+    labels = tuple(category.get("label") for category in categories)
+    if not all(isinstance(label, str) and label for label in labels):
+        raise RuleSetError("Every category needs a label")
+
+    subtypes = []
+    for i, subtype in enumerate(spec.get("subtypes") or []):
+        name = subtype.get("name") if isinstance(subtype, dict) else None
+        if not isinstance(name, str) or not name:
+            raise RuleSetError(f"subtypes[{i}] needs a name")
+        conditions = []
+        for j, condition in enumerate(subtype.get("when") or []):
+            section = INPUT_SECTIONS.get(condition.get("input") if isinstance(condition, dict) else None)
+            if section is None:
+                raise RuleSetError(f"subtypes[{i}].when[{j}]: unknown input {condition!r}")
+            conditions.append(_term(condition, section, f"subtypes[{i}].when[{j}]", weighted=False))
+        subtypes.append((name, tuple(conditions)))
+
+    digest = hashlib.sha256(json.dumps(spec, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+    rules = CompiledRules(
+        name=str(spec.get("name") or "sarcrisk"),
+        version=version,
+        fingerprint=f"{version}+{digest[:12]}",
+        terms=tuple(terms),
+        factors=tuple(factors),
+        max_score=_number(spec.get("max_score", 1.0), "max_score"),
+        thresholds=thresholds,
+        labels=labels,
+        subtypes=tuple(subtypes),
+    )
+    # Generate the scorers now, so a rule set that cannot be compiled is rejected before it is swapped in
+    try:
+        rules._scalar
+    except (SyntaxError, NameError, TypeError, ValueError) as e:
+        raise RuleSetError(f"Rule set cannot be compiled: {e}")
+    return rules
+
+
+def load_rules(path: str) -> CompiledRules:
+    try:
+        with open(path) as f:
+            spec = json.load(f)
+    except (OSError, ValueError) as e:
+        raise RuleSetError(f"Cannot read rule set {path}: {e}")
+    return compile_rules(spec)
+
+
+class RuleSetHolder:
+    """
+    The active rule set of this process.
+
+    ``rules`` is read once per scoring call or batch; ``reload`` replaces it
+    atomically, and a rule set that fails validation never replaces a good one.
+    """
+
+    def __init__(self, path: str = SARCRISK_RULES_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = self._stat()
+        self.rules = load_rules(path)
+
+    def _stat(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def reload(self) -> CompiledRules:
+        """Compile the rule set file and swap it in; raises RuleSetError (keeping the old rules) if invalid"""
+        with self._lock:
+            mtime = self._stat()
+            rules = load_rules(self.path)
+            previous, self.rules, self._mtime = self.rules, rules, mtime
+        if rules.fingerprint != previous.fingerprint:
+            logger.info("Loaded rule set %s (was %s)", rules.fingerprint, previous.fingerprint)
+        return rules
+
+    def reload_if_changed(self) -> bool:
+        """Reload when the file was modified since the last load; invalid files are logged and skipped"""
+        mtime = self._stat()
+        if mtime is None or mtime == self._mtime:
+            return False
+        try:
+            self.reload()
+        except RuleSetError as e:
+            self._mtime = mtime  # do not retry until the file changes again
+            logger.error("Keeping rule set %s: %s", self.rules.fingerprint, e)
+            return False
+        return True
+
+    async def watch(self, interval: float = SARCRISK_RULES_POLL_INTERVAL) -> None:
+        """Poll the rule set file for changes until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(self.reload_if_changed)
+
+
+# Process-wide active rule set
+ruleset = RuleSetHolder()
+
+
+def current_rules() -> CompiledRules:
+    return ruleset.rules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate and compile a SarcRisk rule set")
+    parser.add_argument("path", nargs="?", default=SARCRISK_RULES_PATH, help="rule set JSON file")
+    args = parser.parse_args()
+
+    try:
+        rules = load_rules(args.path)
+    except RuleSetError as e:
+        raise SystemExit(str(e))
+    print(json.dumps(rules.describe()))
+    for section, terms, factor in zip(SECTIONS, rules.terms, rules.factors):
+        print(f"  {section} x{factor}: " + ", ".join(
+            f"{term.input}{'' if term.above is None else f' > {term.above:g}'} (+{term.weight:g})" for term in terms
+        ))
+    print("  categories: " + " < ".join(
+        f"{label}" + (f" ({threshold:g})" if threshold is not None else "")
+        for label, threshold in zip(rules.labels, (None,) + rules.thresholds)
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .models import INPUT_INDEX, INPUTS, PatientInputs, PatientRecord
+from .rules import CLINICAL_FLAGS, IMAGING_FLAGS, MOLECULAR_FLAGS, CompiledRules, current_rules
+
+# Weights, thresholds and categories come from the active rule set (see
+# ``rules``). Every function takes an optional ``rules`` so a batch can pin
+# one rule set for its whole run even if it is hot-reloaded meanwhile.
+
+
+def calculate_molecular_score(molecular_data: dict, rules: Optional[CompiledRules] = None) -> float:
+    """Score molecular markers (VEGF level and CDKN2A / TP53 mutations)"""
+    return (rules or current_rules()).section_scorers[0](molecular_data)
+
+
+def calculate_clinical_score(clinical_data: dict, rules: Optional[CompiledRules] = None) -> float:
+    """Score clinical symptoms and tumor size"""
+    return (rules or current_rules()).section_scorers[1](clinical_data)
+
+
+def calculate_imaging_score(imaging_data: dict, rules: Optional[CompiledRules] = None) -> float:
+    """Score imaging abnormalities"""
+    return (rules or current_rules()).section_scorers[2](imaging_data)
+
+
+def combine_scores(molecular_score: float, clinical_score: float, imaging_score: float,
+                   rules: Optional[CompiledRules] = None) -> float:
+    """Weight the sub-scores into an overall risk score in [0, max_score]"""
+    rules = rules or current_rules()
+    molecular_factor, clinical_factor, imaging_factor = rules.factors
+    score = molecular_score * molecular_factor + clinical_score * clinical_factor + imaging_score * imaging_factor
+    return min(rules.max_score, score)
+
+
+def calculate_risk_score_with_symptoms_and_imaging(molecular_data: dict, clinical_data: dict, imaging_data: dict,
+                                                   rules: Optional[CompiledRules] = None) -> float:
+    """Overall sarcoma risk score from molecular, clinical and imaging data"""
+    return (rules or current_rules()).risk_score(molecular_data, clinical_data, imaging_data)
+
+
+def explain_risk_score(molecular_data: dict, clinical_data: dict, imaging_data: dict,
+                       rules: Optional[CompiledRules] = None) -> Tuple[float, Tuple[float, ...]]:
+    """
+    ``calculate_risk_score_with_symptoms_and_imaging`` plus what each factor
+    contributed to it (in ``rules.factor_terms`` order), from the same evaluation
+    """
+    return (rules or current_rules()).explain(molecular_data, clinical_data, imaging_data)
+
+
+def categorize_risk(risk_score: float, rules: Optional[CompiledRules] = None) -> str:
+    """Map a risk score to its category (High / Medium / Low with the default rules)"""
+    return (rules or current_rules()).category(risk_score)
+
+
+# Batch scoring: the same rules as above, evaluated column-wise over a cohort.
+# Every operation is applied in the same order as the scalar path so that the
+# float results are bit-for-bit identical.
+
+@dataclass
+class CohortArrays:
+    """Columnar representation of a cohort's scoring inputs"""
+    vegf_level: np.ndarray  # float64
+    tumor_size: np.ndarray  # float64
+    flags: Dict[str, np.ndarray]  # bool, one column per name in *_FLAGS
+
+    def __len__(self) -> int:
+        return len(self.vegf_level)
+
+
+@dataclass
+class CohortScores:
+    molecular: np.ndarray
+    clinical: np.ndarray
+    imaging: np.ndarray
+    total: np.ndarray
+    category: np.ndarray
+    # Per patient, the contribution of each of ``rules.factor_terms`` (only when scored with ``explain``)
+    contributions: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.total)
+
+
+def pack_records(records: List[PatientRecord]) -> CohortArrays:
+    """``pack_cohort`` for ``PatientRecord``s: one matrix build instead of a pass per column"""
+    matrix = np.array([record.vector for record in records], dtype=np.float64).reshape(len(records), len(INPUTS))
+    columns = np.ascontiguousarray(matrix.T)
+    flags = {name: columns[INPUT_INDEX[name]] != 0 for name in MOLECULAR_FLAGS + CLINICAL_FLAGS + IMAGING_FLAGS}
+    return CohortArrays(
+        vegf_level=columns[INPUT_INDEX["VEGF_level"]],
+        tumor_size=columns[INPUT_INDEX["tumor_size"]],
+        flags=flags,
+    )
+
+
+def pack_cohort(patients: Iterable[PatientInputs]) -> CohortArrays:
+    """
+    Pack ``patient_data`` dicts (molecular_data / clinical_data / imaging_data)
+    into columnar NumPy arrays. A cohort of ``PatientRecord``s goes through
+    ``pack_records``.
+    """
+    patients = patients if isinstance(patients, list) else list(patients)
+    if patients and isinstance(patients[0], PatientRecord):
+        return pack_records(patients)
+    count = len(patients)
+    molecular = [patient.get("molecular_data") or {} for patient in patients]
+    clinical = [patient.get("clinical_data") or {} for patient in patients]
+    imaging = [patient.get("imaging_data") or {} for patient in patients]
+
+    def column(sections: List[dict], name: str, dtype) -> np.ndarray:
+        cast = float if dtype is np.float64 else bool
+        return np.fromiter((cast(section.get(name) or 0) for section in sections), dtype=dtype, count=count)
+
+    flags = {name: column(molecular, name, np.bool_) for name in MOLECULAR_FLAGS}
+    flags.update({name: column(clinical, name, np.bool_) for name in CLINICAL_FLAGS})
+    flags.update({name: column(imaging, name, np.bool_) for name in IMAGING_FLAGS})
+    return CohortArrays(
+        vegf_level=column(molecular, "VEGF_level", np.float64),
+        tumor_size=column(clinical, "tumor_size", np.float64),
+        flags=flags,
+    )
+
+
+def _section_scores(terms, cohort: CohortArrays, conditions: Optional[List[np.ndarray]] = None) -> np.ndarray:
+    score = np.zeros(len(cohort))
+    for term in terms:
+        condition = term.condition(cohort)
+        np.add(score, term.weight, out=score, where=condition)
+        if conditions is not None:
+            conditions.append(condition)
+    return score
+
+
+def score_cohort(cohort: CohortArrays, rules: Optional[CompiledRules] = None, explain: bool = False) -> CohortScores:
+    """
+    Compute sub-scores, overall risk scores and categories for a whole cohort.
+
+    With ``explain`` the condition evaluated for each term is kept and turned
+    into per-factor ``contributions`` with one multiplication.
+    """
+    rules = rules or current_rules()
+    conditions = [] if explain else None
+    molecular, clinical, imaging = (_section_scores(terms, cohort, conditions) for terms in rules.terms)
+    molecular_factor, clinical_factor, imaging_factor = rules.factors
+    total = np.minimum(rules.max_score,
+                       molecular * molecular_factor + clinical * clinical_factor + imaging * imaging_factor)
+    contributions = None
+    if explain:
+        # Built factor-major (one contiguous row per term), viewed patient-major
+        contributions = np.zeros((len(conditions), len(cohort)))
+        for row, condition, weight in zip(contributions, conditions, rules.contribution_weights):
+            np.multiply(condition, weight, out=row)
+        contributions = contributions.T
+    return CohortScores(
+        molecular=molecular,
+        clinical=clinical,
+        imaging=imaging,
+        total=total,
+        category=rules.categories(total),
+        contributions=contributions,
+    )
+
+
+def categorize_risk_array(risk_scores: np.ndarray, rules: Optional[CompiledRules] = None) -> np.ndarray:
+    """Vectorized ``categorize_risk``"""
+    return (rules or current_rules()).categories(risk_scores)
+
+
+def score_patients(patients: Iterable[PatientInputs], rules: Optional[CompiledRules] = None,
+                   explain: bool = False) -> CohortScores:
+    """Convenience wrapper: pack ``patient_data`` dicts (or records) and score them in one pass"""
+    return score_cohort(pack_cohort(patients), rules, explain)
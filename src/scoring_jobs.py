@@ -0,0 +1,542 @@
+"""
+Background cohort scoring jobs.
+
+A cohort too large to score within one request is submitted as a job: the
+validated patients are spooled to disk in fixed-size chunks, the job is put
+on a queue, and the client polls the job's status for progress. Chunks are
+scored and mapped in a process pool (the work is CPU-bound), and each
+chunk's Bundle entries are written to disk as soon as it finishes. That file
+is the checkpoint: a job interrupted by a restart is put back on the queue
+and resumes from the first chunk without results. A job is scored with the
+rule set active when it runs; if the rules were reloaded since it was
+submitted, it is re-scored with the current rules from the first chunk.
+
+The queue is a local SQLite database by default (``SARCRISK_JOB_BACKEND=sqlite``),
+``memory`` keeps it in the process, and ``package.module:factory`` plugs in
+any other ``JobBackend``. At most ``SARCRISK_MAX_CONCURRENT_JOBS`` jobs run at
+once, in worker processes niced below the API, so interactive requests keep
+their latency while a large cohort is scored. When several server processes
+share a job directory, one of them runs the jobs and the others only submit
+and report on them.
+"""
+import abc
+import asyncio
+import bisect
+import contextlib
+import dataclasses
+import importlib
+import logging
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from .assessment_cache import AssessmentCache, assessment_cache
+from .athena import assess_patients, bundle_entries
+from .fhir_ingest import IngestError
+from .fhir_json import dumps, loads
+from .models import PatientInputs, PatientRecord
+from .rules import CompiledRules, current_rules
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - fcntl is POSIX-only
+    fcntl = None
+
+# Scoring job configuration
+SARCRISK_JOB_DIR = os.getenv("SARCRISK_JOB_DIR", os.path.join(tempfile.gettempdir(), "sarcrisk-jobs"))
+SARCRISK_JOB_BACKEND = os.getenv("SARCRISK_JOB_BACKEND", "sqlite")
+SARCRISK_JOB_CHUNK_SIZE = int(os.getenv("SARCRISK_JOB_CHUNK_SIZE", "500"))
+# Worker processes shared by all jobs; 0 scores in a thread of this process instead
+SARCRISK_JOB_WORKERS = int(os.getenv("SARCRISK_JOB_WORKERS", "2"))
+SARCRISK_JOB_NICE = int(os.getenv("SARCRISK_JOB_NICE", "10"))
+SARCRISK_JOB_START_METHOD = os.getenv("SARCRISK_JOB_START_METHOD", "spawn")
+SARCRISK_MAX_CONCURRENT_JOBS = int(os.getenv("SARCRISK_MAX_CONCURRENT_JOBS", "1"))
+# How often the queue is checked for jobs submitted by other processes
+SARCRISK_JOB_POLL_INTERVAL = float(os.getenv("SARCRISK_JOB_POLL_INTERVAL", "2"))
+
+JOB_STATUSES = ("queued", "running", "completed", "failed")
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ScoringJob:
+    id: str
+    total: int  # patients
+    chunk_size: int
+    status: str = "queued"  # queued | running | completed | failed
+    processed: int = 0
+    rejected: int = 0  # entries that failed validation at submission
+    # fingerprint of the rule set the job's results are scored with: the active one at submission, and the
+    # then-active one if the rules changed before the job ran (the whole job is re-scored with it)
+    scored_with: Optional[str] = None
+    error: Optional[str] = None
+    created: float = field(default_factory=time.time)
+    updated: float = field(default_factory=time.time)
+
+    @property
+    def chunks(self) -> int:
+        return -(-self.total // self.chunk_size)
+
+    def chunk_total(self, number: int) -> int:
+        return min(self.chunk_size, self.total - number * self.chunk_size)
+
+    @property
+    def progress(self) -> str:
+        percent = 100 if not self.total else int(self.processed * 100 / self.total)
+        return f"{percent}% ({self.processed}/{self.total} patients)"
+
+    def as_dict(self) -> Dict[str, object]:
+        return {**dataclasses.asdict(self), "progress": self.progress}
+
+
+class JobBackend(abc.ABC):
+    """
+    Job queue interface. ``claim`` atomically moves the oldest queued job to
+    running, so several processes can share one backend; ``recover`` puts
+    jobs left running by a process that stopped back on the queue.
+    """
+
+    @abc.abstractmethod
+    def create(self, job: ScoringJob) -> None:
+        """Store a new queued job"""
+
+    @abc.abstractmethod
+    def get(self, job_id: str) -> Optional[ScoringJob]:
+        """The job, or None if there is none with that id"""
+
+    @abc.abstractmethod
+    def claim(self) -> Optional[ScoringJob]:
+        """Move the oldest queued job to running and return it, or None if the queue is empty"""
+
+    @abc.abstractmethod
+    def update(self, job: ScoringJob) -> None:
+        """Store the job's progress and status"""
+
+    @abc.abstractmethod
+    def delete(self, job_id: str) -> bool:
+        """Remove the job; False if there was none with that id"""
+
+    @abc.abstractmethod
+    def recover(self) -> int:
+        """Put jobs left running back on the queue; returns how many"""
+
+    @abc.abstractmethod
+    def counts(self) -> Dict[str, int]:
+        """Number of jobs per status"""
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryJobBackend(JobBackend):
+    """In-process queue; jobs do not survive a restart"""
+
+    def __init__(self):
+        self._jobs: Dict[str, ScoringJob] = {}
+        self._lock = threading.Lock()
+
+    def create(self, job: ScoringJob) -> None:
+        with self._lock:
+            self._jobs[job.id] = dataclasses.replace(job)
+
+    def get(self, job_id: str) -> Optional[ScoringJob]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dataclasses.replace(job) if job is not None else None
+
+    def claim(self) -> Optional[ScoringJob]:
+        with self._lock:
+            queued = [job for job in self._jobs.values() if job.status == "queued"]
+            if not queued:
+                return None
+            job = min(queued, key=lambda job: job.created)
+            job.status, job.updated = "running", time.time()
+            return dataclasses.replace(job)
+
+    def update(self, job: ScoringJob) -> None:
+        with self._lock:
+            if job.id in self._jobs:
+                self._jobs[job.id] = dataclasses.replace(job, updated=time.time())
+
+    def delete(self, job_id: str) -> bool:
+        with self._lock:
+            return self._jobs.pop(job_id, None) is not None
+
+    def recover(self) -> int:
+        with self._lock:
+            running = [job for job in self._jobs.values() if job.status == "running"]
+            for job in running:
+                job.status = "queued"
+            return len(running)
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            counts = dict.fromkeys(JOB_STATUSES, 0)
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return counts
+
+
+class SQLiteJobBackend(JobBackend):
+    """Queue in a local SQLite database, so queued and interrupted jobs survive a restart"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, created REAL NOT NULL, "
+            "data TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _job(data: str, **changes) -> ScoringJob:
+        return ScoringJob(**{**loads(data), **changes})
+
+    def create(self, job: ScoringJob) -> None:
+        with self._lock:
+            self._db.execute("INSERT INTO jobs VALUES (?, ?, ?, ?)",
+                             (job.id, job.status, job.created, dumps(dataclasses.asdict(job))))
+
+    def get(self, job_id: str) -> Optional[ScoringJob]:
+        with self._lock:
+            row = self._db.execute("SELECT status, data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row[1], status=row[0]) if row else None
+
+    def claim(self) -> Optional[ScoringJob]:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT id, data FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE jobs SET status = 'running' WHERE id = ?", (row[0],))
+            finally:
+                self._db.execute("COMMIT")
+        return self._job(row[1], status="running") if row else None
+
+    def update(self, job: ScoringJob) -> None:
+        job.updated = time.time()
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status = ?, data = ? WHERE id = ?",
+                             (job.status, dumps(dataclasses.asdict(job)), job.id))
+
+    def delete(self, job_id: str) -> bool:
+        with self._lock:
+            return self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,)).rowcount > 0
+
+    def recover(self) -> int:
+        with self._lock:
+            return self._db.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'").rowcount
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {**dict.fromkeys(JOB_STATUSES, 0), **dict(rows)}
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def _write_atomic(path: str, lines: List[str]) -> None:
+    """Write lines to ``path`` so that it either does not exist or is complete"""
+    with open(path + ".tmp", "w") as target:
+        for line in lines:
+            target.write(line)
+            target.write("\n")
+    os.replace(path + ".tmp", path)
+
+
+def chunk_errors_path(source: str) -> str:
+    """File of the rejected request entries that fall among a chunk's patients"""
+    return source[:-len(".ndjson")] + ".errors.ndjson"
+
+
+def score_chunk(source: str, target: str, rules: CompiledRules) -> Tuple[Dict[str, Tuple[str, str]], int]:
+    """
+    Score and map one chunk file of ``patient_data`` lines (with ``id`` and
+    request entry ``index``) and checkpoint its Bundle entries, merged in
+    request order with the chunk's rejected entries, to ``target``. Runs in a
+    worker process.
+
+    Returns the ``{patient_id: (input_hash, resource_json)}`` assessments and
+    the number of patients that could not be mapped.
+    """
+    with open(source, "rb") as lines:
+        patients = {}
+        for line in lines:
+            patient_data = loads(line)
+            record = PatientRecord.from_patient_data(patient_data["id"], patient_data)
+            record.index = patient_data.get("index")
+            patients[record.id] = record
+    rejected = []
+    if os.path.exists(chunk_errors_path(source)):
+        with open(chunk_errors_path(source), "rb") as lines:
+            rejected = [IngestError(error["message"], error["index"]) for error in map(loads, lines)]
+    assessments, errors = assess_patients(patients, rejected, rules=rules)
+    _write_atomic(target, bundle_entries(assessments, errors, patients))
+    return assessments, len(errors) - len(rejected)
+
+
+def _nice_worker(increment: int) -> None:
+    try:
+        os.nice(increment)
+    except (AttributeError, OSError):  # pragma: no cover - not supported on every platform
+        pass
+
+
+class ScoringJobRunner:
+    """
+    Submits cohorts as jobs and runs queued jobs in the background.
+
+    ``start`` opens the backend (``create_job_backend`` unless one was given)
+    and, in the process holding the job directory's dispatcher lock, recovers
+    jobs interrupted by a previous process and starts the dispatcher. ``stop``
+    puts the jobs it was running back on the queue.
+    """
+
+    def __init__(self, backend: Optional[JobBackend] = None, root: str = SARCRISK_JOB_DIR,
+                 chunk_size: int = SARCRISK_JOB_CHUNK_SIZE, workers: int = SARCRISK_JOB_WORKERS,
+                 max_concurrent: int = SARCRISK_MAX_CONCURRENT_JOBS, poll_interval: float = SARCRISK_JOB_POLL_INTERVAL,
+                 cache: Optional[AssessmentCache] = None):
+        self.backend = backend
+        self.root = root
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.max_concurrent = max(1, max_concurrent)
+        self.poll_interval = poll_interval
+        self.cache = cache
+        self.running: Dict[str, asyncio.Task] = {}
+        self._executor: Optional[Executor] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._lock_file = None
+
+    def directory(self, job_id: str) -> str:
+        return os.path.join(self.root, job_id)
+
+    def source_path(self, job_id: str, number: int) -> str:
+        return os.path.join(self.directory(job_id), f"{number:06d}.ndjson")
+
+    def result_path(self, job_id: str, number: int) -> str:
+        return os.path.join(self.directory(job_id), f"{number:06d}.entries.ndjson")
+
+    def rejected_path(self, job_id: str) -> str:
+        return os.path.join(self.directory(job_id), "rejected.entries.ndjson")
+
+    def _spool(self, job: ScoringJob, patients: Dict[str, PatientInputs], errors: List[Exception]) -> None:
+        staging = self.directory(job.id) + ".tmp"
+        os.makedirs(staging)
+        lines, indexes = [], []
+        for patient_id, patient_data in patients.items():
+            index = getattr(patient_data, "index", None)
+            if isinstance(patient_data, PatientRecord):
+                patient_data = patient_data.as_patient_data()
+            lines.append(dumps({"id": patient_id, "index": index, **patient_data}))
+            indexes.append(index)
+
+        # Rejected entries go with the chunk whose patients surround them, so the
+        # Bundle answers the request's entries in order; the rest come last
+        starts = [indexes[number * job.chunk_size] for number in range(job.chunks)]
+        chunk_errors: List[List[str]] = [[] for _ in starts]
+        rejected = []
+        for error in errors:
+            index = getattr(error, "index", None)
+            if index is None or not starts or None in starts:
+                rejected.append(error)
+                continue
+            number = max(0, bisect.bisect_right(starts, index) - 1)
+            chunk_errors[number].append(dumps({"index": index, "message": str(error)}))
+
+        for number in range(job.chunks):
+            source = os.path.join(staging, os.path.basename(self.source_path(job.id, number)))
+            _write_atomic(source, lines[number * job.chunk_size:(number + 1) * job.chunk_size])
+            if chunk_errors[number]:
+                _write_atomic(chunk_errors_path(source), chunk_errors[number])
+        _write_atomic(os.path.join(staging, os.path.basename(self.rejected_path(job.id))),
+                      bundle_entries({}, rejected))
+        os.replace(staging, self.directory(job.id))
+
+    async def submit(self, patients: Dict[str, PatientInputs], errors: List[Exception]) -> ScoringJob:
+        """Spool validated patients (and the entries that failed validation) to disk and queue a job"""
+        job = ScoringJob(id=uuid.uuid4().hex, total=len(patients), chunk_size=self.chunk_size, rejected=len(errors),
+                         scored_with=current_rules().fingerprint)
+        await asyncio.to_thread(self._spool, job, patients, errors)
+        self.backend.create(job)
+        if self._wake is not None:
+            self._wake.set()
+        return job
+
+    def get(self, job_id: str) -> Optional[ScoringJob]:
+        return self.backend.get(job_id)
+
+    async def cancel(self, job_id: str) -> bool:
+        """Cancel a queued or running job (or discard a finished one) and remove its files"""
+        if not self.backend.delete(job_id):
+            return False
+        task = self.running.get(job_id)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await asyncio.to_thread(shutil.rmtree, self.directory(job_id), True)
+        return True
+
+    def iter_bundle(self, job: ScoringJob) -> Iterator[bytes]:
+        """A completed job's transaction-response Bundle, streamed chunk by chunk from its checkpoints"""
+        yield b'{"resourceType":"Bundle","type":"transaction-response","entry":['
+        separator = b""
+        for path in [self.result_path(job.id, number) for number in range(job.chunks)] + [self.rejected_path(job.id)]:
+            with open(path, "rb") as source:
+                entries = source.read().splitlines()
+            if entries:
+                yield separator + b",".join(entries)
+                separator = b","
+        yield b"]}"
+
+    def _lock_dispatcher(self) -> bool:
+        """Take the job directory's dispatcher lock, if no other process holds it"""
+        if fcntl is None:  # pragma: no cover - fcntl is POSIX-only
+            return True
+        self._lock_file = open(os.path.join(self.root, "dispatcher.lock"), "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            self._lock_file = None
+            return False
+        return True
+
+    async def start(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        if self.backend is None:
+            self.backend = create_job_backend(root=self.root)
+        self._wake = asyncio.Event()
+        if not self._lock_dispatcher():
+            logger.info("Another process runs the scoring jobs in %s", self.root)
+            return
+        recovered = self.backend.recover()
+        if recovered:
+            logger.info("Resuming %d interrupted scoring job(s)", recovered)
+        if self.workers > 0:
+            self._executor = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context(SARCRISK_JOB_START_METHOD),
+                initializer=_nice_worker, initargs=(SARCRISK_JOB_NICE,),
+            )
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self) -> None:
+        tasks = list(self.running.values())
+        if self._dispatcher is not None:
+            tasks.append(self._dispatcher)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        if self._lock_file is not None:
+            self._lock_file.close()  # releases the lock
+        self._executor = self._dispatcher = self._wake = self._lock_file = None
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._wake.clear()
+            while len(self.running) < self.max_concurrent:
+                job = self.backend.claim()
+                if job is None:
+                    break
+                self.running[job.id] = asyncio.create_task(self._run(job))
+            # Not wait_for: on Python < 3.12 it can swallow a cancellation that races with the wake-up or timeout
+            wake = asyncio.ensure_future(self._wake.wait())
+            try:
+                await asyncio.wait((wake,), timeout=self.poll_interval)
+            finally:
+                wake.cancel()
+
+    async def _run(self, job: ScoringJob) -> None:
+        try:
+            await self._score(job)
+        except asyncio.CancelledError:
+            # Stopping: back on the queue, to resume from its checkpoints (a no-op if the job was deleted)
+            job.status = "queued"
+            self.backend.update(job)
+            raise
+        except Exception as e:
+            logger.exception("Scoring job %s failed", job.id)
+            job.status, job.error = "failed", str(e)
+            self.backend.update(job)
+        else:
+            job.status = "completed"
+            self.backend.update(job)
+        finally:
+            self.running.pop(job.id, None)
+            if self._wake is not None:
+                self._wake.set()
+
+    async def _score(self, job: ScoringJob) -> None:
+        rules = current_rules()
+        if job.scored_with != rules.fingerprint:
+            # The rule set changed since the job was submitted (or last run): re-score all of it with the current
+            # one, so the Bundle never mixes rule sets (checkpoints of an interrupted run used the old one)
+            logger.info("Re-scoring job %s with rule set %s instead of %s", job.id, rules.fingerprint, job.scored_with)
+            for number in range(job.chunks):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self.result_path(job.id, number))
+            job.scored_with = rules.fingerprint
+        # Chunks checkpointed before an interrupted run are not scored again
+        pending = [number for number in range(job.chunks) if not os.path.exists(self.result_path(job.id, number))]
+        job.processed = job.total - sum(job.chunk_total(number) for number in pending)
+        self.backend.update(job)
+
+        # Keep every worker busy, but queue no more of this job than the pool can run
+        slots = asyncio.Semaphore(max(1, self.workers))
+
+        async def run_chunk(number: int) -> None:
+            async with slots:
+                assessments, _ = await self._call(
+                    score_chunk, self.source_path(job.id, number), self.result_path(job.id, number), rules
+                )
+            # Later batches with the same inputs are served these while they stay cached; the inputs are
+            # client-supplied, so they never become a patient's latest assessment on GET /RiskAssessment/{id}
+            if self.cache is not None:
+                await asyncio.to_thread(self.cache.set_many, (
+                    (key, resource) for key, resource in assessments.values()
+                ))
+            job.processed += job.chunk_total(number)
+            self.backend.update(job)
+
+        await asyncio.gather(*(run_chunk(number) for number in pending))
+
+    async def _call(self, function: Callable, *args):
+        if self._executor is None:
+            return await asyncio.to_thread(function, *args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+
+def create_job_backend(spec: str = SARCRISK_JOB_BACKEND, root: str = SARCRISK_JOB_DIR) -> JobBackend:
+    """``sqlite`` (the default), ``memory``, or ``package.module:factory`` returning a ``JobBackend``"""
+    if spec == "sqlite":
+        return SQLiteJobBackend(os.path.join(root, "jobs.sqlite3"))
+    if spec == "memory":
+        return MemoryJobBackend()
+    module, _, name = spec.partition(":")
+    if not name:
+        raise ValueError(f"Unknown SARCRISK_JOB_BACKEND {spec!r}; use sqlite, memory or module:factory")
+    return getattr(importlib.import_module(module), name)()
+
+
+# Process-wide scoring job runner
+scoring_jobs = ScoringJobRunner(cache=assessment_cache)
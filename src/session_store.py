@@ -0,0 +1,340 @@
+"""
+Encrypted store for user sessions and Athena tokens.
+
+``/callback`` keeps the tokens it obtains here and hands the browser an
+opaque session id instead; ``get_oauth_token`` maps that id back to the
+Athena access token with a single keyed lookup. The ``TokenManager`` also
+keeps its client-credentials tokens here, so a token fetched by one worker
+process is reused by the others rather than each re-authenticating.
+
+Records are encrypted (Fernet: AES-CBC + HMAC) before they reach a backend,
+and the lookup key is a hash of the session id, so neither the tokens nor
+usable session ids are ever stored in clear. Backends:
+
+- ``memory``: this process only
+- ``sqlite`` (default): a local SQLite file (WAL, memory-mapped reads) shared
+  by every worker on the node
+- ``redis``: a shared key-value service (``SARCRISK_SESSION_REDIS_URL``) for
+  several nodes; any redis-py style ``get`` / ``set(ex=...)`` / ``delete``
+  client works, see ``SharedSessionBackend``
+- ``package.module:factory`` returning any other ``SessionBackend``
+
+``SARCRISK_SESSION_KEYS`` holds comma-separated Fernet keys: the first
+encrypts, all decrypt, so keys can be rotated. Without it a random key is
+made when the app is imported; gunicorn's preloaded workers share it, but
+sessions do not outlive the server.
+"""
+import abc
+import hashlib
+import importlib
+import logging
+import math
+import os
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from .fhir_json import dumps, loads
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+except ImportError:  # pragma: no cover - cryptography is optional
+    Fernet = None
+
+# Session store configuration
+SARCRISK_SESSION_BACKEND = os.getenv("SARCRISK_SESSION_BACKEND", "sqlite")
+SARCRISK_SESSION_PATH = os.getenv(
+    "SARCRISK_SESSION_PATH", os.path.join(tempfile.gettempdir(), "sarcrisk-sessions.sqlite3")
+)
+SARCRISK_SESSION_REDIS_URL = os.getenv("SARCRISK_SESSION_REDIS_URL")
+SARCRISK_SESSION_KEYS = os.getenv("SARCRISK_SESSION_KEYS", "")
+SARCRISK_SESSION_MMAP_SIZE = int(os.getenv("SARCRISK_SESSION_MMAP_SIZE", str(16 * 1024 * 1024)))
+SARCRISK_SESSION_DEFAULT_TTL = float(os.getenv("SARCRISK_SESSION_DEFAULT_TTL", "3600"))
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SessionStats:
+    hits: int = 0
+    misses: int = 0
+    rejected: int = 0  # records that failed to decrypt or belong to another key
+    writes: int = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(self.__dict__)
+
+
+@dataclass
+class Session:
+    id: str
+    access_token: str
+    expires_at: float  # wall clock
+    token_type: str = "Bearer"
+    refresh_token: Optional[str] = None
+    scope: Optional[str] = None
+    practice_id: str = ""
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        """Authorization header for Athena calls made on behalf of the session"""
+        return {"Authorization": f"{self.token_type} {self.access_token}"}
+
+
+class SessionCipher:
+    """Authenticated encryption of stored records with a rotatable key ring"""
+
+    def __init__(self, keys: Sequence[bytes]):
+        if Fernet is None:
+            raise RuntimeError("Encrypted session storage needs the cryptography package")
+        self._fernet = MultiFernet([Fernet(key) for key in keys])
+
+    @staticmethod
+    def generate_key() -> bytes:
+        return Fernet.generate_key()
+
+    def encrypt(self, data: bytes) -> bytes:
+        return self._fernet.encrypt(data)
+
+    def decrypt(self, token: bytes) -> Optional[bytes]:
+        """The plaintext, or None when the record was tampered with or encrypted under an unknown key"""
+        try:
+            return self._fernet.decrypt(token)
+        except InvalidToken:
+            return None
+
+
+class SessionBackend(abc.ABC):
+    """Opaque values by key, each with a wall-clock expiry"""
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        """The value, or None if there is none or it has expired"""
+
+    @abc.abstractmethod
+    def set(self, key: str, value: bytes, expires_at: float) -> None:
+        """Store the value until ``expires_at`` (seconds since the epoch)"""
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> None:
+        """Remove the value, if there is one"""
+
+
+class MemorySessionBackend(SessionBackend):
+    """Values held by this process only"""
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self._values: Dict[str, Tuple[bytes, float]] = {}
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= self.clock():
+            self._values.pop(key, None)
+            return None
+        return entry[0]
+
+    def set(self, key: str, value: bytes, expires_at: float) -> None:
+        self._values[key] = (value, expires_at)
+
+    def delete(self, key: str) -> None:
+        self._values.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """
+    Values in a local SQLite file that every worker process on the node opens.
+
+    WAL lets readers run alongside a writer and reads go through a memory
+    map. Each process opens its own connection on first use (connections must
+    not cross a fork). Expired rows are purged on write.
+    """
+
+    def __init__(self, path: str, mmap_size: int = SARCRISK_SESSION_MMAP_SIZE,
+                 clock: Callable[[], float] = time.time):
+        self.path = path
+        self.mmap_size = mmap_size
+        self.clock = clock
+        self._db: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                "expires_at REAL NOT NULL) WITHOUT ROWID"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (expires_at)")
+            self._db, self._pid = db, os.getpid()
+        return self._db
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value FROM sessions WHERE key = ? AND expires_at > ?", (key, self.clock())
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: bytes, expires_at: float) -> None:
+        with self._lock:
+            db = self._connection()
+            db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (key, value, expires_at))
+            db.execute("DELETE FROM sessions WHERE expires_at <= ?", (self.clock(),))
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._connection().execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+class SharedSessionBackend(SessionBackend):
+    """
+    Values on a shared key-value service (anything with a redis-py style
+    ``get`` / ``set(name, value, ex=...)`` / ``delete`` client), for workers
+    on several nodes. The service expires the keys.
+    """
+
+    def __init__(self, client, prefix: str = "sarcrisk:session:", clock: Callable[[], float] = time.time):
+        self.client = client
+        self.prefix = prefix
+        self.clock = clock
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(self.prefix + key)
+
+    def set(self, key: str, value: bytes, expires_at: float) -> None:
+        ttl = math.ceil(expires_at - self.clock())
+        if ttl > 0:
+            self.client.set(self.prefix + key, value, ex=ttl)
+
+    def delete(self, key: str) -> None:
+        self.client.delete(self.prefix + key)
+
+
+class SessionStore:
+    """
+    Sessions and cached tokens as encrypted records in a ``SessionBackend``.
+
+    Each record is sealed together with its name, so a value copied to
+    another key is rejected rather than served. Without a cipher records are
+    kept in clear, which only the memory backend allows.
+    """
+
+    def __init__(self, backend: SessionBackend, cipher: Optional[SessionCipher],
+                 default_ttl: float = SARCRISK_SESSION_DEFAULT_TTL, clock: Callable[[], float] = time.time):
+        if cipher is None and not isinstance(backend, MemorySessionBackend):
+            raise ValueError("Sessions are only kept unencrypted in memory")
+        self.backend = backend
+        self.cipher = cipher
+        self.default_ttl = default_ttl
+        self.clock = clock
+        self.stats = SessionStats()
+
+    @staticmethod
+    def _key(kind: str, name: str) -> str:
+        return f"{kind}:{hashlib.sha256(name.encode()).hexdigest()}"
+
+    def save(self, kind: str, name: str, record: dict, expires_at: float) -> None:
+        value = dumps({"name": f"{kind}:{name}", "record": record}).encode()
+        self.backend.set(self._key(kind, name), self.cipher.encrypt(value) if self.cipher else value, expires_at)
+        self.stats.writes += 1
+
+    def load(self, kind: str, name: str) -> Optional[dict]:
+        value = self.backend.get(self._key(kind, name))
+        if value is None:
+            self.stats.misses += 1
+            return None
+        if self.cipher is not None:
+            value = self.cipher.decrypt(value)
+        sealed = loads(value) if value is not None else None
+        if sealed is None or sealed.get("name") != f"{kind}:{name}":
+            self.stats.rejected += 1
+            return None
+        self.stats.hits += 1
+        return sealed["record"]
+
+    def delete(self, kind: str, name: str) -> None:
+        self.backend.delete(self._key(kind, name))
+
+    def create_session(self, token_data: dict, practice_id: str = "") -> Session:
+        """Keep the tokens from an OAuth token response under a new, unguessable session id"""
+        session = Session(
+            id=secrets.token_urlsafe(32),
+            access_token=token_data["access_token"],
+            expires_at=self.clock() + float(token_data.get("expires_in") or self.default_ttl),
+            token_type=token_data.get("token_type") or "Bearer",
+            refresh_token=token_data.get("refresh_token"),
+            scope=token_data.get("scope"),
+            practice_id=practice_id,
+        )
+        record = asdict(session)
+        del record["id"]
+        self.save("session", session.id, record, session.expires_at)
+        return session
+
+    def session(self, session_id: str) -> Optional[Session]:
+        """The live session with this id, if any; never calls upstream"""
+        record = self.load("session", session_id)
+        if record is None:
+            return None
+        session = Session(id=session_id, **record)
+        return session if session.expires_at > self.clock() else None
+
+    def end_session(self, session_id: str) -> None:
+        self.delete("session", session_id)
+
+
+def _session_keys() -> Sequence[bytes]:
+    keys = [key.strip().encode() for key in SARCRISK_SESSION_KEYS.split(",") if key.strip()]
+    if keys:
+        return keys
+    logger.info("SARCRISK_SESSION_KEYS is not set; sessions are encrypted with a key that lasts until restart")
+    return [SessionCipher.generate_key()]
+
+
+def create_session_store(spec: str = SARCRISK_SESSION_BACKEND) -> SessionStore:
+    """Build the process session store for ``SARCRISK_SESSION_BACKEND``"""
+    if Fernet is None:
+        logger.warning("cryptography is not installed; sessions are kept unencrypted in this process only")
+        return SessionStore(MemorySessionBackend(), None)
+    cipher = SessionCipher(_session_keys())
+    if spec == "memory":
+        backend = MemorySessionBackend()
+    elif spec == "sqlite":
+        backend = SQLiteSessionBackend(SARCRISK_SESSION_PATH)
+    elif spec == "redis":
+        try:
+            import redis
+        except ImportError:
+            logger.warning("SARCRISK_SESSION_BACKEND is redis but redis is not installed; using sqlite")
+            backend = SQLiteSessionBackend(SARCRISK_SESSION_PATH)
+        else:
+            backend = SharedSessionBackend(redis.Redis.from_url(SARCRISK_SESSION_REDIS_URL))
+    else:
+        module, _, name = spec.partition(":")
+        if not name:
+            raise ValueError(f"Unknown SARCRISK_SESSION_BACKEND {spec!r}; use memory, sqlite, redis or module:factory")
+        backend = getattr(importlib.import_module(module), name)()
+    return SessionStore(backend, cipher)
+
+
+# Process-wide session and token store
+session_store = create_session_store()
@@ -0,0 +1,117 @@
+"""
+Startup-time profiling report.
+
+Imports the app in a fresh interpreter under ``-X importtime`` and breaks the
+import time down by top-level package and by module, then (with ``--serve``)
+starts uvicorn and measures the time until ``GET /`` first answers 200.
+
+    python -m src.startup_profile [--top 20] [--serve] [--runs 5]
+"""
+import argparse
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List
+
+import httpx
+
+_IMPORT_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+@dataclass
+class ImportRecord:
+    module: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+def parse_importtime(output: str) -> List[ImportRecord]:
+    """Parse ``-X importtime`` stderr into one record per imported module"""
+    records = []
+    for line in output.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            records.append(ImportRecord(module, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+    return records
+
+
+def profile_imports(module: str) -> List[ImportRecord]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True,
+    )
+    return parse_importtime(result.stderr)
+
+
+def by_package(records: List[ImportRecord]) -> Dict[str, int]:
+    """Self import time (µs) summed per top-level package"""
+    totals = defaultdict(int)
+    for record in records:
+        totals[record.module.split(".")[0]] += record.self_us
+    return dict(sorted(totals.items(), key=lambda item: item[1], reverse=True))
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_to_first_healthy(app: str, timeout: float = 60.0) -> float:
+    """Seconds from spawning uvicorn until ``GET /`` returns 200"""
+    port = _free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--host", "127.0.0.1", "--port", str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/", timeout=1).status_code == 200:
+                    return time.perf_counter() - started
+            except httpx.TransportError:
+                time.sleep(0.005)
+        raise RuntimeError(f"{app} did not answer on / within {timeout:.0f}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup-time profiling report")
+    parser.add_argument("--module", default="src.main", help="module to import (default: src.main)")
+    parser.add_argument("--top", type=int, default=20, help="number of packages / modules to list")
+    parser.add_argument("--serve", action="store_true", help="also measure time to first healthy response")
+    parser.add_argument("--app", default="src.main:app")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    records = profile_imports(args.module)
+    total = sum(record.self_us for record in records)
+    print(f"import {args.module}: {total / 1000:.1f} ms across {len(records)} modules\n")
+
+    print(f"{'package':<32} {'ms':>8} {'share':>6}")
+    for package, self_us in list(by_package(records).items())[:args.top]:
+        print(f"{package:<32} {self_us / 1000:>8.1f} {self_us / total:>6.1%}")
+
+    print(f"\n{'module (cumulative)':<48} {'ms':>8}")
+    for record in sorted(records, key=lambda r: r.cumulative_us, reverse=True)[:args.top]:
+        print(f"{record.module:<48} {record.cumulative_us / 1000:>8.1f}")
+
+    if args.serve:
+        samples = [time_to_first_healthy(args.app) for _ in range(args.runs)]
+        print(f"\ntime to first healthy response on /: median {statistics.median(samples) * 1000:.0f} ms "
+              f"(min {min(samples) * 1000:.0f}, max {max(samples) * 1000:.0f}, {args.runs} runs)")
+
+
+if __name__ == "__main__":
+    main()
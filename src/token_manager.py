@@ -0,0 +1,215 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from .athena_auth import AthenaAuth, athena_auth
+from .metrics import stage
+from .session_store import SessionStore, session_store
+
+# Token cache configuration
+TOKEN_REFRESH_MARGIN = float(os.getenv("ATHENA_TOKEN_REFRESH_MARGIN", "120"))
+TOKEN_REFRESH_INTERVAL = float(os.getenv("ATHENA_TOKEN_REFRESH_INTERVAL", "15"))
+TOKEN_DEFAULT_TTL = float(os.getenv("ATHENA_TOKEN_DEFAULT_TTL", "3600"))
+
+# Tokens are cached per (client_id, practice_id)
+TokenKey = Tuple[str, str]
+TokenFetcher = Callable[[TokenKey, Optional[str]], Awaitable[dict]]
+
+
+@dataclass
+class CachedToken:
+    access_token: str
+    expires_at: float
+    token_type: str = "Bearer"
+    refresh_token: Optional[str] = None
+    raw: dict = field(default_factory=dict)
+
+    def expires_within(self, seconds: float, now: float) -> bool:
+        return self.expires_at - now <= seconds
+
+
+@dataclass
+class TokenStats:
+    hits: int = 0
+    misses: int = 0
+    refreshes: int = 0
+    background_refreshes: int = 0
+    failures: int = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(self.__dict__)
+
+
+class TokenManager:
+    """
+    In-process OAuth token cache with proactive background refresh.
+
+    Tokens are keyed by client/practice and refreshed ``refresh_margin``
+    seconds before they expire, so request paths almost never wait on the
+    token endpoint. Concurrent refreshes for the same key share a single
+    in-flight upstream call.
+
+    With a ``store`` the tokens are also kept in the shared session store: a
+    refresh first adopts a token another worker process already fetched, so
+    the workers share one token per key instead of each re-authenticating.
+    """
+
+    def __init__(
+        self,
+        fetch_token: TokenFetcher,
+        refresh_margin: float = TOKEN_REFRESH_MARGIN,
+        refresh_interval: float = TOKEN_REFRESH_INTERVAL,
+        default_ttl: float = TOKEN_DEFAULT_TTL,
+        clock: Callable[[], float] = time.monotonic,
+        store: Optional[SessionStore] = None,
+    ):
+        self.fetch_token = fetch_token
+        self.refresh_margin = refresh_margin
+        self.refresh_interval = refresh_interval
+        self.default_ttl = default_ttl
+        self.clock = clock
+        self.store = store
+        self.stats = TokenStats()
+        self._tokens: Dict[TokenKey, CachedToken] = {}
+        self._in_flight: Dict[TokenKey, asyncio.Task] = {}
+        self._refresher: Optional[asyncio.Task] = None
+
+    async def get_token(self, client_id: str, practice_id: str = "") -> CachedToken:
+        """Return a valid token for the key, fetching it only on a miss or expiry"""
+        key = (client_id, practice_id)
+        token = self._tokens.get(key)
+        if token is not None and not token.expires_within(0, self.clock()):
+            self.stats.hits += 1
+            return token
+        self.stats.misses += 1
+        return await self._refresh(key)
+
+    def invalidate(self, client_id: str, practice_id: str = "") -> None:
+        """Drop a cached token, e.g. after the upstream rejected it with a 401, here and in the shared store"""
+        key = (client_id, practice_id)
+        self._tokens.pop(key, None)
+        if self.store is not None:
+            # Otherwise the next fetch would adopt the rejected token from the store again
+            self.store.delete("token", "\n".join(key))
+
+    async def _refresh(self, key: TokenKey) -> CachedToken:
+        # Single-flight: every caller for this key awaits the same upstream call
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def _load_shared(self, key: TokenKey) -> Optional[CachedToken]:
+        record = self.store.load("token", "\n".join(key))
+        if record is None:
+            return None
+        # Stored with a wall-clock expiry; this cache runs on ``clock``
+        record["expires_at"] = self.clock() + record["expires_at"] - time.time()
+        return CachedToken(**record)
+
+    def _save_shared(self, key: TokenKey, token: CachedToken) -> None:
+        expires_at = time.time() + token.expires_at - self.clock()
+        record = {
+            "access_token": token.access_token, "expires_at": expires_at, "token_type": token.token_type,
+            "refresh_token": token.refresh_token, "raw": token.raw,
+        }
+        self.store.save("token", "\n".join(key), record, expires_at)
+
+    async def _fetch(self, key: TokenKey) -> CachedToken:
+        previous = self._tokens.get(key)
+        if self.store is not None:
+            shared = self._load_shared(key)
+            if shared is not None and not shared.expires_within(self.refresh_margin, self.clock()):
+                self._tokens[key] = shared
+                return shared
+            if shared is not None and previous is None:
+                previous = shared
+        refresh_token = previous.refresh_token if previous else None
+        self.stats.refreshes += 1
+        try:
+            data = await self.fetch_token(key, refresh_token)
+        except Exception:
+            if refresh_token is None:
+                self.stats.failures += 1
+                raise
+            # The refresh token may have been revoked; fall back to a fresh grant
+            try:
+                data = await self.fetch_token(key, None)
+            except Exception:
+                self.stats.failures += 1
+                raise
+        token = CachedToken(
+            access_token=data["access_token"],
+            token_type=data.get("token_type", "Bearer"),
+            expires_at=self.clock() + float(data.get("expires_in") or self.default_ttl),
+            refresh_token=data.get("refresh_token", refresh_token),
+            raw=data,
+        )
+        self._tokens[key] = token
+        if self.store is not None:
+            self._save_shared(key, token)
+        return token
+
+    async def refresh_expiring(self) -> int:
+        """Refresh every cached token that is inside the refresh margin"""
+        now = self.clock()
+        expiring = [
+            key for key, token in self._tokens.items()
+            if token.expires_within(self.refresh_margin, now)
+        ]
+        results = await asyncio.gather(
+            *(self._refresh(key) for key in expiring), return_exceptions=True
+        )
+        refreshed = sum(1 for result in results if isinstance(result, CachedToken))
+        self.stats.background_refreshes += refreshed
+        return refreshed
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self.refresh_expiring()
+
+    async def start(self) -> None:
+        """Start the background refresh task; called from app startup"""
+        if self._refresher is None:
+            self._refresher = asyncio.ensure_future(self._refresh_loop())
+
+    async def stop(self) -> None:
+        """Stop the background refresh task; called from app shutdown"""
+        if self._refresher is None:
+            return
+        self._refresher.cancel()
+        try:
+            await self._refresher
+        except asyncio.CancelledError:
+            pass
+        self._refresher = None
+
+
+def athena_token_fetcher(auth: AthenaAuth) -> TokenFetcher:
+    """Fetcher for ``auth``'s client: the refresh token when we have one, else client credentials"""
+    async def fetch_athena_token(key: TokenKey, refresh_token: Optional[str] = None) -> dict:
+        with stage("oauth_exchange"):
+            if refresh_token:
+                return await auth.refresh_access_token(refresh_token)
+            return await auth.get_client_credentials_token()
+    return fetch_athena_token
+
+
+# Process-wide token cache shared by every Athena call path, against the same token endpoint as /callback
+athena_tokens = TokenManager(athena_token_fetcher(athena_auth), store=session_store)
+
+
+async def get_athena_headers(practice_id: str = "") -> Dict[str, str]:
+    """
+    Authorization headers for an Athena API call, served from the token cache.
+
+    The client credentials grant does not name a practice (each call selects
+    it in its URL), so every practice shares the client's one token.
+    """
+    token = await athena_tokens.get_token(athena_auth.client_id or "")
+    return {"Authorization": f"{token.token_type} {token.access_token}"}
@@ -0,0 +1,331 @@
+"""
+Resilience building blocks for upstream (athenahealth) calls.
+
+``AthenaHttpClient`` wraps every request in these:
+
+* ``EndpointPolicy`` - timeout and retry budget per endpoint class: token
+  exchange, reads, FHIR batch reads and anything else;
+* ``backoff_delay`` - full-jitter exponential backoff between attempts.
+  Idempotent calls retry transport errors and 502/503/504; other calls retry
+  only failures to connect, which never reached the server;
+* ``CircuitBreaker`` - per host; after ``failure_threshold`` consecutive
+  failures calls fail fast with ``CircuitOpenError`` until a single half-open
+  probe succeeds;
+* ``StaleCache`` - the last good response of each read, served with a
+  ``Warning: 110`` header while the breaker is open or retries are exhausted;
+* ``TokenBucket`` / ``RateLimiter`` - per-practice pacing that queues callers
+  instead of sending them into a 429, and holds a practice back for
+  ``Retry-After`` when Athena throttles anyway. Buckets live in each worker
+  process, so each paces at its share of the quota: the configured rate and
+  burst divided by ``WEB_CONCURRENCY`` (the worker count, which
+  ``gunicorn.conf.py`` exports). Replicas behind a load balancer are not
+  accounted for; give each its share of the quota in ``ATHENA_RATE_LIMIT``.
+"""
+import asyncio
+import os
+import random
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+# Per-endpoint timeouts (seconds) and retry budgets (extra attempts)
+ATHENA_TOKEN_TIMEOUT = float(os.getenv("ATHENA_TOKEN_TIMEOUT", "5.0"))
+ATHENA_TOKEN_RETRIES = int(os.getenv("ATHENA_TOKEN_RETRIES", "1"))
+ATHENA_READ_TIMEOUT = float(os.getenv("ATHENA_READ_TIMEOUT", "10.0"))
+ATHENA_BATCH_TIMEOUT = float(os.getenv("ATHENA_BATCH_TIMEOUT", "30.0"))
+ATHENA_HTTP_RETRIES = int(os.getenv("ATHENA_HTTP_RETRIES", "2"))
+ATHENA_RETRY_BACKOFF = float(os.getenv("ATHENA_RETRY_BACKOFF", "0.2"))
+ATHENA_RETRY_MAX_BACKOFF = float(os.getenv("ATHENA_RETRY_MAX_BACKOFF", "5.0"))
+
+# Circuit breaker: consecutive failures that open it, and seconds before a probe
+ATHENA_BREAKER_FAILURES = int(os.getenv("ATHENA_BREAKER_FAILURES", "5"))
+ATHENA_BREAKER_RESET = float(os.getenv("ATHENA_BREAKER_RESET", "30.0"))
+
+# Last-known-good reads kept for serving stale
+ATHENA_STALE_TTL = float(os.getenv("ATHENA_STALE_TTL", "3600"))
+ATHENA_STALE_MAX_ENTRIES = int(os.getenv("ATHENA_STALE_MAX_ENTRIES", "1024"))
+
+# Requests per second and burst per practice (0 disables pacing); set these to
+# the practice's API quota. ATHENA_PRACTICE_RATE_LIMITS overrides them per
+# practice as "practice=rate[:burst],..."
+ATHENA_RATE_LIMIT = float(os.getenv("ATHENA_RATE_LIMIT", "15"))
+# Worker processes on this replica sharing the quota; each paces at 1/N of it
+ATHENA_RATE_WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY") or "1"))
+ATHENA_RATE_BURST = int(os.getenv("ATHENA_RATE_BURST", "30"))
+ATHENA_PRACTICE_RATE_LIMITS = os.getenv("ATHENA_PRACTICE_RATE_LIMITS", "")
+# Longest a request queues for its practice's quota before failing fast
+ATHENA_RATE_MAX_WAIT = float(os.getenv("ATHENA_RATE_MAX_WAIT", "30"))
+
+RETRY_STATUSES = (502, 503, 504)
+STALE_WARNING = '110 - "Response is Stale"'
+
+Clock = Callable[[], float]
+Sleep = Callable[[float], Awaitable[None]]
+
+
+class UpstreamUnavailable(httpx.TransportError):
+    """Raised without contacting Athena; ``retry_after`` is when trying again makes sense"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    """The host's circuit breaker is open and no stale response is available"""
+
+
+class RateLimitedError(UpstreamUnavailable):
+    """The practice's request queue is longer than ``ATHENA_RATE_MAX_WAIT``"""
+
+
+@dataclass(frozen=True)
+class EndpointPolicy:
+    name: str
+    timeout: float
+    retries: int = 0
+    idempotent: bool = False  # safe to resend after it may have reached the server
+    serve_stale: bool = False
+
+
+POLICIES = {
+    "token": EndpointPolicy("token", ATHENA_TOKEN_TIMEOUT, ATHENA_TOKEN_RETRIES),
+    "read": EndpointPolicy("read", ATHENA_READ_TIMEOUT, ATHENA_HTTP_RETRIES, idempotent=True, serve_stale=True),
+    "batch": EndpointPolicy("batch", ATHENA_BATCH_TIMEOUT, ATHENA_HTTP_RETRIES, idempotent=True),
+    "write": EndpointPolicy("write", ATHENA_READ_TIMEOUT, ATHENA_TOKEN_RETRIES),
+}
+
+
+def classify_endpoint(method: str, url: str) -> str:
+    """The ``POLICIES`` name for a request; FHIR batch reads must be named explicitly (``endpoint="batch"``)"""
+    if urlsplit(str(url)).path.rstrip("/").endswith("/oauth2/token"):
+        return "token"
+    if method.upper() in ("GET", "HEAD"):
+        return "read"
+    return "write"
+
+
+def retryable(policy: EndpointPolicy, error: Optional[BaseException] = None,
+              response: Optional[httpx.Response] = None) -> bool:
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+        return True  # never reached the server
+    if not policy.idempotent:
+        return False
+    return isinstance(error, httpx.TransportError) or (response is not None and response.status_code in RETRY_STATUSES)
+
+
+def retry_after(response: httpx.Response) -> Optional[float]:
+    """``Retry-After`` in seconds (the delay-seconds form), or None"""
+    value = response.headers.get("Retry-After")
+    try:
+        return max(float(value), 0.0) if value is not None else None
+    except ValueError:
+        return None
+
+
+def backoff_delay(attempt: int, base: float = ATHENA_RETRY_BACKOFF, cap: float = ATHENA_RETRY_MAX_BACKOFF,
+                  rng: Callable[[], float] = random.random) -> float:
+    """Full jitter: uniform in [0, min(cap, base * 2**attempt)) so retrying workers spread out"""
+    return rng() * min(cap, base * 2 ** attempt)
+
+
+class CircuitBreaker:
+    """
+    Closed -> open after ``failure_threshold`` consecutive failures; open ->
+    half-open after ``reset_timeout``, letting one probe through; the probe's
+    outcome closes or re-opens it.
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = ATHENA_BREAKER_FAILURES, reset_timeout: float = ATHENA_BREAKER_RESET,
+                 clock: Clock = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._state = self.CLOSED
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and self.clock() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self._state
+
+    def retry_after(self) -> float:
+        return max(self.reset_timeout - (self.clock() - self.opened_at), 0.0) if self._state == self.OPEN else 0.0
+
+    def allow(self) -> bool:
+        """Whether a call may go upstream now; in half-open only the first caller gets through"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.OPEN or self._probing:
+            return False
+        self._state, self._probing = self.HALF_OPEN, True
+        return True
+
+    def record_success(self) -> None:
+        self._state, self._probing, self.failures = self.CLOSED, False, 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self._state == self.OPEN:
+            return  # a call already in flight when it opened; keep the original reset time
+        if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opens += 1
+            self._state, self._probing, self.opened_at = self.OPEN, False, self.clock()
+
+    def release(self) -> None:
+        """The call was abandoned (cancelled) without an outcome; let another probe through"""
+        self._probing = False
+
+
+class StaleCache:
+    """Bounded LRU of the last successful response per key, kept for ``ttl`` seconds"""
+
+    # Describe the encoded body; the cached content is already decoded
+    _DROPPED_HEADERS = ("content-encoding", "content-length", "transfer-encoding")
+
+    def __init__(self, max_entries: int = ATHENA_STALE_MAX_ENTRIES, ttl: float = ATHENA_STALE_TTL,
+                 clock: Clock = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._entries: "OrderedDict[Hashable, Tuple[float, httpx.Response]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def put(self, key: Hashable, response: httpx.Response) -> None:
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (self.clock(), response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key: Hashable) -> Optional[httpx.Response]:
+        """A copy of the cached response marked stale, or None if missing or older than ``ttl``"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, response = entry
+        if self.clock() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        headers = [(name, value) for name, value in response.headers.items() if name not in self._DROPPED_HEADERS]
+        headers.append(("Warning", STALE_WARNING))
+        return httpx.Response(response.status_code, headers=headers, content=response.content,
+                              request=response.request)
+
+
+class TokenBucket:
+    """
+    ``rate`` requests per second with bursts of up to ``burst``, as GCRA
+    virtual scheduling: each caller reserves its slot up front and is told how
+    long to wait for it, so queued callers go out in arrival order.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, clock: Clock = time.monotonic):
+        self.interval = 1.0 / rate
+        self.tolerance = (max(burst, 1) - 1) * self.interval
+        self.clock = clock
+        self._tat = 0.0  # theoretical arrival time of the next request
+
+    def reserve(self, max_wait: float = float("inf")) -> Optional[float]:
+        """Seconds to wait before sending, or None (nothing reserved) if that exceeds ``max_wait``"""
+        now = self.clock()
+        tat = max(self._tat, now)
+        wait = max(tat - self.tolerance - now, 0.0)
+        if wait > max_wait:
+            return None
+        self._tat = tat + self.interval
+        return wait
+
+    def backlog(self) -> float:
+        """Seconds a request arriving now would wait"""
+        return max(max(self._tat, self.clock()) - self.tolerance - self.clock(), 0.0)
+
+    def pause(self, seconds: float) -> None:
+        """Hold every request back for ``seconds`` (e.g. after a 429), then resume at ``rate``"""
+        self._tat = max(self._tat, self.clock() + seconds + self.tolerance)
+
+
+def parse_rate_limits(spec: str) -> Dict[str, Tuple[float, int]]:
+    """``"practice=rate[:burst],..."`` -> ``{practice: (rate, burst)}``; burst defaults to ``rate``"""
+    limits = {}
+    for item in spec.split(","):
+        practice, _, limit = item.strip().partition("=")
+        if not limit:
+            continue
+        rate, _, burst = limit.partition(":")
+        limits[practice.strip()] = (float(rate), int(burst) if burst else max(int(float(rate)), 1))
+    return limits
+
+
+@dataclass
+class UpstreamStats:
+    retries: int = 0
+    coalesced: int = 0
+    stale_served: int = 0
+    short_circuited: int = 0
+    throttled: int = 0
+    queued: int = 0
+    queued_seconds: float = 0.0
+    rejected: int = 0
+
+    def as_dict(self) -> Dict[str, float]:
+        return dict(self.__dict__)
+
+
+class RateLimiter:
+    """
+    One ``TokenBucket`` per practice id, in this process. With ``workers``
+    processes sharing a quota, each bucket gets ``1 / workers`` of the rate
+    and burst (at least one request of burst).
+    """
+
+    def __init__(self, rate: float = ATHENA_RATE_LIMIT, burst: int = ATHENA_RATE_BURST,
+                 overrides: Optional[Dict[str, Tuple[float, int]]] = None, max_wait: float = ATHENA_RATE_MAX_WAIT,
+                 clock: Clock = time.monotonic, workers: int = ATHENA_RATE_WORKERS):
+        self.rate = rate
+        self.burst = burst
+        self.overrides = parse_rate_limits(ATHENA_PRACTICE_RATE_LIMITS) if overrides is None else overrides
+        self.max_wait = max_wait
+        self.clock = clock
+        self.workers = workers
+        self._buckets: Dict[str, Optional[TokenBucket]] = {}
+
+    def bucket(self, practice_id: str) -> Optional[TokenBucket]:
+        if practice_id not in self._buckets:
+            rate, burst = self.overrides.get(practice_id, (self.rate, self.burst))
+            rate, burst = rate / self.workers, max(1, burst // self.workers)
+            self._buckets[practice_id] = TokenBucket(rate, burst, self.clock) if rate > 0 else None
+        return self._buckets[practice_id]
+
+    async def acquire(self, practice_id: str, stats: UpstreamStats, sleep: Sleep = asyncio.sleep) -> None:
+        """Wait for the practice's next slot; raises ``RateLimitedError`` rather than queue past ``max_wait``"""
+        bucket = self.bucket(practice_id)
+        if bucket is None:
+            return
+        wait = bucket.reserve(self.max_wait)
+        if wait is None:
+            stats.rejected += 1
+            raise RateLimitedError(f"rate limit queue for practice {practice_id!r} is full",
+                                   bucket.backlog() - self.max_wait)
+        if wait > 0:
+            stats.queued += 1
+            stats.queued_seconds += wait
+            await sleep(wait)
+
+    def pause(self, practice_id: str, seconds: float) -> None:
+        bucket = self.bucket(practice_id)
+        if bucket is not None:
+            bucket.pause(seconds)
@@ -0,0 +1,23 @@
+import os
+import tempfile
+import time
+
+import pytest
+
+# The node-shared assessment cache outlives the process; start every test run with an empty one
+os.environ.setdefault("SARCRISK_CACHE_PATH", os.path.join(tempfile.mkdtemp(prefix="sarcrisk-tests-"), "cache.sqlite3"))
+
+from src.session_store import session_store  # noqa: E402
+
+# Bearer token the tests send (``AUTH`` in the test modules)
+TEST_SESSION = "test-token"
+
+
+@pytest.fixture(autouse=True)
+def test_session():
+    """A live session for ``TEST_SESSION``, as ``/callback`` would have created"""
+    expires_at = time.time() + 3600
+    session_store.save("session", TEST_SESSION, {"access_token": "athena-session-token", "expires_at": expires_at},
+                       expires_at)
+    yield
+    session_store.end_session(TEST_SESSION)
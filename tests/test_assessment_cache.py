@@ -0,0 +1,186 @@
+import json
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from src import main
+from src.assessment_cache import (
+    AssessmentCache, LocalCacheBackend, SharedCacheBackend, SQLiteCacheBackend, canonical_input_hash, etag_matches
+)
+from src.main import app
+from src.session_store import session_store
+from tests.test_athena_fhir import MockFhirServer, make_client
+
+AUTH = {"Authorization": "Bearer test-token"}
+
+PATIENT_DATA = {
+    "molecular_data": {"VEGF_level": 120, "CDKN2A_mutation": True},
+    "clinical_data": {"pain": True, "tumor_size": 6},
+    "imaging_data": {"mri_abnormalities": True},
+}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis:
+    """Local stand-in for a redis-py client"""
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+
+    def get(self, name):
+        return self.data.get(name)
+
+    def set(self, name, value, ex=None):
+        self.data[name] = value
+        self.expiry[name] = ex
+
+    def delete(self, name):
+        self.data.pop(name, None)
+
+
+def test_canonical_hash_normalizes_inputs():
+    reordered = {
+        "imaging_data": {"mri_abnormalities": 1},
+        "clinical_data": {"tumor_size": 6.0, "pain": True},
+        "molecular_data": {"CDKN2A_mutation": True, "VEGF_level": 120.0},
+    }
+    assert canonical_input_hash(PATIENT_DATA, "p1") == canonical_input_hash(reordered, "p1")
+    assert canonical_input_hash(PATIENT_DATA, "p1") != canonical_input_hash(PATIENT_DATA, "p2")
+    assert canonical_input_hash(PATIENT_DATA, "p1") != canonical_input_hash(PATIENT_DATA, "p1", "2.0.0")
+    changed = {**PATIENT_DATA, "clinical_data": {"pain": True, "tumor_size": 4}}
+    assert canonical_input_hash(PATIENT_DATA, "p1") != canonical_input_hash(changed, "p1")
+
+
+def test_local_backend_lru_ttl_and_budget():
+    clock = FakeClock()
+    backend = LocalCacheBackend(max_entries=2, max_bytes=10, ttl=60, clock=clock)
+    backend.set("a", b"1234")
+    backend.set("b", b"1234")
+    backend.get("a")  # a is now most recently used
+    backend.set("c", b"1234")
+    assert backend.get("b") is None
+    assert backend.get("a") == b"1234"
+    assert backend.stats.evictions == 1
+
+    backend.set("d", b"12345678")  # exceeds the byte budget together with the others
+    assert backend.size <= 10
+    assert backend.get("d") == b"12345678"
+
+    clock.now += 61
+    assert backend.get("d") is None
+    assert backend.stats.expirations == 1
+    backend.set("huge", b"x" * 11)
+    assert backend.get("huge") is None
+
+
+def test_shared_backend_fills_local_cache():
+    redis = FakeRedis()
+    writer = AssessmentCache(local=LocalCacheBackend(), shared=SharedCacheBackend(redis, ttl=30))
+    writer.set("key", '{"resourceType":"RiskAssessment"}')
+    writer.set_latest("alice", "p1", "key")
+    assert redis.expiry["sarcrisk:ra:key"] == 30
+
+    # A different worker with an empty local cache
+    reader = AssessmentCache(local=LocalCacheBackend(), shared=SharedCacheBackend(redis))
+    assert reader.latest("alice", "p1") == ("key", '{"resourceType":"RiskAssessment"}')
+    assert reader.latest("bob", "p1") is None
+    redis.data.clear()
+    assert reader.get("key") == '{"resourceType":"RiskAssessment"}'
+
+
+def test_sqlite_backend_is_shared_between_workers(tmp_path):
+    now = [1000.0]
+    first = AssessmentCache(local=LocalCacheBackend(), shared=SQLiteCacheBackend(str(tmp_path / "c.db"), ttl=30,
+                                                                                clock=lambda: now[0]))
+    second = AssessmentCache(local=LocalCacheBackend(), shared=SQLiteCacheBackend(str(tmp_path / "c.db"), ttl=30,
+                                                                                 clock=lambda: now[0]))
+    first.set_many([("k1", '{"id":"1"}'), ("k2", '{"id":"2"}')])
+    first.set_latest_many("alice", [("p1", "k1"), ("p2", "k2")])
+    assert second.get_many(["k1", "k2", "k3"]) == {"k1": '{"id":"1"}', "k2": '{"id":"2"}'}
+    assert (second.stats.hits, second.stats.misses) == (2, 1)
+
+    # The latest pointer moved by one worker is seen by the other, despite its local copy
+    assert first.latest("alice", "p1") == ("k1", '{"id":"1"}')
+    second.set("k3", '{"id":"3"}')
+    second.set_latest("alice", "p1", "k3")
+    assert first.latest("alice", "p1") == ("k3", '{"id":"3"}')
+
+    now[0] += 31
+    assert SQLiteCacheBackend(str(tmp_path / "c.db"), clock=lambda: now[0]).get("ra:k3") is None
+
+
+def test_etag_matching():
+    assert etag_matches('W/"abc"', "abc")
+    assert etag_matches('"x", "abc"', "abc")
+    assert etag_matches("*", "abc")
+    assert not etag_matches(None, "abc")
+    assert not etag_matches('W/"other"', "abc")
+
+
+@pytest.fixture
+def fresh_cache(monkeypatch):
+    cache = AssessmentCache(local=LocalCacheBackend())
+    monkeypatch.setattr(main, "assessment_cache", cache)
+    return cache
+
+
+def batch_body(vegf):
+    return json.dumps({"resourceType": "Bundle", "type": "batch", "entry": [
+        {"resource": {"resourceType": "Patient", "id": "p1"}},
+        {"resource": {
+            "resourceType": "Observation",
+            "status": "final",
+            "code": {"coding": [{"code": "VEGF_level"}]},
+            "subject": {"reference": "Patient/p1"},
+            "valueQuantity": {"value": vegf},
+        }},
+    ]})
+
+
+def test_batch_uses_the_cache_but_never_feeds_the_read_endpoint(fresh_cache):
+    with TestClient(app) as client:
+        first = client.post("/RiskAssessment/$batch", content=batch_body(120), headers=AUTH).json()
+        second = client.post("/RiskAssessment/$batch", content=batch_body(120), headers=AUTH).json()
+        assert first == second
+        assert fresh_cache.stats.hits == 1
+        assert client.get("/assessment-cache").json()["hits"] == 1
+
+        # Client-supplied inputs must not stand in for the patient's real assessment
+        assert client.get("/RiskAssessment/p1", headers=AUTH).status_code == 404
+
+
+def test_read_serves_the_callers_athena_assessment(fresh_cache, monkeypatch):
+    monkeypatch.setattr(main, "athena_fhir", make_client(MockFhirServer()))
+    expires_at = time.time() + 3600
+    session_store.save("session", "other-session", {"access_token": "other-athena-token", "expires_at": expires_at},
+                       expires_at)
+    other = {"Authorization": "Bearer other-session"}
+    try:
+        with TestClient(app) as client:
+            assessed = client.get("/Patient/p1/$risk-assessment", headers=AUTH)
+            tag = assessed.headers["ETag"]
+
+            read = client.get("/RiskAssessment/p1", headers=AUTH)
+            assert read.status_code == 200
+            assert read.headers["ETag"] == tag
+            assert read.json() == assessed.json()
+
+            not_modified = client.get("/RiskAssessment/p1", headers={**AUTH, "If-None-Match": tag})
+            assert not_modified.status_code == 304
+            assert not_modified.content == b""
+
+            # Athena data read for one user is not served to another
+            assert client.get("/RiskAssessment/p1", headers=other).status_code == 404
+            assert client.get("/RiskAssessment/unknown", headers=AUTH).status_code == 404
+            assert client.get("/RiskAssessment/p1%26x", headers=AUTH).status_code == 400
+    finally:
+        session_store.end_session("other-session")
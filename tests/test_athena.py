@@ -0,0 +1,55 @@
+from fhir.resources.riskassessment import RiskAssessment
+
+from src.athena import map_to_observation, map_to_patient, map_to_risk_assessment
+
+PATIENT_DATA = {
+    "name": {"family": "Doe", "given": ["John"]},
+    "molecular_data": {"VEGF_level": 120, "CDKN2A_mutation": True, "TP53_mutation": True},
+    "clinical_data": {"pain": True, "swelling": True, "fever": False, "tumor_size": 6},
+    "imaging_data": {
+        "mri_abnormalities": True,
+        "ct_scan_abnormalities": False,
+        "pet_scan_high_activity": True,
+        "x_ray_findings": False,
+    },
+}
+
+
+# Test map_to_risk_assessment function
+def test_map_to_risk_assessment():
+    risk_assessment = map_to_risk_assessment(
+        PATIENT_DATA, 0.9, "High", ["Soft Tissue Sarcoma", "Osteosarcoma"]
+    )
+
+    # Check if the FHIR RiskAssessment object is created correctly
+    assert isinstance(risk_assessment, RiskAssessment), "RiskAssessment object was not created."
+    assert risk_assessment.status == "final", f"Expected 'final' status, but got {risk_assessment.status}"
+    assert len(risk_assessment.prediction) == 1, "Risk assessment should have one prediction."
+
+    prediction = risk_assessment.prediction[0]
+    assert prediction.outcome.text == "High", f"Expected 'High' outcome but got {prediction.outcome.text}"
+    assert float(prediction.probabilityDecimal) == 0.9
+
+    # Check for extensions (suspected subtypes)
+    extensions = [ext for ext in risk_assessment.extension if ext.url == "http://example.com/suspected-sarcoma-subtypes"]
+    assert extensions, "Suspected sarcoma subtypes not found in the extensions."
+    assert extensions[0].valueCodeableConcept.text == "Soft Tissue Sarcoma, Osteosarcoma"
+
+    # Check for tumor size extension
+    tumor_size_ext = [ext for ext in risk_assessment.extension if ext.url == "http://example.com/tumor-size"]
+    assert tumor_size_ext, "Tumor size extension not found."
+    assert tumor_size_ext[0].valueQuantity.value == 6
+
+
+def test_map_to_risk_assessment_subject():
+    risk_assessment = map_to_risk_assessment(PATIENT_DATA, 0.2, "Low", ["Osteosarcoma"], patient_id="p-1")
+    assert risk_assessment.subject.reference == "Patient/p-1"
+
+
+def test_map_to_observation_and_patient():
+    observation = map_to_observation("molecular", PATIENT_DATA["molecular_data"], "1234", "VEGF")
+    assert observation.valueQuantity.unit == "pg/mL"
+    assert observation.valueQuantity.value == 120
+
+    patient = map_to_patient(PATIENT_DATA)
+    assert patient.name[0].family == "Doe"
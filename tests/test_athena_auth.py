@@ -0,0 +1,53 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from src.athena_auth import AthenaAuth
+from src.http_client import AthenaHttpClient
+
+
+def make_auth(handler, **kwargs) -> AthenaAuth:
+    return AthenaAuth(http_client=AthenaHttpClient(transport=httpx.MockTransport(handler), **kwargs))
+
+
+def test_get_access_token():
+    def handler(request):
+        assert b"grant_type=authorization_code" in request.content
+        return httpx.Response(200, json={"access_token": "abc", "expires_in": 3600})
+
+    token = asyncio.run(make_auth(handler).get_access_token("code-1"))
+    assert token["access_token"] == "abc"
+
+
+def test_refresh_access_token_failure():
+    def handler(request):
+        assert b"grant_type=refresh_token" in request.content
+        return httpx.Response(401)
+
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(make_auth(handler).refresh_access_token("stale"))
+    assert excinfo.value.status_code == 401
+
+
+def test_concurrency_is_bounded():
+    in_flight = 0
+    peak = 0
+
+    async def handler(request):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return httpx.Response(200, json={"access_token": "abc"})
+
+    auth = make_auth(handler, max_concurrency=3)
+
+    async def burst():
+        await asyncio.gather(*(auth.get_access_token(str(i)) for i in range(12)))
+        await auth.http_client.close()
+
+    asyncio.run(burst())
+    assert peak == 3
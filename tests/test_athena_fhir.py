@@ -0,0 +1,244 @@
+import asyncio
+import json
+from urllib.parse import parse_qs, urlsplit
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from src import main
+from src.athena_fhir import AthenaFhirClient, AthenaFhirError
+from src.http_client import AthenaHttpClient
+from src.main import app
+from src.upstream import RateLimiter
+
+BASE = "https://fhir.test/r4"
+AUTH = {"Authorization": "Bearer test-token"}
+
+
+def observation(patient_id, code, **value):
+    return {
+        "resourceType": "Observation",
+        "status": "final",
+        "code": {"coding": [{"system": "http://example.com/sarcrisk-features", "code": code}]},
+        "subject": {"reference": f"Patient/{patient_id}"},
+        **value,
+    }
+
+
+OBSERVATIONS = {
+    "laboratory": [
+        observation("p1", "VEGF_level", valueQuantity={"value": 120, "unit": "pg/mL"}),
+        observation("p1", "CDKN2A_mutation", valueBoolean=True),
+        observation("p1", "TP53_mutation", valueBoolean=True),
+    ],
+    "exam": [
+        observation("p1", "pain", valueBoolean=True),
+        observation("p1", "swelling", valueBoolean=True),
+        observation("p1", "tumor_size", valueQuantity={"value": 6, "unit": "cm"}),
+    ],
+    "imaging": [
+        observation("p1", "mri_abnormalities", valueBoolean=True),
+        observation("p1", "pet_scan_high_activity", valueBoolean=True),
+    ],
+}
+
+
+class MockFhirServer:
+    """In-process FHIR server: Patient reads, paged Observation search, batch and throttling"""
+
+    def __init__(self, page_size=2, throttle=0, delay=0.0):
+        self.page_size = page_size
+        self.throttle = throttle
+        self.delay = delay
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def search_page(self, params):
+        matches = OBSERVATIONS.get(params["category"], []) if params["patient"] == "p1" else []
+        offset = int(params.get("offset", 0))
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "entry": [{"resource": r} for r in matches[offset:offset + self.page_size]],
+            "link": [],
+        }
+        if offset + self.page_size < len(matches):
+            query = f"patient={params['patient']}&category={params['category']}&offset={offset + self.page_size}"
+            bundle["link"].append({"relation": "next", "url": f"{BASE}/Observation?{query}"})
+        return bundle
+
+    def read(self, path, params):
+        resource_type, _, resource_id = path.partition("/")
+        if resource_type == "Observation":
+            return 200, self.search_page(params)
+        if resource_id == "p1":
+            return 200, {"resourceType": "Patient", "id": "p1", "name": [{"family": "Doe", "given": ["Jane"]}]}
+        return 404, {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "not-found"}]}
+
+    def batch(self, body):
+        entries = []
+        for entry in body["entry"]:
+            url = urlsplit(entry["request"]["url"])
+            status, resource = self.read(url.path, {k: v[0] for k, v in parse_qs(url.query).items()})
+            entries.append({"resource": resource, "response": {"status": f"{status}"}})
+        return {"resourceType": "Bundle", "type": "batch-response", "entry": entries}
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if self.throttle:
+            self.throttle -= 1
+            return httpx.Response(429, headers={"Retry-After": "2"})
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        if request.method == "POST":
+            return httpx.Response(200, json=self.batch(json.loads(request.content)))
+        path = request.url.path[len("/r4/"):]
+        status, body = self.read(path, dict(request.url.params))
+        return httpx.Response(status, json=body)
+
+
+def make_client(server, sleeps=None, **kwargs):
+    async def headers(practice_id):
+        return {"Authorization": "Bearer athena-token"}
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+
+    return AthenaFhirClient(
+        base_url=BASE,
+        # No practice pacing: these tests exercise the FHIR client's own 429 handling
+        http_client=AthenaHttpClient(transport=httpx.MockTransport(server), rate_limiter=RateLimiter(rate=0)),
+        headers=headers,
+        sleep=sleep if sleeps is not None else asyncio.sleep,
+        **kwargs,
+    )
+
+
+EXPECTED = {
+    "name": {"family": "Doe", "given": ["Jane"]},
+    "molecular_data": {"VEGF_level": 120.0, "CDKN2A_mutation": True, "TP53_mutation": True},
+    "clinical_data": {"pain": True, "swelling": True, "tumor_size": 6.0},
+    "imaging_data": {"mri_abnormalities": True, "pet_scan_high_activity": True},
+}
+
+
+def assert_patient_data(patient_data):
+    for section in ("molecular_data", "clinical_data", "imaging_data"):
+        assert patient_data[section] == EXPECTED[section]
+
+
+def test_fetch_patient_data_follows_pages():
+    server = MockFhirServer(page_size=2)
+    patient_data = asyncio.run(make_client(server).fetch_patient_data("p1"))
+
+    assert_patient_data(patient_data)
+    # Patient + 3 categories, two of which span two pages
+    assert len(server.requests) == 6
+    assert all(r.headers["authorization"] == "Bearer athena-token" for r in server.requests)
+
+
+def test_fetch_patient_data_batch_matches_concurrent_reads():
+    server = MockFhirServer(page_size=2)
+    patient_data = asyncio.run(make_client(server).fetch_patient_data("p1", use_batch=True))
+
+    assert_patient_data(patient_data)
+    assert server.requests[0].method == "POST"
+    # One batch round-trip, then only the follow-up pages
+    assert len(server.requests) == 3
+
+
+def test_429_is_retried_after_retry_after():
+    server, sleeps = MockFhirServer(page_size=10, throttle=2), []
+    patient_data = asyncio.run(make_client(server, sleeps).fetch_patient_data("p1"))
+
+    assert_patient_data(patient_data)
+    assert sleeps == [2.0, 2.0]
+
+
+def test_429_gives_up_after_max_retries():
+    server, sleeps = MockFhirServer(throttle=10), []
+    client = make_client(server, sleeps, max_retries=2)
+
+    try:
+        asyncio.run(client.read("Patient", "p1"))
+    except AthenaFhirError as e:
+        assert e.status_code == 429
+    else:
+        raise AssertionError("expected AthenaFhirError")
+    assert len(server.requests) == 3
+
+
+def test_per_host_concurrency_limit():
+    server = MockFhirServer(page_size=10, delay=0.01)
+    client = make_client(server, max_per_host=2)
+
+    async def scenario():
+        return [item async for item in client.fetch_cohort(["p1"] * 5, concurrency=5)]
+
+    results = asyncio.run(scenario())
+    assert len(results) == 5
+    assert server.max_in_flight == 2
+
+
+def test_fetch_cohort_reports_failures_per_patient():
+    server = MockFhirServer(page_size=10)
+    client = make_client(server)
+
+    async def scenario():
+        return {patient_id: result async for patient_id, result in client.fetch_cohort(["p1", "missing"])}
+
+    results = asyncio.run(scenario())
+    assert_patient_data(results["p1"])
+    assert isinstance(results["missing"], AthenaFhirError)
+    assert results["missing"].status_code == 404
+
+
+def test_batch_request_urls_are_encoded():
+    server = MockFhirServer()
+    with pytest.raises(AthenaFhirError):
+        asyncio.run(make_client(server).fetch_patient_data("x&category=y", use_batch=True))
+    urls = [entry["request"]["url"] for entry in json.loads(server.requests[0].content)["entry"]]
+    assert urls[:2] == ["Patient/x%26category%3Dy", "Observation?patient=x%26category%3Dy&category=laboratory"]
+
+
+def test_non_json_response_is_an_upstream_error():
+    client = make_client(lambda request: httpx.Response(200, text="<html>maintenance</html>"))
+    with pytest.raises(AthenaFhirError) as error:
+        asyncio.run(client.read("Patient", "p1"))
+    assert error.value.status_code == 502
+
+
+def test_patient_risk_assessment_endpoint(monkeypatch):
+    server = MockFhirServer()
+    monkeypatch.setattr(main, "athena_fhir", make_client(server))
+    with TestClient(app) as client:
+        response = client.get("/Patient/p1/$risk-assessment", headers=AUTH)
+        missing = client.get("/Patient/missing/$risk-assessment", headers=AUTH)
+        invalid = client.get("/Patient/p1%26x/$risk-assessment", headers=AUTH)
+        unknown = client.get("/Patient/p1/$risk-assessment", headers={"Authorization": "Bearer x"})
+        monkeypatch.setattr(main, "athena_fhir", make_client(lambda request: httpx.Response(200, text="oops")))
+        not_json = client.get("/Patient/p1/$risk-assessment", headers=AUTH)
+
+    # Athena is read with the caller's session token, never the system token
+    assert {r.headers["authorization"] for r in server.requests} == {"Bearer athena-session-token"}
+    assert invalid.status_code == 400
+    assert unknown.status_code == 401
+    assert not_json.status_code == 502
+
+    assert response.status_code == 200
+    assert response.headers["etag"].startswith('W/"')
+    resource = response.json()
+    assert resource["subject"] == {"reference": "Patient/p1"}
+    assert resource["prediction"][0]["outcome"]["text"] == "High"
+    assert [reference["reference"] for reference in resource["basis"]] == [
+        "Observation/p1-clinical", "Observation/p1-molecular", "Observation/p1-imaging",
+    ]
+    assert all("display" in reference for reference in resource["basis"])
+    assert missing.status_code == 404
+    assert missing.json()["resourceType"] == "OperationOutcome"
@@ -0,0 +1,191 @@
+import json
+
+from fastapi.testclient import TestClient
+
+from src import main
+from src.main import app
+
+AUTH = {"Authorization": "Bearer test-token"}
+
+
+def observation(patient_id, code, **value):
+    return {
+        "resourceType": "Observation",
+        "status": "final",
+        "code": {"coding": [{"system": "http://example.com/sarcrisk-features", "code": code}]},
+        "subject": {"reference": f"Patient/{patient_id}"},
+        **value,
+    }
+
+
+def patient(patient_id):
+    return {"resourceType": "Patient", "id": patient_id, "name": [{"family": "Doe", "given": ["Jane"]}]}
+
+
+HIGH_RISK = [
+    patient("p1"),
+    observation("p1", "VEGF_level", valueQuantity={"value": 120, "unit": "pg/mL"}),
+    observation("p1", "CDKN2A_mutation", valueBoolean=True),
+    observation("p1", "TP53_mutation", valueBoolean=True),
+    {
+        "resourceType": "Observation",
+        "status": "final",
+        "code": {"text": "symptoms"},
+        "subject": {"reference": "Patient/p1"},
+        "component": [
+            {"code": {"text": "pain"}, "valueBoolean": True},
+            {"code": {"text": "swelling"}, "valueBoolean": True},
+            {"code": {"text": "tumor_size"}, "valueQuantity": {"value": 6, "unit": "cm"}},
+        ],
+    },
+    observation("p1", "mri_abnormalities", valueBoolean=True),
+    observation("p1", "pet_scan_high_activity", valueBoolean=True),
+]
+
+
+def bundle(resources):
+    return {"resourceType": "Bundle", "type": "batch", "entry": [{"resource": r} for r in resources]}
+
+
+def post(client, body, content_type="application/fhir+json"):
+    return client.post("/RiskAssessment/$batch", content=body, headers={**AUTH, "Content-Type": content_type})
+
+
+def test_batch_scores_bundle():
+    resources = HIGH_RISK + [patient("p2"), observation("p2", "fever", valueBoolean=True)]
+    with TestClient(app) as client:
+        response = post(client, json.dumps(bundle(resources)))
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/fhir+json")
+    result = response.json()
+    assert result["type"] == "transaction-response"
+    entries = result["entry"]
+    assert [e["response"]["status"] for e in entries] == ["201 Created", "201 Created"]
+    first, second = (e["resource"] for e in entries)
+    assert first["subject"]["reference"] == "Patient/p1"
+    assert first["prediction"][0]["outcome"]["text"] == "High"
+    assert second["prediction"][0]["outcome"]["text"] == "Low"
+    assert "fever" not in first["prediction"][0]["rationale"]
+    assert second["prediction"][0]["rationale"] == "Risk factors: fever (+0.03)"
+    assert second["basis"] == [
+        {"reference": "Observation/p2-clinical", "display": "fever (+0.03)"},
+        {"reference": "Observation/p2-molecular"},
+        {"reference": "Observation/p2-imaging"},
+    ]
+
+
+def test_batch_accepts_ndjson():
+    body = "\n".join(json.dumps(r) for r in HIGH_RISK)
+    with TestClient(app) as client:
+        response = post(client, body, "application/fhir+ndjson")
+    entries = response.json()["entry"]
+    assert len(entries) == 1
+    assert entries[0]["resource"]["prediction"][0]["outcome"]["text"] == "High"
+
+
+def test_bad_entries_are_reported_individually():
+    resources = HIGH_RISK + [
+        patient("p2"),
+        observation("p2", "VEGF_level", valueString="high"),  # unsupported value type
+        observation("missing", "pain", valueBoolean=True),
+        {"resourceType": "Medication"},
+    ]
+    body = "\n".join(json.dumps(r) for r in resources) + "\n{not json"
+    with TestClient(app) as client:
+        response = post(client, body, "application/x-ndjson")
+
+    entries = response.json()["entry"]
+    statuses = [e["response"]["status"] for e in entries]
+    assert statuses.count("201 Created") == 1
+    assert statuses.count("400 Bad Request") == 5
+    diagnostics = [e["response"]["outcome"]["issue"][0]["diagnostics"] for e in entries[1:]]
+    assert any("Patient/p2 was not scored" in d for d in diagnostics)
+    assert any(d.startswith("Entry 11: Invalid JSON") for d in diagnostics)
+
+
+def test_invalid_patient_ids_are_reported_individually():
+    resources = HIGH_RISK + [patient("p" * 65), patient("p 2")]
+    with TestClient(app) as client:
+        response = post(client, json.dumps(bundle(resources)), "application/fhir+json")
+
+    entries = response.json()["entry"]
+    assert [e["response"]["status"] for e in entries] == ["201 Created", "400 Bad Request", "400 Bad Request"]
+    diagnostics = [e["response"]["outcome"]["issue"][0]["diagnostics"] for e in entries[1:]]
+    assert all("is not a valid FHIR id" in d for d in diagnostics)
+
+
+def test_malformed_names_subjects_and_values_are_reported_individually():
+    resources = HIGH_RISK + [
+        {**patient("p2"), "name": {"family": "Doe"}},
+        {**patient("p3"), "name": ["Doe"]},
+        {**observation("p1", "pain", valueBoolean=True), "subject": "Patient/p1"},
+        {**observation("p1", "pain", valueBoolean=True), "subject": {"reference": 7}},
+        patient("p4"),
+        observation("p4", "tumor_size", valueQuantity={"value": "inf", "unit": "cm"}),
+    ]
+    with TestClient(app) as client:
+        response = post(client, json.dumps(bundle(resources)))
+
+    assert response.status_code == 200
+    entries = response.json()["entry"]
+    statuses = [e["response"]["status"] for e in entries]
+    assert statuses.count("201 Created") == 1
+    diagnostics = [e["response"]["outcome"]["issue"][0]["diagnostics"] for e in entries[1:]]
+    assert any("Entry 7: Patient.name must be a list" in d for d in diagnostics)
+    assert any("Entry 8: Patient.name must be a list" in d for d in diagnostics)
+    assert any("Entry 9: Observation.subject must be a Reference" in d for d in diagnostics)
+    assert any("Entry 10: Observation.subject.reference must be a string" in d for d in diagnostics)
+    assert any("Entry 12: valueQuantity value 'inf' is not a finite number" in d for d in diagnostics)
+    assert any("Patient/p4 was not scored" in d for d in diagnostics)
+
+
+def test_entries_answer_the_request_in_order():
+    resources = [
+        observation("missing", "pain", valueBoolean=True),
+        patient("p2"), observation("p2", "fever", valueBoolean=True),
+        *HIGH_RISK,
+        patient("p2"),
+    ]
+    with TestClient(app) as client:
+        response = post(client, json.dumps(bundle(resources)))
+
+    entries = response.json()["entry"]
+    assert [e["response"]["status"] for e in entries] == ["400 Bad Request", "400 Bad Request", "201 Created",
+                                                          "400 Bad Request"]
+    diagnostics = [e["response"]["outcome"]["issue"][0]["diagnostics"] for e in entries if "outcome" in e["response"]]
+    assert diagnostics == [
+        "Entry 0: Observation subject missing is not a Patient in this batch",
+        "Entry 1: Patient/p2 was not scored because its id is not unique",
+        "Entry 10: Patient/p2 is already given in entry 1",
+    ]
+    assert entries[2]["resource"]["subject"]["reference"] == "Patient/p1"
+
+
+def test_batch_size_limit(monkeypatch):
+    monkeypatch.setattr(main, "SARCRISK_MAX_BATCH_SIZE", 1)
+    with TestClient(app) as client:
+        response = post(client, json.dumps(bundle([patient("a"), patient("b")])))
+    assert response.status_code == 413
+    assert response.json()["resourceType"] == "OperationOutcome"
+
+
+def test_batch_rejects_malformed_body():
+    with TestClient(app) as client:
+        response = post(client, "[1, 2")
+    assert response.status_code == 400
+
+
+def test_batch_requires_bearer_token():
+    with TestClient(app) as client:
+        response = client.post("/RiskAssessment/$batch", content=json.dumps(bundle(HIGH_RISK)))
+    assert response.status_code == 403
+
+
+def test_unmappable_patient_is_reported_individually():
+    resources = HIGH_RISK + [patient("p2"), observation("p2", "tumor_size", valueBoolean=True)]
+    with TestClient(app) as client:
+        response = post(client, json.dumps(bundle(resources)))
+    entries = response.json()["entry"]
+    assert [e["response"]["status"] for e in entries] == ["201 Created", "400 Bad Request"]
+    assert "Patient/p2 could not be mapped" in entries[1]["response"]["outcome"]["issue"][0]["diagnostics"]
@@ -0,0 +1,196 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from src import bulk_export
+from src.bulk_export import ExportJob, ExportJobManager, iter_export_lines
+from src.main import app
+
+AUTH = {"Authorization": "Bearer test-token"}
+ASYNC = {**AUTH, "Prefer": "respond-async"}
+
+RECORD = {
+    "id": "p1",
+    "molecular_data": {"VEGF_level": 120, "CDKN2A_mutation": True, "TP53_mutation": True},
+    "clinical_data": {"pain": True, "swelling": True, "fever": False, "tumor_size": 6},
+    "imaging_data": {"mri_abnormalities": True, "pet_scan_high_activity": True},
+}
+
+
+@pytest.fixture(autouse=True)
+def export_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(bulk_export, "export_jobs", ExportJobManager(root=str(tmp_path), chunk_size=2))
+    monkeypatch.setattr("src.main.export_jobs", bulk_export.export_jobs)
+    return tmp_path
+
+
+def wait_for_completion(client, status_url):
+    for _ in range(200):
+        response = client.get(status_url, headers=AUTH)
+        if response.status_code != 202:
+            return response
+        assert "X-Progress" in response.headers
+        time.sleep(0.01)
+    raise AssertionError("export did not finish")
+
+
+def test_iter_export_lines_is_lazy():
+    def records():
+        for i in range(5):
+            yield {**RECORD, "id": f"p{i}"}
+        raise AssertionError("consumed past the first chunk")
+
+    lines = iter_export_lines(records(), ["RiskAssessment"], chunk_size=5)
+    first = [next(lines) for _ in range(5)]
+    assert [json.loads(line)["subject"]["reference"] for _, line in first] == [f"Patient/p{i}" for i in range(5)]
+
+
+def test_export_round_trip():
+    body = "\n".join(json.dumps({**RECORD, "id": f"p{i}"}) for i in range(5)) + "\nnot json\n"
+    with TestClient(app) as client:
+        kick_off = client.post("/$export", content=body, headers=ASYNC)
+        assert kick_off.status_code == 202
+        status_url = kick_off.headers["Content-Location"]
+
+        status = wait_for_completion(client, status_url)
+        assert status.status_code == 200
+        manifest = status.json()
+        assert manifest["requiresAccessToken"] is True
+        outputs = {output["type"]: output for output in manifest["output"]}
+        assert outputs["RiskAssessment"]["count"] == 5
+        assert outputs["Observation"]["count"] == 15
+        assert manifest["error"][0]["count"] == 1
+
+        download = client.get(outputs["RiskAssessment"]["url"], headers=AUTH)
+        assert download.headers["content-type"].startswith("application/fhir+ndjson")
+        resources = [json.loads(line) for line in download.text.splitlines()]
+        assert [r["subject"]["reference"] for r in resources] == [f"Patient/p{i}" for i in range(5)]
+        assert resources[0]["prediction"][0]["outcome"]["text"] == "High"
+        assert resources[0]["basis"][0] == {
+            "reference": "Observation/p0-clinical", "display": "tumor_size > 5 (+0.12), swelling (+0.09), pain (+0.06)",
+        }
+
+        observations = client.get(outputs["Observation"]["url"], headers=AUTH)
+        observation_ids = {json.loads(line)["id"] for line in observations.text.splitlines()}
+        references = {reference["reference"] for resource in resources for reference in resource["basis"]}
+        assert references == {f"Observation/{observation_id}" for observation_id in observation_ids}
+
+        errors = client.get(manifest["error"][0]["url"], headers=AUTH)
+        assert "Line 6" in errors.text
+
+
+def test_invalid_records_are_reported_without_failing_the_export(tmp_path):
+    lines = [
+        json.dumps(RECORD),
+        "   ",
+        json.dumps({**RECORD, "id": "p2", "clinical_data": None}),
+        json.dumps({**RECORD, "id": "p3", "molecular_data": {"VEGF_level": "high"}}),
+        json.dumps({**RECORD, "id": "p 4"}),
+        json.dumps({**RECORD, "id": "p5", "imaging_data": {"mri_abnormalities": "yes"}}),
+    ]
+    body = ("\n".join(lines) + "\n\n").encode()
+
+    async def chunks():
+        # Split mid-line, so records are counted across pieces
+        for start in range(0, len(body), 7):
+            yield body[start:start + 7]
+
+    async def scenario():
+        manager = ExportJobManager(root=str(tmp_path))
+        job = await manager.kick_off(chunks(), ["RiskAssessment"], "http://testserver/$export")
+        await job.task
+        return job
+
+    job = asyncio.run(scenario())
+    assert job.status == "completed"
+    assert job.total == job.processed == 5
+    assert job.counts == {"RiskAssessment": 1}
+    assert job.error_count == 4
+    with open(job.output_path("OperationOutcome")) as errors:
+        diagnostics = [json.loads(line)["issue"][0]["diagnostics"] for line in errors]
+    assert diagnostics == [
+        "Line 3: clinical_data must be an object",
+        "Line 4: VEGF_level must be a finite number, got 'high'",
+        "Line 5: id 'p 4' is not a valid FHIR id",
+        "Line 6: mri_abnormalities must be true or false, got 'yes'",
+    ]
+
+
+def test_export_type_filter():
+    with TestClient(app) as client:
+        kick_off = client.post("/$export?_type=Observation", content=json.dumps(RECORD), headers=ASYNC)
+        manifest = wait_for_completion(client, kick_off.headers["Content-Location"]).json()
+    assert [output["type"] for output in manifest["output"]] == ["Observation"]
+    assert manifest["output"][0]["count"] == 3
+
+
+def test_export_rejects_unknown_type_and_sync_requests():
+    with TestClient(app) as client:
+        assert client.post("/$export?_type=Patient", content="", headers=ASYNC).status_code == 400
+        assert client.post("/$export", content="", headers=AUTH).status_code == 400
+
+
+def test_export_cancel_removes_files(export_root):
+    with TestClient(app) as client:
+        kick_off = client.post("/$export", content=json.dumps(RECORD), headers=ASYNC)
+        status_url = kick_off.headers["Content-Location"]
+        wait_for_completion(client, status_url)
+        assert client.delete(status_url, headers=AUTH).status_code == 202
+        assert client.get(status_url, headers=AUTH).status_code == 404
+    assert list(export_root.iterdir()) == []
+
+
+def test_finished_exports_expire(tmp_path):
+    clock = [1000.0]
+    jobs = ExportJobManager(root=str(tmp_path), ttl=60, clock=lambda: clock[0])
+
+    async def body():
+        yield json.dumps(RECORD).encode()
+
+    async def scenario():
+        job = await jobs.kick_off(body(), ["RiskAssessment"], "http://testserver/$export")
+        await job.task
+        return job
+
+    job = asyncio.run(scenario())
+    orphan = tmp_path / "left-by-another-process"
+    orphan.mkdir()
+    os.utime(orphan, (0, 0))
+
+    clock[0] += 59
+    assert jobs.get(job.id).status == "completed"
+    clock[0] += 1
+    assert jobs.expire() == 2
+    assert jobs.get(job.id) is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_jobs_are_shared_between_processes(tmp_path):
+    """A second manager on the same directory stands in for another gunicorn worker"""
+    runner, other = ExportJobManager(root=str(tmp_path)), ExportJobManager(root=str(tmp_path))
+
+    async def body():
+        yield "\n".join(json.dumps({**RECORD, "id": f"p{i}"}) for i in range(3)).encode()
+
+    async def scenario():
+        job = await runner.kick_off(body(), ["RiskAssessment"], "http://testserver/$export")
+        await job.task
+        return job
+
+    job = asyncio.run(scenario())
+    seen = other.get(job.id)
+    assert (seen.status, seen.counts, seen.progress) == ("completed", {"RiskAssessment": 3}, "100% (3/3 patients)")
+    assert other.get("../" + job.id) is None
+
+    # A job left in progress by a process that is gone is reported as failed
+    stopped = ExportJob.load(job.directory)
+    stopped.status, stopped.finished, stopped.pid = "in-progress", None, 2 ** 22 + 1
+    stopped.save()
+    assert other.get(job.id).status == "failed"
+
+    assert other.delete(job.id)
+    assert runner.get(job.id) is None and not os.path.exists(job.directory)
@@ -0,0 +1,97 @@
+import gzip
+
+from fastapi.testclient import TestClient
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from src.compression import CompressionMiddleware, GzipCodec, choose_codec
+
+BIG = "x" * 4096
+
+
+class FakeBrotliCodec(GzipCodec):
+    """Stands in for an optional codec so preference order can be tested without brotli / zstd"""
+    name = "br"
+
+
+def make_app(**options):
+    async def big(request):
+        return PlainTextResponse(BIG)
+
+    async def small(request):
+        return PlainTextResponse("ok")
+
+    async def binary(request):
+        return Response(BIG.encode(), media_type="application/octet-stream")
+
+    async def not_modified(request):
+        return Response(status_code=304)
+
+    async def stream(request):
+        async def chunks():
+            for i in range(5):
+                yield f"line {i} {'y' * 1000}\n".encode()
+        return StreamingResponse(chunks(), media_type="application/fhir+ndjson")
+
+    app = Starlette(routes=[Route(path, endpoint) for path, endpoint in [
+        ("/big", big), ("/small", small), ("/binary", binary), ("/not-modified", not_modified), ("/stream", stream),
+    ]])
+    app.add_middleware(CompressionMiddleware, **options)
+    return app
+
+
+def test_codec_negotiation_follows_q_values_then_server_preference():
+    gzip_codec, br_codec = GzipCodec(), FakeBrotliCodec()
+    codecs = [br_codec, gzip_codec]
+    assert choose_codec("gzip, br", codecs) is br_codec
+    assert choose_codec("gzip;q=1.0, br;q=0.5", codecs) is gzip_codec
+    assert choose_codec("br;q=0, *", codecs) is gzip_codec
+    assert choose_codec("identity", codecs) is None
+    assert choose_codec(None, codecs) is None
+
+
+def test_large_bodies_are_compressed_small_ones_are_not():
+    client = TestClient(make_app(minimum_size=1024))
+    big = client.get("/big", headers={"Accept-Encoding": "gzip"})
+    small = client.get("/small", headers={"Accept-Encoding": "gzip"})
+    plain = client.get("/big", headers={"Accept-Encoding": "identity"})
+
+    assert big.headers["content-encoding"] == "gzip"
+    assert int(big.headers["content-length"]) < len(BIG)
+    assert "Accept-Encoding" in big.headers["vary"]
+    assert big.text == BIG
+    assert "content-encoding" not in small.headers
+    assert "content-encoding" not in plain.headers
+
+
+def test_uncompressed_responses_still_vary_on_accept_encoding():
+    client = TestClient(make_app(minimum_size=1024))
+    small = client.get("/small", headers={"Accept-Encoding": "gzip"})
+    plain = client.get("/big", headers={"Accept-Encoding": "identity"})
+    unasked = client.get("/big", headers={"Accept-Encoding": ""})
+    binary = client.get("/binary", headers={"Accept-Encoding": ""})
+
+    for response in (small, plain, unasked):
+        assert "content-encoding" not in response.headers
+        assert response.headers["vary"] == "Accept-Encoding"
+    assert unasked.text == BIG
+    assert "vary" not in binary.headers
+
+
+def test_binary_and_bodiless_responses_pass_through():
+    client = TestClient(make_app(minimum_size=0))
+    assert "content-encoding" not in client.get("/binary", headers={"Accept-Encoding": "gzip"}).headers
+    response = client.get("/not-modified", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 304
+    assert "content-encoding" not in response.headers
+
+
+def test_streamed_bodies_are_compressed_in_chunks_off_the_loop():
+    client = TestClient(make_app(threadpool_size=100))
+    with client.stream("GET", "/stream", headers={"Accept-Encoding": "gzip"}) as response:
+        raw = b"".join(response.iter_raw())
+
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    assert gzip.decompress(raw).decode().splitlines()[4].startswith("line 4 ")
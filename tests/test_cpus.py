@@ -0,0 +1,28 @@
+import io
+
+import pytest
+
+from src import cpus
+
+
+def cgroup_files(monkeypatch, files):
+    def fake_open(path, *args, **kwargs):
+        if path not in files:
+            raise FileNotFoundError(path)
+        return io.StringIO(files[path])
+
+    monkeypatch.setattr(cpus, "open", fake_open, raising=False)
+    monkeypatch.setattr(cpus.os, "sched_getaffinity", lambda pid: set(range(8)), raising=False)
+
+
+@pytest.mark.parametrize("files, expected", [
+    ({}, 8),
+    ({"/sys/fs/cgroup/cpu.max": "max 100000\n"}, 8),
+    ({"/sys/fs/cgroup/cpu.max": "150000 100000\n"}, 2),
+    ({"/sys/fs/cgroup/cpu.max": "1600000 100000\n"}, 8),
+    ({"/sys/fs/cgroup/cpu/cpu.cfs_quota_us": "50000\n", "/sys/fs/cgroup/cpu/cpu.cfs_period_us": "100000\n"}, 1),
+    ({"/sys/fs/cgroup/cpu/cpu.cfs_quota_us": "-1\n", "/sys/fs/cgroup/cpu/cpu.cfs_period_us": "100000\n"}, 8),
+])
+def test_available_cpus_is_capped_by_the_cgroup_quota(monkeypatch, files, expected):
+    cgroup_files(monkeypatch, files)
+    assert cpus.available_cpus() == expected
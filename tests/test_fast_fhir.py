@@ -0,0 +1,90 @@
+import json
+import random
+
+import pytest
+from pydantic import ValidationError
+
+from src import fast_fhir
+from src.athena import map_to_observation, map_to_patient, map_to_risk_assessment
+from src.fast_fhir import render_observation, render_patient, render_risk_assessment
+from src.fhir_json import _dumps_json
+from src.rules import current_rules
+from src.scoring import score_patients
+
+PATIENT_DATA = {
+    "name": {"family": "Doe", "given": ["John"]},
+    "molecular_data": {"VEGF_level": 120, "CDKN2A_mutation": True, "TP53_mutation": True},
+    "clinical_data": {"pain": True, "swelling": True, "fever": False, "tumor_size": 6},
+    "imaging_data": {
+        "mri_abnormalities": True,
+        "ct_scan_abnormalities": False,
+        "pet_scan_high_activity": True,
+        "x_ray_findings": False,
+    },
+}
+SUBTYPES = ["Soft Tissue Sarcoma", "Osteosarcoma"]
+
+
+def cohort(seed=0, size=200):
+    rng = random.Random(seed)
+    patients = []
+    for i in range(size):
+        patients.append({
+            "name": {"family": f"Family{i}", "given": ["Given", "Ñame"]},
+            "molecular_data": {"VEGF_level": rng.choice([120, 80.5, 0]), "TP53_mutation": rng.random() < 0.5},
+            "clinical_data": {"pain": rng.random() < 0.5, "tumor_size": rng.choice([6, 2.25, "7", 0.1 + 0.2])},
+            "imaging_data": {k: True for k in rng.sample(["mri_abnormalities", "x_ray_findings"], rng.randint(0, 2))},
+        })
+    return patients
+
+
+def test_golden_risk_assessment_is_byte_identical():
+    for method in (None, current_rules().method):
+        fast = render_risk_assessment(PATIENT_DATA, 0.93, "High", SUBTYPES, patient_id="p1", validate=False,
+                                      method=method)
+        slow = map_to_risk_assessment(PATIENT_DATA, 0.93, "High", SUBTYPES, patient_id="p1", method=method).json()
+        assert fast == slow
+        strict = render_risk_assessment(PATIENT_DATA, 0.93, "High", SUBTYPES, patient_id="p1", validate=True,
+                                        method=method)
+        assert strict == slow
+
+
+def test_golden_observation_and_patient_are_byte_identical():
+    for kind, section in [("clinical", "clinical_data"), ("molecular", "molecular_data"), ("imaging", "imaging_data")]:
+        fast = render_observation(kind, PATIENT_DATA[section], "7530005", "Tumor Size", patient_id="p1", validate=False)
+        slow = map_to_observation(kind, PATIENT_DATA[section], "7530005", "Tumor Size", patient_id="p1").json()
+        assert fast == slow
+    assert render_patient(PATIENT_DATA, "p1", validate=False) == map_to_patient(PATIENT_DATA, "p1").json()
+
+
+def test_cohort_is_semantically_equal():
+    patients = cohort()
+    scores = score_patients(patients)
+    for i, patient_data in enumerate(patients):
+        args = (patient_data, float(scores.total[i]), str(scores.category[i]), SUBTYPES)
+        fast = json.loads(render_risk_assessment(*args, patient_id=str(i), validate=False))
+        slow = json.loads(map_to_risk_assessment(*args, patient_id=str(i)).json())
+        assert fast == slow
+        fast = json.loads(render_observation("clinical", patient_data["clinical_data"], "1", "x", validate=False))
+        slow = json.loads(map_to_observation("clinical", patient_data["clinical_data"], "1", "x").json())
+        assert fast == slow
+
+
+def test_strict_mode_validates():
+    bad = {**PATIENT_DATA, "clinical_data": {"tumor_size": "large"}}
+    with pytest.raises(ValueError):
+        render_risk_assessment(bad, 0.5, "Medium", SUBTYPES, validate=False)
+    with pytest.raises(ValidationError):
+        render_risk_assessment({**PATIENT_DATA, "clinical_data": {}}, 0.5, "", SUBTYPES, validate=True)
+
+
+def test_strict_flag_default(monkeypatch):
+    monkeypatch.setattr(fast_fhir, "SARCRISK_STRICT_FHIR", True)
+    strict = render_risk_assessment(PATIENT_DATA, 0.93, "High", SUBTYPES)
+    assert strict == map_to_risk_assessment(PATIENT_DATA, 0.93, "High", SUBTYPES).json()
+
+
+def test_json_fallback_encoder(monkeypatch):
+    fast = render_risk_assessment(PATIENT_DATA, 0.93, "High", SUBTYPES, validate=False)
+    monkeypatch.setattr(fast_fhir, "dumps", _dumps_json)
+    assert json.loads(render_risk_assessment(PATIENT_DATA, 0.93, "High", SUBTYPES, validate=False)) == json.loads(fast)
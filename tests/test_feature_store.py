@@ -0,0 +1,129 @@
+import multiprocessing
+import random
+
+import numpy as np
+import pytest
+
+from src.feature_store import FeatureStore, decode, encode
+from src.scoring import score_patients
+
+
+def random_patient(rng):
+    return {
+        "molecular_data": {
+            "VEGF_level": rng.choice([None, 80, 120.5]),
+            "CDKN2A_mutation": rng.random() < 0.5,
+            "TP53_mutation": rng.random() < 0.5,
+        },
+        "clinical_data": {
+            "pain": rng.random() < 0.5,
+            "swelling": rng.random() < 0.5,
+            "fever": rng.random() < 0.5,
+            "tumor_size": rng.uniform(0, 10),
+        },
+        "imaging_data": {
+            "mri_abnormalities": rng.random() < 0.5,
+            "ct_scan_abnormalities": rng.random() < 0.5,
+            "pet_scan_high_activity": rng.random() < 0.5,
+            "x_ray_findings": rng.random() < 0.5,
+        },
+    }
+
+
+def test_encode_decode_keeps_supplied_inputs_only():
+    patient_data = {"molecular_data": {"VEGF_level": 120, "TP53_mutation": True}, "clinical_data": {"fever": False}}
+
+    assert decode(*encode(patient_data)) == {
+        "molecular_data": {"VEGF_level": 120.0, "TP53_mutation": True},
+        "clinical_data": {"fever": False},
+        "imaging_data": {},
+    }
+
+
+def test_upsert_persists_and_reopens(tmp_path):
+    store = FeatureStore(str(tmp_path), initial_capacity=2)
+    rng = random.Random(1)
+    patients = {f"p{i}": random_patient(rng) for i in range(5)}
+    store.upsert(patients)
+    store.upsert({"p2": {"clinical_data": {"pain": True}}})
+    store.close()
+
+    reopened = FeatureStore(str(tmp_path))
+    assert len(reopened) == 5
+    assert reopened.capacity >= 5
+    assert reopened.ids == ["p0", "p1", "p2", "p3", "p4"]
+    assert reopened.get("p2") == {"molecular_data": {}, "clinical_data": {"pain": True}, "imaging_data": {}}
+    assert reopened.get("p4")["clinical_data"]["tumor_size"] == patients["p4"]["clinical_data"]["tumor_size"]
+    assert reopened.get("missing") is None
+
+
+def test_store_scores_match_batch_scorer(tmp_path):
+    rng = random.Random(7)
+    patients = {f"p{i}": random_patient(rng) for i in range(500)}
+    store = FeatureStore(str(tmp_path), initial_capacity=64)
+    store.upsert(patients)
+
+    ids, scores = store.score()
+    expected = score_patients([patients[patient_id] for patient_id in ids])
+    assert np.array_equal(scores.total, expected.total)
+    assert np.array_equal(scores.category, expected.category)
+
+    subset = ["p10", "p3"]
+    _, subset_scores = store.score(subset)
+    assert subset_scores.total.tolist() == [expected.total[10], expected.total[3]]
+
+
+def test_full_cohort_reads_are_zero_copy(tmp_path):
+    store = FeatureStore(str(tmp_path))
+    store.upsert({"p1": random_patient(random.Random(0))})
+
+    cohort = store.cohort()
+    assert np.shares_memory(cohort.vegf_level, store._columns["vegf_level"])
+    assert np.shares_memory(cohort.tumor_size, store._columns["tumor_size"])
+
+
+def test_rejects_invalid_ids(tmp_path):
+    store = FeatureStore(str(tmp_path))
+    with pytest.raises(ValueError):
+        store.upsert({"bad\nid": {}})
+    assert len(store) == 0
+
+
+def _upsert_range(path, start):
+    store = FeatureStore(path, initial_capacity=2)
+    for i in range(start, start + 50):
+        store.upsert({f"p{i}": {"clinical_data": {"tumor_size": float(i)}}})
+
+
+def test_processes_share_one_store(tmp_path):
+    # Like gunicorn workers: one store opened before the fork, then written by every process
+    store = FeatureStore(str(tmp_path), initial_capacity=2)
+    store.upsert({"p0": {"clinical_data": {"pain": True}}})
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_upsert_range, args=(str(tmp_path), start)) for start in (100, 200, 300)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert all(worker.exitcode == 0 for worker in workers)
+
+    # Growth and rows written elsewhere are picked up without reopening
+    assert len(store) == 151
+    written = [f"p{i}" for start in (100, 200, 300) for i in range(start, start + 50)]
+    assert sorted(store.ids) == sorted(["p0"] + written)
+    assert store.get("p249")["clinical_data"] == {"tumor_size": 249.0}
+    store.upsert({"p1": {}})
+    assert FeatureStore(str(tmp_path)).ids == store.ids
+
+
+def test_uncommitted_ids_are_dropped(tmp_path):
+    store = FeatureStore(str(tmp_path))
+    store.upsert({"p1": {}})
+    # A writer that died after appending its ids but before updating meta.json
+    with open(tmp_path / "ids.txt", "a") as f:
+        f.write("lost\n")
+
+    reopened = FeatureStore(str(tmp_path))
+    reopened.upsert({"p2": {"clinical_data": {"fever": True}}})
+    assert FeatureStore(str(tmp_path)).ids == ["p1", "p2"]
+    assert "lost" not in reopened
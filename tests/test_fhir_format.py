@@ -0,0 +1,75 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from src.fast_fhir import render_risk_assessment
+from src.fhir_format import FHIR_JSON, FHIR_NDJSON, SUBSETTED_TAG, FormatError, Representation, negotiate
+from src.main import app
+
+AUTH = {"Authorization": "Bearer test-token"}
+
+PATIENT_DATA = {
+    "molecular_data": {"VEGF_level": 120},
+    "clinical_data": {"pain": True, "tumor_size": 6},
+    "imaging_data": {"mri_abnormalities": True},
+}
+RESOURCE = render_risk_assessment(PATIENT_DATA, 0.5, "Medium", ["Osteosarcoma"], patient_id="p1", assessment_id="p1")
+
+BUNDLE = {
+    "resourceType": "Bundle",
+    "type": "batch",
+    "entry": [
+        {"resource": {"resourceType": "Patient", "id": "f1", "name": [{"family": "Doe", "given": ["Jane"]}]}},
+        {"resource": {"resourceType": "Patient", "id": "f2", "name": [{"family": "Roe", "given": ["Jo"]}]}},
+        {"resource": {"resourceType": "Observation", "status": "final", "code": {"text": "pain"}}},
+    ],
+}
+
+
+def test_format_negotiation():
+    assert negotiate({}).media_type == FHIR_JSON
+    assert negotiate({}, "application/fhir+ndjson, application/fhir+json;q=0.5").media_type == FHIR_NDJSON
+    assert negotiate({}, "application/fhir+xml, */*;q=0.1").media_type == FHIR_JSON
+    assert negotiate({"_format": "ndjson"}, "application/fhir+json").media_type == FHIR_NDJSON
+    # "+" not escaped in the query string
+    assert negotiate({"_format": "application/fhir json"}).media_type == FHIR_JSON
+
+    with pytest.raises(FormatError) as excinfo:
+        negotiate({"_format": "xml"})
+    assert excinfo.value.status_code == 406
+    with pytest.raises(FormatError):
+        negotiate({"_summary": "count"})
+    with pytest.raises(FormatError):
+        negotiate({"_summary": "true", "_elements": "prediction"})
+
+
+def test_elements_keep_mandatory_elements_and_tag_the_subset():
+    resource = json.loads(Representation(elements=("prediction",)).render(RESOURCE))
+
+    assert list(resource) == ["resourceType", "id", "meta", "status", "subject", "prediction"]
+    assert resource["meta"]["tag"] == [SUBSETTED_TAG]
+    assert resource["prediction"][0]["outcome"] == {"text": "Medium"}
+
+
+def test_summary_modes():
+    summary = json.loads(Representation(summary="true").render(RESOURCE))
+    assert set(summary) == {"resourceType", "id", "meta", "status", "code", "subject"}
+    assert Representation(summary="data").render(RESOURCE) == RESOURCE  # nothing to drop
+    assert Representation().render(RESOURCE) is RESOURCE
+
+
+def test_batch_as_ndjson_with_elements():
+    with TestClient(app) as client:
+        response = client.post(
+            "/RiskAssessment/$batch", params={"_format": "ndjson", "_elements": "prediction"}, json=BUNDLE,
+            headers=AUTH,
+        )
+        rejected = client.post("/RiskAssessment/$batch", params={"_format": "xml"}, json=BUNDLE, headers=AUTH)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith(FHIR_NDJSON)
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["resourceType"] for line in lines] == ["RiskAssessment", "RiskAssessment", "OperationOutcome"]
+    assert all("extension" not in line and "prediction" in line for line in lines[:2])
+    assert rejected.status_code == 406
@@ -0,0 +1,33 @@
+import pytest
+
+from src.athena import map_to_observation, map_to_risk_assessment
+from src.fast_fhir import risk_assessment_dict
+from src.fhir_fragments import BASIS_REFERENCES, SARCOMA_RISK_CODE, freeze, observation_code
+
+PATIENT_DATA = {"clinical_data": {"tumor_size": 6}, "imaging_data": {}}
+
+
+def test_fragments_are_frozen():
+    with pytest.raises(TypeError):
+        SARCOMA_RISK_CODE.value["coding"] = []
+    with pytest.raises(TypeError):
+        SARCOMA_RISK_CODE.value["coding"][0].update(code="0")
+    assert isinstance(BASIS_REFERENCES.value, tuple)
+    assert freeze({"a": [{"b": 1}]}) == {"a": ({"b": 1},)}
+
+
+def test_fragments_are_shared_between_resources():
+    first = map_to_risk_assessment(PATIENT_DATA, 0.5, "Medium", ["Osteosarcoma"], patient_id="1")
+    second = map_to_risk_assessment(PATIENT_DATA, 0.2, "Low", ["Osteosarcoma"], patient_id="2")
+    assert first.code is second.code is SARCOMA_RISK_CODE.model
+    assert first.basis[0] is second.basis[0]
+
+    assert risk_assessment_dict(PATIENT_DATA, 0.5, "Medium", [])["basis"] is BASIS_REFERENCES.value
+
+
+def test_observation_codes_are_cached():
+    fragment = observation_code("http://snomed.info/sct", "7530005", "Tumor Size")
+    assert observation_code("http://snomed.info/sct", "7530005", "Tumor Size") is fragment
+    observation = map_to_observation("clinical", {"tumor_size": 3}, "7530005", "Tumor Size")
+    assert observation.code is fragment.model
+    assert fragment.json == '{"coding":[{"system":"http://snomed.info/sct","code":"7530005","display":"Tumor Size"}]}'
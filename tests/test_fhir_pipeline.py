@@ -0,0 +1,151 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from src.athena import (
+    EXPORT_OBSERVATIONS, map_to_observation, map_to_patient, map_to_risk_assessment, observation_ids, resource_id
+)
+from src.fhir_pipeline import TransactionPipeline, patient_entries
+from src.main import app
+from src.models import PatientRecord
+from src.rules import current_rules
+from src.scoring import score_patients
+
+from tests.test_batch import AUTH, HIGH_RISK, bundle, observation, patient
+
+PATIENT_DATA = {
+    "name": {"family": "Doe", "given": ["John"]},
+    "molecular_data": {"VEGF_level": 120, "TP53_mutation": True},
+    "clinical_data": {"pain": True, "tumor_size": 6},
+    "imaging_data": {"mri_abnormalities": True},
+}
+
+
+def cohort(size):
+    return {f"p{i}": PatientRecord.from_patient_data(f"p{i}", PATIENT_DATA) for i in range(size)}
+
+
+def test_bundle_holds_every_resource_with_resolved_references():
+    transaction, errors = TransactionPipeline(workers=0).build(cohort(2), base_url="http://testserver/")
+    entries = json.loads(transaction)["entry"]
+
+    assert errors == []
+    assert [entry["request"]["url"] for entry in entries[:5]] == [
+        "Patient/p0", "Observation/p0-clinical", "Observation/p0-molecular", "Observation/p0-imaging",
+        "RiskAssessment/p0",
+    ]
+    full_urls = {entry["fullUrl"] for entry in entries}
+    assert len(full_urls) == len(entries) == 10
+    for entry in entries:
+        resource = entry["resource"]
+        assert entry["fullUrl"] == f"http://testserver/{resource['resourceType']}/{resource['id']}"
+        references = [resource.get("subject")] + resource.get("basis", [])
+        for reference in filter(None, references):
+            assert f"http://testserver/{reference['reference']}" in full_urls
+
+
+def test_resources_match_the_model_mappers():
+    rules = current_rules()
+    scores = score_patients([PATIENT_DATA], rules, explain=True)
+    score = (float(scores.total[0]), str(scores.category[0]), scores.contributions[0].tolist())
+    entries = patient_entries("p1", PATIENT_DATA, *score, rules)
+    resources = [json.loads(entry)["resource"] for entry in entries]
+
+    expected = [map_to_patient(PATIENT_DATA, "p1")]
+    for (section, resource_type, system, code, display), observation_id in zip(
+        EXPORT_OBSERVATIONS, observation_ids("p1")
+    ):
+        expected.append(map_to_observation(
+            resource_type, PATIENT_DATA[section], code, display, "p1", system, observation_id
+        ))
+    expected.append(map_to_risk_assessment(
+        PATIENT_DATA, score[0], score[1], rules.suspected_subtypes(PATIENT_DATA), "p1",
+        assessment_id="p1", method=rules.method, basis=resources[-1]["basis"], rationale=rules.rationale(score[2])
+    ))
+    assert resources == [json.loads(resource.json()) for resource in expected]
+    # Strict mode validates every resource without changing it
+    assert patient_entries("p1", PATIENT_DATA, *score, rules, validate=True) == entries
+
+
+def test_extensions_list_only_present_findings():
+    patient_data = {
+        **PATIENT_DATA,
+        "clinical_data": {"pain": True, "swelling": False, "tumor_size": 6},
+        "imaging_data": {"mri_abnormalities": False, "pet_scan_high_activity": True},
+    }
+    expected = ["Pain, Swelling, Fever: pain", "MRI Abnormalities, PET Scan Activity: pet_scan_high_activity"]
+    for record in (patient_data, PatientRecord.from_patient_data("p1", patient_data)):
+        entries = patient_entries("p1", record, 0.5, "Moderate", [], current_rules())
+        resource = json.loads(entries[-1])["resource"]
+        assert [extension["valueCodeableConcept"]["text"] for extension in resource["extension"][2:]] == expected
+    model = map_to_risk_assessment(patient_data, 0.5, "Moderate", ["Leiomyosarcoma"])
+    assert [extension.valueCodeableConcept.text for extension in model.extension[2:]] == expected
+
+
+def test_parallel_bundle_matches_sequential():
+    patients = cohort(7)
+    sequential = TransactionPipeline(workers=0).build(patients)
+    pipeline = TransactionPipeline(workers=2, parallel_min=5, chunk_size=3)
+    try:
+        assert pipeline.build(patients) == sequential
+        assert pipeline._executor is not None
+    finally:
+        pipeline.shutdown()
+
+
+def test_long_patient_ids_keep_valid_resource_ids():
+    assert resource_id("p1", "clinical") == "p1-clinical"
+    long_id = resource_id("x" * 64, "molecular")
+    assert len(long_id) <= 64 and long_id.endswith("-molecular")
+
+
+def test_entry_urls_are_escaped():
+    entries, _ = TransactionPipeline(workers=0).build(cohort(1), base_url='http://x/"a\\b/')
+    entry = json.loads(entries)["entry"][0]
+    assert entry["fullUrl"] == 'http://x/"a\\b/Patient/p0'
+    assert entry["request"]["url"] == "Patient/p0"
+
+
+def test_invalid_patient_ids_are_rejected():
+    for patient_id in ("x" * 65, 'p"1', ""):
+        with pytest.raises(ValueError, match="not a valid FHIR id"):
+            patient_entries(patient_id, PATIENT_DATA, 0.5, "Moderate", [], current_rules())
+
+
+def test_patients_that_cannot_be_mapped_are_reported():
+    unnamed = {key: value for key, value in PATIENT_DATA.items() if key != "name"}
+    transaction, errors = TransactionPipeline(workers=0).build({"p0": PATIENT_DATA, "p1": unnamed})
+
+    assert len(errors) == 1 and errors[0].startswith("Patient/p1 could not be mapped")
+    assert {entry["resource"]["id"].split("-")[0] for entry in json.loads(transaction)["entry"]} == {"p0"}
+
+
+def test_transaction_endpoint():
+    with TestClient(app) as client:
+        response = client.post("/RiskAssessment/$transaction", content=json.dumps(bundle(HIGH_RISK)),
+                               headers={**AUTH, "Content-Type": "application/fhir+json"})
+    assert response.status_code == 200
+    transaction = response.json()
+    assert transaction["type"] == "transaction"
+    assert [entry["resource"]["resourceType"] for entry in transaction["entry"]] == [
+        "Patient", "Observation", "Observation", "Observation", "RiskAssessment",
+    ]
+    risk_assessment = transaction["entry"][-1]["resource"]
+    assert risk_assessment["basis"] == [
+        {"reference": "Observation/p1-clinical", "display": "tumor_size > 5 (+0.12), swelling (+0.09), pain (+0.06)"},
+        {"reference": "Observation/p1-molecular",
+         "display": "VEGF_level > 100 (+0.20), CDKN2A_mutation (+0.16), TP53_mutation (+0.12)"},
+        {"reference": "Observation/p1-imaging", "display": "mri_abnormalities (+0.12), pet_scan_high_activity (+0.06)"},
+    ]
+    assert risk_assessment["prediction"][0]["rationale"].startswith("Risk factors: VEGF_level > 100 (+0.20), ")
+
+
+def test_transaction_endpoint_rejects_the_whole_batch():
+    resources = HIGH_RISK + [patient("p2"), observation("p2", "tumor_size", valueBoolean=True)]
+    with TestClient(app) as client:
+        response = client.post("/RiskAssessment/$transaction", content=json.dumps(bundle(resources)),
+                               headers={**AUTH, "Content-Type": "application/fhir+json"})
+    assert response.status_code == 422
+    issues = response.json()["issue"]
+    assert len(issues) == 1 and "Patient/p2 could not be mapped" in issues[0]["diagnostics"]
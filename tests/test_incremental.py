@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from src.feature_store import FeatureStore
+from src.incremental import IncrementalScorer, iter_feed_observations
+from src.scoring import calculate_risk_score_with_symptoms_and_imaging
+
+PATIENT = {
+    "molecular_data": {"VEGF_level": 120, "CDKN2A_mutation": False, "TP53_mutation": False},
+    "clinical_data": {"pain": True, "swelling": False, "fever": False, "tumor_size": 3},
+    "imaging_data": {"mri_abnormalities": True, "ct_scan_abnormalities": False},
+}
+
+
+def observation(patient_id, code, **value):
+    return {
+        "resourceType": "Observation",
+        "status": "final",
+        "code": {"coding": [{"system": "http://example.com/sarcrisk-features", "code": code}]},
+        "subject": {"reference": f"Patient/{patient_id}"},
+        **value,
+    }
+
+
+@pytest.fixture
+def scorer(tmp_path):
+    store = FeatureStore(str(tmp_path))
+    store.upsert({"p1": PATIENT, "p2": PATIENT})
+    return IncrementalScorer(store)
+
+
+def test_only_changed_sections_are_rescored_and_emitted(scorer):
+    changes = scorer.apply([observation("p1", "fever", valueBoolean=True)])
+
+    assert len(changes) == 1
+    change = changes[0]
+    assert change.sections == ("clinical_data",)
+    assert scorer.stats.recomputed_sections == 1
+    assert change.emitted
+    assert change.total > change.previous_total
+    expected = calculate_risk_score_with_symptoms_and_imaging(
+        PATIENT["molecular_data"], {**PATIENT["clinical_data"], "fever": True}, PATIENT["imaging_data"]
+    )
+    assert change.total == expected
+    resource = json.loads(change.resource)
+    assert resource["subject"] == {"reference": "Patient/p1"}
+    assert resource["prediction"][0]["probabilityDecimal"] == expected
+    assert scorer.store.get("p1")["clinical_data"]["fever"] is True
+
+
+def test_no_assessment_when_score_does_not_move(scorer):
+    # Still above the VEGF threshold: inputs change, the score does not
+    changes = scorer.apply([observation("p1", "VEGF_level", valueQuantity={"value": 150})])
+
+    assert [change.sections for change in changes] == [("molecular_data",)]
+    assert not changes[0].emitted
+    assert scorer.stats.emitted == 0
+    assert scorer.store.get("p1")["molecular_data"]["VEGF_level"] == 150.0
+
+
+def test_unchanged_inputs_are_skipped(scorer):
+    changes = scorer.apply([
+        observation("p2", "pain", valueBoolean=True),
+        observation("p2", "unknown-code", valueBoolean=True),
+    ])
+
+    assert changes == []
+    assert scorer.stats.unchanged_inputs == 1
+    assert scorer.stats.ignored == 1
+
+
+def test_new_patient_is_scored_in_full(scorer):
+    changes = scorer.apply([observation("p3", "CDKN2A_mutation", valueBoolean=True)])
+
+    assert changes[0].previous_total is None
+    assert changes[0].emitted
+    assert scorer.stats.recomputed_sections == 3
+    assert "p3" in scorer.store
+
+
+def test_feed_reads_observations_and_notification_bundles():
+    notification = {
+        "resourceType": "Bundle",
+        "type": "subscription-notification",
+        "entry": [
+            {"resource": {"resourceType": "SubscriptionStatus"}},
+            {"resource": observation("p1", "pain", valueBoolean=True)},
+        ],
+    }
+    lines = [json.dumps(observation("p2", "fever", valueBoolean=True)), "", json.dumps(notification), "{oops"]
+    errors = []
+
+    observations = list(iter_feed_observations(lines, errors))
+    assert [o["subject"]["reference"] for o in observations] == ["Patient/p2", "Patient/p1"]
+    assert len(errors) == 1 and errors[0].startswith("Line 4")
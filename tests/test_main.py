@@ -0,0 +1,95 @@
+# test_main.py
+import asyncio
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from src import token_manager
+from src.athena_auth import athena_auth
+from src.http_client import athena_http
+from src.main import app
+from src.session_store import session_store
+
+
+@pytest.fixture
+def token_endpoint(monkeypatch):
+    """Route the shared Athena client to an in-process token endpoint"""
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        if b"code=bad" in request.content:
+            return httpx.Response(400, text="invalid_grant")
+        return httpx.Response(200, json={
+            "access_token": "abc",
+            "token_type": "Bearer",
+            "expires_in": 3600,
+        })
+
+    monkeypatch.setattr(athena_http, "transport", httpx.MockTransport(handler))
+    yield calls
+
+
+# Test the health check endpoint
+def test_read_root():
+    with TestClient(app) as client:
+        response = client.get("/")
+    assert response.status_code == 200
+    assert response.json()["status"] == "healthy"
+
+
+# Test the OAuth2 callback token exchange
+def test_callback_exchanges_code(token_endpoint):
+    with TestClient(app) as client:
+        response = client.get("/callback", params={"code": "good"})
+    body = response.json()
+    assert body["message"] == "Authentication successful"
+    assert body["token_type"] == "Bearer" and body["expires_in"] == 3600
+    # The tokens stay server-side; the browser only gets the session id
+    assert "access_token" not in body and "abc" not in response.text
+    assert session_store.session(body["session_id"]).access_token == "abc"
+    assert len(token_endpoint) == 1
+    assert token_endpoint[0].headers["Content-Type"] == "application/x-www-form-urlencoded"
+
+
+def test_callback_reports_upstream_error(token_endpoint):
+    with TestClient(app) as client:
+        response = client.get("/callback", params={"code": "bad"})
+    body = response.json()
+    assert body["error"] == "Failed to obtain access token"
+    assert body["status_code"] == 400
+
+
+def test_system_token_uses_the_callback_token_endpoint(token_endpoint, monkeypatch):
+    monkeypatch.setattr(token_manager, "athena_tokens",
+                        token_manager.TokenManager(token_manager.athena_token_fetcher(athena_auth)))
+    with TestClient(app) as client:
+        client.get("/callback", params={"code": "good"})
+
+    async def headers():
+        return [await token_manager.get_athena_headers(practice_id) for practice_id in ("195900", "1")]
+
+    assert asyncio.run(headers()) == [{"Authorization": "Bearer abc"}] * 2
+    # One token for every practice, from the endpoint the code exchange used
+    assert [str(request.url) for request in token_endpoint] == [athena_auth.auth_url] * 2
+    assert b"grant_type=client_credentials" in token_endpoint[1].content
+
+
+def test_callback_missing_code():
+    with TestClient(app) as client:
+        response = client.get("/callback")
+    assert response.json() == {"error": "Authorization code missing"}
+
+
+def test_http_client_closed_on_shutdown(token_endpoint):
+    with TestClient(app) as client:
+        client.get("/callback", params={"code": "good"})
+        assert athena_http.started
+    assert not athena_http.started
+
+
+def test_token_cache_stats_endpoint():
+    with TestClient(app) as client:
+        response = client.get("/auth/token-cache")
+    assert set(response.json()) == {"hits", "misses", "refreshes", "background_refreshes", "failures"}
@@ -0,0 +1,82 @@
+import os
+
+import httpx
+from fastapi.testclient import TestClient
+
+from src.http_client import athena_http
+from src.main import app
+from src.metrics import Registry, request_profiler
+
+AUTH = {"Authorization": "Bearer test-token"}
+
+BUNDLE = {
+    "resourceType": "Bundle",
+    "type": "batch",
+    "entry": [
+        {"resource": {"resourceType": "Patient", "id": "m1", "name": [{"family": "Doe", "given": ["Jane"]}]}},
+        {"resource": {
+            "resourceType": "Observation",
+            "status": "final",
+            "code": {"coding": [{"system": "http://example.com/sarcrisk-features", "code": "pain"}]},
+            "subject": {"reference": "Patient/m1"},
+            "valueBoolean": True,
+        }},
+    ],
+}
+
+
+def test_histogram_and_counter_text_format():
+    registry = Registry()
+    histogram = registry.histogram("demo_seconds", "Demo latency", ("stage",), buckets=(0.1, 1.0))
+    counter = registry.counter("demo_total", "Demo events", ("reason",))
+    histogram.labels("score").observe(0.05)
+    histogram.labels("score").observe(0.1)
+    histogram.labels("score").observe(3)
+    counter.labels('say "hi"').inc()
+
+    lines = registry.render().splitlines()
+    assert "# TYPE demo_seconds histogram" in lines
+    assert 'demo_seconds_bucket{stage="score",le="0.1"} 2' in lines
+    assert 'demo_seconds_bucket{stage="score",le="1.0"} 2' in lines
+    assert 'demo_seconds_bucket{stage="score",le="+Inf"} 3' in lines
+    assert 'demo_seconds_count{stage="score"} 3' in lines
+    assert 'demo_total{reason="say \\"hi\\""} 1.0' in lines
+
+
+def test_metrics_endpoint_reports_stages_routes_and_upstream(monkeypatch):
+    def token_endpoint(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(503 if b"code=down" in request.content else 200, json={"access_token": "abc"})
+
+    monkeypatch.setattr(athena_http, "transport", httpx.MockTransport(token_endpoint))
+    with TestClient(app) as client:
+        client.post("/RiskAssessment/$batch", json=BUNDLE, headers=AUTH)
+        client.get("/callback", params={"code": "good"})
+        client.get("/callback", params={"code": "down"})
+        response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = response.text
+    for stage in ("score", "map", "serialize", "oauth_exchange"):
+        assert f'sarcrisk_stage_duration_seconds_count{{stage="{stage}"}}' in text
+    assert 'route="/RiskAssessment/$batch",status="200"' in text
+    assert 'sarcrisk_upstream_request_duration_seconds_count{host="api.athenahealth.com",method="POST",status="503"}' in text
+    assert 'sarcrisk_upstream_errors_total{host="api.athenahealth.com",reason="503"}' in text
+    assert 'sarcrisk_assessment_cache_events_total{event="misses"}' in text
+
+
+def test_request_profiling_is_opt_in(monkeypatch, tmp_path):
+    with TestClient(app) as client:
+        unprofiled = client.get("/", headers={"X-SarcRisk-Profile": "1"})
+        monkeypatch.setattr(request_profiler, "enabled", True)
+        monkeypatch.setattr(request_profiler, "directory", str(tmp_path))
+        profiled = client.get("/", headers={"X-SarcRisk-Profile": "1"})
+        plain = client.get("/")
+        profile_id = profiled.headers["x-sarcrisk-profile-id"]
+        download = client.get(f"/metrics/profiles/{profile_id}", headers=AUTH)
+
+    assert "x-sarcrisk-profile-id" not in unprofiled.headers
+    assert "x-sarcrisk-profile-id" not in plain.headers
+    assert os.path.exists(tmp_path / f"{profile_id}.prof")
+    assert download.status_code == 200
+    assert len(download.content) > 0
@@ -0,0 +1,94 @@
+import json
+import random
+
+import numpy as np
+import pytest
+
+from benchmarks.cohorts import cohort_bundle, make_cohort
+from src.assessment_cache import canonical_input_hash
+from src.athena import assess_patients
+from src.fast_fhir import render_risk_assessment
+from src.feature_store import encode
+from src.fhir_ingest import group_patient_data, ingest_records, parse_resources
+from src.models import PatientRecord
+from src.rules import current_rules
+from src.scoring import calculate_risk_score_with_symptoms_and_imaging, pack_cohort, score_patients
+
+from tests.test_batch import HIGH_RISK, observation, patient
+
+
+def sparse_cohort(seed):
+    """Cohort with random inputs left out and supplied in random order"""
+    rng = random.Random(seed)
+    cohort = make_cohort(200, seed)
+    for patient_data in cohort.values():
+        for section in ("molecular_data", "clinical_data", "imaging_data"):
+            items = [item for item in patient_data[section].items() if rng.random() < 0.7]
+            rng.shuffle(items)
+            patient_data[section] = dict(items)
+    return cohort
+
+
+@pytest.fixture(params=[0, 1, 2])
+def cohort(request):
+    return sparse_cohort(request.param)
+
+
+def test_ingest_records_matches_patient_data():
+    resources = parse_resources(json.dumps({"resourceType": "Bundle", "entry": [
+        {"resource": resource} for resource in HIGH_RISK + [observation("nobody", "pain", valueBoolean=True)]
+    ]}).encode())
+    records, record_errors = ingest_records(resources)
+    patients, errors = group_patient_data(resources)
+
+    assert list(records) == list(patients) == ["p1"]
+    assert records["p1"].as_patient_data() == patients["p1"]
+    assert [str(error) for error in record_errors] == [str(error) for error in errors]
+    assert records["p1"].keys("clinical_data") == ["pain", "swelling", "tumor_size"]
+
+
+def test_records_score_hash_and_render_like_dicts(cohort):
+    rules = current_rules()
+    records = {patient_id: PatientRecord.from_patient_data(patient_id, data) for patient_id, data in cohort.items()}
+
+    by_dict, by_record = score_patients(list(cohort.values()), rules), score_patients(list(records.values()), rules)
+    for name in ("molecular", "clinical", "imaging", "total"):
+        assert getattr(by_record, name).tobytes() == getattr(by_dict, name).tobytes()
+    for i, (patient_id, data) in enumerate(cohort.items()):
+        record = records[patient_id]
+        scalar = calculate_risk_score_with_symptoms_and_imaging(record, record, record, rules)
+        assert scalar == by_dict.total[i]
+        assert canonical_input_hash(record, patient_id, "v") == canonical_input_hash(data, patient_id, "v")
+        assert encode(record) == encode(data)
+        assert rules.suspected_subtypes(record) == rules.suspected_subtypes(data)
+        for strict in (False, True):
+            assert render_risk_assessment(record, scalar, "High", ["X"], patient_id, strict, patient_id) == \
+                render_risk_assessment(data, scalar, "High", ["X"], patient_id, strict, patient_id)
+
+
+def test_batch_request_path_uses_records():
+    body = json.dumps(cohort_bundle(make_cohort(50, 7))).encode()
+    resources = parse_resources(body)
+    records, _ = ingest_records(resources)
+    patients, _ = group_patient_data(resources)
+
+    assert all(isinstance(record, PatientRecord) for record in records.values())
+    assert assess_patients(records, []) == assess_patients(patients, [])
+    assert np.array_equal(pack_cohort(list(records.values())).flags["pain"],
+                          pack_cohort(list(patients.values())).flags["pain"])
+
+
+@pytest.mark.parametrize("value", ["6", 6.5, True, None])
+def test_value_integer_must_be_an_integer(value):
+    records, errors = ingest_records(list(enumerate([
+        patient("p1"), observation("p1", "tumor_size", valueInteger=value),
+    ])))
+    assert records == {}
+    assert "is not an integer" in str(errors[0])
+
+
+def test_unknown_inputs_are_rejected():
+    with pytest.raises(ValueError, match="shoe_size"):
+        PatientRecord.from_patient_data("p1", {"clinical_data": {"shoe_size": 44}})
+    with pytest.raises(ValueError, match="Unknown imaging_data input 'pain'"):
+        PatientRecord.from_patient_data("p1", {"imaging_data": {"pain": True}})
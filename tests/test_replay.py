@@ -0,0 +1,56 @@
+import asyncio
+import io
+import json
+
+import pytest
+
+from benchmarks.cohorts import make_cohort, write_cohort
+from benchmarks.replay import replay
+from src.bulk_export import read_records
+from src.fhir_ingest import ingest_records, parse_resources
+
+
+def test_cohorts_are_reproducible_in_every_format(tmp_path):
+    outputs = {}
+    for format in ("records", "ndjson", "bundle"):
+        out = io.StringIO()
+        write_cohort(out, 50, seed=3, format=format)
+        again = io.StringIO()
+        write_cohort(again, 50, seed=3, format=format)
+        assert out.getvalue() == again.getvalue()
+        outputs[format] = out.getvalue()
+
+    cohort = make_cohort(50, seed=3)
+    assert make_cohort(50, seed=4) != cohort
+    records_path = tmp_path / "cohort.ndjson"
+    records_path.write_text(outputs["records"])
+    assert [record["clinical_data"] for record in read_records(str(records_path))] == [
+        patient_data["clinical_data"] for patient_data in cohort.values()
+    ]
+    for format, content_type in (("ndjson", "application/fhir+ndjson"), ("bundle", "application/fhir+json")):
+        patients, errors = ingest_records(parse_resources(outputs[format].encode(), content_type))
+        assert errors == []
+        assert {patient_id: record.as_patient_data() for patient_id, record in patients.items()} == cohort
+
+
+def test_cohort_distributions_are_plausible():
+    cohort = list(make_cohort(5_000).values())
+    vegf = [patient["molecular_data"]["VEGF_level"] for patient in cohort if "VEGF_level" in patient["molecular_data"]]
+    assert 0.75 < len(vegf) / len(cohort) < 0.85
+    assert 0.02 < sum(patient["molecular_data"]["TP53_mutation"] for patient in cohort) / len(cohort) < 0.06
+    sizes = sorted(patient["clinical_data"]["tumor_size"] for patient in cohort)
+    assert 3 < sizes[len(sizes) // 2] < 5 and sizes[-1] > 10
+
+
+@pytest.mark.parametrize("mode", ["inprocess", "localhost"])
+def test_replay_reports_every_scenario(mode):
+    mix = {"batch": 1, "transaction": 1, "patient": 1, "health": 1}
+    report = asyncio.run(replay(mode, rps=40, duration=0.5, mix=mix, batch_size=3, cohort_size=20))
+
+    assert report["total"]["requests"] == 20
+    assert report["total"]["errors"] == 0
+    assert report["athena_requests"] > 0
+    assert set(report["scenarios"]) <= set(mix)
+    for scenario in report["scenarios"].values():
+        assert set(scenario["latency_ms"]) == {"mean", "p50", "p90", "p99", "max"}
+    json.dumps(report)
@@ -0,0 +1,165 @@
+import copy
+import json
+import os
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from src.main import app
+from src.rules import SARCRISK_RULES_PATH, RuleSetError, RuleSetHolder, compile_rules, ruleset
+from src.scoring import calculate_risk_score_with_symptoms_and_imaging, categorize_risk, score_patients
+
+AUTH = {"Authorization": "Bearer test-token"}
+
+with open(SARCRISK_RULES_PATH) as f:
+    DEFAULT_SPEC = json.load(f)
+
+PATIENT = {
+    "molecular_data": {"VEGF_level": 120, "CDKN2A_mutation": False, "TP53_mutation": False},
+    "clinical_data": {"pain": True, "swelling": False, "fever": False, "tumor_size": 6},
+    "imaging_data": {"mri_abnormalities": False},
+}
+
+
+def spec_with(**changes):
+    spec = copy.deepcopy(DEFAULT_SPEC)
+    spec.update(changes)
+    return spec
+
+
+def write_spec(path, spec):
+    path.write_text(json.dumps(spec))
+    return str(path)
+
+
+def test_category_thresholds_are_strict():
+    rules = compile_rules(DEFAULT_SPEC)
+    assert [rules.category(score) for score in (0.0, 0.4, 0.40001, 0.7, 0.70001, 1.0)] == \
+        ["Low", "Low", "Medium", "Medium", "High", "High"]
+    scores = np.array([0.0, 0.4, 0.40001, 0.7, 0.70001, 1.0])
+    assert rules.categories(scores).tolist() == [rules.category(score) for score in scores]
+
+
+def test_custom_rule_set_drives_scalar_and_batch_scoring():
+    spec = copy.deepcopy(DEFAULT_SPEC)
+    spec["version"] = "2.0.0"
+    spec["sections"]["molecular_data"]["terms"][0] = {"input": "VEGF_level", "above": 150, "weight": 0.5}
+    spec["categories"] = [{"label": "Low"}, {"label": "Elevated", "above": 0.1}]
+    spec["subtypes"] = [
+        {"name": "Osteosarcoma", "when": [{"input": "tumor_size", "above": 5}]},
+        {"name": "Ewing Sarcoma", "when": [{"input": "fever"}]},
+    ]
+    rules = compile_rules(spec)
+
+    score = calculate_risk_score_with_symptoms_and_imaging(
+        PATIENT["molecular_data"], PATIENT["clinical_data"], PATIENT["imaging_data"], rules
+    )
+    # VEGF 120 no longer counts: only pain and tumor size do
+    assert score == (0.2 + 0.4) * 0.3
+    assert categorize_risk(score, rules) == "Elevated"
+    batch = score_patients([PATIENT], rules)
+    assert batch.total.tolist() == [score]
+    assert batch.category.tolist() == ["Elevated"]
+    assert rules.suspected_subtypes(PATIENT) == ["Osteosarcoma"]
+    assert rules.fingerprint.startswith("2.0.0+")
+    assert rules.fingerprint != compile_rules(DEFAULT_SPEC).fingerprint
+
+
+@pytest.mark.parametrize("spec, message", [
+    (spec_with(version=""), "version"),
+    (spec_with(sections={}), "sections"),
+    (spec_with(categories=[{"label": "Low"}, {"label": "High", "above": 0.7}, {"label": "Medium", "above": 0.4}]),
+     "ascending"),
+    (spec_with(subtypes=[{"name": "X", "when": [{"input": "shoe_size"}]}]), "unknown input"),
+])
+def test_invalid_rule_sets_are_rejected(spec, message):
+    with pytest.raises(RuleSetError, match=message):
+        compile_rules(spec)
+
+
+def test_flag_with_threshold_is_rejected():
+    spec = copy.deepcopy(DEFAULT_SPEC)
+    spec["sections"]["clinical_data"]["terms"][0]["above"] = 1
+    with pytest.raises(RuleSetError, match="takes no threshold"):
+        compile_rules(spec)
+
+
+def test_non_finite_numbers_are_rejected(tmp_path):
+    # json.load accepts Infinity and NaN, which have no literal for the generated scorers
+    holder = RuleSetHolder(write_spec(tmp_path / "rules.json", DEFAULT_SPEC))
+    spec = copy.deepcopy(DEFAULT_SPEC)
+    spec["sections"]["molecular_data"]["terms"][0]["above"] = float("inf")
+    write_spec(tmp_path / "rules.json", spec)
+    with pytest.raises(RuleSetError, match="finite number"):
+        holder.reload()
+    write_spec(tmp_path / "rules.json", spec_with(max_score=float("nan")))
+    with pytest.raises(RuleSetError, match="finite number"):
+        holder.reload()
+    assert holder.rules.version == DEFAULT_SPEC["version"]
+
+
+def test_rule_sets_are_compiled_before_they_are_swapped_in(monkeypatch, tmp_path):
+    holder = RuleSetHolder(write_spec(tmp_path / "rules.json", DEFAULT_SPEC))
+    monkeypatch.setattr("src.rules._compile_scalar", lambda *args: compile("1 +", "<rules>", "eval"))
+    write_spec(tmp_path / "rules.json", spec_with(version="9.0.0"))
+    with pytest.raises(RuleSetError, match="cannot be compiled"):
+        holder.reload()
+    assert holder.rules.version == DEFAULT_SPEC["version"]
+
+
+def test_reload_swaps_atomically_and_keeps_good_rules(tmp_path):
+    path = write_spec(tmp_path / "rules.json", DEFAULT_SPEC)
+    holder = RuleSetHolder(path)
+    in_flight = holder.rules
+
+    write_spec(tmp_path / "rules.json", spec_with(version="1.1.0"))
+    assert holder.reload().version == "1.1.0"
+    assert in_flight.version == "1.0.0"  # a batch holding the old rules is unaffected
+
+    (tmp_path / "rules.json").write_text("{not json")
+    with pytest.raises(RuleSetError):
+        holder.reload()
+    assert holder.rules.version == "1.1.0"
+
+
+def test_reload_if_changed_ignores_invalid_files(tmp_path):
+    path = write_spec(tmp_path / "rules.json", DEFAULT_SPEC)
+    holder = RuleSetHolder(path)
+    assert not holder.reload_if_changed()
+
+    write_spec(tmp_path / "rules.json", spec_with(version="", name="broken"))
+    os.utime(path, (1, 1))
+    assert not holder.reload_if_changed()
+    assert holder.rules.version == "1.0.0"
+
+    write_spec(tmp_path / "rules.json", spec_with(version="1.2.0"))
+    os.utime(path, (2, 2))
+    assert holder.reload_if_changed()
+    assert holder.rules.version == "1.2.0"
+
+
+def test_reload_endpoint_and_method_stamp(monkeypatch, tmp_path):
+    path = write_spec(tmp_path / "rules.json", spec_with(version="3.0.0"))
+    monkeypatch.setattr(ruleset, "path", path)
+    monkeypatch.setattr(ruleset, "rules", ruleset.rules)
+    monkeypatch.setattr(ruleset, "_mtime", ruleset._mtime)
+    bundle = {"resourceType": "Bundle", "type": "batch", "entry": [
+        {"resource": {"resourceType": "Patient", "id": "r1", "name": [{"family": "Doe", "given": ["Jane"]}]}},
+    ]}
+
+    with TestClient(app) as client:
+        assert client.post("/rules/$reload").status_code == 403
+        reloaded = client.post("/rules/$reload", headers=AUTH)
+        info = client.get("/rules")
+        response = client.post("/RiskAssessment/$batch", json=bundle, headers=AUTH)
+        (tmp_path / "rules.json").write_text("[]")
+        rejected = client.post("/rules/$reload", headers=AUTH)
+
+    assert reloaded.status_code == 200
+    assert info.json()["version"] == "3.0.0"
+    resource = response.json()["entry"][0]["resource"]
+    assert resource["method"]["coding"][0]["code"] == "3.0.0"
+    assert rejected.status_code == 422
+    assert rejected.json()["resourceType"] == "OperationOutcome"
+    assert ruleset.rules.version == "3.0.0"
@@ -0,0 +1,175 @@
+import random
+
+import numpy as np
+import pytest
+
+from src.scoring import (
+    calculate_clinical_score,
+    calculate_imaging_score,
+    calculate_molecular_score,
+    calculate_risk_score_with_symptoms_and_imaging,
+    categorize_risk,
+    explain_risk_score,
+    pack_cohort,
+    score_patients,
+)
+from src.rules import current_rules
+
+PATIENT = {
+    "molecular_data": {"VEGF_level": 120, "CDKN2A_mutation": True, "TP53_mutation": True},
+    "clinical_data": {"pain": True, "swelling": True, "fever": False, "tumor_size": 6},
+    "imaging_data": {
+        "mri_abnormalities": True,
+        "ct_scan_abnormalities": False,
+        "pet_scan_high_activity": True,
+        "x_ray_findings": False,
+    },
+}
+
+
+# Test calculate_molecular_score function
+def test_calculate_molecular_score():
+    # Test case 1: High VEGF, CDKN2A mutation, and TP53 mutation
+    score = calculate_molecular_score(PATIENT["molecular_data"])
+    assert score == 1.2, f"Expected 1.2 but got {score}"
+
+    # Test case 2: No genetic markers
+    molecular_data = {"VEGF_level": 50, "CDKN2A_mutation": False, "TP53_mutation": False}
+    score = calculate_molecular_score(molecular_data)
+    assert score == 0.0, f"Expected 0.0 but got {score}"
+
+
+# Test calculate_risk_score_with_symptoms_and_imaging function
+def test_calculate_risk_score_with_symptoms_and_imaging():
+    score = calculate_risk_score_with_symptoms_and_imaging(
+        PATIENT["molecular_data"], PATIENT["clinical_data"], PATIENT["imaging_data"]
+    )
+    assert score > 0.8, f"Expected score > 0.8 but got {score}"
+    assert categorize_risk(score) == "High"
+
+
+def random_patient(rng: random.Random) -> dict:
+    def flag():
+        return rng.choice([True, False, None, 0, 1])
+
+    patient = {
+        "molecular_data": {
+            # Include the exact thresholds and missing values
+            "VEGF_level": rng.choice([None, 0, 100, 100.0001, rng.uniform(0, 300), rng.randint(0, 300)]),
+            "CDKN2A_mutation": flag(),
+            "TP53_mutation": flag(),
+        },
+        "clinical_data": {
+            "pain": flag(),
+            "swelling": flag(),
+            "fever": flag(),
+            "tumor_size": rng.choice([None, 5, 5.0001, rng.uniform(0, 20)]),
+        },
+        "imaging_data": {
+            "mri_abnormalities": flag(),
+            "ct_scan_abnormalities": flag(),
+            "pet_scan_high_activity": flag(),
+            "x_ray_findings": flag(),
+        },
+    }
+    # Randomly drop keys and whole sections
+    for section in list(patient):
+        if rng.random() < 0.05:
+            del patient[section]
+            continue
+        for key in list(patient[section]):
+            if rng.random() < 0.1:
+                del patient[section][key]
+    return patient
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_batch_matches_scalar_exactly(seed):
+    rng = random.Random(seed)
+    patients = [PATIENT] + [random_patient(rng) for _ in range(2000)]
+
+    scores = score_patients(patients)
+
+    for i, patient in enumerate(patients):
+        molecular = patient.get("molecular_data", {})
+        clinical = patient.get("clinical_data", {})
+        imaging = patient.get("imaging_data", {})
+        assert scores.molecular[i] == calculate_molecular_score(molecular)
+        assert scores.clinical[i] == calculate_clinical_score(clinical)
+        assert scores.imaging[i] == calculate_imaging_score(imaging)
+        total = calculate_risk_score_with_symptoms_and_imaging(molecular, clinical, imaging)
+        assert scores.total[i] == total
+        assert scores.category[i] == categorize_risk(total)
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_explanations_match_scalar_and_the_score(seed):
+    rng = random.Random(seed)
+    patients = [PATIENT] + [random_patient(rng) for _ in range(2000)]
+    rules = current_rules()
+
+    plain = score_patients(patients)
+    scores = score_patients(patients, explain=True)
+
+    assert plain.contributions is None
+    np.testing.assert_array_equal(scores.total, plain.total)
+    assert scores.contributions.shape == (len(patients), len(rules.factor_terms))
+    for i, patient in enumerate(patients):
+        sections = [patient.get(section, {}) for section in ("molecular_data", "clinical_data", "imaging_data")]
+        total, contributions = explain_risk_score(*sections)
+        assert total == calculate_risk_score_with_symptoms_and_imaging(*sections) == scores.total[i]
+        assert tuple(scores.contributions[i].tolist()) == contributions
+        assert min(rules.max_score, sum(contributions)) == pytest.approx(total)
+
+
+def test_rationale_names_only_factors_that_hold():
+    rules = current_rules()
+    _, contributions = explain_risk_score(PATIENT["molecular_data"], PATIENT["clinical_data"], PATIENT["imaging_data"])
+    rationale = rules.rationale(contributions)
+
+    assert rationale.startswith("Risk factors: VEGF_level > 100 (+0.20), CDKN2A_mutation (+0.16)")
+    for absent in ("fever", "ct_scan_abnormalities", "x_ray_findings"):
+        assert absent not in rationale
+    assert rules.contributing_factors(contributions, "imaging_data") == [
+        ("mri_abnormalities", pytest.approx(0.12)), ("pet_scan_high_activity", pytest.approx(0.06)),
+    ]
+    assert rules.rationale(explain_risk_score({}, {}, {})[1]) == "No risk factors present"
+
+
+def test_every_flag_combination_matches_scalar():
+    # Exhaustively cover all 2**9 flag combinations around the numeric thresholds
+    patients = []
+    for bits in range(2 ** 9):
+        flags = [bool(bits >> shift & 1) for shift in range(9)]
+        for vegf, tumor_size in [(100, 5), (101, 6)]:
+            patients.append({
+                "molecular_data": {"VEGF_level": vegf, "CDKN2A_mutation": flags[0], "TP53_mutation": flags[1]},
+                "clinical_data": {"pain": flags[2], "swelling": flags[3], "fever": flags[4], "tumor_size": tumor_size},
+                "imaging_data": {
+                    "mri_abnormalities": flags[5],
+                    "ct_scan_abnormalities": flags[6],
+                    "pet_scan_high_activity": flags[7],
+                    "x_ray_findings": flags[8],
+                },
+            })
+    scores = score_patients(patients)
+    expected = [
+        calculate_risk_score_with_symptoms_and_imaging(p["molecular_data"], p["clinical_data"], p["imaging_data"])
+        for p in patients
+    ]
+    np.testing.assert_array_equal(scores.total, np.array(expected))
+    assert list(scores.category) == [categorize_risk(score) for score in expected]
+    assert set(scores.category) == {"High", "Medium", "Low"}
+
+
+def test_pack_cohort_columns():
+    cohort = pack_cohort([PATIENT, {}])
+    assert len(cohort) == 2
+    assert cohort.vegf_level.dtype == np.float64
+    assert list(cohort.vegf_level) == [120.0, 0.0]
+    assert list(cohort.flags["pet_scan_high_activity"]) == [True, False]
+
+
+def test_empty_cohort():
+    scores = score_patients([])
+    assert len(scores) == 0
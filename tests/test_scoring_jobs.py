@@ -0,0 +1,231 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from benchmarks.cohorts import cohort_bundle, make_cohort
+from src import main, scoring_jobs
+from src.fhir_ingest import ingest_records
+from src.main import app
+from src.rules import compile_rules
+from src.scoring_jobs import MemoryJobBackend, ScoringJob, ScoringJobRunner, SQLiteJobBackend
+
+from tests.test_batch import AUTH, observation
+from tests.test_rules import spec_with
+
+ASYNC = {**AUTH, "Prefer": "respond-async", "Content-Type": "application/fhir+json"}
+
+
+@pytest.fixture
+def runner(tmp_path, monkeypatch):
+    runner = ScoringJobRunner(root=str(tmp_path), chunk_size=10, workers=0, poll_interval=0.05)
+    monkeypatch.setattr(main, "scoring_jobs", runner)
+    return runner
+
+
+def cohort_body(size, seed=0, extra=()):
+    body = cohort_bundle(make_cohort(size, seed))
+    body["entry"] += [{"resource": resource} for resource in extra]
+    return json.dumps(body)
+
+
+def ingest(size, seed=0):
+    entries = json.loads(cohort_body(size, seed))["entry"]
+    return ingest_records([(i, entry["resource"]) for i, entry in enumerate(entries)])
+
+
+def wait_for_job(client, status_url):
+    for _ in range(500):
+        response = client.get(status_url, headers=AUTH)
+        if response.status_code != 202:
+            return response
+        assert response.json()["status"] in ("queued", "running")
+        assert "patients" in response.headers["X-Progress"]
+        time.sleep(0.01)
+    raise AssertionError("scoring job did not finish")
+
+
+def test_async_batch_matches_sync_batch(runner):
+    body = cohort_body(25, extra=[observation("nobody", "pain", valueBoolean=True)])
+    with TestClient(app) as client:
+        submitted = client.post("/RiskAssessment/$batch", content=body, headers=ASYNC)
+        assert submitted.status_code == 202
+        assert submitted.json()["total"] == 25 and submitted.json()["rejected"] == 1
+        status_url = submitted.headers["Content-Location"]
+        assert status_url.endswith(f"/$job-status/{submitted.json()['id']}")
+
+        result = wait_for_job(client, status_url)
+        sync = client.post("/RiskAssessment/$batch", content=body, headers=AUTH)
+        # Client-supplied inputs never become a patient's latest assessment
+        read = client.get("/RiskAssessment/p0", headers=AUTH)
+
+    assert result.status_code == 200
+    assert result.headers["content-type"].startswith("application/fhir+json")
+    entries, expected = result.json()["entry"], sync.json()["entry"]
+    assert len(entries) == 26
+    assert entries == expected
+    assert read.status_code == 404
+
+
+def test_interrupted_job_resumes_from_checkpoints(tmp_path, monkeypatch):
+    patients, errors = ingest(25)
+    scored = []
+    score_chunk = scoring_jobs.score_chunk
+
+    def counting_score_chunk(source, target, rules):
+        scored.append(os.path.basename(source))
+        return score_chunk(source, target, rules)
+
+    monkeypatch.setattr(scoring_jobs, "score_chunk", counting_score_chunk)
+
+    async def interrupted():
+        # The first process checkpoints one chunk, then dies with the job still running
+        first = ScoringJobRunner(SQLiteJobBackend(str(tmp_path / "jobs.sqlite3")), root=str(tmp_path), chunk_size=10,
+                                 workers=0)
+        job = await first.submit(patients, errors)
+        first.backend.claim()
+        counting_score_chunk(first.source_path(job.id, 1), first.result_path(job.id, 1), scoring_jobs.current_rules())
+        return job.id
+
+    async def restarted(job_id):
+        second = ScoringJobRunner(root=str(tmp_path), chunk_size=10, workers=0, poll_interval=0.01)
+        await second.start()
+        for _ in range(500):
+            job = second.get(job_id)
+            if job.status == "completed":
+                break
+            await asyncio.sleep(0.01)
+        await second.stop()
+        return second, job
+
+    job_id = asyncio.run(interrupted())
+    runner, job = asyncio.run(restarted(job_id))
+
+    assert job.status == "completed" and job.processed == 25
+    assert sorted(scored) == ["000000.ndjson", "000001.ndjson", "000002.ndjson"]
+    entries = json.loads(b"".join(runner.iter_bundle(job)))["entry"]
+    assert [entry["resource"]["id"] for entry in entries] == [f"p{i}" for i in range(25)]
+
+
+def test_job_is_rescored_when_the_rules_changed_since_submission(tmp_path, monkeypatch):
+    patients, errors = ingest(25)
+    submitted_rules = scoring_jobs.current_rules()
+    new_rules = compile_rules(spec_with(version="9.9.9"))
+
+    async def scenario():
+        runner = ScoringJobRunner(SQLiteJobBackend(str(tmp_path / "jobs.sqlite3")), root=str(tmp_path), chunk_size=10,
+                                  workers=0, poll_interval=0.01)
+        job = await runner.submit(patients, errors)
+        assert runner.get(job.id).scored_with == submitted_rules.fingerprint
+        # A checkpoint made with the submission's rules, then the rule set is reloaded
+        scoring_jobs.score_chunk(runner.source_path(job.id, 1), runner.result_path(job.id, 1), submitted_rules)
+        monkeypatch.setattr(scoring_jobs, "current_rules", lambda: new_rules)
+        await runner.start()
+        for _ in range(500):
+            job = runner.get(job.id)
+            if job.status == "completed":
+                break
+            await asyncio.sleep(0.01)
+        await runner.stop()
+        return runner, job
+
+    runner, job = asyncio.run(scenario())
+
+    assert job.status == "completed" and job.scored_with == new_rules.fingerprint
+    entries = json.loads(b"".join(runner.iter_bundle(job)))["entry"]
+    assert {entry["resource"]["method"]["coding"][0]["code"] for entry in entries} == {"9.9.9"}
+
+
+@pytest.mark.parametrize("max_concurrent", [1, 2])
+def test_concurrent_jobs_are_capped(tmp_path, monkeypatch, max_concurrent):
+    active, peak = set(), []
+    score_chunk = scoring_jobs.score_chunk
+
+    def slow_score_chunk(source, target, rules):
+        active.add(os.path.dirname(source))
+        peak.append(len(active))
+        time.sleep(0.02)
+        try:
+            return score_chunk(source, target, rules)
+        finally:
+            active.discard(os.path.dirname(source))
+
+    monkeypatch.setattr(scoring_jobs, "score_chunk", slow_score_chunk)
+    patients, errors = ingest(20)
+
+    async def scenario():
+        runner = ScoringJobRunner(MemoryJobBackend(), root=str(tmp_path), chunk_size=10, workers=0,
+                                  max_concurrent=max_concurrent, poll_interval=0.01)
+        await runner.start()
+        jobs = [await runner.submit(patients, errors) for _ in range(3)]
+        for _ in range(500):
+            if all(runner.get(job.id).status == "completed" for job in jobs):
+                break
+            await asyncio.sleep(0.01)
+        await runner.stop()
+        return [runner.get(job.id) for job in jobs]
+
+    jobs = asyncio.run(scenario())
+    assert [job.status for job in jobs] == ["completed"] * 3
+    assert max(peak) == max_concurrent
+
+
+def test_process_pool_scores_like_threads(tmp_path):
+    patients, errors = ingest(30, 3)
+
+    async def run(workers):
+        runner = ScoringJobRunner(MemoryJobBackend(), root=str(tmp_path / str(workers)), chunk_size=10,
+                                  workers=workers, poll_interval=0.01)
+        await runner.start()
+        job = await runner.submit(patients, errors)
+        for _ in range(3000):
+            job = runner.get(job.id)
+            if job.status != "queued" and job.status != "running":
+                break
+            await asyncio.sleep(0.01)
+        await runner.stop()
+        return job, b"".join(runner.iter_bundle(job))
+
+    (pooled, pooled_bundle), (threaded, threaded_bundle) = asyncio.run(run(2)), asyncio.run(run(0))
+    assert pooled.status == threaded.status == "completed"
+    assert pooled_bundle == threaded_bundle
+
+
+def test_sqlite_backend_claims_in_order_and_recovers(tmp_path):
+    backend = SQLiteJobBackend(str(tmp_path / "jobs.sqlite3"))
+    for i, job_id in enumerate(["b", "a", "c"]):
+        backend.create(ScoringJob(id=job_id, total=5, chunk_size=2, created=1000.0 + i))
+
+    claimed = backend.claim()
+    assert claimed.id == "b" and claimed.status == "running"
+    claimed.processed = 2
+    backend.update(claimed)
+    assert backend.counts() == {"queued": 2, "running": 1, "completed": 0, "failed": 0}
+
+    reopened = SQLiteJobBackend(str(tmp_path / "jobs.sqlite3"))
+    assert reopened.recover() == 1
+    job = reopened.get("b")
+    assert (job.status, job.processed, job.chunks, job.progress) == ("queued", 2, 3, "40% (2/5 patients)")
+    assert reopened.delete("a") and not reopened.delete("a")
+    assert [reopened.claim().id, reopened.claim().id, reopened.claim()] == ["b", "c", None]
+
+
+def test_cancel_removes_job_and_files(runner, tmp_path):
+    with TestClient(app) as client:
+        submitted = client.post("/RiskAssessment/$batch", content=cohort_body(5), headers=ASYNC)
+        status_url = submitted.headers["Content-Location"]
+        assert client.delete(status_url, headers=AUTH).status_code == 202
+        assert client.get(status_url, headers=AUTH).status_code == 404
+        assert client.delete(status_url, headers=AUTH).status_code == 404
+    assert not os.path.exists(runner.directory(submitted.json()["id"]))
+
+
+def test_async_batch_size_limit(runner, monkeypatch):
+    monkeypatch.setattr(main, "SARCRISK_MAX_JOB_SIZE", 3)
+    with TestClient(app) as client:
+        response = client.post("/RiskAssessment/$batch", content=cohort_body(5), headers=ASYNC)
+    assert response.status_code == 413
+    assert response.json()["issue"][0]["code"] == "too-costly"
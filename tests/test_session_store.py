@@ -0,0 +1,164 @@
+import asyncio
+import subprocess
+import sys
+
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+
+from src import athena_auth
+from src.athena_auth import AthenaAuth, get_oauth_token
+from src.session_store import (
+    MemorySessionBackend, SessionCipher, SessionStore, SharedSessionBackend, SQLiteSessionBackend,
+)
+from src.token_manager import TokenManager
+
+from tests.test_assessment_cache import FakeClock, FakeRedis
+
+TOKEN_RESPONSE = {
+    "access_token": "athena-secret", "token_type": "Bearer", "expires_in": 600, "refresh_token": "athena-refresh",
+}
+
+
+@pytest.fixture(params=["memory", "sqlite", "shared"])
+def backend(request, tmp_path):
+    clock = FakeClock()
+    if request.param == "memory":
+        return MemorySessionBackend(clock=clock), clock
+    if request.param == "sqlite":
+        return SQLiteSessionBackend(str(tmp_path / "sessions.sqlite3"), clock=clock), clock
+    return SharedSessionBackend(FakeRedis(), clock=clock), clock
+
+
+def stored_values(backend):
+    if isinstance(backend, SharedSessionBackend):
+        return dict(backend.client.data)
+    if isinstance(backend, SQLiteSessionBackend):
+        return dict(backend._connection().execute("SELECT key, value FROM sessions").fetchall())
+    return {key: value for key, (value, _) in backend._values.items()}
+
+
+def test_sessions_round_trip_encrypted(backend):
+    backend, clock = backend
+    store = SessionStore(backend, SessionCipher([SessionCipher.generate_key()]), clock=clock)
+    session = store.create_session(TOKEN_RESPONSE, practice_id="195900")
+
+    found = store.session(session.id)
+    assert found == session
+    assert found.headers == {"Authorization": "Bearer athena-secret"}
+    assert found.expires_at == clock.now + 600
+    # Neither the tokens nor the session id are stored in clear
+    for key, value in stored_values(backend).items():
+        assert session.id not in key
+        assert b"athena-secret" not in value and b"athena-refresh" not in value
+
+    assert store.session("not-a-session") is None
+    store.end_session(session.id)
+    assert store.session(session.id) is None
+    assert store.stats.as_dict() == {"hits": 1, "misses": 2, "rejected": 0, "writes": 1}
+
+
+def test_sessions_expire(backend):
+    backend, clock = backend
+    store = SessionStore(backend, SessionCipher([SessionCipher.generate_key()]), clock=clock)
+    session = store.create_session(TOKEN_RESPONSE)
+    clock.now += 599
+    assert store.session(session.id) is not None
+    clock.now += 1
+    assert store.session(session.id) is None
+    if isinstance(backend, SharedSessionBackend):
+        assert set(backend.client.expiry.values()) == {600}
+
+
+def test_tampered_or_foreign_records_are_rejected():
+    backend = MemorySessionBackend()
+    old_key, new_key = SessionCipher.generate_key(), SessionCipher.generate_key()
+    store = SessionStore(backend, SessionCipher([old_key]))
+    first, second = store.create_session(TOKEN_RESPONSE), store.create_session(TOKEN_RESPONSE)
+
+    # Rotation: a ring that still holds the old key reads old records
+    rotated = SessionStore(backend, SessionCipher([new_key, old_key]))
+    assert rotated.session(first.id) is not None
+    assert SessionStore(backend, SessionCipher([new_key])).session(first.id) is None
+
+    # A record copied under another session's key is not served
+    backend._values[store._key("session", second.id)] = backend._values[store._key("session", first.id)]
+    assert store.session(second.id) is None
+    assert store.stats.rejected == 1
+
+    with pytest.raises(ValueError):
+        SessionStore(SharedSessionBackend(FakeRedis()), None)
+
+
+def test_sqlite_store_is_shared_between_processes(tmp_path):
+    key = SessionCipher.generate_key()
+    path = str(tmp_path / "sessions.sqlite3")
+    session = SessionStore(SQLiteSessionBackend(path), SessionCipher([key])).create_session(TOKEN_RESPONSE)
+
+    code = (
+        "import sys\n"
+        "from src.session_store import SQLiteSessionBackend, SessionCipher, SessionStore\n"
+        "store = SessionStore(SQLiteSessionBackend(sys.argv[1]), SessionCipher([sys.argv[2].encode()]))\n"
+        "print(store.session(sys.argv[3]).access_token)\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code, path, key.decode(), session.id],
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "athena-secret"
+
+
+def test_get_oauth_token_resolves_sessions(monkeypatch):
+    store = SessionStore(MemorySessionBackend(), SessionCipher([SessionCipher.generate_key()]))
+    monkeypatch.setattr(athena_auth, "session_store", store)
+    session = store.create_session(TOKEN_RESPONSE)
+
+    resolved = get_oauth_token(HTTPAuthorizationCredentials(scheme="Bearer", credentials=session.id))
+    assert resolved == {"Authorization": "Bearer athena-secret"}
+    assert AthenaAuth(store=store).session_headers(session.id) == resolved
+
+    # Raw tokens and ended sessions are not passed on to Athena
+    store.end_session(session.id)
+    for credentials in ("other-token", session.id):
+        with pytest.raises(HTTPException) as rejected:
+            get_oauth_token(HTTPAuthorizationCredentials(scheme="Bearer", credentials=credentials))
+        assert rejected.value.status_code == 401
+
+
+def test_token_managers_share_tokens_through_the_store():
+    store = SessionStore(MemorySessionBackend(), SessionCipher([SessionCipher.generate_key()]))
+    calls = []
+
+    async def fetch(key, refresh_token):
+        calls.append(refresh_token)
+        return {"access_token": f"tok-{len(calls)}", "expires_in": 600, "refresh_token": "r"}
+
+    async def scenario():
+        # Two worker processes, each with its own in-process cache
+        first = TokenManager(fetch, refresh_margin=60, store=store)
+        second = TokenManager(fetch, refresh_margin=60, store=store)
+        return await first.get_token("client", "195900"), await second.get_token("client", "195900")
+
+    first, second = asyncio.run(scenario())
+    assert calls == [None]
+    assert second.access_token == first.access_token == "tok-1"
+    assert second.refresh_token == "r"
+    assert abs(second.expires_at - first.expires_at) < 1
+
+
+def test_invalidated_token_is_not_adopted_from_the_store():
+    store = SessionStore(MemorySessionBackend(), SessionCipher([SessionCipher.generate_key()]))
+    calls = []
+
+    async def fetch(key, refresh_token):
+        calls.append(refresh_token)
+        return {"access_token": f"tok-{len(calls)}", "expires_in": 600}
+
+    async def scenario():
+        tokens = TokenManager(fetch, refresh_margin=60, store=store)
+        rejected = await tokens.get_token("client", "195900")
+        tokens.invalidate("client", "195900")
+        return rejected, await tokens.get_token("client", "195900")
+
+    rejected, fresh = asyncio.run(scenario())
+    assert rejected.access_token == "tok-1"
+    assert fresh.access_token == "tok-2"
+    assert store.load("token", "client\n195900")["access_token"] == "tok-2"
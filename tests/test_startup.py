@@ -0,0 +1,38 @@
+import subprocess
+import sys
+
+from src import fhir_models
+from src.fhir_fragments import SARCOMA_RISK_CODE
+from src.startup_profile import by_package, parse_importtime
+
+
+def test_app_import_does_not_load_fhir_resources():
+    code = "import sys, src.main; print(any(m.startswith('fhir.resources') for m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "False"
+
+
+def test_warm_up_loads_classes_and_fragment_models():
+    fhir_models.warm_up()
+
+    assert fhir_models.loaded()
+    assert fhir_models.RiskAssessment.__module__ == "fhir.resources.riskassessment"
+    assert isinstance(SARCOMA_RISK_CODE.model, fhir_models.CodeableConcept)
+    assert SARCOMA_RISK_CODE.model.coding[0].code == "420324007"
+
+
+def test_parse_importtime():
+    output = "\n".join([
+        "import time: self [us] | cumulative | imported package",
+        "import time:       120 |        120 |     fhir.resources.fhirtypes",
+        "import time:       300 |        420 |   fhir.resources",
+        "import time:        50 |         50 | json",
+    ])
+    records = parse_importtime(output)
+
+    assert [(r.module, r.self_us, r.cumulative_us, r.depth) for r in records] == [
+        ("fhir.resources.fhirtypes", 120, 120, 2),
+        ("fhir.resources", 300, 420, 1),
+        ("json", 50, 50, 0),
+    ]
+    assert by_package(records) == {"fhir": 420, "json": 50}
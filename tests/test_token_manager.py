@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+from src.token_manager import TokenManager
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_manager(clock, calls, expires_in=300, fail_refresh=False):
+    async def fetch(key, refresh_token):
+        calls.append((key, refresh_token))
+        await asyncio.sleep(0.01)
+        if refresh_token and fail_refresh:
+            raise RuntimeError("refresh token revoked")
+        return {"access_token": f"tok-{len(calls)}", "expires_in": expires_in, "refresh_token": "r"}
+
+    return TokenManager(fetch, refresh_margin=60, refresh_interval=0.01, clock=clock)
+
+
+def test_cache_hit_until_expiry():
+    clock, calls = FakeClock(), []
+    manager = make_manager(clock, calls)
+
+    async def scenario():
+        first = await manager.get_token("client", "195900")
+        second = await manager.get_token("client", "195900")
+        clock.now += 301
+        third = await manager.get_token("client", "195900")
+        return first, second, third
+
+    first, second, third = asyncio.run(scenario())
+    assert first is second
+    assert third.access_token == "tok-2"
+    assert calls[1] == (("client", "195900"), "r")
+    assert manager.stats.as_dict() == {
+        "hits": 1, "misses": 2, "refreshes": 2, "background_refreshes": 0, "failures": 0,
+    }
+
+
+def test_keys_are_isolated_per_practice():
+    clock, calls = FakeClock(), []
+    manager = make_manager(clock, calls)
+
+    async def scenario():
+        await manager.get_token("client", "1")
+        await manager.get_token("client", "2")
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
+
+
+def test_concurrent_misses_are_single_flight():
+    clock, calls = FakeClock(), []
+    manager = make_manager(clock, calls)
+
+    async def scenario():
+        return await asyncio.gather(*(manager.get_token("client", "1") for _ in range(50)))
+
+    tokens = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert len({token.access_token for token in tokens}) == 1
+    assert manager.stats.misses == 50
+
+
+def test_background_refresh_ahead_of_expiry():
+    clock, calls = FakeClock(), []
+    manager = make_manager(clock, calls)
+
+    async def scenario():
+        await manager.get_token("client", "1")
+        clock.now += 250  # inside the 60s refresh margin, still valid
+        await manager.start()
+        await asyncio.sleep(0.05)
+        await manager.stop()
+        return await manager.get_token("client", "1")
+
+    token = asyncio.run(scenario())
+    assert token.access_token == "tok-2"
+    assert manager.stats.background_refreshes >= 1
+    assert manager.stats.hits == 1
+
+
+def test_revoked_refresh_token_falls_back_to_new_grant():
+    clock, calls = FakeClock(), []
+    manager = make_manager(clock, calls, fail_refresh=True)
+
+    async def scenario():
+        await manager.get_token("client", "1")
+        clock.now += 301
+        return await manager.get_token("client", "1")
+
+    token = asyncio.run(scenario())
+    assert [refresh for _, refresh in calls] == [None, "r", None]
+    assert token.access_token == "tok-3"
+
+
+def test_failures_are_counted_and_raised():
+    async def fetch(key, refresh_token):
+        raise RuntimeError("down")
+
+    manager = TokenManager(fetch)
+    with pytest.raises(RuntimeError):
+        asyncio.run(manager.get_token("client", "1"))
+    assert manager.stats.failures == 1
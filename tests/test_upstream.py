@@ -0,0 +1,328 @@
+import asyncio
+import functools
+import json
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from src import main
+from src.athena_fhir import AthenaFhirClient
+from src.http_client import AthenaHttpClient
+from src.main import app
+from src.upstream import (
+    POLICIES, STALE_WARNING, CircuitBreaker, CircuitOpenError, EndpointPolicy, RateLimitedError, RateLimiter,
+    TokenBucket, UpstreamStats, backoff_delay, parse_rate_limits,
+)
+
+AUTH = {"Authorization": "Bearer test-token"}
+
+
+class FaultStub:
+    """
+    Local HTTP/1.1 server that answers each request with the next scripted
+    fault: "ok", a status code such as 503 or 429, "reset" (drop the
+    connection), "hang" (never answer) or ("slow", seconds).
+    """
+
+    def __init__(self, *faults):
+        self.faults = list(faults)
+        self.requests = []
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self
+
+    async def __aexit__(self, *exc):
+        self._server.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+            length = next((int(line.split(":", 1)[1]) for line in head.split("\r\n")
+                           if line.lower().startswith("content-length:")), 0)
+            if length:
+                await reader.readexactly(length)
+            method, path = head.split(" ", 2)[:2]
+            self.requests.append((method, path))
+            fault = self.faults.pop(0) if self.faults else "ok"
+            if fault == "reset":
+                return
+            if fault == "hang":
+                await asyncio.sleep(60)
+                return
+            if isinstance(fault, tuple):
+                await asyncio.sleep(fault[1])
+                fault = "ok"
+            status = 200 if fault == "ok" else fault
+            body = json.dumps({"path": path, "n": len(self.requests)}).encode()
+            extra = "Retry-After: 3\r\n" if status == 429 else ""
+            writer.write(
+                f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                f"{extra}Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_http(clock=None, failures=3, rate=0, **kwargs):
+    clock = clock or FakeClock()
+    return AthenaHttpClient(
+        breaker_factory=functools.partial(CircuitBreaker, failure_threshold=failures, reset_timeout=30),
+        rate_limiter=RateLimiter(rate=rate, burst=1, overrides={}, clock=clock),
+        clock=clock, sleep=clock.sleep, **kwargs,
+    )
+
+
+def test_idempotent_reads_are_retried_through_faults():
+    async def scenario():
+        async with FaultStub("reset", 503, "ok") as stub:
+            http = make_http(failures=5)
+            response = await http.get(f"{stub.url}/Patient/p1")
+            await http.close()
+            return stub, http, response, http.breaker(stub.url.split("//")[1])
+
+    stub, http, response, breaker = asyncio.run(scenario())
+    assert response.status_code == 200
+    assert len(stub.requests) == 3
+    assert http.stats.retries == 2
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.failures == 0
+
+
+def test_backoff_is_full_jitter_and_capped():
+    assert backoff_delay(3, base=0.5, cap=2.0, rng=lambda: 1.0) == 2.0
+    assert backoff_delay(1, base=0.5, cap=2.0, rng=lambda: 0.5) == 0.5
+    assert backoff_delay(0, rng=lambda: 0.0) == 0.0
+
+
+def test_token_exchange_is_not_resent_and_times_out_quickly():
+    policies = {**POLICIES, "token": EndpointPolicy("token", timeout=0.2, retries=1)}
+
+    async def scenario():
+        async with FaultStub(503, "hang") as stub:
+            http = make_http(policies=policies)
+            first = await http.post(f"{stub.url}/oauth2/token", data={"grant_type": "client_credentials"})
+            with pytest.raises(httpx.ReadTimeout):
+                await http.post(f"{stub.url}/oauth2/token", data={"grant_type": "client_credentials"})
+            await http.close()
+            return stub, first
+
+    stub, first = asyncio.run(scenario())
+    # A POST that reached the server is never sent twice
+    assert first.status_code == 503
+    assert stub.requests == [("POST", "/oauth2/token"), ("POST", "/oauth2/token")]
+
+
+def test_breaker_fails_fast_serves_stale_and_recovers():
+    clock = FakeClock()
+
+    async def scenario():
+        async with FaultStub("ok", 503, 503) as stub:
+            http = make_http(clock, failures=2, policies={**POLICIES, "read": EndpointPolicy(
+                "read", timeout=1.0, retries=0, idempotent=True, serve_stale=True)})
+            fresh = await http.get(f"{stub.url}/Patient/p1")
+            failed = [await http.get(f"{stub.url}/Patient/p1") for _ in range(2)]
+            seen = len(stub.requests)
+            stale = await http.get(f"{stub.url}/Patient/p1")
+            with pytest.raises(CircuitOpenError) as excinfo:
+                await http.get(f"{stub.url}/Patient/p2")
+            assert len(stub.requests) == seen  # both answered without contacting the host
+
+            clock.now += 30
+            recovered = await http.get(f"{stub.url}/Patient/p2")
+            await http.close()
+            return http, fresh, failed, stale, excinfo.value, recovered, http.breaker(stub.url.split("//")[1])
+
+    http, fresh, failed, stale, error, recovered, breaker = asyncio.run(scenario())
+    # Failed reads fall back to the last good copy, marked stale
+    for response in failed + [stale]:
+        assert response.status_code == 200
+        assert response.headers["Warning"] == STALE_WARNING
+        assert response.json() == fresh.json()
+    assert error.retry_after == 30
+    assert recovered.status_code == 200 and "Warning" not in recovered.headers
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert http.stats.short_circuited == 2 and http.stats.stale_served == 3
+
+
+def test_stale_reads_are_only_served_to_the_same_credential():
+    async def scenario():
+        async with FaultStub("ok", 503, 503) as stub:
+            http = make_http(failures=5, policies={**POLICIES, "read": EndpointPolicy(
+                "read", timeout=1.0, retries=0, idempotent=True, serve_stale=True)})
+            url = f"{stub.url}/Patient/p1"
+            fresh = await http.get(url, headers={"Authorization": "Bearer alice"})
+            other = await http.get(url, headers={"Authorization": "Bearer bob"})
+            same = await http.get(url, headers={"Authorization": "Bearer alice"})
+            await http.close()
+            return fresh, other, same
+
+    fresh, other, same = asyncio.run(scenario())
+    assert other.status_code == 503 and "Warning" not in other.headers
+    assert same.status_code == 200 and same.headers["Warning"] == STALE_WARNING
+    assert same.json() == fresh.json()
+
+
+def test_half_open_lets_one_probe_through():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+    breaker.record_failure()
+    assert not breaker.allow()
+    clock.now += 10
+    assert breaker.allow()
+    assert not breaker.allow()  # probe in flight
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and breaker.opens == 2
+
+
+def test_half_open_probe_is_released_when_it_never_goes_upstream():
+    clock = FakeClock()
+    sent = []
+    policies = {**POLICIES, "read": EndpointPolicy("read", timeout=1.0, retries=0, idempotent=True)}
+
+    async def upstream(request):
+        sent.append(request)
+        return httpx.Response(503 if len(sent) == 1 else 200)
+
+    async def scenario():
+        http = make_http(clock, failures=1, rate=100, policies=policies, transport=httpx.MockTransport(upstream))
+        url = "http://athena.test/Patient/p1"
+        breaker = http.breaker("athena.test")
+        await http.get(url)
+        assert breaker.state == CircuitBreaker.OPEN
+
+        # The probe is rejected by the rate limiter
+        clock.now += 30
+        http.rate_limiter.pause("p-busy", 1000)
+        with pytest.raises(RateLimitedError):
+            await http.get(url, practice_id="p-busy")
+
+        # The probe is cancelled while it waits for a rate limit slot
+        http.rate_limiter.pause("p-slow", 5)
+        http.sleep = lambda seconds: asyncio.Event().wait()
+        probe = asyncio.ensure_future(http.post(url, practice_id="p-slow", content=b"{}"))
+        await asyncio.sleep(0)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert len(sent) == 1
+
+        recovered = await http.get(url)
+        await http.close()
+        return breaker, recovered
+
+    breaker, recovered = asyncio.run(scenario())
+    assert recovered.status_code == 200 and len(sent) == 2
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_identical_concurrent_gets_are_coalesced():
+    async def scenario():
+        async with FaultStub(*[("slow", 0.05)] * 3) as stub:
+            http = make_http()
+            same = [http.get(f"{stub.url}/Patient/p1", headers=AUTH) for _ in range(5)]
+            other = [http.get(f"{stub.url}/Patient/p2", headers=AUTH), http.get(f"{stub.url}/Patient/p1")]
+            responses = await asyncio.gather(*same, *other)
+            await http.close()
+            return stub, http, responses
+
+    stub, http, responses = asyncio.run(scenario())
+    # p1 with the same headers once, p2 once, p1 with different headers once
+    assert len(stub.requests) == 3
+    assert http.stats.coalesced == 4
+    assert len({id(response) for response in responses[:5]}) == 1
+
+
+def test_token_bucket_paces_bursts_and_honours_pause():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=10, burst=2, clock=clock)
+    assert [round(bucket.reserve(), 3) for _ in range(4)] == [0.0, 0.0, 0.1, 0.2]
+    clock.now += 1
+    bucket.pause(3)
+    assert bucket.reserve() == pytest.approx(3.0)
+    assert bucket.reserve(max_wait=1.0) is None
+
+
+def test_rate_limiter_queues_per_practice_and_rejects_long_queues():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=5, burst=1, overrides=parse_rate_limits("p-fast=100:10"), max_wait=1.0, clock=clock)
+    stats = UpstreamStats()
+
+    async def scenario():
+        for _ in range(3):
+            await limiter.acquire("p-slow", stats, clock.sleep)
+        for _ in range(10):
+            await limiter.acquire("p-fast", stats, clock.sleep)
+        limiter.pause("p-slow", 5)
+        await limiter.acquire("p-slow", stats, clock.sleep)
+
+    with pytest.raises(RateLimitedError):
+        asyncio.run(scenario())
+    assert clock.sleeps == pytest.approx([0.2, 0.2])
+    assert stats.queued == 2 and stats.rejected == 1
+
+
+def test_rate_limit_is_shared_by_the_worker_processes():
+    limiter = RateLimiter(rate=15, burst=30, overrides={"p-small": (2, 1)}, workers=3)
+    assert limiter.bucket("p1").interval == pytest.approx(1 / 5)
+    assert limiter.bucket("p1").tolerance == pytest.approx(9 / 5)
+    assert limiter.bucket("p-small").interval == pytest.approx(3 / 2)
+    assert limiter.bucket("p-small").tolerance == 0
+
+
+def test_429_holds_back_the_practice():
+    clock = FakeClock()
+
+    async def scenario():
+        async with FaultStub(429, "ok") as stub:
+            http = make_http(clock, rate=100)
+            throttled = await http.get(f"{stub.url}/Patient/p1", practice_id="195900")
+            await http.get(f"{stub.url}/Patient/p2", practice_id="195900")
+            await http.close()
+            return http, throttled
+
+    http, throttled = asyncio.run(scenario())
+    assert throttled.status_code == 429
+    assert clock.sleeps == pytest.approx([3.0])
+    assert http.stats.throttled == 1
+
+
+def test_open_circuit_maps_to_503(monkeypatch):
+    def refuse(request):
+        raise httpx.ConnectError("connection refused", request=request)
+
+    async def headers(practice_id):
+        return {"Authorization": "Bearer athena-token"}
+
+    http = make_http(failures=1, transport=httpx.MockTransport(refuse))
+    monkeypatch.setattr(main, "athena_fhir", AthenaFhirClient(base_url="https://fhir.test/r4", http_client=http,
+                                                              headers=headers))
+    with TestClient(app) as client:
+        response = client.get("/Patient/p1/$risk-assessment", headers=AUTH)
+
+    # The refused connection opened the breaker, so the retry failed fast
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "30"
+    assert response.json()["issue"][0]["code"] == "transient"